@@ -10,10 +10,32 @@ import os
 from dotenv import load_dotenv
 from langchain_core.messages import HumanMessage, AIMessage, BaseMessage
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 # --- Importaciones del Agente LangGraph ---
-from graph.perfil.memory import ensure_tables_exist, set_checkpointer_instance
+from graph.perfil.memory import (
+    inicializar_checkpointer, cerrar_checkpointer, obtener_estadisticas_pool_checkpointer, obtener_estadisticas_cache_checkpoints
+)
 from graph.perfil.builder import build_sequential_agent_graph
-from langgraph.checkpoint.postgres.aio import AsyncPostgresSaver
+from utils.search_cache import obtener_estadisticas_cache_busquedas
+from utils.bigquery_tools import obtener_estadisticas_plantillas_sql
+from utils.bq_client import inicializar_clientes_bq, cerrar_clientes_bq, obtener_estadisticas_clientes_bq, registro_clientes_bq
+from utils.bq_logger import PROJECT_ID as BQ_PROJECT_ID, detener_registrador_bq, obtener_estadisticas_registrador_bq
+from utils.cp_climate_index import obtener_indice_cp
+from utils.cp_extractor import obtener_estadisticas_extractor_cp
+from utils.structured_llm_cache import obtener_estadisticas_cache_llm
+from utils.profile_answer_parser import obtener_estadisticas_parser_perfil
+from utils.context_window import obtener_estadisticas_contexto
+from utils.ranking_cache import obtener_estadisticas_cache_rankings
+from utils.incremental_rerank import obtener_estadisticas_reranking_incremental
+from utils.state_delta import obtener_estadisticas_delta_estado
+from utils.weights_genome import obtener_estadisticas_genoma_pesos
+from utils.explanation_cache import guardar_cache_explicaciones, obtener_estadisticas_cache_explicaciones
+from utils.checkpoint_maintenance import (
+    construir_conn_string_postgres, bucle_mantenimiento_checkpoints, obtener_estadisticas_mantenimiento_checkpoints
+)
+from config.settings import CHECKPOINTS_MANTENIMIENTO_INTERVALO_SEG
+import asyncio
+import json
 
 # --- Configuración de Logging ---
 # En producción, considera cambiar level=logging.INFO
@@ -26,8 +48,7 @@ load_dotenv()
 
 # --- Variables Globales ---
 car_mentor_graph = None
-_checkpointer_context_manager = None
-_persistent_checkpointer_instance = None
+_tarea_mantenimiento_checkpoints = None
 # --- 1. Definimos los modelos para la respuesta estructurada ---
 
 class Car(BaseModel):
@@ -97,34 +118,34 @@ app.add_middleware(
 # --- Eventos de Startup y Shutdown ---
 @app.on_event("startup")
 async def startup_event():
-    global car_mentor_graph, _checkpointer_context_manager, _persistent_checkpointer_instance
+    global car_mentor_graph, _tarea_mantenimiento_checkpoints
     logger.info("Ejecutando evento de startup de FastAPI para CarBlau Agent...")
-    db_user = os.environ.get("DB_USER")
-    db_password = os.environ.get("DB_PASSWORD")
-    db_host = os.environ.get("DB_HOST")
-    db_port = os.environ.get("DB_PORT", "5432")
-    db_name = os.environ.get("DB_NAME")
-    
-    if not all([db_user, db_password, db_host, db_name]):
-        raise RuntimeError("Configuración de base de datos incompleta.")
-
-    conn_string = f"postgresql://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}"
-    if db_host.startswith("/cloudsql/"):
-        conn_string = f"dbname='{db_name}' user='{db_user}' password='{db_password}' host='{db_host}'"
+    conn_string = construir_conn_string_postgres()
 
-    await ensure_tables_exist(conn_string)
-    _checkpointer_context_manager = AsyncPostgresSaver.from_conn_string(conn_string)
-    _persistent_checkpointer_instance = await _checkpointer_context_manager.__aenter__()
-    set_checkpointer_instance(_persistent_checkpointer_instance)
+    # Pool de conexiones para el checkpointer (antes, una única conexión compartida por todas las conversaciones)
+    await inicializar_checkpointer(conn_string)
     car_mentor_graph = build_sequential_agent_graph()
+    # Clientes BigQuery compartidos: se crean aquí para no pagar credenciales/TLS en la primera conversación
+    await asyncio.to_thread(inicializar_clientes_bq, None, BQ_PROJECT_ID)
+    # Índice local de zonas climáticas: se mapea una vez para que buscar_info_clima_node no toque BQ
+    await asyncio.to_thread(obtener_indice_cp)
+    # Compactación/TTL de checkpoints dentro de la API (en Cloud Run es preferible un Job con el CLI)
+    if CHECKPOINTS_MANTENIMIENTO_INTERVALO_SEG > 0:
+        _tarea_mantenimiento_checkpoints = asyncio.create_task(
+            bucle_mantenimiento_checkpoints(conn_string, CHECKPOINTS_MANTENIMIENTO_INTERVALO_SEG)
+        )
     logger.info("¡EVENTO DE STARTUP COMPLETADO EXITOSAMENTE!")
 
 @app.on_event("shutdown")
 async def shutdown_event():
     # ... (Tu lógica de shutdown se mantiene igual, es correcta)
-    if _checkpointer_context_manager:
-        await _checkpointer_context_manager.__aexit__(None, None, None)
-        logger.info("Conexión del checkpointer cerrada.")
+    if _tarea_mantenimiento_checkpoints:
+        _tarea_mantenimiento_checkpoints.cancel()
+    await cerrar_checkpointer()
+    # Vaciar la cola de logs ANTES de cerrar los clientes BQ que usa el hilo de fondo
+    await asyncio.to_thread(detener_registrador_bq)
+    cerrar_clientes_bq()
+    guardar_cache_explicaciones()
 
 # --- Endpoints de la API ---
 @app.get("/", tags=["root"])
@@ -136,6 +157,115 @@ async def read_root():
 async def test_endpoint(): # ... (como antes)
     logger.info("Solicitud recibida en el endpoint de prueba ('/test').")
 
+@app.get("/metrics/cache-busquedas", tags=["metrics"])
+async def cache_busquedas_metrics():
+    """Aciertos/fallos y ocupación de la caché de resultados de búsqueda de coches."""
+    return obtener_estadisticas_cache_busquedas()
+
+@app.get("/metrics/bigquery", tags=["metrics"])
+async def bigquery_clients_metrics():
+    """Clientes BigQuery activos y tiempos de adquisición."""
+    return obtener_estadisticas_clientes_bq()
+
+
+@app.get("/metrics/plantillas-sql", tags=["metrics"])
+async def plantillas_sql_metrics():
+    """Plantillas SQL de búsqueda usadas: ejecuciones, aciertos de la caché de BigQuery y bytes procesados."""
+    return obtener_estadisticas_plantillas_sql()
+
+
+@app.get("/metrics/cache-explicaciones", tags=["metrics"])
+async def cache_explicaciones_metrics():
+    """Aciertos/fallos de la caché de explicaciones de coches."""
+    return obtener_estadisticas_cache_explicaciones()
+
+
+@app.get("/metrics/extractor-cp", tags=["metrics"])
+async def extractor_cp_metrics():
+    """Cuántos CPs se resolvieron con la regex y cuántos necesitaron al LLM."""
+    return obtener_estadisticas_extractor_cp()
+
+
+@app.get("/metrics/cache-llm", tags=["metrics"])
+async def cache_llm_metrics():
+    """Aciertos de la caché exacta de los LLMs estructurados (perfil, pasajeros)."""
+    return obtener_estadisticas_cache_llm()
+
+
+@app.get("/metrics/parser-perfil", tags=["metrics"])
+async def parser_perfil_metrics():
+    """Respuestas del perfil interpretadas sin LLM vs. delegadas a llm_solo_perfil, por campo."""
+    return obtener_estadisticas_parser_perfil()
+
+
+@app.get("/metrics/contexto-llm", tags=["metrics"])
+async def contexto_llm_metrics():
+    """Tokens de prompt por extractor (medios y máximos) tras aplicar la política de contexto."""
+    return obtener_estadisticas_contexto()
+
+
+@app.get("/metrics/cache-rankings", tags=["metrics"])
+async def cache_rankings_metrics():
+    """Rankings guardados para paginar ("ver más coches") y su ratio de aciertos."""
+    return obtener_estadisticas_cache_rankings()
+
+@app.get("/metrics/reranking-incremental", tags=["metrics"])
+async def reranking_incremental_metrics():
+    """Refinamientos reordenados sobre los candidatos en caché frente a búsquedas completas, por motivo."""
+    return obtener_estadisticas_reranking_incremental()
+
+@app.get("/metrics/delta-estado", tags=["metrics"])
+async def delta_estado_metrics():
+    """Claves que cada nodo devuelve sin cambiar el estado (requiere GUARDA_DELTA_ESTADO=true)."""
+    return obtener_estadisticas_delta_estado()
+
+@app.get("/metrics/pesos-genoma", tags=["metrics"])
+async def pesos_genoma_metrics():
+    """master_weights.yaml cargado en memoria: ruta, mtime y recargas en caliente."""
+    return obtener_estadisticas_genoma_pesos()
+
+@app.get("/metrics/checkpointer-pool", tags=["metrics"])
+async def checkpointer_pool_metrics():
+    """Pool de Postgres del checkpointer: conexiones, clientes esperando y tiempo medio de adquisición."""
+    return obtener_estadisticas_pool_checkpointer()
+
+@app.get("/metrics/cache-checkpoints", tags=["metrics"])
+async def cache_checkpoints_metrics():
+    """Caché write-through del último checkpoint por hilo: aciertos y escrituras diferidas pendientes."""
+    return obtener_estadisticas_cache_checkpoints()
+
+@app.get("/metrics/checkpoints", tags=["metrics"])
+async def checkpoints_metrics():
+    """Último informe del mantenimiento de checkpoints (filas y tamaño antes/después, hilos expirados)."""
+    return obtener_estadisticas_mantenimiento_checkpoints()
+
+
+@app.get("/metrics/bq-logger", tags=["metrics"])
+async def bq_logger_metrics():
+    """Estado de la cola de logs de búsqueda (insertadas, reintentos, spool)."""
+    return obtener_estadisticas_registrador_bq()
+
+
+@app.get("/health/bigquery", tags=["metrics"])
+async def bigquery_health():
+    """Healthcheck (SELECT 1) de cada cliente BigQuery registrado."""
+    resultado = await asyncio.to_thread(registro_clientes_bq.verificar_salud)
+    if not all(r.get("ok") for r in resultado.values()):
+        raise HTTPException(status_code=HTTPStatus.SERVICE_UNAVAILABLE, detail=resultado)
+    return resultado
+
+
+def _mensaje_a_api(msg: BaseMessage) -> Message:
+    message_data = {
+        "id": msg.id,
+        "role": "agent" if isinstance(msg, AIMessage) else "user",
+        "content": msg.content
+    }
+    if hasattr(msg, 'additional_kwargs') and msg.additional_kwargs:
+        message_data["additional_kwargs"] = msg.additional_kwargs
+    return Message(**message_data)
+
+
 # ✅ CORREGIDO: La ruta ahora es /start para coincidir con el frontend.
 @app.post("/start", response_model=StartConversationResponse, status_code=201, tags=["conversation"])
 async def start_conversation():
@@ -149,19 +279,8 @@ async def start_conversation():
     try:
         output = await car_mentor_graph.ainvoke({"messages": []}, config=config)
         
-        agent_response_messages: List[Message] = []
-        if output and "messages" in output:
-            for msg in output["messages"]:
-                # Usamos la misma lógica robusta de conversión aquí
-                message_data = {
-                    "id": msg.id,
-                    "role": "agent" if isinstance(msg, AIMessage) else "user",
-                    "content": msg.content
-                }
-                if hasattr(msg, 'additional_kwargs') and msg.additional_kwargs:
-                    message_data["additional_kwargs"] = msg.additional_kwargs
-                agent_response_messages.append(Message(**message_data))
-        
+        agent_response_messages: List[Message] = [_mensaje_a_api(msg) for msg in (output or {}).get("messages", [])]
+
         return StartConversationResponse(thread_id=thread_id, messages=agent_response_messages)
     except Exception as e:
         logger.error(f"Error al invocar grafo en /start: {e}", exc_info=True)
@@ -186,24 +305,7 @@ async def send_message(
         new_human_message = HumanMessage(content=user_content)
         output = await car_mentor_graph.ainvoke({"messages": [new_human_message]}, config=config)
         
-        agent_response_messages: List[Message] = []
-        if output and "messages" in output:
-            # ✅ INICIO DE LA LÓGICA DE CONVERSIÓN CORREGIDA
-            for msg in output["messages"]:
-                message_data = {
-                    "id": msg.id,
-                    "role": "agent" if isinstance(msg, AIMessage) else "user",
-                    "content": msg.content
-                }
-                
-                # Comprobamos si el mensaje tiene 'additional_kwargs' y no es nulo
-                if hasattr(msg, 'additional_kwargs') and msg.additional_kwargs:
-                    # Si los tiene, los añadimos al diccionario.
-                    message_data["additional_kwargs"] = msg.additional_kwargs
-
-                # Creamos la instancia del modelo Pydantic a partir del diccionario
-                agent_response_messages.append(Message(**message_data))
-            # ✅ FIN DE LA LÓGICA DE CONVERSIÓN
+        agent_response_messages: List[Message] = [_mensaje_a_api(msg) for msg in (output or {}).get("messages", [])]
 
         return AgentMessageResponse(thread_id=thread_id, messages=agent_response_messages)
     except Exception as e:
@@ -211,6 +313,89 @@ async def send_message(
         raise HTTPException(status_code=500, detail=f"Error interno del agente: {str(e)}")
 
 
+def _evento_sse(evento: str, datos: dict) -> str:
+    return f"event: {evento}\ndata: {json.dumps(datos, ensure_ascii=False)}\n\n"
+
+
+@app.post("/conversation/{thread_id}/message/stream", tags=["conversation"])
+async def send_message_stream(
+    message_request: UserMessageRequest,
+    thread_id: str = Path(...)
+):
+    """
+    Variante en streaming (Server-Sent Events) de /message. Emite:
+      - `node`: cada nodo del grafo al terminar ({"node": nombre}).
+      - `message`: cada mensaje nuevo del agente en cuanto se añade al estado (mismo formato que /message).
+      - `end` al terminar el turno, o `error` si falla.
+    Así el frontend puede mostrar el mensaje de transición antes de que acabe la búsqueda final.
+    """
+    if not car_mentor_graph:
+        raise HTTPException(status_code=HTTPStatus.SERVICE_UNAVAILABLE, detail="El servicio del agente no está disponible.")
+
+    if not message_request.messages or not message_request.messages[0].content.strip():
+        raise HTTPException(status_code=400, detail="El contenido del mensaje no puede estar vacío.")
+
+    user_content = message_request.messages[0].content
+    config = {"configurable": {"thread_id": thread_id}}
+    logger.info(f"Continuando (stream) {thread_id}. Usuario: {user_content}")
+
+    async def generar_eventos():
+        try:
+            # Los mensajes que ya estaban en el checkpoint no se reenvían
+            estado_previo = await car_mentor_graph.aget_state(config)
+            ids_enviados = {m.id for m in (estado_previo.values or {}).get("messages", [])}
+            async for modo, chunk in car_mentor_graph.astream(
+                {"messages": [HumanMessage(content=user_content)]},
+                config=config,
+                stream_mode=["updates", "values"],
+            ):
+                if modo == "updates":
+                    for nodo in chunk:
+                        if not nodo.startswith("__"):
+                            yield _evento_sse("node", {"node": nodo})
+                    continue
+                for msg in chunk.get("messages", []):
+                    if msg.id in ids_enviados:
+                        continue
+                    ids_enviados.add(msg.id)
+                    if isinstance(msg, AIMessage):
+                        yield _evento_sse("message", _mensaje_a_api(msg).model_dump(mode="json"))
+            yield _evento_sse("end", {"thread_id": thread_id})
+        except Exception as e:
+            logger.error(f"Error al invocar grafo en /message/stream: {e}", exc_info=True)
+            yield _evento_sse("error", {"detail": f"Error interno del agente: {str(e)}"})
+
+    return StreamingResponse(
+        generar_eventos(),
+        media_type="text/event-stream",
+        # Sin caché ni buffering en proxies (nginx) para que cada evento llegue al momento
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.post("/conversation/{thread_id}/more-cars", response_model=AgentMessageResponse, tags=["conversation"])
+async def more_cars(thread_id: str = Path(...)):
+    """
+    Siguiente página de recomendaciones. Equivale a que el usuario escriba "Ver más coches":
+    el router lo detecta y el grafo va directo a mostrar_mas_coches (sin extractores ni finalización).
+    """
+    if not car_mentor_graph:
+        raise HTTPException(status_code=HTTPStatus.SERVICE_UNAVAILABLE, detail="El servicio del agente no está disponible.")
+
+    config = {"configurable": {"thread_id": thread_id}}
+    estado = await car_mentor_graph.aget_state(config)
+    if not (estado.values or {}).get("coches_recomendados"):
+        raise HTTPException(status_code=HTTPStatus.CONFLICT, detail="La conversación todavía no tiene recomendaciones que paginar.")
+
+    logger.info(f"Siguiente página de coches para {thread_id}.")
+    try:
+        output = await car_mentor_graph.ainvoke({"messages": [HumanMessage(content="Ver más coches")]}, config=config)
+        agent_response_messages = [_mensaje_a_api(msg) for msg in (output or {}).get("messages", [])]
+        return AgentMessageResponse(thread_id=thread_id, messages=agent_response_messages)
+    except Exception as e:
+        logger.error(f"Error al invocar grafo en /more-cars: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Error interno del agente: {str(e)}")
+
 # @app.post("/conversation/{thread_id}/message", response_model=AgentMessageResponse, tags=["conversation"])
 # async def send_message(
 #     message_request: UserMessageRequest,
@@ -0,0 +1,124 @@
+# benchmark_finalizacion.py
+# Compara la latencia de la etapa de finalización con la cadena secuencial y con el fan-out.
+#
+# Ejecuta solo los nodos de cálculo (modo1, filtros, km, flags, pesos, tabla) sobre un perfil
+# completo de ejemplo; buscar_coches_finales se sustituye por un nodo vacío porque su coste es
+# idéntico en las dos topologías. Cada checkpoint escrito añade --latencia-checkpoint-ms para
+# simular el round-trip a Postgres (Cloud SQL), que es lo que de verdad ahorra quitar supersteps.
+#
+# Uso:
+#   python benchmark_finalizacion.py --iteraciones 50 --latencia-checkpoint-ms 15
+import argparse
+import asyncio
+import statistics
+import time
+import uuid
+
+from langgraph.checkpoint.memory import InMemorySaver
+from langgraph.graph import StateGraph, START, END
+
+from graph.perfil.builder import NODOS_INICIO_FINALIZACION, conectar_finalizacion
+from graph.perfil.nodes import (
+    calcular_recomendacion_economia_modo1_node, construir_filtros_node, calcular_km_anuales_postprocessing_node,
+    calcular_flags_dinamicos_node, calcular_pesos_finales_node, formatear_tabla_resumen_node
+)
+from graph.perfil.state import EstadoAnalisisPerfil, PerfilUsuario, InfoPasajeros, InfoClimaUsuario, EconomiaUsuario
+from utils.enums import (
+    FrecuenciaUso, DistanciaTrayecto, FrecuenciaViajesLargos, NivelAventura, EstiloConduccion, Transmision
+)
+
+
+class CheckpointerConLatencia(InMemorySaver):
+    """InMemorySaver que cuenta los checkpoints y simula la latencia de escritura de Postgres."""
+
+    def __init__(self, latencia_seg: float):
+        super().__init__()
+        self.latencia_seg = latencia_seg
+        self.escrituras = 0
+
+    async def aput(self, config, checkpoint, metadata, new_versions):
+        self.escrituras += 1
+        await asyncio.sleep(self.latencia_seg)
+        return await super().aput(config, checkpoint, metadata, new_versions)
+
+
+def estado_de_ejemplo() -> dict:
+    return {
+        "messages": [],
+        "codigo_postal_usuario": "28001",
+        "info_clima_usuario": InfoClimaUsuario(cp_valido_encontrado=True, codigo_postal_consultado="28001"),
+        "preferencias_usuario": PerfilUsuario(
+            apasionado_motor="no", valora_estetica="sí", coche_principal_hogar="sí",
+            frecuencia_uso=FrecuenciaUso.DIARIO, distancia_trayecto=DistanciaTrayecto.ENTRE_10_Y_50_KM,
+            realiza_viajes_largos="sí", frecuencia_viajes_largos=FrecuenciaViajesLargos.OCASIONALMENTE,
+            circula_principalmente_ciudad="sí", uso_profesional="no", prefiere_diseno_exclusivo="no",
+            altura_mayor_190="no", transporta_carga_voluminosa="sí", necesita_espacio_objetos_especiales="no",
+            arrastra_remolque="no", tiene_garage="sí", espacio_sobra_garage="sí", tiene_punto_carga_propio="no",
+            aventura=NivelAventura.ninguna, estilo_conduccion=EstiloConduccion.TRANQUILO, solo_electricos="no",
+            prioriza_baja_depreciacion="sí", transmision_preferida=Transmision.AUTOMATICO,
+            rating_fiabilidad_durabilidad=8, rating_seguridad=9, rating_comodidad=7,
+            rating_impacto_ambiental=6, rating_tecnologia_conectividad=5, rating_costes_uso=8,
+        ),
+        "info_pasajeros": InfoPasajeros(
+            suele_llevar_acompanantes=True, frecuencia_viaje_con_acompanantes="frecuente",
+            num_ninos_silla=1, num_otros_pasajeros=1,
+        ),
+        "economia": EconomiaUsuario(presupuesto_definido=True, tipo_presupuesto="contado", pago_contado=30000),
+        "penalizar_puertas_bajas": True,
+    }
+
+
+def construir_grafo_finalizacion(en_paralelo: bool, checkpointer: InMemorySaver):
+    workflow = StateGraph(EstadoAnalisisPerfil)
+    workflow.add_node("calcular_recomendacion_economia_modo1", calcular_recomendacion_economia_modo1_node)
+    workflow.add_node("construir_filtros", construir_filtros_node)
+    workflow.add_node("calcular_km_anuales_postprocessing", calcular_km_anuales_postprocessing_node)
+    workflow.add_node("calcular_flags_dinamicos", calcular_flags_dinamicos_node)
+    workflow.add_node("calcular_pesos_finales", calcular_pesos_finales_node)
+    workflow.add_node("formatear_tabla_resumen", formatear_tabla_resumen_node)
+    workflow.add_node("buscar_coches_finales", lambda state: {})
+    for nodo in (NODOS_INICIO_FINALIZACION if en_paralelo else NODOS_INICIO_FINALIZACION[:1]):
+        workflow.add_edge(START, nodo)
+    conectar_finalizacion(workflow, en_paralelo)
+    workflow.add_edge("buscar_coches_finales", END)
+    return workflow.compile(checkpointer=checkpointer)
+
+
+async def medir(en_paralelo: bool, iteraciones: int, latencia_seg: float) -> dict:
+    checkpointer = CheckpointerConLatencia(latencia_seg)
+    grafo = construir_grafo_finalizacion(en_paralelo, checkpointer)
+    tiempos_ms = []
+    pesos = None
+    for _ in range(iteraciones):
+        config = {"configurable": {"thread_id": str(uuid.uuid4())}}
+        inicio = time.perf_counter()
+        salida = await grafo.ainvoke(estado_de_ejemplo(), config=config)
+        tiempos_ms.append((time.perf_counter() - inicio) * 1000)
+        pesos = salida.get("pesos")
+    tiempos_ms.sort()
+    return {
+        "mediana_ms": statistics.median(tiempos_ms),
+        "p95_ms": tiempos_ms[int(0.95 * (len(tiempos_ms) - 1))],
+        "checkpoints_por_turno": checkpointer.escrituras / iteraciones,
+        "pesos": pesos,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Latencia de la finalización: cadena secuencial vs. fan-out.")
+    parser.add_argument("--iteraciones", type=int, default=50)
+    parser.add_argument("--latencia-checkpoint-ms", type=float, default=15.0)
+    args = parser.parse_args()
+
+    latencia_seg = args.latencia_checkpoint_ms / 1000
+    secuencial = await medir(False, args.iteraciones, latencia_seg)
+    paralelo = await medir(True, args.iteraciones, latencia_seg)
+
+    print(f"\n--- Finalización ({args.iteraciones} iteraciones, {args.latencia_checkpoint_ms} ms por checkpoint) ---")
+    for nombre, r in (("Secuencial", secuencial), ("Fan-out", paralelo)):
+        print(f"{nombre:<11} mediana {r['mediana_ms']:8.1f} ms | p95 {r['p95_ms']:8.1f} ms | {r['checkpoints_por_turno']:.0f} checkpoints")
+    print(f"Mismos pesos en las dos topologías: {secuencial['pesos'] == paralelo['pesos']}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -2,6 +2,7 @@
 from langchain.chat_models import init_chat_model
 from graph.perfil.state import PerfilUsuario, ResultadoSoloFiltros, EconomiaUsuario, CodigoPostalExtraido, InfoPasajeros# Ajusta la ruta de importación
 from dotenv import load_dotenv
+from utils.structured_llm_cache import envolver_con_cache
 import logging
 
 load_dotenv()
@@ -89,11 +90,13 @@ if llm and llm_potente and llm_res:
     llm_cp_extractor = llm.with_structured_output(
         CodigoPostalExtraido, method="function_calling"
     )
-    llm_solo_perfil = llm.with_structured_output(
-        PerfilUsuario, method="function_calling"
+    # Perfil y pasajeros reciben preguntas fijas + respuestas cortas: se cachean por el contexto completo
+    # enviado (prompt + huella de todos los mensajes, rol y contenido normalizado), no solo el último turno
+    llm_solo_perfil = envolver_con_cache(
+        llm.with_structured_output(PerfilUsuario, method="function_calling"), "llm_solo_perfil"
     )
-    llm_pasajeros = llm.with_structured_output(
-        InfoPasajeros, method="function_calling"
+    llm_pasajeros = envolver_con_cache(
+        llm.with_structured_output(InfoPasajeros, method="function_calling"), "llm_pasajeros"
     )
     llm_solo_filtros = llm.with_structured_output(
         ResultadoSoloFiltros, method="function_calling"
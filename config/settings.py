@@ -445,3 +445,153 @@ MAPA_REALIZA_VIAJES_LARGOS_KM = {
 # obtendrá 85 puntos base.
 FACTOR_ESCALA_BASE = 100.0
 
+
+# --- MOTOR DE BÚSQUEDA DE COCHES (`graph/perfil/nodes.py` -> buscar_coches_finales_node) ---
+# "bigquery": ejecuta la query de scoring en BigQuery (utils/bigquery_tools.py).
+# "numpy": puntúa el catálogo cargado en memoria (utils/numpy_scoring.py), sin query facturada por usuario.
+MOTOR_BUSQUEDA_COCHES = os.getenv("MOTOR_BUSQUEDA_COCHES", "bigquery").strip().lower()
+# Tabla del catálogo de coches sobre la que puntúan ambos motores.
+TABLA_COCHES_BQ = os.getenv("TABLA_COCHES_BQ", "thecarmentor-mvp2.web_cars.coches_prueba_2")
+
+# --- CARACTERÍSTICAS ESCALADAS MATERIALIZADAS (`utils/scaled_features.py`) ---
+# Tabla derivada con las columnas *_scaled precalculadas (se regenera con `python -m utils.scaled_features`).
+TABLA_COCHES_ESCALADOS_BQ = os.getenv("TABLA_COCHES_ESCALADOS_BQ", "thecarmentor-mvp2.web_cars.coches_prueba_2_scaled")
+# Si es False, la búsqueda siempre escala al vuelo sobre TABLA_COCHES_BQ.
+USAR_TABLA_ESCALADA = os.getenv("USAR_TABLA_ESCALADA", "true").lower() == "true"
+# Snapshot local (parquet) del catálogo escalado para el motor NumPy.
+SNAPSHOT_COCHES_ESCALADOS_PATH = os.getenv("SNAPSHOT_COCHES_ESCALADOS_PATH", "data/coches_escalados.parquet")
+# Cada cuánto se vuelve a comprobar que la tabla materializada sigue vigente (segundos).
+TTL_VERIFICACION_TABLA_ESCALADA_SEG = int(os.getenv("TTL_VERIFICACION_TABLA_ESCALADA_SEG", "300"))
+
+# --- CACHÉ DE RESULTADOS DE BÚSQUEDA (`utils/search_cache.py`) ---
+CACHE_BUSQUEDAS_ACTIVA = os.getenv("CACHE_BUSQUEDAS_ACTIVA", "true").lower() == "true"
+CACHE_BUSQUEDAS_MAX_ENTRADAS = int(os.getenv("CACHE_BUSQUEDAS_MAX_ENTRADAS", "512"))
+CACHE_BUSQUEDAS_TTL_SEG = int(os.getenv("CACHE_BUSQUEDAS_TTL_SEG", "3600"))
+# Opcional: backend compartido entre instancias (p. ej. redis://10.0.0.3:6379/0). Requiere el paquete 'redis'.
+CACHE_BUSQUEDAS_REDIS_URL = os.getenv("CACHE_BUSQUEDAS_REDIS_URL")
+
+# --- CLIENTES BIGQUERY COMPARTIDOS (`utils/bq_client.py`) ---
+# Conexiones HTTP keep-alive que mantiene abiertas cada cliente (una por petición concurrente a BQ).
+BQ_POOL_CONEXIONES = int(os.getenv("BQ_POOL_CONEXIONES", "20"))
+BQ_TIMEOUT_HEALTHCHECK_SEG = float(os.getenv("BQ_TIMEOUT_HEALTHCHECK_SEG", "10"))
+
+# --- ÍNDICE LOCAL DE ZONAS CLIMÁTICAS POR CP (`utils/cp_climate_index.py`) ---
+# Fichero binario memory-mapped (1 byte por CP) que se regenera con `python -m utils.cp_climate_index`.
+CP_CLIMA_INDEX_PATH = os.getenv("CP_CLIMA_INDEX_PATH", "data/cp_zonas_clima.idx")
+# Con el índice vigente, un CP que no aparece en él no tiene zonas (todo False) y no se consulta BQ.
+# Un índice más antiguo que CP_CLIMA_INDEX_MAX_DIAS se considera caducado.
+CP_CLIMA_INDEX_MAX_DIAS = float(os.getenv("CP_CLIMA_INDEX_MAX_DIAS", "30"))
+# Si no hay índice, o está caducado, se consulta BigQuery como antes.
+CP_CLIMA_FALLBACK_BQ = os.getenv("CP_CLIMA_FALLBACK_BQ", "true").lower() == "true"
+
+# --- LOG DE BÚSQUEDAS EN SEGUNDO PLANO (`utils/bq_logger.py`) ---
+LOG_BQ_MAX_COLA = int(os.getenv("LOG_BQ_MAX_COLA", "1000"))
+# Se inserta un lote al llegar a LOG_BQ_TAMANO_LOTE filas o LOG_BQ_INTERVALO_FLUSH_SEG segundos desde la primera.
+LOG_BQ_TAMANO_LOTE = int(os.getenv("LOG_BQ_TAMANO_LOTE", "50"))
+LOG_BQ_INTERVALO_FLUSH_SEG = float(os.getenv("LOG_BQ_INTERVALO_FLUSH_SEG", "5"))
+LOG_BQ_MAX_REINTENTOS = int(os.getenv("LOG_BQ_MAX_REINTENTOS", "3"))
+LOG_BQ_BACKOFF_BASE_SEG = float(os.getenv("LOG_BQ_BACKOFF_BASE_SEG", "0.5"))
+# Filas que no se pudieron insertar (BQ caído o cola llena); se reenvían automáticamente.
+LOG_BQ_SPOOL_PATH = os.getenv("LOG_BQ_SPOOL_PATH", "data/spool_logs_busquedas.jsonl")
+# Filas que BigQuery rechaza por inválidas (p. ej. error de esquema); no se reintentan.
+LOG_BQ_DESCARTADAS_PATH = os.getenv("LOG_BQ_DESCARTADAS_PATH", "data/logs_busquedas_descartadas.jsonl")
+
+# --- EXPLICACIONES POR COCHE (`utils/explanation_generator.py`) ---
+# Si está activo, buscar_coches_finales_node rellena el "analysis" de cada coche con el LLM.
+EXPLICACIONES_COCHES_ACTIVAS = os.getenv("EXPLICACIONES_COCHES_ACTIVAS", "false").lower() == "true"
+EXPLICACIONES_MAX_CONCURRENCIA = int(os.getenv("EXPLICACIONES_MAX_CONCURRENCIA", "7"))
+# Timeout por llamada; si se supera, ese coche recibe un texto determinista.
+EXPLICACIONES_TIMEOUT_SEG = float(os.getenv("EXPLICACIONES_TIMEOUT_SEG", "8"))
+
+# --- CACHÉ DE EXPLICACIONES (`utils/explanation_cache.py`) ---
+CACHE_EXPLICACIONES_ACTIVA = os.getenv("CACHE_EXPLICACIONES_ACTIVA", "true").lower() == "true"
+CACHE_EXPLICACIONES_MAX_ENTRADAS = int(os.getenv("CACHE_EXPLICACIONES_MAX_ENTRADAS", "2000"))
+CACHE_EXPLICACIONES_TTL_SEG = int(os.getenv("CACHE_EXPLICACIONES_TTL_SEG", str(7 * 24 * 3600)))
+# Fichero JSON donde se persiste la caché entre reinicios (vacío = solo memoria).
+CACHE_EXPLICACIONES_PATH = os.getenv("CACHE_EXPLICACIONES_PATH", "data/cache_explicaciones.json")
+
+# --- CACHÉ EXACTA DE LLMs ESTRUCTURADOS (`utils/structured_llm_cache.py`) ---
+CACHE_LLM_ESTRUCTURADO_ACTIVA = os.getenv("CACHE_LLM_ESTRUCTURADO_ACTIVA", "true").lower() == "true"
+CACHE_LLM_ESTRUCTURADO_MAX_ENTRADAS = int(os.getenv("CACHE_LLM_ESTRUCTURADO_MAX_ENTRADAS", "4096"))
+
+# --- CONTEXTO DE LOS LLMs EXTRACTORES (`utils/context_window.py`) ---
+# Presupuesto de tokens del prompt (system + historial) por llamada; se descartan los mensajes más antiguos.
+CONTEXTO_LLM_MAX_TOKENS = int(os.getenv("CONTEXTO_LLM_MAX_TOKENS", "3000"))
+# Máximo de mensajes del historial dentro de la ventana de etapa (pasajeros).
+CONTEXTO_LLM_ULTIMOS_N = int(os.getenv("CONTEXTO_LLM_ULTIMOS_N", "8"))
+# o200k_base es el encoding de gpt-4o / gpt-4o-mini
+CONTEXTO_LLM_ENCODING = os.getenv("CONTEXTO_LLM_ENCODING", "o200k_base")
+
+# --- PAGINACIÓN DE RECOMENDACIONES (`utils/ranking_cache.py`) ---
+PAGINACION_COCHES_POR_PAGINA = int(os.getenv("PAGINACION_COCHES_POR_PAGINA", "7"))
+# Coches que se piden al motor en la búsqueda final (páginas disponibles = MAX / POR_PAGINA).
+PAGINACION_MAX_COCHES = int(os.getenv("PAGINACION_MAX_COCHES", "35"))
+PAGINACION_CACHE_MAX_CONVERSACIONES = int(os.getenv("PAGINACION_CACHE_MAX_CONVERSACIONES", "1000"))
+PAGINACION_CACHE_TTL_SEG = int(os.getenv("PAGINACION_CACHE_TTL_SEG", "3600"))
+
+# --- FINALIZACIÓN EN PARALELO (`graph/perfil/builder.py`) ---
+# Si está activo, los nodos de finalización independientes comparten superstep (4 checkpoints en vez de 7).
+FINALIZACION_EN_PARALELO = os.getenv("FINALIZACION_EN_PARALELO", "true").lower() == "true"
+
+# --- GUARDA DE DELTAS DEL ESTADO (`utils/state_delta.py`) ---
+# Si está activo, cada nodo se envuelve y se avisa cuando devuelve claves que no cambian el estado.
+GUARDA_DELTA_ESTADO = os.getenv("GUARDA_DELTA_ESTADO", "false").lower() == "true"
+
+# --- MANTENIMIENTO DEL CHECKPOINTER (`utils/checkpoint_maintenance.py`) ---
+# Checkpoints que se conservan por hilo (para retomar la conversación basta con el último).
+CHECKPOINTS_MANTENER_POR_HILO = int(os.getenv("CHECKPOINTS_MANTENER_POR_HILO", "5"))
+# Hilos sin actividad durante más de estos días se borran por completo.
+CHECKPOINTS_TTL_HILO_DIAS = int(os.getenv("CHECKPOINTS_TTL_HILO_DIAS", "30"))
+CHECKPOINTS_LOTE_HILOS = int(os.getenv("CHECKPOINTS_LOTE_HILOS", "500"))
+# No se compactan hilos con actividad más reciente que este margen (turno en curso).
+CHECKPOINTS_MARGEN_INACTIVIDAD_MIN = int(os.getenv("CHECKPOINTS_MARGEN_INACTIVIDAD_MIN", "10"))
+CHECKPOINTS_PAUSA_ENTRE_LOTES_SEG = float(os.getenv("CHECKPOINTS_PAUSA_ENTRE_LOTES_SEG", "0.2"))
+# Si es > 0, la API lanza el mantenimiento cada N segundos (0 = solo CLI / Cloud Run Job).
+CHECKPOINTS_MANTENIMIENTO_INTERVALO_SEG = int(os.getenv("CHECKPOINTS_MANTENIMIENTO_INTERVALO_SEG", "0"))
+
+# --- POOL DEL CHECKPOINTER (`graph/perfil/memory.py`) ---
+CHECKPOINTER_POOL_MIN = int(os.getenv("CHECKPOINTER_POOL_MIN", "2"))
+# max * nº de instancias de Cloud Run debe quedar por debajo de max_connections de Cloud SQL.
+CHECKPOINTER_POOL_MAX = int(os.getenv("CHECKPOINTER_POOL_MAX", "10"))
+# Espera máxima para obtener una conexión antes de fallar el turno.
+CHECKPOINTER_POOL_TIMEOUT_SEG = float(os.getenv("CHECKPOINTER_POOL_TIMEOUT_SEG", "10"))
+CHECKPOINTER_POOL_MAX_IDLE_SEG = float(os.getenv("CHECKPOINTER_POOL_MAX_IDLE_SEG", "300"))
+# Ejecuciones de una query antes de prepararla en el servidor ("none" = sin prepared statements, p. ej. con PgBouncer).
+CHECKPOINTER_PREPARE_THRESHOLD = os.getenv("CHECKPOINTER_PREPARE_THRESHOLD", "5")
+
+# --- CACHÉ DE CHECKPOINTS (`graph/perfil/memory.py`) ---
+# Solo es segura con afinidad de sesión (cada hilo atendido siempre por la misma instancia).
+CACHE_CHECKPOINTS_ACTIVA = os.getenv("CACHE_CHECKPOINTS_ACTIVA", "false").lower() == "true"
+CACHE_CHECKPOINTS_MAX_HILOS = int(os.getenv("CACHE_CHECKPOINTS_MAX_HILOS", "2000"))
+CACHE_CHECKPOINTS_TTL_SEG = int(os.getenv("CACHE_CHECKPOINTS_TTL_SEG", "1800"))
+# true = aput no espera a Postgres (menos durable: un crash puede perder los últimos checkpoints).
+CACHE_CHECKPOINTS_ESCRITURA_ASINCRONA = os.getenv("CACHE_CHECKPOINTS_ESCRITURA_ASINCRONA", "false").lower() == "true"
+
+# --- GENOMA DE PESOS BASE (`utils/weights_genome.py`) ---
+# Ruta relativa a la raíz del proyecto (no al directorio de trabajo) o absoluta.
+MASTER_WEIGHTS_PATH = os.getenv("MASTER_WEIGHTS_PATH", "master_weights.yaml")
+# Cada cuánto se mira el mtime del fichero para recargarlo en caliente.
+MASTER_WEIGHTS_INTERVALO_COMPROBACION_SEG = float(os.getenv("MASTER_WEIGHTS_INTERVALO_COMPROBACION_SEG", "5"))
+
+# --- SCORING POR LOTES (`utils/batch_scoring.py`) ---
+# Perfiles por multiplicación matricial: la matriz de scores es (bloque x coches) float64.
+BATCH_SCORING_BLOQUE_PERFILES = int(os.getenv("BATCH_SCORING_BLOQUE_PERFILES", "256"))
+
+# --- RE-RANKING INCREMENTAL POR SESIÓN (`utils/incremental_rerank.py`) ---
+# Si está activo, los refinamientos (un peso, un flag, el presupuesto) se reordenan sobre los
+# candidatos en caché de la última búsqueda del hilo, sin volver a lanzar la query.
+# Solo se aplica con MOTOR_BUSQUEDA_COCHES = "numpy": con "bigquery" la primera búsqueda de cada
+# instancia tendría que descargar el catálogo completo dentro de la petición.
+RERANK_INCREMENTAL_ACTIVO = os.getenv("RERANK_INCREMENTAL_ACTIVO", "true").lower() == "true"
+# Cada sesión guarda ~75 columnas float64 por candidato: acotar según la memoria de la instancia.
+RERANK_INCREMENTAL_MAX_SESIONES = int(os.getenv("RERANK_INCREMENTAL_MAX_SESIONES", "300"))
+RERANK_INCREMENTAL_TTL_SEG = int(os.getenv("RERANK_INCREMENTAL_TTL_SEG", "1800"))
+# Los candidatos cubren el rango de presupuesto ampliado este porcentaje por cada lado
+# (0.5 = de la mitad del mínimo a 1,5 veces el máximo); fuera de él se repite la búsqueda.
+RERANK_INCREMENTAL_MARGEN_PRESUPUESTO = float(os.getenv("RERANK_INCREMENTAL_MARGEN_PRESUPUESTO", "0.5"))
+
+# --- REFINAMIENTO DE LA BÚSQUEDA TRAS ENSEÑAR COCHES (`graph/perfil/nodes.py`) ---
+# "más baratos" / "más caros" multiplican el presupuesto (contado o cuota) por estos factores
+# y repiten buscar_coches_finales con el resto del estado tal cual.
+REFINAMIENTO_FACTOR_MAS_BARATO = float(os.getenv("REFINAMIENTO_FACTOR_MAS_BARATO", "0.85"))
+REFINAMIENTO_FACTOR_MAS_CARO = float(os.getenv("REFINAMIENTO_FACTOR_MAS_CARO", "1.15"))
@@ -6,37 +6,124 @@ from graph.perfil.nodes import ( saludo_y_pregunta_inicial_node, recopilar_cp_no
     recopilar_preferencias_node, generar_mensaje_transicion_perfil, construir_filtros_node,recopilar_economia_node, preguntar_economia_node,
     preguntar_preferencias_node, preguntar_economia_node,buscar_coches_finales_node, generar_mensaje_transicion_pasajeros,
     recopilar_info_pasajeros_node, preguntar_info_pasajeros_node,aplicar_filtros_pasajeros_node, calcular_recomendacion_economia_modo1_node,
-    calcular_flags_dinamicos_node,calcular_pesos_finales_node,formatear_tabla_resumen_node, calcular_km_anuales_postprocessing_node)
+    calcular_flags_dinamicos_node,calcular_pesos_finales_node,formatear_tabla_resumen_node, calcular_km_anuales_postprocessing_node,
+    recopilar_cp_node_async, buscar_info_clima_node_async, recopilar_preferencias_node_async, recopilar_info_pasajeros_node_async,
+    recopilar_economia_node_async, buscar_coches_finales_node_async, mostrar_mas_coches_node, mostrar_mas_coches_node_async,
+    refinar_busqueda_node)
 from graph.perfil.memory import get_memory 
 from graph.perfil.condition import (ruta_decision_cp_refactorizada, decidir_siguiente_paso_economia, decidir_siguiente_paso_perfil, decidir_siguiente_paso_pasajeros, 
                                     decidir_ruta_inicial, route_based_on_state_node)
+from langchain_core.runnables import RunnableLambda
+from config.settings import FINALIZACION_EN_PARALELO, GUARDA_DELTA_ESTADO
+from utils.state_delta import verificar_delta
 import logging
 
+# Nodos de finalización que no dependen entre sí y arrancan en el mismo superstep:
+# calcular_km_anuales_postprocessing y calcular_flags_dinamicos solo leen preferencias/clima/pasajeros,
+# así que no tienen por qué esperar a los filtros.
+NODOS_INICIO_FINALIZACION = [
+    "calcular_recomendacion_economia_modo1",
+    "calcular_km_anuales_postprocessing",
+    "calcular_flags_dinamicos",
+]
 
-def build_sequential_agent_graph(): 
+
+def _nodo_sync_async(func, afunc, nombre: str) -> RunnableLambda:
+    """
+    Nodo con las dos implementaciones: ainvoke (API FastAPI) usa la async y no bloquea el
+    event loop mientras espera al LLM/BigQuery; invoke (scripts como pruebas_carV1.py) usa la sync.
+    """
+    return RunnableLambda(func, afunc=afunc, name=nombre)
+
+
+def _ruta_con_fan_out(decision):
+    """Convierte la decisión "iniciar_finalizacion" en la lista de nodos que arrancan en paralelo."""
+    def ruta(state: EstadoAnalisisPerfil):
+        destino = decision(state)
+        return list(NODOS_INICIO_FINALIZACION) if destino == "iniciar_finalizacion" else destino
+    ruta.__name__ = decision.__name__
+    return ruta
+
+
+def conectar_finalizacion(workflow: StateGraph, en_paralelo: bool) -> None:
+    """
+    Aristas de la etapa de finalización (de calcular_recomendacion_economia_modo1 a buscar_coches_finales).
+
+    Secuencial (7 supersteps, un checkpoint por cada uno):
+        modo1 -> construir_filtros -> km_anuales -> flags -> pesos -> tabla -> buscar_coches
+    En paralelo (4 supersteps), según lo que lee cada nodo:
+        1. modo1 | km_anuales | flags      (economía, preferencias, clima, pasajeros)
+        2. construir_filtros               (filtros de modo1)
+        3. pesos | tabla                   (filtros + km_anuales)
+        4. buscar_coches                   (todo lo anterior)
+    Ningún par de nodos del mismo superstep escribe la misma clave del estado.
+    """
+    if not en_paralelo:
+        workflow.add_edge("calcular_recomendacion_economia_modo1", "construir_filtros")
+        workflow.add_edge("construir_filtros", "calcular_km_anuales_postprocessing")
+        workflow.add_edge("calcular_km_anuales_postprocessing", "calcular_flags_dinamicos")
+        workflow.add_edge("calcular_flags_dinamicos", "calcular_pesos_finales")
+        workflow.add_edge("calcular_pesos_finales", "formatear_tabla_resumen")
+        workflow.add_edge("formatear_tabla_resumen", "buscar_coches_finales")
+        return
+    workflow.add_edge("calcular_recomendacion_economia_modo1", "construir_filtros")
+    # Las aristas con varios orígenes esperan a que terminen TODOS (fan-in)
+    workflow.add_edge(["construir_filtros", "calcular_km_anuales_postprocessing"], "calcular_pesos_finales")
+    workflow.add_edge("construir_filtros", "formatear_tabla_resumen")
+    workflow.add_edge(["calcular_flags_dinamicos", "calcular_pesos_finales", "formatear_tabla_resumen"], "buscar_coches_finales")
+
+
+def _con_guarda_delta(nombre: str, nodo):
+    """Envuelve el runnable de un nodo para comprobar que solo devuelve lo que cambia."""
+    def func(state: EstadoAnalisisPerfil, config):
+        delta = nodo.invoke(state, config)
+        verificar_delta(nombre, state, delta)
+        return delta
+
+    async def afunc(state: EstadoAnalisisPerfil, config):
+        delta = await nodo.ainvoke(state, config)
+        verificar_delta(nombre, state, delta)
+        return delta
+
+    return RunnableLambda(func, afunc=afunc, name=nombre)
+
+
+def aplicar_guarda_delta(workflow: StateGraph) -> None:
+    """Activa utils/state_delta.py en todos los nodos ya añadidos al workflow."""
+    # StateNodeSpec es un NamedTuple: se sustituye la entrada en vez de mutarla
+    for nombre, spec in list(workflow.nodes.items()):
+        workflow.nodes[nombre] = spec._replace(runnable=_con_guarda_delta(nombre, spec.runnable))
+    logging.info(f"INFO (Builder) ► Guarda de deltas activa en {len(workflow.nodes)} nodos.")
+
+
+def build_sequential_agent_graph(finalizacion_en_paralelo: bool = FINALIZACION_EN_PARALELO, guarda_delta: bool = GUARDA_DELTA_ESTADO): 
     workflow = StateGraph(EstadoAnalisisPerfil)
+    # Con la finalización en paralelo, la entrada a la etapa lanza varios nodos a la vez
+    envolver_ruta = _ruta_con_fan_out if finalizacion_en_paralelo else (lambda decision: decision)
+    destinos_finalizacion = {nodo: nodo for nodo in NODOS_INICIO_FINALIZACION} if finalizacion_en_paralelo else {}
 
     # --- 1. Añadir todos los nodos ---
+    # Los nodos con LLM o BigQuery tienen variante async; el resto son cálculos en memoria de pocos ms.
     workflow.add_node("saludo_y_pregunta_inicial", saludo_y_pregunta_inicial_node)
     # (Tu lista de nodos es correcta, la mantenemos) 
     workflow.add_node("router", route_based_on_state_node)
-    workflow.add_node("recopilar_cp", recopilar_cp_node)
+    workflow.add_node("recopilar_cp", _nodo_sync_async(recopilar_cp_node, recopilar_cp_node_async, "recopilar_cp"))
     workflow.add_node("validar_y_decidir_cp", validar_y_decidir_cp_node)
     workflow.add_node("preguntar_cp", preguntar_cp_node)
-    workflow.add_node("buscar_info_clima", buscar_info_clima_node)
+    workflow.add_node("buscar_info_clima", _nodo_sync_async(buscar_info_clima_node, buscar_info_clima_node_async, "buscar_info_clima"))
 
-    workflow.add_node("recopilar_preferencias", recopilar_preferencias_node)
+    workflow.add_node("recopilar_preferencias", _nodo_sync_async(recopilar_preferencias_node, recopilar_preferencias_node_async, "recopilar_preferencias"))
     workflow.add_node("preguntar_preferencias", preguntar_preferencias_node)
     workflow.add_node("generar_mensaje_transicion", generar_mensaje_transicion_perfil)
         
-    workflow.add_node("recopilar_info_pasajeros", recopilar_info_pasajeros_node)
+    workflow.add_node("recopilar_info_pasajeros", _nodo_sync_async(recopilar_info_pasajeros_node, recopilar_info_pasajeros_node_async, "recopilar_info_pasajeros"))
     workflow.add_node("preguntar_info_pasajeros", preguntar_info_pasajeros_node)
     workflow.add_node("aplicar_filtros_pasajeros", aplicar_filtros_pasajeros_node)
     workflow.add_node("generar_mensaje_transicion_pasajeros", generar_mensaje_transicion_pasajeros)
     workflow.add_node("construir_filtros", construir_filtros_node)
 
 
-    workflow.add_node("recopilar_economia", recopilar_economia_node)
+    workflow.add_node("recopilar_economia", _nodo_sync_async(recopilar_economia_node, recopilar_economia_node_async, "recopilar_economia"))
     workflow.add_node("preguntar_economia", preguntar_economia_node)
     workflow.add_node("calcular_recomendacion_economia_modo1", calcular_recomendacion_economia_modo1_node)
     
@@ -44,21 +131,26 @@ def build_sequential_agent_graph():
     workflow.add_node("calcular_flags_dinamicos", calcular_flags_dinamicos_node)
     workflow.add_node("calcular_pesos_finales", calcular_pesos_finales_node)
     workflow.add_node("formatear_tabla_resumen", formatear_tabla_resumen_node)
-    workflow.add_node("buscar_coches_finales", buscar_coches_finales_node)
+    workflow.add_node("buscar_coches_finales", _nodo_sync_async(buscar_coches_finales_node, buscar_coches_finales_node_async, "buscar_coches_finales"))
+    workflow.add_node("mostrar_mas_coches", _nodo_sync_async(mostrar_mas_coches_node, mostrar_mas_coches_node_async, "mostrar_mas_coches"))
+    workflow.add_node("refinar_busqueda", refinar_busqueda_node)
 
     # --- 2. Definir el punto de entrada y el router principal ---
     workflow.set_entry_point("router")
 
     workflow.add_conditional_edges(
     "router",
-    decidir_ruta_inicial, # Tu función de enrutamiento principal
-    {   "iniciar_conversacion": "saludo_y_pregunta_inicial",
+    envolver_ruta(decidir_ruta_inicial), # Tu función de enrutamiento principal
+    {   **destinos_finalizacion,
+        "iniciar_conversacion": "saludo_y_pregunta_inicial",
         "recopilar_cp": "recopilar_cp",
         "recopilar_preferencias": "recopilar_preferencias", 
         "recopilar_info_pasajeros": "recopilar_info_pasajeros",
         "recopilar_economia": "recopilar_economia", 
         "iniciar_finalizacion": "calcular_recomendacion_economia_modo1",
-        "buscar_coches_finales": "buscar_coches_finales" 
+        "buscar_coches_finales": "buscar_coches_finales",
+        "mostrar_mas_coches": "mostrar_mas_coches",
+        "refinar_busqueda": "refinar_busqueda"
     }
 )
     # Después del saludo y la primera pregunta, el agente debe esperar la respuesta del usuario.
@@ -120,26 +212,25 @@ def build_sequential_agent_graph():
     # Flujo de Economía
     workflow.add_conditional_edges(
     "recopilar_economia",
-    decidir_siguiente_paso_economia, # <-- Nuestra nueva función de decisión
+    envolver_ruta(decidir_siguiente_paso_economia), # <-- Nuestra nueva función de decisión
     {
+        **destinos_finalizacion,
         "preguntar_economia": "preguntar_economia",
         "iniciar_finalizacion": "calcular_recomendacion_economia_modo1" # <-- Tu nodo de finalización
     }
     )
     # Si tenemos que volver a preguntar, el turno del agente termina.
     workflow.add_edge("preguntar_economia", END)
-    # El flujo de Finalización continúa como lo tenías.
-    workflow.add_edge("calcular_recomendacion_economia_modo1", "construir_filtros")
     
     # Flujo de Finalización (Cadena de cálculo silencioso)
-    # Esta es la única parte que es una cadena lineal, ya que un cálculo depende del anterior.
-    workflow.add_edge("calcular_recomendacion_economia_modo1", "construir_filtros") # ✅ Renombrado
-    workflow.add_edge("construir_filtros", "calcular_km_anuales_postprocessing")
-    workflow.add_edge("calcular_km_anuales_postprocessing", "calcular_flags_dinamicos")
-    workflow.add_edge("calcular_flags_dinamicos", "calcular_pesos_finales")
-    workflow.add_edge("calcular_pesos_finales", "formatear_tabla_resumen")
-    workflow.add_edge("formatear_tabla_resumen", "buscar_coches_finales") 
+    conectar_finalizacion(workflow, finalizacion_en_paralelo)
     workflow.add_edge("buscar_coches_finales", END) 
+    workflow.add_edge("mostrar_mas_coches", END)
+    # El refinamiento solo toca el presupuesto: pesos, flags y filtros ya están en el estado
+    workflow.add_edge("refinar_busqueda", "buscar_coches_finales")
+
+    if guarda_delta:
+        aplicar_guarda_delta(workflow)
 
     # --- 4. Compilar el Grafo ---
     logging.info("Compilando el grafo...")
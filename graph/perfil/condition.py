@@ -1,6 +1,8 @@
 # En graph/condition.py
 from .state import EstadoAnalisisPerfil # o donde esté tu TypedDict
 from utils.validation import check_perfil_usuario_completeness, check_economia_completa, check_pasajeros_completo
+from utils.conversion import es_peticion_mas_coches, detectar_refinamiento_presupuesto
+from langchain_core.messages import HumanMessage
 from typing import Literal
 import logging
 
@@ -83,8 +85,8 @@ def decidir_siguiente_paso_economia(state: EstadoAnalisisPerfil) -> str:
 def route_based_on_state_node(state: EstadoAnalisisPerfil) -> dict:
     """Nodo intermedio que no hace nada, solo permite la bifurcación inicial."""
     print("--- Ejecutando Nodo: route_based_on_state_node ---")
-    # No modifica el estado, solo lo pasa
-    return {**state}
+    # No modifica el estado: devolver {**state} reescribiría todas las claves en el checkpoint
+    return {}
 
 
 def decidir_ruta_inicial(state: EstadoAnalisisPerfil) -> str:
@@ -134,6 +136,14 @@ def decidir_ruta_inicial(state: EstadoAnalisisPerfil) -> str:
     elif coches is None: # Si todo lo anterior está completo y los pesos están, pero no hay coches
         print("DEBUG Router: Decisión -> buscar_coches_finales")
         return "buscar_coches_finales"
+    elif isinstance(messages[-1], HumanMessage) and es_peticion_mas_coches(messages[-1].content):
+        # Paginación: se reutilizan pesos, flags y el ranking ya calculado
+        print("DEBUG Router: Decisión -> mostrar_mas_coches")
+        return "mostrar_mas_coches"
+    elif isinstance(messages[-1], HumanMessage) and detectar_refinamiento_presupuesto(messages[-1].content):
+        # Refinamiento ("más baratos"): se ajusta el presupuesto y se repite solo la búsqueda
+        print("DEBUG Router: Decisión -> refinar_busqueda")
+        return "refinar_busqueda"
     else: # Conversación completa y coches ya buscados, reiniciar para una nueva consulta
         print("DEBUG Router: Decisión -> Conversación Completa con coches. Reiniciando con saludo.")
         # APUNTAMOS A LA NUEVA RUTA DE INICIO
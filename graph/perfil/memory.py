@@ -3,7 +3,8 @@
 import os
 import logging
 import asyncio # Para ejecutar setup si es necesario desde un contexto síncrono
-from typing import Literal, Optional
+import threading
+from typing import Literal, Optional, Dict, Any, AsyncIterator, Iterator, Sequence, Tuple
 
 # Activar, descomentar estas tres lineas de codigo en caso de hacer pruebas en local y con memoria RAM del ordenador
 # #======================================================================
@@ -12,50 +13,371 @@ from typing import Literal, Optional
 #     return MemorySaver()
 # #======================================================================
 
-# # Activar, descomentar las lineas abajo en caso de hacer API y con memoria en SQLCLOUD:
-# from langgraph.checkpoint.postgres.aio import AsyncPostgresSaver 
-
-# logger = logging.getLogger(__name__)
-
-
-# ##Variable global para almacenar la instancia del checkpointer inicializada
-# _checkpointer_instance: Optional[AsyncPostgresSaver] = None
-# _db_conn_str: Optional[str] = None # Para construir la instancia si es necesario
-
-# async def ensure_tables_exist(conn_string: str):
-#     """
-#     Asegura que las tablas del checkpointer existan.
-#     Se llama una vez durante el startup de la aplicación.
-#     """
-#     logger.info(f"AsyncPostgresSaver: Verificando/creando tablas para la BBDD...")
-#     try:
-#         ##Usar async with para el setup, como en la documentación
-#         async with AsyncPostgresSaver.from_conn_string(conn_string) as checkpointer_for_setup:
-#             await checkpointer_for_setup.setup()
-#         logger.info("AsyncPostgresSaver: Tablas del checkpointer verificadas/creadas exitosamente.")
-#     except ImportError:
-#         logger.error("Error de importación para AsyncPostgresSaver o psycopg. "
-#                      "Instala 'langgraph-checkpoint-postgres' y 'psycopg[binary]'.")
-#         raise
-#     except Exception as e:
-#         logger.error(f"Error durante el setup de tablas de AsyncPostgresSaver: {e}", exc_info=True)
-#         raise RuntimeError(f"No se pudo hacer setup de las tablas de AsyncPostgresSaver: {e}")
-
-# def set_checkpointer_instance(instance: AsyncPostgresSaver):
-#     """Función para establecer la instancia global del checkpointer desde main.py"""
-#     global _checkpointer_instance
-#     _checkpointer_instance = instance
-
-# def get_memory() -> AsyncPostgresSaver:
-#     """
-#     Devuelve la instancia del checkpointer AsyncPostgresSaver previamente inicializada.
-#     """
-#     global _checkpointer_instance
-#     if _checkpointer_instance is None:
-#       ##  Esto no debería ocurrir si la inicialización en startup fue exitosa.
-#         logger.error("ERROR CRÍTICO: get_memory() llamado pero _checkpointer_instance es None.")
-#         raise RuntimeError(
-#             "AsyncPostgresSaver no ha sido inicializado. "
-#             "Asegúrate de que el evento de startup de FastAPI lo configure correctamente."
-#         )
-#     return _checkpointer_instance
+# Checkpointer en Postgres (Cloud SQL) para la API.
+#
+# AsyncPostgresSaver.from_conn_string abre UNA conexión: todas las conversaciones
+# concurrentes de la instancia se serializaban en ella para cada lectura/escritura de
+# checkpoint. Ahora el saver va sobre un psycopg_pool.AsyncConnectionPool:
+#   - tamaño min/max configurable (CHECKPOINTER_POOL_MIN/MAX). Cada turno hace 1 lectura y
+#     ~5 escrituras cortas, así que con max ≈ concurrencia esperada / 8 rara vez hay espera;
+#     el máximo debe caber en max_connections de Cloud SQL contando todas las instancias.
+#   - prepared statements del lado servidor (prepare_threshold): las queries del saver son
+#     siempre las mismas. Ponerlo a "none" si hay un PgBouncer en modo transacción delante.
+#   - pipeline: el saver envía en pipeline los upserts de cada aput/aput_writes cuando la
+#     libpq lo soporta (>= 14); se informa en las estadísticas.
+from cachetools import TTLCache
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    BaseCheckpointSaver, ChannelVersions, Checkpoint, CheckpointMetadata, CheckpointTuple,
+    get_checkpoint_id, get_checkpoint_metadata
+)
+from langgraph.checkpoint.postgres.aio import AsyncPostgresSaver
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+
+from config.settings import (
+    CHECKPOINTER_POOL_MIN, CHECKPOINTER_POOL_MAX, CHECKPOINTER_POOL_TIMEOUT_SEG,
+    CHECKPOINTER_POOL_MAX_IDLE_SEG, CHECKPOINTER_PREPARE_THRESHOLD,
+    CACHE_CHECKPOINTS_ACTIVA, CACHE_CHECKPOINTS_MAX_HILOS, CACHE_CHECKPOINTS_TTL_SEG,
+    CACHE_CHECKPOINTS_ESCRITURA_ASINCRONA
+)
+
+logger = logging.getLogger(__name__)
+
+
+##Variable global para almacenar la instancia del checkpointer inicializada
+_checkpointer_instance: Optional[BaseCheckpointSaver] = None
+_saver_postgres: Optional[AsyncPostgresSaver] = None
+_pool: Optional[AsyncConnectionPool] = None
+
+
+# --- Caché write-through del último checkpoint de cada hilo ---
+#
+# Cada ainvoke empieza con aget_tuple(thread_id) contra Postgres, aunque el checkpoint lo
+# escribió esta misma instancia en el turno anterior. CheckpointerConCache guarda en memoria
+# (LRU + TTL, CACHE_CHECKPOINTS_MAX_HILOS hilos) el último checkpoint escrito o leído de cada
+# hilo, serializado con el serde del saver para que nadie pueda mutarlo desde fuera:
+#   - lecturas del último checkpoint (sin checkpoint_id, o con el id del cacheado): memoria;
+#   - escrituras: siempre llegan a Postgres. Con CACHE_CHECKPOINTS_ESCRITURA_ASINCRONA=true
+#     aput devuelve en cuanto actualiza la caché y la escritura se encola por hilo (en orden);
+#     si falla, se invalida el hilo. Es menos durable: un crash pierde los últimos turnos.
+#   - aput_writes invalida el hilo (las escrituras pendientes solo se leen de Postgres);
+#   - historial (alist) y borrado de hilos van directos al saver.
+# Requiere afinidad de sesión: si otra instancia escribe el mismo hilo, esta serviría un
+# checkpoint viejo hasta que expire el TTL. Por eso está desactivada por defecto.
+class CheckpointerConCache(BaseCheckpointSaver):
+    """Envuelve un BaseCheckpointSaver (AsyncPostgresSaver) con una caché del último checkpoint por hilo."""
+
+    def __init__(self, saver: BaseCheckpointSaver, max_hilos: int, ttl_seg: int, escritura_asincrona: bool = False):
+        super().__init__(serde=saver.serde)
+        self.saver = saver
+        self.escritura_asincrona = escritura_asincrona
+        self._cache: TTLCache = TTLCache(maxsize=max_hilos, ttl=ttl_seg)
+        self._lock = threading.Lock()
+        # Última escritura encolada por hilo: la siguiente la espera para conservar el orden
+        self._escrituras_pendientes: Dict[str, asyncio.Task] = {}
+        self.aciertos = 0
+        self.fallos = 0
+        self.escrituras = 0
+        self.errores_escritura = 0
+
+    @property
+    def config_specs(self):
+        return self.saver.config_specs
+
+    # -- Caché --
+    @staticmethod
+    def _clave(config: RunnableConfig) -> Tuple[str, str]:
+        configurable = config["configurable"]
+        return str(configurable["thread_id"]), configurable.get("checkpoint_ns", "")
+
+    def _guardar(self, tupla: CheckpointTuple) -> None:
+        serializado = self.serde.dumps_typed(tupla.checkpoint)
+        with self._lock:
+            self._cache[self._clave(tupla.config)] = (tupla.config, serializado, tupla.metadata, tupla.parent_config)
+
+    def _leer(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        with self._lock:
+            entrada = self._cache.get(self._clave(config))
+        checkpoint_id = get_checkpoint_id(config)
+        if entrada is None or (checkpoint_id and checkpoint_id != entrada[0]["configurable"]["checkpoint_id"]):
+            with self._lock:
+                self.fallos += 1
+            return None
+        config_cache, serializado, metadata, parent_config = entrada
+        with self._lock:
+            self.aciertos += 1
+        return CheckpointTuple(
+            config=config_cache,
+            checkpoint=self.serde.loads_typed(serializado),
+            metadata=dict(metadata),
+            parent_config=parent_config,
+            pending_writes=[],
+        )
+
+    def invalidar(self, thread_id: str) -> None:
+        with self._lock:
+            for clave in [c for c in self._cache if c[0] == str(thread_id)]:
+                self._cache.pop(clave, None)
+
+    @staticmethod
+    def _tupla_escrita(config: RunnableConfig, checkpoint: Checkpoint, metadata: CheckpointMetadata) -> CheckpointTuple:
+        """La misma tupla que devolvería el saver al leer el checkpoint recién escrito."""
+        configurable = config["configurable"]
+        nuevo_config = {"configurable": {
+            "thread_id": configurable["thread_id"],
+            "checkpoint_ns": configurable.get("checkpoint_ns", ""),
+            "checkpoint_id": checkpoint["id"],
+        }}
+        checkpoint_padre = get_checkpoint_id(config)
+        parent_config = {"configurable": {**nuevo_config["configurable"], "checkpoint_id": checkpoint_padre}} if checkpoint_padre else None
+        return CheckpointTuple(nuevo_config, checkpoint, get_checkpoint_metadata(config, metadata), parent_config, [])
+
+    # -- Escritura en Postgres (síncrona o encolada por hilo) --
+    async def _escribir(self, thread_id: str, coro) -> None:
+        if not self.escritura_asincrona:
+            await coro
+            return
+        anterior = self._escrituras_pendientes.get(thread_id)
+
+        async def escribir_en_orden():
+            if anterior is not None:
+                await asyncio.gather(anterior, return_exceptions=True)
+            try:
+                await coro
+            except Exception as e:
+                self.errores_escritura += 1
+                self.invalidar(thread_id)
+                logger.error(f"❌ (Caché Checkpoints) ► Falló la escritura diferida del hilo {thread_id}: {e}", exc_info=True)
+            finally:
+                if self._escrituras_pendientes.get(thread_id) is tarea:
+                    self._escrituras_pendientes.pop(thread_id, None)
+
+        tarea = asyncio.create_task(escribir_en_orden())
+        self._escrituras_pendientes[thread_id] = tarea
+
+    async def vaciar_escrituras_pendientes(self) -> None:
+        """Espera a que terminen las escrituras diferidas (llamar en el shutdown)."""
+        pendientes = list(self._escrituras_pendientes.values())
+        if pendientes:
+            logger.info(f"INFO (Caché Checkpoints) ► Esperando {len(pendientes)} escrituras diferidas...")
+            await asyncio.gather(*pendientes, return_exceptions=True)
+
+    # -- API async (la que usa la API con ainvoke/astream) --
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        tupla = self._leer(config)
+        if tupla is not None:
+            return tupla
+        tupla = await self.saver.aget_tuple(config)
+        # Solo se cachea el último checkpoint y si no tiene escrituras pendientes
+        if tupla is not None and not get_checkpoint_id(config) and not tupla.pending_writes:
+            self._guardar(tupla)
+        return tupla
+
+    async def alist(self, config: Optional[RunnableConfig], *, filter: Optional[Dict[str, Any]] = None,
+                    before: Optional[RunnableConfig] = None, limit: Optional[int] = None) -> AsyncIterator[CheckpointTuple]:
+        # El historial se lee de Postgres: antes hay que esperar a las escrituras diferidas del hilo
+        pendiente = self._escrituras_pendientes.get(self._clave(config)[0]) if config else None
+        if pendiente is not None:
+            await asyncio.gather(pendiente, return_exceptions=True)
+        async for tupla in self.saver.alist(config, filter=filter, before=before, limit=limit):
+            yield tupla
+
+    async def aput(self, config: RunnableConfig, checkpoint: Checkpoint, metadata: CheckpointMetadata,
+                   new_versions: ChannelVersions) -> RunnableConfig:
+        tupla = self._tupla_escrita(config, checkpoint, metadata)
+        self.escrituras += 1
+        if self.escritura_asincrona:
+            self._guardar(tupla)
+            await self._escribir(self._clave(config)[0], self.saver.aput(config, checkpoint, metadata, new_versions))
+        else:
+            # Síncrona: solo se cachea lo que ya está en Postgres
+            await self.saver.aput(config, checkpoint, metadata, new_versions)
+            self._guardar(tupla)
+        return tupla.config
+
+    async def aput_writes(self, config: RunnableConfig, writes: Sequence[Tuple[str, Any]], task_id: str, task_path: str = "") -> None:
+        thread_id = self._clave(config)[0]
+        self.invalidar(thread_id)
+        await self._escribir(thread_id, self.saver.aput_writes(config, writes, task_id, task_path))
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        self.invalidar(thread_id)
+        pendiente = self._escrituras_pendientes.get(str(thread_id))
+        if pendiente is not None:
+            await asyncio.gather(pendiente, return_exceptions=True)
+        await self.saver.adelete_thread(thread_id)
+
+    # -- API síncrona (scripts): sin caché, solo se invalida al escribir --
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        return self.saver.get_tuple(config)
+
+    def list(self, config: Optional[RunnableConfig], *, filter: Optional[Dict[str, Any]] = None,
+             before: Optional[RunnableConfig] = None, limit: Optional[int] = None) -> Iterator[CheckpointTuple]:
+        return self.saver.list(config, filter=filter, before=before, limit=limit)
+
+    def put(self, config: RunnableConfig, checkpoint: Checkpoint, metadata: CheckpointMetadata,
+            new_versions: ChannelVersions) -> RunnableConfig:
+        self.invalidar(self._clave(config)[0])
+        return self.saver.put(config, checkpoint, metadata, new_versions)
+
+    def put_writes(self, config: RunnableConfig, writes: Sequence[Tuple[str, Any]], task_id: str, task_path: str = "") -> None:
+        self.invalidar(self._clave(config)[0])
+        return self.saver.put_writes(config, writes, task_id, task_path)
+
+    def delete_thread(self, thread_id: str) -> None:
+        self.invalidar(thread_id)
+        return self.saver.delete_thread(thread_id)
+
+    def get_next_version(self, current, channel):
+        return self.saver.get_next_version(current, channel)
+
+    def estadisticas(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.aciertos + self.fallos
+            return {
+                "activa": True,
+                "hilos": len(self._cache),
+                "max_hilos": self._cache.maxsize,
+                "ttl_seg": self._cache.ttl,
+                "escritura_asincrona": self.escritura_asincrona,
+                "escrituras_pendientes": len(self._escrituras_pendientes),
+                "aciertos": self.aciertos,
+                "fallos": self.fallos,
+                "ratio_aciertos": round(self.aciertos / total, 4) if total else 0.0,
+                "escrituras": self.escrituras,
+                "errores_escritura": self.errores_escritura,
+            }
+
+
+def _prepare_threshold() -> Optional[int]:
+    """"none" desactiva los prepared statements; un entero es el nº de ejecuciones antes de preparar."""
+    if str(CHECKPOINTER_PREPARE_THRESHOLD).strip().lower() in ("none", ""):
+        return None
+    return int(CHECKPOINTER_PREPARE_THRESHOLD)
+
+
+async def crear_pool_checkpointer(conn_string: str) -> AsyncConnectionPool:
+    """
+    Abre el pool de conexiones del checkpointer. AsyncPostgresSaver necesita conexiones en
+    autocommit y con row_factory=dict_row.
+    """
+    global _pool
+    _pool = AsyncConnectionPool(
+        conninfo=conn_string,
+        min_size=CHECKPOINTER_POOL_MIN,
+        max_size=CHECKPOINTER_POOL_MAX,
+        timeout=CHECKPOINTER_POOL_TIMEOUT_SEG,
+        max_idle=CHECKPOINTER_POOL_MAX_IDLE_SEG,
+        kwargs={"autocommit": True, "prepare_threshold": _prepare_threshold(), "row_factory": dict_row},
+        name="checkpointer",
+        open=False,
+    )
+    await _pool.open(wait=True)
+    logger.info(f"✅ (Checkpointer) ► Pool abierto (min={CHECKPOINTER_POOL_MIN}, max={CHECKPOINTER_POOL_MAX}).")
+    return _pool
+
+
+async def ensure_tables_exist(checkpointer: AsyncPostgresSaver):
+    """
+    Asegura que las tablas del checkpointer existan.
+    Se llama una vez durante el startup de la aplicación.
+    """
+    logger.info(f"AsyncPostgresSaver: Verificando/creando tablas para la BBDD...")
+    try:
+        await checkpointer.setup()
+        logger.info("AsyncPostgresSaver: Tablas del checkpointer verificadas/creadas exitosamente.")
+    except ImportError:
+        logger.error("Error de importación para AsyncPostgresSaver o psycopg. "
+                     "Instala 'langgraph-checkpoint-postgres' y 'psycopg[binary]'.")
+        raise
+    except Exception as e:
+        logger.error(f"Error durante el setup de tablas de AsyncPostgresSaver: {e}", exc_info=True)
+        raise RuntimeError(f"No se pudo hacer setup de las tablas de AsyncPostgresSaver: {e}")
+
+
+async def inicializar_checkpointer(conn_string: str) -> AsyncPostgresSaver:
+    """Pool + AsyncPostgresSaver + setup de tablas. Deja la instancia lista para get_memory()."""
+    global _saver_postgres
+    pool = await crear_pool_checkpointer(conn_string)
+    _saver_postgres = AsyncPostgresSaver(conn=pool)
+    await ensure_tables_exist(_saver_postgres)
+    if not _saver_postgres.supports_pipeline:
+        logger.warning("WARN (Checkpointer) ► La libpq no soporta pipeline mode; los upserts irán en transacción.")
+    checkpointer = _saver_postgres
+    if CACHE_CHECKPOINTS_ACTIVA:
+        checkpointer = CheckpointerConCache(
+            _saver_postgres,
+            max_hilos=CACHE_CHECKPOINTS_MAX_HILOS,
+            ttl_seg=CACHE_CHECKPOINTS_TTL_SEG,
+            escritura_asincrona=CACHE_CHECKPOINTS_ESCRITURA_ASINCRONA,
+        )
+        logger.info(f"✅ (Checkpointer) ► Caché de checkpoints activa (escritura {'asíncrona' if CACHE_CHECKPOINTS_ESCRITURA_ASINCRONA else 'síncrona'}).")
+    set_checkpointer_instance(checkpointer)
+    return checkpointer
+
+
+async def cerrar_checkpointer() -> None:
+    global _pool, _checkpointer_instance, _saver_postgres
+    if isinstance(_checkpointer_instance, CheckpointerConCache):
+        await _checkpointer_instance.vaciar_escrituras_pendientes()
+    if _pool is not None:
+        await _pool.close()
+        logger.info("Pool de conexiones del checkpointer cerrado.")
+    _pool = None
+    _checkpointer_instance = None
+    _saver_postgres = None
+
+
+def set_checkpointer_instance(instance: BaseCheckpointSaver):
+    """Función para establecer la instancia global del checkpointer desde main.py"""
+    global _checkpointer_instance
+    _checkpointer_instance = instance
+
+def get_memory() -> BaseCheckpointSaver:
+    """
+    Devuelve la instancia del checkpointer AsyncPostgresSaver previamente inicializada.
+    """
+    global _checkpointer_instance
+    if _checkpointer_instance is None:
+      ##  Esto no debería ocurrir si la inicialización en startup fue exitosa.
+        logger.error("ERROR CRÍTICO: get_memory() llamado pero _checkpointer_instance es None.")
+        raise RuntimeError(
+            "AsyncPostgresSaver no ha sido inicializado. "
+            "Asegúrate de que el evento de startup de FastAPI lo configure correctamente."
+        )
+    return _checkpointer_instance
+
+
+def obtener_estadisticas_pool_checkpointer() -> Dict[str, Any]:
+    """
+    Estadísticas del pool (psycopg_pool.get_stats): conexiones abiertas/libres, clientes
+    esperando ahora mismo y tiempo medio de espera para obtener una conexión.
+    """
+    if _pool is None:
+        return {"activo": False}
+    stats = _pool.get_stats()
+    peticiones = stats.get("requests_num", 0)
+    espera_total_ms = stats.get("requests_wait_ms", 0)
+    return {
+        "activo": True,
+        "min": stats.get("pool_min"),
+        "max": stats.get("pool_max"),
+        "conexiones_abiertas": stats.get("pool_size"),
+        "conexiones_libres": stats.get("pool_available"),
+        "clientes_esperando": stats.get("requests_waiting", 0),
+        "peticiones": peticiones,
+        "peticiones_en_cola": stats.get("requests_queued", 0),
+        "peticiones_timeout": stats.get("requests_errors", 0),
+        "espera_media_ms": round(espera_total_ms / peticiones, 2) if peticiones else 0.0,
+        "espera_total_ms": espera_total_ms,
+        "prepare_threshold": _prepare_threshold(),
+        "pipeline": bool(_saver_postgres and _saver_postgres.supports_pipeline),
+        "detalle": stats,
+    }
+
+
+def obtener_estadisticas_cache_checkpoints() -> Dict[str, Any]:
+    if isinstance(_checkpointer_instance, CheckpointerConCache):
+        return _checkpointer_instance.estadisticas()
+    return {"activa": False}
@@ -1,4 +1,4 @@
-from utils.explanation_generator import generar_explicacion_coche_mejorada # <-- NUEVO IMPORT
+from utils.explanation_generator import generar_explicacion_coche_mejorada, generar_explicaciones_coches, generar_explicaciones_coches_async # <-- NUEVO IMPORT
 from langchain_core.messages import AIMessage , SystemMessage, HumanMessage
 from pydantic import ValidationError # Importar para manejo de errores si es necesario
 from .state import (EstadoAnalisisPerfil, 
@@ -13,11 +13,18 @@ from prompts.loader import system_prompt_perfil, prompt_economia_structured_sys_
 from utils.postprocessing import aplicar_postprocesamiento_perfil, aplicar_postprocesamiento_filtros
 from utils.validation import check_perfil_usuario_completeness , check_pasajeros_completo, es_cp_valido
 from utils.formatters import formatear_preferencias_en_tabla
-from utils.weights import compute_raw_weights, normalize_weights
+from utils.weights import calcular_vector_pesos_crudos, normalizar_vector_pesos
+from utils.weights_index import vector_a_dict
 from utils.bigquery_tools import buscar_coches_bq
+from utils.numpy_scoring import buscar_coches_numpy
 from utils.bq_data_lookups import obtener_datos_climaticos_por_cp # IMPORT para la función de búsqueda de clima ---
-from utils.conversion import is_yes 
+from utils.cp_extractor import extraer_cp_con_metricas
+from utils.context_window import seleccionar_contexto, marcar_etapa
+from utils.profile_answer_parser import interpretar_respuesta_perfil_con_metricas
+from utils.conversion import is_yes, detectar_refinamiento_presupuesto
 from utils.bq_logger import log_busqueda_a_bigquery
+from utils.ranking_cache import cache_rankings
+from utils.incremental_rerank import reranking_incremental
 from utils.sanitize_dict_for_json import sanitize_dict_for_json
 from utils.question_bank import QUESTION_BANK , PREGUNTAS_CP_INICIAL , PREGUNTAS_CP_REINTENTO ,PREGUNTA_BIENVENIDA
 import traceback
@@ -26,9 +33,10 @@ import pandas as pd
 from utils.enums import EstiloConduccion
 import json # Para construir el contexto del prompt
 from typing import Literal, Optional ,Dict, Any
-from config.settings import (MAPA_RATING_A_PREGUNTA_AMIGABLE, UMBRAL_COMODIDAD_PARA_PENALIZAR_FLAGS, UMBRAL_TECNOLOGIA_PARA_PENALIZAR_ANTIGUEDAD_FLAG, UMBRAL_IMPACTO_AMBIENTAL_PARA_LOGICA_DISTINTIVO_FLAG, UMBRAL_COMODIDAD_PARA_FAVORECER_CARROCERIA)
+from config.settings import (MOTOR_BUSQUEDA_COCHES, RERANK_INCREMENTAL_ACTIVO, REFINAMIENTO_FACTOR_MAS_BARATO, REFINAMIENTO_FACTOR_MAS_CARO, EXPLICACIONES_COCHES_ACTIVAS, PAGINACION_COCHES_POR_PAGINA, PAGINACION_MAX_COCHES, MAPA_RATING_A_PREGUNTA_AMIGABLE, UMBRAL_COMODIDAD_PARA_PENALIZAR_FLAGS, UMBRAL_TECNOLOGIA_PARA_PENALIZAR_ANTIGUEDAD_FLAG, UMBRAL_IMPACTO_AMBIENTAL_PARA_LOGICA_DISTINTIVO_FLAG, UMBRAL_COMODIDAD_PARA_FAVORECER_CARROCERIA)
 import random
 import logging
+import asyncio
 
 # --- Configuración de Logging ---
 logger = logging.getLogger(__name__)  # ayuda a tener logs mas claros INFO:graph.perfil.nodes:Calculando flags dinámicos...
@@ -54,7 +62,7 @@ def saludo_y_pregunta_inicial_node(state: EstadoAnalisisPerfil) -> dict:
     )
     
     # Devolvemos dos mensajes para que el frontend pueda mostrarlos por separado
-    return {"messages": [AIMessage(content=welcome_message), AIMessage(content=first_question)]}
+    return {"messages": [AIMessage(content=welcome_message), marcar_etapa(AIMessage(content=first_question), "cp")]}
 
 def preguntar_cp_node(state: EstadoAnalisisPerfil) -> dict:
     """
@@ -74,19 +82,47 @@ def preguntar_cp_node(state: EstadoAnalisisPerfil) -> dict:
         # Si no hay ningún intento previo, elegimos una pregunta inicial al azar.
         pregunta = random.choice(PREGUNTAS_CP_INICIAL)
 
-    # Añadimos el mensaje al historial
+    # Añadimos el mensaje al historial (solo el nuevo: add_messages lo agrega al final)
     historial_actual = state.get("messages", [])
-    historial_nuevo = list(historial_actual)
     
     if not historial_actual or historial_actual[-1].content != pregunta:
         logging.info(f"DEBUG (Preguntar CP) ► Añadiendo pregunta: {pregunta}")
-        historial_nuevo.append(AIMessage(content=pregunta))
-    else:
-        logging.warning("DEBUG (Preguntar CP) ► Mensaje duplicado, no se añade.")
+        return {"messages": [marcar_etapa(AIMessage(content=pregunta), "cp")]}
+    logging.warning("DEBUG (Preguntar CP) ► Mensaje duplicado, no se añade.")
+    return {}
+
+
+
+
+def _mensajes_llm_cp(state: EstadoAnalisisPerfil) -> Optional[list]:
+    """Mensajes para llm_cp_extractor, o None si no hay nuevo mensaje de usuario."""
+    historial = state.get("messages", [])
+    if not historial or isinstance(historial[-1], AIMessage):
+        logging.debug("DEBUG (CP) ► No hay nuevo mensaje de usuario para procesar.")
+        return None
+    # Construimos la lista de mensajes manualmente para un control total.
+    return seleccionar_contexto(historial, "cp", system_prompt_cp)
 
-    return {"messages": historial_nuevo}
+
+def _resultado_llm_cp(response: CodigoPostalExtraido) -> dict:
+    # La única salida de este nodo es el CP extraído, que guardamos en el estado para que el siguiente paso (la arista condicional) lo valide.
+    # Ya no necesitamos 'tipo_mensaje' ni 'contenido_mensaje'.
+    cp_extraido = response.codigo_postal
+    logging.info(f"DEBUG (CP) ► CP extraído por LLM: '{cp_extraido}'")
+    return {
+        "codigo_postal_extraido_temporal": cp_extraido
+    }
 
 
+def _cp_sin_llm(state: EstadoAnalisisPerfil) -> Optional[dict]:
+    """Camino rápido: si el último mensaje se resuelve con la regex, devuelve el resultado del nodo."""
+    historial = state.get("messages", [])
+    resuelto, cp_extraido = extraer_cp_con_metricas(historial[-1].content)
+    if not resuelto:
+        logging.debug("DEBUG (CP) ► Mensaje ambiguo, se delega al LLM.")
+        return None
+    logging.info(f"DEBUG (CP) ► CP extraído sin LLM: '{cp_extraido}'")
+    return {"codigo_postal_extraido_temporal": cp_extraido}
 
 
 def recopilar_cp_node(state: EstadoAnalisisPerfil) -> dict:
@@ -96,29 +132,20 @@ def recopilar_cp_node(state: EstadoAnalisisPerfil) -> dict:
     """
     logging.info("--- Ejecutando Nodo (Refactorizado): recopilar_cp_node ---")
     
-    historial = state.get("messages", [])
-
-    if not historial or isinstance(historial[-1], AIMessage):
-        logging.debug("DEBUG (CP) ► No hay nuevo mensaje de usuario para procesar.")
+    mensajes_para_llm = _mensajes_llm_cp(state)
+    if mensajes_para_llm is None:
         return {}
+    resultado_regex = _cp_sin_llm(state)
+    if resultado_regex is not None:
+        return resultado_regex
 
     try:
-        # Construimos la lista de mensajes manualmente para un control total.
-        mensajes_para_llm = [SystemMessage(content=system_prompt_cp), *historial]
-        
         # Invocamos al LLM estructurado.
         response: CodigoPostalExtraido = llm_cp_extractor.invoke(
             mensajes_para_llm,
             config={"configurable": {"tags": ["llm_cp_extractor"]}}
         )
-        # La única salida de este nodo es el CP extraído, que guardamos en el estado para que el siguiente paso (la arista condicional) lo valide.
-        # Ya no necesitamos 'tipo_mensaje' ni 'contenido_mensaje'.
-        cp_extraido = response.codigo_postal
-        logging.info(f"DEBUG (CP) ► CP extraído por LLM: '{cp_extraido}'")
-        
-        return {
-            "codigo_postal_extraido_temporal": cp_extraido
-        }
+        return _resultado_llm_cp(response)
 
     except (ValidationError, Exception) as e:
         logging.error(f"ERROR (CP) ► Fallo en la extracción del CP: {e}", exc_info=True)
@@ -127,6 +154,26 @@ def recopilar_cp_node(state: EstadoAnalisisPerfil) -> dict:
         return {"codigo_postal_extraido_temporal": None}
 
 
+async def recopilar_cp_node_async(state: EstadoAnalisisPerfil) -> dict:
+    """Variante async de recopilar_cp_node (usa ainvoke, no bloquea el event loop)."""
+    logging.info("--- Ejecutando Nodo (async): recopilar_cp_node ---")
+    mensajes_para_llm = _mensajes_llm_cp(state)
+    if mensajes_para_llm is None:
+        return {}
+    resultado_regex = _cp_sin_llm(state)
+    if resultado_regex is not None:
+        return resultado_regex
+    try:
+        response: CodigoPostalExtraido = await llm_cp_extractor.ainvoke(
+            mensajes_para_llm,
+            config={"configurable": {"tags": ["llm_cp_extractor"]}}
+        )
+        return _resultado_llm_cp(response)
+    except (ValidationError, Exception) as e:
+        logging.error(f"ERROR (CP) ► Fallo en la extracción del CP: {e}", exc_info=True)
+        return {"codigo_postal_extraido_temporal": None}
+
+
 
 def validar_y_decidir_cp_node(state: EstadoAnalisisPerfil) -> dict:
     """
@@ -197,70 +244,60 @@ def buscar_info_clima_node(state: EstadoAnalisisPerfil) -> dict:
 
     return {"info_clima_usuario": info_clima_calculada}
 
+
+async def buscar_info_clima_node_async(state: EstadoAnalisisPerfil) -> dict:
+    """Variante async: la consulta (índice local o fallback a BQ) se ejecuta fuera del event loop."""
+    return await asyncio.to_thread(buscar_info_clima_node, state)
+
 # --- FIN NUEVOS NODOS PARA ETAPA DE CÓDIGO POSTAL ---
 
 # --- Etapa 1: Recopilación de Preferencias del Usuario ---
 
-# def recopilar_preferencias_node(state: EstadoAnalisisPerfil) -> dict:
-#     """
-#     Procesa la entrada del usuario, llama al LLM para extraer nueva información,
-#     y FUSIONA esa nueva información con el perfil existente.
-#     --- VERSIÓN FINAL COMPLETAMENTE REFACTORIZADA ---
-#     """
-#     logging.info("--- Ejecutando Nodo (Final): recopilar_preferencias_node ---")
-    
-#     historial = state.get("messages", [])
-#     preferencias_actuales_obj = state.get("preferencias_usuario") or PerfilUsuario()
+def _mensajes_llm_perfil(state: EstadoAnalisisPerfil) -> Optional[list]:
+    """Mensajes para llm_solo_perfil, o None si no hay nuevo mensaje de usuario."""
+    historial = state.get("messages", [])
+    # Si el último mensaje no es del usuario, no hay nueva entrada que procesar.
+    if not historial or not isinstance(historial[-1], HumanMessage):
+        logging.debug("(Perfil) ► No hay nuevo mensaje de usuario para procesar.")
+        return None
 
-#     # Si el último mensaje es de la IA, no hay nueva entrada de usuario que procesar.
-#     if not historial or isinstance(historial[-1], AIMessage):
-#         logging.debug("(Perfil) ► No hay nuevo mensaje de usuario para procesar.")
-#         return {} # No hay cambios en el estado
+    logging.debug("(Perfil) ► Llamando a llm_solo_perfil con contexto limitado...")
+    # --- ✅ CAMBIO CLAVE: ACORTAR EL CONTEXTO ---
+    # En lugar de pasar todo el historial, pasamos solo la última pregunta del agente
+    # y la última respuesta del usuario. Esto enfoca al LLM en la tarea inmediata.
+    return seleccionar_contexto(historial, "perfil", system_prompt_perfil)
 
-#     logging.debug("(Perfil) ► Llamando a llm_solo_perfil...")
-    
-#     perfil_final_a_guardar = preferencias_actuales_obj # Por defecto, mantenemos el perfil actual
 
-#     try:
-#         # La variable 'response' ahora es de tipo PerfilUsuario directamente.
-#         response: PerfilUsuario = llm_solo_perfil.invoke(
-#             [SystemMessage(content=system_prompt_perfil), *historial],
-#             config={"configurable": {"tags": ["llm_solo_perfil"]}} 
-#         )
+def _fusionar_respuesta_perfil(preferencias_actuales_obj: PerfilUsuario, preferencias_del_llm: Optional[PerfilUsuario]) -> PerfilUsuario:
+    if preferencias_del_llm:
+        nuevos_datos = preferencias_del_llm.model_dump(exclude_unset=True)
         
-#         # 'response' es ahora el objeto PerfilUsuario que necesitamos.
-#         preferencias_del_llm = response
+        if nuevos_datos:
+            logging.info(f"DEBUG (Perfil) ► Fusionando nuevos datos del LLM: {nuevos_datos}")
+            perfil_consolidado = preferencias_actuales_obj.model_copy(update=nuevos_datos)
+        else:
+            logging.info("DEBUG (Perfil) ► El LLM no extrajo nuevos datos.")
+            perfil_consolidado = preferencias_actuales_obj
         
-#         # --- Lógica de Fusión Inteligente ---
-#         if preferencias_del_llm:
-#             nuevos_datos = preferencias_del_llm.model_dump(exclude_unset=True)
-            
-#             if nuevos_datos:
-#                 logging.info(f"DEBUG (Perfil) ► Fusionando nuevos datos del LLM: {nuevos_datos}")
-#                 perfil_consolidado = preferencias_actuales_obj.model_copy(update=nuevos_datos)
-#             else:
-#                 logging.info("DEBUG (Perfil) ► El LLM no extrajo nuevos datos.")
-#                 perfil_consolidado = preferencias_actuales_obj
-            
-#             # Asumiendo que tienes una función de post-procesamiento
-#             perfil_final_a_guardar = aplicar_postprocesamiento_perfil(perfil_consolidado)
-#         else:
-#             logging.warning("WARN (Perfil) ► El LLM no devolvió un objeto de preferencias.")
-#             perfil_final_a_guardar = preferencias_actuales_obj
-
-#     except ValidationError as e_val:
-#         logging.error(f"ERROR (Perfil) ► Error de Validación Pydantic en llm_solo_perfil: {e_val.errors()}")
-#         # En caso de error de formato, no actualizamos el perfil para no corromperlo.
-#         perfil_final_a_guardar = preferencias_actuales_obj 
-
-#     except Exception as e_general:
-#         logging.error(f"ERROR (Perfil) ► Fallo general al invocar llm_solo_perfil o en post-procesamiento: {e_general}", exc_info=True)
-#         perfil_final_a_guardar = preferencias_actuales_obj
-
-#     # Este nodo solo actualiza el perfil. No devuelve mensajes.
-#     return {
-#         "preferencias_usuario": perfil_final_a_guardar,
-#     }
+        return aplicar_postprocesamiento_perfil(perfil_consolidado)
+    logging.warning("WARN (Perfil) ► El LLM no devolvió un objeto de preferencias.")
+    return preferencias_actuales_obj
+
+
+def _perfil_sin_llm(state: EstadoAnalisisPerfil, preferencias_actuales_obj: PerfilUsuario) -> Optional[PerfilUsuario]:
+    """
+    Camino rápido: si la respuesta a la pregunta pendiente es inequívoca ("sí", "8",
+    "ocasionalmente"), rellena el campo sin LLM. None => hay que llamar a llm_solo_perfil.
+    """
+    historial = state.get("messages", [])
+    campo = _campo_pendiente_perfil(state.get("preferencias_usuario"))
+    pregunta = historial[-2].content if len(historial) > 1 and isinstance(historial[-2], AIMessage) else ""
+    valor = interpretar_respuesta_perfil_con_metricas(campo, pregunta, historial[-1].content)
+    if valor is None:
+        return None
+    logging.info(f"DEBUG (Perfil) ► Respuesta interpretada sin LLM: {campo}={valor}")
+    return _fusionar_respuesta_perfil(preferencias_actuales_obj, PerfilUsuario(**{campo: valor}))
+
 
 def recopilar_preferencias_node(state: EstadoAnalisisPerfil) -> dict:
     """
@@ -270,46 +307,23 @@ def recopilar_preferencias_node(state: EstadoAnalisisPerfil) -> dict:
     """
     logging.info("--- Ejecutando Nodo (Final): recopilar_preferencias_node ---")
     
-    historial = state.get("messages", [])
     preferencias_actuales_obj = state.get("preferencias_usuario") or PerfilUsuario()
-
-    # Si el último mensaje no es del usuario, no hay nueva entrada que procesar.
-    if not historial or not isinstance(historial[-1], HumanMessage):
-        logging.debug("(Perfil) ► No hay nuevo mensaje de usuario para procesar.")
+    mensajes_para_llm = _mensajes_llm_perfil(state)
+    if mensajes_para_llm is None:
         return {} 
-
-    logging.debug("(Perfil) ► Llamando a llm_solo_perfil con contexto limitado...")
-    
-    # --- ✅ CAMBIO CLAVE: ACORTAR EL CONTEXTO ---
-    # En lugar de pasar todo el historial, pasamos solo la última pregunta del agente
-    # y la última respuesta del usuario. Esto enfoca al LLM en la tarea inmediata.
-    contexto_relevante = historial[-2:]
+    perfil_sin_llm = _perfil_sin_llm(state, preferencias_actuales_obj)
+    if perfil_sin_llm is not None:
+        return {"preferencias_usuario": perfil_sin_llm}
 
     perfil_final_a_guardar = preferencias_actuales_obj 
 
     try:
         response: PerfilUsuario = llm_solo_perfil.invoke(
             # Usamos el contexto acotado en lugar de todo el historial
-            [SystemMessage(content=system_prompt_perfil), *contexto_relevante], 
+            mensajes_para_llm, 
             config={"configurable": {"tags": ["llm_solo_perfil"]}} 
         )
-        
-        preferencias_del_llm = response
-        
-        if preferencias_del_llm:
-            nuevos_datos = preferencias_del_llm.model_dump(exclude_unset=True)
-            
-            if nuevos_datos:
-                logging.info(f"DEBUG (Perfil) ► Fusionando nuevos datos del LLM: {nuevos_datos}")
-                perfil_consolidado = preferencias_actuales_obj.model_copy(update=nuevos_datos)
-            else:
-                logging.info("DEBUG (Perfil) ► El LLM no extrajo nuevos datos.")
-                perfil_consolidado = preferencias_actuales_obj
-            
-            perfil_final_a_guardar = aplicar_postprocesamiento_perfil(perfil_consolidado)
-        else:
-            logging.warning("WARN (Perfil) ► El LLM no devolvió un objeto de preferencias.")
-            perfil_final_a_guardar = preferencias_actuales_obj
+        perfil_final_a_guardar = _fusionar_respuesta_perfil(preferencias_actuales_obj, response)
 
     except Exception as e:
         logging.error(f"ERROR (Perfil) ► Fallo en la invocación del LLM o fusión: {e}", exc_info=True)
@@ -319,75 +333,110 @@ def recopilar_preferencias_node(state: EstadoAnalisisPerfil) -> dict:
         "preferencias_usuario": perfil_final_a_guardar,
     }
 
-def _obtener_siguiente_pregunta_perfil(prefs: Optional[PerfilUsuario]) -> str:
+
+async def recopilar_preferencias_node_async(state: EstadoAnalisisPerfil) -> dict:
+    """Variante async de recopilar_preferencias_node (usa ainvoke)."""
+    logging.info("--- Ejecutando Nodo (async): recopilar_preferencias_node ---")
+    preferencias_actuales_obj = state.get("preferencias_usuario") or PerfilUsuario()
+    mensajes_para_llm = _mensajes_llm_perfil(state)
+    if mensajes_para_llm is None:
+        return {}
+    perfil_sin_llm = _perfil_sin_llm(state, preferencias_actuales_obj)
+    if perfil_sin_llm is not None:
+        return {"preferencias_usuario": perfil_sin_llm}
+    try:
+        response: PerfilUsuario = await llm_solo_perfil.ainvoke(
+            mensajes_para_llm,
+            config={"configurable": {"tags": ["llm_solo_perfil"]}}
+        )
+        perfil_final_a_guardar = _fusionar_respuesta_perfil(preferencias_actuales_obj, response)
+    except Exception as e:
+        logging.error(f"ERROR (Perfil) ► Fallo en la invocación del LLM o fusión: {e}", exc_info=True)
+        perfil_final_a_guardar = preferencias_actuales_obj
+    return {
+        "preferencias_usuario": perfil_final_a_guardar,
+    }
+
+
+def _campo_pendiente_perfil(prefs: Optional[PerfilUsuario]) -> Optional[str]:
     """
-    Genera una pregunta específica y variada basada en el primer campo 
-    obligatorio que falta en el perfil del usuario, siguiendo un orden secuencial estricto.
+    Devuelve el primer campo obligatorio que falta en el perfil del usuario (clave de
+    QUESTION_BANK), siguiendo un orden secuencial estricto. "fallback" si no falta ninguno.
     """
     if prefs is None: 
-        return "¿Podrías contarme un poco sobre qué buscas o para qué usarás el coche?"
+        return None
 
     # --- La función ahora es una secuencia de comprobaciones "planas" ---
-    if prefs.apasionado_motor is None: return random.choice(QUESTION_BANK["apasionado_motor"])
-    if prefs.valora_estetica is None: return random.choice(QUESTION_BANK["valora_estetica"])
-    if prefs.coche_principal_hogar is None: return random.choice(QUESTION_BANK["coche_principal_hogar"])
-    if prefs.frecuencia_uso is None: return random.choice(QUESTION_BANK["frecuencia_uso"])
-    if prefs.distancia_trayecto is None: return random.choice(QUESTION_BANK["distancia_trayecto"])
+    if prefs.apasionado_motor is None: return "apasionado_motor"
+    if prefs.valora_estetica is None: return "valora_estetica"
+    if prefs.coche_principal_hogar is None: return "coche_principal_hogar"
+    if prefs.frecuencia_uso is None: return "frecuencia_uso"
+    if prefs.distancia_trayecto is None: return "distancia_trayecto"
     
     # Lógica anidada para viajes largos
     if (prefs.distancia_trayecto is not None and
             prefs.distancia_trayecto != DistanciaTrayecto.MAS_150_KM.value and
             prefs.realiza_viajes_largos is None):
-        return random.choice(QUESTION_BANK["realiza_viajes_largos"])
+        return "realiza_viajes_largos"
     
     if is_yes(prefs.realiza_viajes_largos) and prefs.frecuencia_viajes_largos is None:
-        return random.choice(QUESTION_BANK["frecuencia_viajes_largos"])
+        return "frecuencia_viajes_largos"
 
-    if prefs.circula_principalmente_ciudad is None: return random.choice(QUESTION_BANK["circula_principalmente_ciudad"])
-    if prefs.uso_profesional is None: return random.choice(QUESTION_BANK["uso_profesional"])
+    if prefs.circula_principalmente_ciudad is None: return "circula_principalmente_ciudad"
+    if prefs.uso_profesional is None: return "uso_profesional"
     if is_yes(prefs.uso_profesional) and prefs.tipo_uso_profesional is None:
-        return random.choice(QUESTION_BANK["tipo_uso_profesional"])
-    if prefs.prefiere_diseno_exclusivo is None: return random.choice(QUESTION_BANK["prefiere_diseno_exclusivo"])
-    if prefs.altura_mayor_190 is None: return random.choice(QUESTION_BANK["altura_mayor_190"])
-    if prefs.transporta_carga_voluminosa is None: return random.choice(QUESTION_BANK["transporta_carga_voluminosa"])
+        return "tipo_uso_profesional"
+    if prefs.prefiere_diseno_exclusivo is None: return "prefiere_diseno_exclusivo"
+    if prefs.altura_mayor_190 is None: return "altura_mayor_190"
+    if prefs.transporta_carga_voluminosa is None: return "transporta_carga_voluminosa"
     if is_yes(prefs.transporta_carga_voluminosa) and prefs.necesita_espacio_objetos_especiales is None:
-        return random.choice(QUESTION_BANK["necesita_espacio_objetos_especiales"])
-    if prefs.arrastra_remolque is None: return random.choice(QUESTION_BANK["arrastra_remolque"])
-    if prefs.aventura is None: return random.choice(QUESTION_BANK["aventura"])
-    if prefs.estilo_conduccion is None: return random.choice(QUESTION_BANK["estilo_conduccion"])
+        return "necesita_espacio_objetos_especiales"
+    if prefs.arrastra_remolque is None: return "arrastra_remolque"
+    if prefs.aventura is None: return "aventura"
+    if prefs.estilo_conduccion is None: return "estilo_conduccion"
     
     # --- ✅ LÓGICA DE GARAJE REFACTORIZADA ---
     # Cada pregunta ahora es una comprobación independiente en el flujo.
     if prefs.tiene_garage is None:
-        return random.choice(QUESTION_BANK["tiene_garage"])
+        return "tiene_garage"
     
     # Estas preguntas solo se evalúan si la anterior ya tiene respuesta.
     if is_yes(prefs.tiene_garage) and prefs.espacio_sobra_garage is None:
-        return random.choice(QUESTION_BANK["espacio_sobra_garage"])
+        return "espacio_sobra_garage"
     
     if is_yes(prefs.tiene_garage) and not is_yes(prefs.espacio_sobra_garage) and not prefs.problema_dimension_garage:
-        return random.choice(QUESTION_BANK["problema_dimension_garage"])
+        return "problema_dimension_garage"
         
     if not is_yes(prefs.tiene_garage) and prefs.problemas_aparcar_calle is None:
-        return random.choice(QUESTION_BANK["problemas_aparcar_calle"])
+        return "problemas_aparcar_calle"
 
-    if prefs.tiene_punto_carga_propio is None: return random.choice(QUESTION_BANK["tiene_punto_carga_propio"])
-    if prefs.solo_electricos is None: return random.choice(QUESTION_BANK["solo_electricos"])
+    if prefs.tiene_punto_carga_propio is None: return "tiene_punto_carga_propio"
+    if prefs.solo_electricos is None: return "solo_electricos"
     
     # Pregunta de transmisión solo si no quiere exclusivamente eléctricos
     if not is_yes(prefs.solo_electricos) and prefs.transmision_preferida is None:
-        return random.choice(QUESTION_BANK["transmision_preferida"])
-    if prefs.prioriza_baja_depreciacion is None: return random.choice(QUESTION_BANK["prioriza_baja_depreciacion"])     
+        return "transmision_preferida"
+    if prefs.prioriza_baja_depreciacion is None: return "prioriza_baja_depreciacion"     
     # Ratings en el orden correcto
-    if prefs.rating_fiabilidad_durabilidad is None: return random.choice(QUESTION_BANK["rating_fiabilidad_durabilidad"])
-    if prefs.rating_seguridad is None: return random.choice(QUESTION_BANK["rating_seguridad"])
-    if prefs.rating_comodidad is None: return random.choice(QUESTION_BANK["rating_comodidad"])
-    if prefs.rating_impacto_ambiental is None: return random.choice(QUESTION_BANK["rating_impacto_ambiental"])
-    if prefs.rating_costes_uso is None: return random.choice(QUESTION_BANK["rating_costes_uso"])
-    if prefs.rating_tecnologia_conectividad is None: return random.choice(QUESTION_BANK["rating_tecnologia_conectividad"])
+    if prefs.rating_fiabilidad_durabilidad is None: return "rating_fiabilidad_durabilidad"
+    if prefs.rating_seguridad is None: return "rating_seguridad"
+    if prefs.rating_comodidad is None: return "rating_comodidad"
+    if prefs.rating_impacto_ambiental is None: return "rating_impacto_ambiental"
+    if prefs.rating_costes_uso is None: return "rating_costes_uso"
+    if prefs.rating_tecnologia_conectividad is None: return "rating_tecnologia_conectividad"
     
-    # Si todos los campos están llenos, devuelve una pregunta de fallback al azar.
-    return random.choice(QUESTION_BANK["fallback"])
+    # Si todos los campos están llenos, se usa una pregunta de fallback.
+    return "fallback"
+
+def _obtener_siguiente_pregunta_perfil(prefs: Optional[PerfilUsuario]) -> str:
+    """
+    Genera una pregunta específica y variada basada en el primer campo 
+    obligatorio que falta en el perfil del usuario, siguiendo un orden secuencial estricto.
+    """
+    campo = _campo_pendiente_perfil(prefs)
+    if campo is None: 
+        return "¿Podrías contarme un poco sobre qué buscas o para qué usarás el coche?"
+    return random.choice(QUESTION_BANK[campo])
 
 def preguntar_preferencias_node(state: EstadoAnalisisPerfil) -> Dict:
     """
@@ -438,27 +487,26 @@ def preguntar_preferencias_node(state: EstadoAnalisisPerfil) -> Dict:
              # Si no hay mensaje, usamos uno genérico como fallback.
              mensaje_a_enviar = "¡Perfecto! He recopilado todas tus preferencias. Continuemos."
 
-    # --- 3. Añadimos el mensaje final al historial ---
-    historial_nuevo = list(historial_actual)
+    # --- 3. Añadimos el mensaje final al historial (solo el nuevo) ---
+    mensajes_nuevos = []
     if mensaje_a_enviar and mensaje_a_enviar.strip():
         ai_msg = AIMessage(content=mensaje_a_enviar)
         # Evitamos añadir mensajes duplicados
         if not historial_actual or historial_actual[-1].content != ai_msg.content:
-            historial_nuevo.append(ai_msg)
+            mensajes_nuevos.append(ai_msg)
             logging.info(f"DEBUG (Preguntar Perfil) ► Mensaje final añadido: {mensaje_a_enviar}")
         else:
              logging.warning("DEBUG (Preguntar Perfil) ► Mensaje final duplicado, no se añade.")
     else:
          logging.error("ERROR (Preguntar Perfil) ► No se determinó ningún mensaje a enviar.")
          ai_msg = AIMessage(content="No estoy seguro de qué preguntar ahora. ¿Puedes darme más detalles?")
-         historial_nuevo.append(ai_msg)
+         mensajes_nuevos.append(ai_msg)
 
-    # Devolvemos el estado actualizado
-    return {
-        **state,
-        "messages": historial_nuevo,
-        "pregunta_pendiente": None # Limpiamos la pregunta pendiente una vez usada
-    }
+    # Devolvemos solo lo que cambia
+    delta = {"messages": mensajes_nuevos} if mensajes_nuevos else {}
+    if mensaje_pendiente is not None:
+        delta["pregunta_pendiente"] = None # Limpiamos la pregunta pendiente una vez usada
+    return delta
 
 
 
@@ -481,18 +529,36 @@ def generar_mensaje_transicion_perfil(state: EstadoAnalisisPerfil) -> dict:
     import random
     mensaje_transicion = random.choice(mensajes_posibles)
     
-    # Añadimos el mensaje al historial
-    historial_actual = state.get("messages", [])
-    historial_nuevo = list(historial_actual)
-    historial_nuevo.append(AIMessage(content=mensaje_transicion))
-    
     print(f"INFO: Añadido mensaje de transición: '{mensaje_transicion}'")
     
-    return {"messages": historial_nuevo}
+    return {"messages": [AIMessage(content=mensaje_transicion)]}
 
 
 
 # --- NUEVA ETAPA: PASAJEROS ---
+def _mensajes_llm_pasajeros(state: EstadoAnalisisPerfil) -> Optional[list]:
+    """Mensajes para llm_pasajeros, o None si no hay nuevo mensaje de usuario."""
+    historial = state.get("messages", [])
+    if not historial or isinstance(historial[-1], AIMessage):
+        logging.debug("DEBUG (Pasajeros) ► No hay nuevo mensaje de usuario para procesar.")
+        return None
+    # --- LÓGICA DE INVOCACIÓN CORREGIDA ---
+    # Construimos la lista de mensajes manualmente para evitar el formateo del prompt de sistema.
+    # Solo la ventana de la etapa de pasajeros, no el historial completo.
+    return seleccionar_contexto(historial, "pasajeros", system_prompt_pasajeros)
+
+
+def _fusionar_respuesta_pasajeros(info_pasajeros_actual: InfoPasajeros, info_pasajeros_extraida: InfoPasajeros) -> InfoPasajeros:
+    # --- Lógica de Fusión Inteligente (sin cambios) ---
+    nuevos_datos = info_pasajeros_extraida.model_dump(exclude_unset=True)
+    
+    if nuevos_datos:
+        logging.info(f"DEBUG (Pasajeros) ► Fusionando nuevos datos del LLM: {nuevos_datos}")
+        return info_pasajeros_actual.model_copy(update=nuevos_datos)
+    logging.info("DEBUG (Pasajeros) ► El LLM no extrajo nuevos datos.")
+    return info_pasajeros_actual
+
+
 def recopilar_info_pasajeros_node(state: EstadoAnalisisPerfil) -> dict:
     """
     Invoca al LLM con la única tarea de extraer datos del mensaje del usuario
@@ -501,33 +567,18 @@ def recopilar_info_pasajeros_node(state: EstadoAnalisisPerfil) -> dict:
     """
     logging.info("--- Ejecutando Nodo (Corregido): recopilar_info_pasajeros_node ---")
     
-    historial = state.get("messages", [])
     info_pasajeros_actual = state.get("info_pasajeros") or InfoPasajeros()
-
-    if not historial or isinstance(historial[-1], AIMessage):
-        logging.debug("DEBUG (Pasajeros) ► No hay nuevo mensaje de usuario para procesar.")
+    mensajes_para_llm = _mensajes_llm_pasajeros(state)
+    if mensajes_para_llm is None:
         return {}
 
     try:
-        # --- LÓGICA DE INVOCACIÓN CORREGIDA ---
-        # Construimos la lista de mensajes manualmente para evitar el formateo del prompt de sistema.
-        mensajes_para_llm = [SystemMessage(content=system_prompt_pasajeros), *historial]
-        
         # Invocamos al LLM estructurado con la lista de mensajes y la configuración de tags.
         info_pasajeros_extraida = llm_pasajeros.invoke(
             mensajes_para_llm,
             config={"configurable": {"tags": ["llm_pasajeros"]}}
         )
-        
-        # --- Lógica de Fusión Inteligente (sin cambios) ---
-        nuevos_datos = info_pasajeros_extraida.model_dump(exclude_unset=True)
-        
-        if nuevos_datos:
-            logging.info(f"DEBUG (Pasajeros) ► Fusionando nuevos datos del LLM: {nuevos_datos}")
-            info_pasajeros_final = info_pasajeros_actual.model_copy(update=nuevos_datos)
-        else:
-            logging.info("DEBUG (Pasajeros) ► El LLM no extrajo nuevos datos.")
-            info_pasajeros_final = info_pasajeros_actual
+        info_pasajeros_final = _fusionar_respuesta_pasajeros(info_pasajeros_actual, info_pasajeros_extraida)
 
     except ValidationError as e_val:
         logging.error(f"ERROR (Pasajeros) ► Error de Validación Pydantic: {e_val.errors()}")
@@ -541,6 +592,30 @@ def recopilar_info_pasajeros_node(state: EstadoAnalisisPerfil) -> dict:
     }
 
 
+async def recopilar_info_pasajeros_node_async(state: EstadoAnalisisPerfil) -> dict:
+    """Variante async de recopilar_info_pasajeros_node (usa ainvoke)."""
+    logging.info("--- Ejecutando Nodo (async): recopilar_info_pasajeros_node ---")
+    info_pasajeros_actual = state.get("info_pasajeros") or InfoPasajeros()
+    mensajes_para_llm = _mensajes_llm_pasajeros(state)
+    if mensajes_para_llm is None:
+        return {}
+    try:
+        info_pasajeros_extraida = await llm_pasajeros.ainvoke(
+            mensajes_para_llm,
+            config={"configurable": {"tags": ["llm_pasajeros"]}}
+        )
+        info_pasajeros_final = _fusionar_respuesta_pasajeros(info_pasajeros_actual, info_pasajeros_extraida)
+    except ValidationError as e_val:
+        logging.error(f"ERROR (Pasajeros) ► Error de Validación Pydantic: {e_val.errors()}")
+        info_pasajeros_final = info_pasajeros_actual
+    except Exception as e_general:
+        logging.error(f"ERROR (Pasajeros) ► Fallo general: {e_general}", exc_info=True)
+        info_pasajeros_final = info_pasajeros_actual
+    return {
+        "info_pasajeros": info_pasajeros_final
+    }
+
+
 # def validar_info_pasajeros_node(state: EstadoAnalisisPerfil) -> dict:
 #     """Nodo simple que comprueba si la información de pasajeros está completa."""
 #     print("--- Ejecutando Nodo: validar_info_pasajeros_node ---")
@@ -604,9 +679,7 @@ def preguntar_info_pasajeros_node(state: EstadoAnalisisPerfil) -> dict:
     # Añadimos el mensaje al historial, evitando duplicados.
     if not historial_actual or historial_actual[-1].content != pregunta:
         logging.info(f"DEBUG (Preguntar Pasajeros) ► Añadiendo pregunta: {pregunta}")
-        historial_nuevo = list(historial_actual)
-        historial_nuevo.append(AIMessage(content=pregunta))
-        return {"messages": historial_nuevo}
+        return {"messages": [marcar_etapa(AIMessage(content=pregunta), "pasajeros")]}
     
     logging.warning("DEBUG (Preguntar Pasajeros) ► Mensaje duplicado, no se añade.")
     return {} # No hay cambios
@@ -630,14 +703,9 @@ def generar_mensaje_transicion_pasajeros(state: EstadoAnalisisPerfil) -> dict:
     # Elegimos uno de los mensajes al azar
     mensaje_transicion = random.choice(mensajes_posibles)
     
-    # Añadimos el mensaje al historial
-    historial_actual = state.get("messages", [])
-    historial_nuevo = list(historial_actual)
-    historial_nuevo.append(AIMessage(content=mensaje_transicion))
-    
     print(f"INFO: Añadido mensaje de transición de pasajeros: '{mensaje_transicion}'")
     
-    return {"messages": historial_nuevo}
+    return {"messages": [AIMessage(content=mensaje_transicion)]}
 
 def aplicar_filtros_pasajeros_node(state: EstadoAnalisisPerfil) -> dict:
     """
@@ -707,7 +775,7 @@ def construir_filtros_node(state: EstadoAnalisisPerfil) -> dict:
 
     if not preferencias_obj:
         print("ERROR (Filtros) ► Nodo ejecutado pero 'preferencias_usuario' no existe. No se pueden construir filtros.")
-        return {"filtros_inferidos": filtros_desde_estado}
+        return {}
 
     print("DEBUG (Filtros) ► Preferencias e info_clima disponibles. Construyendo filtros...")
 
@@ -792,37 +860,18 @@ def preguntar_economia_node(state: EstadoAnalisisPerfil) -> dict:
     
     pregunta = _obtener_siguiente_pregunta_economia(economia)
     
-    historial_nuevo = list(historial_actual)
     if not historial_actual or historial_actual[-1].content != pregunta:
         logging.info(f"DEBUG (Preguntar Economía) ► Añadiendo pregunta: {pregunta}")
-        historial_nuevo.append(AIMessage(content=pregunta))
-    else:
-        logging.warning("DEBUG (Preguntar Economía) ► Mensaje duplicado, no se añade.")
-
-    return {"messages": historial_nuevo}
+        return {"messages": [marcar_etapa(AIMessage(content=pregunta), "economia")]}
+    logging.warning("DEBUG (Preguntar Economía) ► Mensaje duplicado, no se añade.")
+    return {}
 
 
-def recopilar_economia_node(state: EstadoAnalisisPerfil) -> dict:
+def _actualizacion_determinista_economia(last_ai_message: str, last_human_message: str) -> Optional[dict]:
     """
-    Primero intenta manejar respuestas numéricas simples de forma determinista.
-    Si la respuesta es compleja, delega la extracción al LLM.
-    --- VERSIÓN FINAL REFORZADA Y DETERMINISTA ---
+    Interceptamos respuestas simples ("1", "2", etc.) antes de llamar al LLM.
+    Devuelve el update para EconomiaUsuario o None si la respuesta no es simple.
     """
-    logging.info("--- Ejecutando Nodo (Reforzado): recopilar_economia_node ---")
-
-    historial = state.get("messages", [])
-    economia_actual = state.get("economia") or EconomiaUsuario()
-
-    if not historial or not isinstance(historial[-1], HumanMessage):
-        return {}
-
-    # Extraemos la última pregunta y respuesta para analizarlas
-    last_ai_message = historial[-2].content if len(historial) > 1 else ""
-    last_human_message = historial[-1].content.strip().lower()
-
-    # --- ✅ MANEJO DETERMINISTA DE RESPUESTAS NUMÉRICAS ---
-    # Interceptamos respuestas simples ("1", "2", etc.) antes de llamar al LLM.
-    
     update_data = None
     
     # Caso 1: El usuario elige entre "Asesoramiento" o "Presupuesto Propio"
@@ -839,44 +888,93 @@ def recopilar_economia_node(state: EstadoAnalisisPerfil) -> dict:
             update_data = {"tipo_presupuesto": "contado"}
         elif last_human_message in ["2", "la 2", "2️⃣"]:
             update_data = {"tipo_presupuesto": "financiado"}
+    return update_data
 
 
+def _preparar_economia(state: EstadoAnalisisPerfil):
+    """
+    Parte común (sin LLM) de recopilar_economia_node.
+    Devuelve (resultado_inmediato, mensajes_para_llm): si resultado_inmediato no es None,
+    el nodo termina sin llamar al LLM.
+    """
+    historial = state.get("messages", [])
+    economia_actual = state.get("economia") or EconomiaUsuario()
+
+    if not historial or not isinstance(historial[-1], HumanMessage):
+        return {}, None
+
+    # Extraemos la última pregunta y respuesta para analizarlas
+    last_ai_message = historial[-2].content if len(historial) > 1 else ""
+    last_human_message = historial[-1].content.strip().lower()
+
+    # --- ✅ MANEJO DETERMINISTA DE RESPUESTAS NUMÉRICAS ---
+    update_data = _actualizacion_determinista_economia(last_ai_message, last_human_message)
+
     # Si hemos encontrado una correspondencia determinista, la aplicamos y terminamos.
     if update_data:
         logging.info(f"DEBUG (Economía) ► Aplicando actualización determinista: {update_data}")
         economia_final = economia_actual.model_copy(update=update_data)
-        return {"economia": economia_final}
+        return {"economia": economia_final}, None
     
     # --- SI LA RESPUESTA NO ERA SIMPLE, PROCEDEMOS CON EL LLM ---
     logging.debug("DEBUG (Economía) ► La respuesta no es simple, delegando al LLM...")
-    
     # Usamos el contexto limitado que ya habiamos implementado
-    contexto_relevante = historial[-2:]
+    return None, seleccionar_contexto(historial, "economia", prompt_economia_structured_sys_msg)
+
+
+def _fusionar_respuesta_economia(economia_actual: EconomiaUsuario, response: EconomiaUsuario) -> dict:
+    if response and response.tipo_presupuesto:
+        response.tipo_presupuesto = response.tipo_presupuesto.lower()
+        
+    nuevos_datos = response.model_dump(exclude_unset=True)
+    if nuevos_datos:
+        logging.info(f"DEBUG (Economía) ► Fusionando nuevos datos del LLM: {nuevos_datos}")
+        economia_final = economia_actual.model_copy(update=nuevos_datos)
+    else:
+        economia_final = economia_actual
+        
+    return {"economia": economia_final}
+
+
+def recopilar_economia_node(state: EstadoAnalisisPerfil) -> dict:
+    """
+    Primero intenta manejar respuestas numéricas simples de forma determinista.
+    Si la respuesta es compleja, delega la extracción al LLM.
+    --- VERSIÓN FINAL REFORZADA Y DETERMINISTA ---
+    """
+    logging.info("--- Ejecutando Nodo (Reforzado): recopilar_economia_node ---")
+
+    resultado_inmediato, mensajes_para_llm = _preparar_economia(state)
+    if resultado_inmediato is not None:
+        return resultado_inmediato
     
     try:
-        mensajes_para_llm = [SystemMessage(content=prompt_economia_structured_sys_msg), *contexto_relevante]
         response: EconomiaUsuario = llm_economia.invoke(
             mensajes_para_llm, config={"configurable": {"tags": ["llm_economia"]}}
         )
-        
-        # ... (el resto de la lógica de fusión y normalización que ya teníamos)
-        if response and response.tipo_presupuesto:
-            response.tipo_presupuesto = response.tipo_presupuesto.lower()
-            
-        nuevos_datos = response.model_dump(exclude_unset=True)
-        if nuevos_datos:
-            logging.info(f"DEBUG (Economía) ► Fusionando nuevos datos del LLM: {nuevos_datos}")
-            economia_final = economia_actual.model_copy(update=nuevos_datos)
-        else:
-            economia_final = economia_actual
-            
-        return {"economia": economia_final}
+        return _fusionar_respuesta_economia(state.get("economia") or EconomiaUsuario(), response)
 
     except Exception as e:
         logging.error(f"ERROR (Economía) ► Fallo en la extracción de datos económicos: {e}", exc_info=True)
         return {}
 
 
+async def recopilar_economia_node_async(state: EstadoAnalisisPerfil) -> dict:
+    """Variante async de recopilar_economia_node (usa ainvoke)."""
+    logging.info("--- Ejecutando Nodo (async): recopilar_economia_node ---")
+    resultado_inmediato, mensajes_para_llm = _preparar_economia(state)
+    if resultado_inmediato is not None:
+        return resultado_inmediato
+    try:
+        response: EconomiaUsuario = await llm_economia.ainvoke(
+            mensajes_para_llm, config={"configurable": {"tags": ["llm_economia"]}}
+        )
+        return _fusionar_respuesta_economia(state.get("economia") or EconomiaUsuario(), response)
+    except Exception as e:
+        logging.error(f"ERROR (Economía) ► Fallo en la extracción de datos económicos: {e}", exc_info=True)
+        return {}
+
+
 # --- Fin Etapa 3 ---
 
 
@@ -968,7 +1066,7 @@ def calcular_flags_dinamicos_node(state: EstadoAnalisisPerfil) -> dict:
     logging.debug("--- Ejecutando Nodo: calcular_flags_dinamicos_node ---")
     preferencias_obj = state.get("preferencias_usuario")
     info_clima_obj = state.get("info_clima_usuario")
-    penalizar_puertas_bajas_actual = state.get("penalizar_puertas_bajas", False) # # Los flags 'penalizar_puertas_bajas' y 'priorizar_ancho' vienen de aplicar_filtros_pasajeros_node ya deberían estar en el estado si esa lógica se ejecutó.
+    # 'penalizar_puertas_bajas' lo escribe aplicar_filtros_pasajeros_node; aquí no se reescribe.
     info_pasajeros_obj = state.get("info_pasajeros") # <-- Obtener info de pasajeros
     print(f"DEBUG contenido de los objetos:  preferencias_obj: {preferencias_obj} - pasajeros {info_pasajeros_obj} - clima {info_clima_obj}") # Debug para ver qué contiene el objeto
     flag_pen_bev_reev_avent_ocas = False
@@ -1018,7 +1116,6 @@ def calcular_flags_dinamicos_node(state: EstadoAnalisisPerfil) -> dict:
         logging.error("ERROR (CalcFlags) ► 'preferencias_usuario' no existe en el estado. No se pueden calcular flags dinámicos.")
         # Devolver los flags con sus valores por defecto y mantener los existentes
         return {
-            "penalizar_puertas_bajas": penalizar_puertas_bajas_actual,
             #"priorizar_ancho": priorizar_ancho_actual,
             "flag_penalizar_low_cost_comodidad": flag_penalizar_lc_comod,
             "flag_penalizar_deportividad_comodidad": flag_penalizar_dep_comod,
@@ -1392,7 +1489,6 @@ def calcular_flags_dinamicos_node(state: EstadoAnalisisPerfil) -> dict:
 
     
     return {
-        "penalizar_puertas_bajas": penalizar_puertas_bajas_actual, # Propagar
        # "priorizar_ancho": priorizar_ancho_actual, # Propagar
         "flag_penalizar_low_cost_comodidad": flag_penalizar_lc_comod,
         "flag_penalizar_deportividad_comodidad": flag_penalizar_dep_comod, 
@@ -1479,7 +1575,7 @@ def calcular_pesos_finales_node(state: EstadoAnalisisPerfil) -> dict:
                       f"  InfoPasajeros: {info_pasajeros_dict_para_weights}\n"
                       f"  ZonaNieblas: {es_nieblas_val}, ZonaNieve: {es_nieve_val}, ZonaMonta: {es_monta_val}")
 
-        raw_weights = compute_raw_weights(
+        raw_weights = calcular_vector_pesos_crudos(
             preferencias=prefs_dict_para_weights, # Usar el dict que ya tenías
             info_pasajeros_dict=info_pasajeros_dict_para_weights,
             es_zona_nieblas=es_nieblas_val,
@@ -1487,7 +1583,9 @@ def calcular_pesos_finales_node(state: EstadoAnalisisPerfil) -> dict:
             # es_zona_clima_monta=es_monta_val,
             km_anuales_estimados=km_anuales_val
         )
-        pesos_calculados_normalizados = normalize_weights(raw_weights)
+        # Todo el cálculo es vectorial; el dict solo se construye aquí, para guardarlo en el estado.
+        if raw_weights is not None:
+            pesos_calculados_normalizados = vector_a_dict(normalizar_vector_pesos(raw_weights))
         logging.debug(f"DEBUG (CalcPesos) ► Pesos finales calculados y normalizados: {pesos_calculados_normalizados}") 
     
     except Exception as e_weights:
@@ -1540,10 +1638,10 @@ def formatear_tabla_resumen_node(state: EstadoAnalisisPerfil) -> dict:
             tabla_final_md = "Hubo un inconveniente al generar el resumen de tus preferencias."
 
     # Devolver solo las claves del estado que este nodo modifica
-    return {
-        "tabla_resumen_criterios": tabla_final_md,
-        "pregunta_pendiente": None # Asegurar que se limpie
-    }
+    delta = {"tabla_resumen_criterios": tabla_final_md}
+    if state.get("pregunta_pendiente") is not None:
+        delta["pregunta_pendiente"] = None # Asegurar que se limpie
+    return delta
 
   # --- Fin Etapa 4 ---
 from config.settings import (MAPA_FRECUENCIA_USO, MAPA_DISTANCIA_TRAYECTO, MAPA_FRECUENCIA_VIAJES_LARGOS, MAPA_REALIZA_VIAJES_LARGOS_KM )
@@ -1592,134 +1690,196 @@ def calcular_km_anuales_postprocessing_node(state: EstadoAnalisisPerfil) -> Dict
 
 
 
-def buscar_coches_finales_node(state: EstadoAnalisisPerfil, config: RunnableConfig) -> dict:
+def _filtros_para_busqueda(state: EstadoAnalisisPerfil) -> dict:
     """
-    Usa los filtros y pesos finales, busca en BQ, y presenta un mensaje combinado
-    con el resumen de criterios y los resultados de los coches.
+    Filtros + presupuesto + flags del estado en el formato que esperan buscar_coches_bq /
+    buscar_coches_numpy. Lo usan la búsqueda final y la paginación ("ver más coches").
+    """
+    filtros_finales_obj = state.get("filtros_inferidos")
+    economia_obj = state.get("economia")
+    filtros_para_bq = filtros_finales_obj.model_dump(mode='json', exclude_none=True)
+
+    # Comprobamos si el usuario definió su propio presupuesto o si pidió asesoramiento.
+    if economia_obj and economia_obj.presupuesto_definido is True:
+        logging.info("DEBUG (Buscar BQ) ► Modo 'Usuario Define' detectado. Añadiendo presupuesto del usuario a los filtros BQ.")
+        
+        # Usamos los valores que el usuario introdujo, infiriendo el tipo por el campo presente.
+        if economia_obj.pago_contado is not None:
+            # Si el usuario ha definido un pago al contado, usamos ese.
+            filtros_para_bq['pago_contado'] = economia_obj.pago_contado
+        elif economia_obj.cuota_max is not None:
+            # Si el usuario ha definido una cuota máxima, usamos esa.
+            filtros_para_bq['cuota_max'] = economia_obj.cuota_max
+    
+    else:
+        # Si el usuario eligió el modo "Asesoramiento" (presupuesto_definido is False),
+        # usamos los valores que calculamos en el nodo anterior y que están guardados en los filtros.
+        logging.info("DEBUG (Buscar BQ) ► Modo 'Asesoramiento' detectado. Añadiendo presupuesto calculado a los filtros BQ.")
+        
+        if filtros_finales_obj:
+            if filtros_finales_obj.modo_adquisicion_recomendado == 'Contado':
+                filtros_para_bq['pago_contado'] = filtros_finales_obj.precio_max_contado_recomendado
+            elif filtros_finales_obj.modo_adquisicion_recomendado == 'Financiado':
+                filtros_para_bq['cuota_max'] = filtros_finales_obj.cuota_max_calculada
+    
+    # Añadimos todos los flags al diccionario de filtros
+    for flag_name in state.keys():
+        if flag_name.startswith('flag_') or flag_name.startswith('penalizar_') or flag_name.startswith('favorecer_'):
+            filtros_para_bq[flag_name] = state.get(flag_name)
+    
+    filtros_para_bq['km_anuales_estimados'] = state.get("km_anuales_estimados")
+    filtros_para_bq['penalizar_puertas_bajas'] = state.get("penalizar_puertas_bajas", False)
+    filtros_para_bq['aplicar_logica_distintivo_ambiental'] = state.get("aplicar_logica_distintivo_ambiental", False)
+    filtros_para_bq['es_municipio_zbe'] = state.get("es_municipio_zbe", False)
+    filtros_para_bq['desfavorecer_carroceria_no_aventura'] = state.get("desfavorecer_carroceria_no_aventura", False)
+    filtros_para_bq['aplicar_logica_objetos_especiales'] = state.get("aplicar_logica_objetos_especiales")
+    return filtros_para_bq
+
+
+# El re-ranking incremental necesita el catálogo en memoria: solo compensa si el motor ya es NumPy
+_RERANK_INCREMENTAL = RERANK_INCREMENTAL_ACTIVO and MOTOR_BUSQUEDA_COCHES == "numpy"
+
+
+def _buscar_ranking_coches(filtros_para_bq: dict, pesos_finales: dict, thread_id: Optional[str] = None):
+    """
+    Lanza el motor de scoring con k=PAGINACION_MAX_COCHES y devuelve
+    (coches sanitizados en orden de ranking, sql, params).
+    Con thread_id, un refinamiento de la búsqueda anterior del hilo se reordena sobre
+    los candidatos en caché (utils/incremental_rerank.py) sin repetir la búsqueda.
+    """
+    k_ranking = max(PAGINACION_MAX_COCHES, PAGINACION_COCHES_POR_PAGINA)
+    resultado = None
+    if _RERANK_INCREMENTAL and thread_id:
+        resultado = reranking_incremental.reordenar(thread_id, filtros_para_bq, pesos_finales, k_ranking)
+    if resultado is None:
+        # El motor de scoring se elige por configuración (MOTOR_BUSQUEDA_COCHES)
+        funcion_busqueda = buscar_coches_numpy if MOTOR_BUSQUEDA_COCHES == "numpy" else buscar_coches_bq
+        logging.debug(f"DEBUG (Buscar BQ) ► Llamando a {funcion_busqueda.__name__} con k={k_ranking}")
+        resultado = funcion_busqueda(
+            filtros=filtros_para_bq, 
+            pesos=pesos_finales, 
+            k=k_ranking
+        )
+        if _RERANK_INCREMENTAL and thread_id:
+            reranking_incremental.registrar(thread_id, filtros_para_bq, pesos_finales)
+    coches_encontrados_raw, sql_ejecutada, params_ejecutados = resultado
+    # Sanitizamos los datos para evitar errores de JSON
+    ranking = [sanitize_dict_for_json(coche_raw) for coche_raw in (coches_encontrados_raw or [])]
+    logging.info(f"INFO (Buscar BQ) ► {len(ranking)} coches sanitizados y listos.")
+    return ranking, sql_ejecutada, params_ejecutados
+
+
+ANALISIS_PENDIENTE = "Análisis detallado de la recomendación pendiente de desarrollo."
+
+
+def _argumentos_explicaciones(state: EstadoAnalisisPerfil) -> Optional[tuple]:
+    """Argumentos de generar_explicaciones_coches(_async) tras la lista de coches; None si no se generan."""
+    if not (EXPLICACIONES_COCHES_ACTIVAS and state.get("preferencias_usuario")):
+        return None
+    return (
+        state.get("preferencias_usuario"),
+        state.get("pesos"),
+        state.get("flag_penalizar_low_cost_comodidad", False),
+        state.get("flag_penalizar_deportividad_comodidad", False),
+        state.get("flag_penalizar_antiguo_por_tecnologia", False),
+        state.get("es_municipio_zbe", False),
+        state.get("aplicar_logica_distintivo_ambiental", False),
+        state.get("penalizar_puertas_bajas", False),
+    )
+
+
+def _analisis_coches(state: EstadoAnalisisPerfil, coches: list) -> list:
+    """Explicaciones por coche para el grafo síncrono (invoke): todas en paralelo con asyncio.run."""
+    argumentos = _argumentos_explicaciones(state)
+    if argumentos is None or not coches:
+        return [ANALISIS_PENDIENTE] * len(coches)
+    return generar_explicaciones_coches(coches, *argumentos)
+
+
+async def _analisis_coches_async(state: EstadoAnalisisPerfil, coches: list) -> list:
+    """Igual que _analisis_coches, pero en el event loop de la petición (sin crear uno por búsqueda)."""
+    argumentos = _argumentos_explicaciones(state)
+    if argumentos is None or not coches:
+        return [ANALISIS_PENDIENTE] * len(coches)
+    return await generar_explicaciones_coches_async(coches, *argumentos)
+
+
+def _mensaje_recomendacion_coches(coches: list, intro: str, analisis_coches: list, primera_posicion: int = 1) -> AIMessage:
+    """Mensaje con el payload "car_recommendation" que pinta el frontend (numeración desde primera_posicion)."""
+    structured_response = {
+        "type": "car_recommendation",
+        "introText": intro,
+        "cars": []
+    }
+
+    for i, coche in enumerate(coches):
+        # Preparamos los datos de cada coche
+        nombre = coche.get('nombre', 'Coche Desconocido')
+        precio_str = "N/A"
+        if coche.get('precio_compra_contado') is not None:
+            try:
+                precio_str = f"{coche.get('precio_compra_contado'):,.0f}€".replace(",", ".")
+            except (ValueError, TypeError): pass
+
+        score_str = "N/A"
+        if coche.get('score_total') is not None:
+            try:
+                score_str = f"{coche.get('score_total'):.2f} pts"
+            except (ValueError, TypeError): pass
+
+        specs = [spec for spec in [coche.get('tipo_mecanica', ''), str(coche.get('ano_unidad', '')), coche.get('traccion', '')] if spec]
+
+        car_object = {
+            "name": f"{primera_posicion + i}. {nombre}",
+            "specs": specs,
+            "imageUrl": coche.get('foto'),
+            "price": precio_str,
+            "score": score_str,
+            "analysis": analisis_coches[i]
+        }
+        structured_response["cars"].append(car_object)
+
+    return AIMessage(
+        content=structured_response["introText"],
+        additional_kwargs={"payload": structured_response}
+    )
+
+
+def _buscar_coches_finales(state: EstadoAnalisisPerfil, config: RunnableConfig) -> dict:
+    """
+    Primera mitad de buscar_coches_finales_node: la búsqueda (BigQuery/NumPy). Devuelve el
+    contexto que necesita _cerrar_busqueda_coches_finales una vez generadas las explicaciones.
     """
     logging.info("--- Ejecutando Nodo: buscar_coches_finales_node ---") 
-    k_coches =  7
-    # Obtenemos el offset actual del estado, si no existe, empezamos en 0.
-    offset = state.get("offset_busqueda", 0)
-    historial = state.get("messages", [])
-    tabla_resumen_criterios_md = state.get("tabla_resumen_criterios", "No se pudo generar el resumen de criterios.")
+    k_coches = PAGINACION_COCHES_POR_PAGINA
     #preferencias_obj = state.get("preferencias_usuario") # Objeto PerfilUsuario
     filtros_finales_obj = state.get("filtros_inferidos") 
     pesos_finales = state.get("pesos")
-    economia_obj = state.get("economia")
-    penalizar_puertas_flag = state.get("penalizar_puertas_bajas", False)
-    flag_penalizar_lc_comod = state.get("flag_penalizar_low_cost_comodidad", False)
-    flag_penalizar_dep_comod = state.get("flag_penalizar_deportividad_comodidad", False)
-    flag_penalizar_antiguo_tec_val = state.get("flag_penalizar_antiguo_por_tecnologia", False)
-    flag_aplicar_distintivo_val = state.get("aplicar_logica_distintivo_ambiental", False)
-    flag_es_zbe_val = state.get("es_municipio_zbe", False)
-    flag_desfav_car_no_aventura_val = state.get("desfavorecer_carroceria_no_aventura", False)
-    flag_aplicar_logica_objetos_especiales= state.get("aplicar_logica_objetos_especiales")
-    flag_pen_bev_reev_avent_ocas = state.get("penalizar_bev_reev_aventura_ocasional", False)
-    flag_pen_phev_avent_ocas= state.get("penalizar_phev_aventura_ocasional", False)
-    flag_pen_electrif_avent_extr = state.get("penalizar_electrificados_aventura_extrema", False)
-    flag_fav_car_montana_val = state.get("favorecer_carroceria_montana", False)
-    flag_fav_car_comercial_val = state.get("favorecer_carroceria_comercial", False)
-    flag_fav_car_pasajeros_pro_val = state.get("favorecer_carroceria_pasajeros_pro", False)
-    flag_fav_suv_aventura_ocasional = state.get("favorecer_suv_aventura_ocasional")
-    flag_fav_pickup_todoterreno_aventura_extrema = state.get("favorecer_pickup_todoterreno_aventura_extrema")
-    flag_fav_carroceria_confort= state.get("favorecer_carroceria_confort")
-    flag_logica_uso_ocasional = state.get("flag_logica_uso_ocasional")
-    flag_favorecer_bev_uso_definido = state.get("flag_favorecer_bev_uso_definido")
-    flag_penalizar_phev_uso_intensivo = state.get("flag_penalizar_phev_uso_intensivo")
-    flag_favorecer_electrificados_por_punto_carga = state.get("flag_favorecer_electrificados_por_punto_carga")
-    flag_logica_diesel_ciudad= state.get("flag_logica_diesel_ciudad")
-    penalizar_awd_ninguna_val = state.get("penalizar_awd_ninguna_aventura", False)
-    favorecer_awd_ocasional_val = state.get("favorecer_awd_aventura_ocasional", False)
-    favorecer_awd_extrema_val = state.get("favorecer_awd_aventura_extrema", False)
-    flag_bonus_nieve_val = state.get("flag_bonus_awd_nieve", False)
-    flag_bonus_montana_val = state.get("flag_bonus_awd_montana", False)
-    flag_reductoras_aventura_val = state.get("flag_logica_reductoras_aventura")
-    flag_bonus_awd_clima_adverso = state.get("flag_bonus_awd_clima_adverso")
-    flag_bonus_seguridad_critico = state.get("flag_bonus_seguridad_critico")
-    flag_bonus_seguridad_fuerte = state.get("flag_bonus_seguridad_fuerte")
-    flag_bonus_fiab_dur_critico = state.get("flag_bonus_fiab_dur_critico")
-    flag_bonus_fiab_dur_fuerte = state.get("flag_bonus_fiab_dur_fuerte")
-    flag_bonus_costes_critico = state.get("flag_bonus_costes_critico")
-    flag_penalizar_tamano_no_compacto = state.get("flag_penalizar_tamano_no_compacto")
-    flag_bonus_singularidad_lifestyle = state.get("flag_bonus_singularidad_lifestyle")
-    flag_deportividad_lifestyle = state.get("flag_deportividad_lifestyle")
-    flag_ajuste_maletero_personal = state.get("flag_ajuste_maletero_personal")
-    flag_coche_ciudad_perfil = state.get("flag_coche_ciudad_perfil")
-    flag_coche_ciudad_2_perfil = state.get("flag_coche_ciudad_2_perfil")
-    flag_es_conductor_urbano = state.get("flag_es_conductor_urbano")
-    km_anuales_val = state.get("km_anuales_estimados")
     configurable_config = config.get("configurable", {})
     thread_id = configurable_config.get("thread_id", "unknown_thread_in_node") #
 
     logging.info(f"INFO (Buscar BQ) ► Ejecutando búsqueda para thread_id: {thread_id}")
     
     final_ai_msg = None
-    coches_encontrados_raw = [] 
     coches_encontrados = []
     sql_ejecutada = None 
     params_ejecutados = None 
+    filtros_para_bq = {}
     
     #mensaje_coches = "No pude realizar la búsqueda de coches en este momento." # Default para la parte de coches
     # --- 2. BÚSQUEDA EN BIGQUERY ---
     if filtros_finales_obj and pesos_finales:
         try:
             # --- 2.1. PREPARACIÓN DE FILTROS PARA BQ ---
-            filtros_para_bq = filtros_finales_obj.model_dump(mode='json', exclude_none=True)
-
-            # Comprobamos si el usuario definió su propio presupuesto o si pidió asesoramiento.
-            if economia_obj and economia_obj.presupuesto_definido is True:
-                logging.info("DEBUG (Buscar BQ) ► Modo 'Usuario Define' detectado. Añadiendo presupuesto del usuario a los filtros BQ.")
-                
-                # Usamos los valores que el usuario introdujo, infiriendo el tipo por el campo presente.
-                if economia_obj.pago_contado is not None:
-                    # Si el usuario ha definido un pago al contado, usamos ese.
-                    filtros_para_bq['pago_contado'] = economia_obj.pago_contado
-                elif economia_obj.cuota_max is not None:
-                    # Si el usuario ha definido una cuota máxima, usamos esa.
-                    filtros_para_bq['cuota_max'] = economia_obj.cuota_max
-            
-            else:
-                # Si el usuario eligió el modo "Asesoramiento" (presupuesto_definido is False),
-                # usamos los valores que calculamos en el nodo anterior y que están guardados en los filtros.
-                logging.info("DEBUG (Buscar BQ) ► Modo 'Asesoramiento' detectado. Añadiendo presupuesto calculado a los filtros BQ.")
-                
-                if filtros_finales_obj:
-                    if filtros_finales_obj.modo_adquisicion_recomendado == 'Contado':
-                        filtros_para_bq['pago_contado'] = filtros_finales_obj.precio_max_contado_recomendado
-                    elif filtros_finales_obj.modo_adquisicion_recomendado == 'Financiado':
-                        filtros_para_bq['cuota_max'] = filtros_finales_obj.cuota_max_calculada
-            
-            # Añadimos todos los flags al diccionario de filtros
-            for flag_name in state.keys():
-                if flag_name.startswith('flag_') or flag_name.startswith('penalizar_') or flag_name.startswith('favorecer_'):
-                    filtros_para_bq[flag_name] = state.get(flag_name)
-            
-            filtros_para_bq['km_anuales_estimados'] = km_anuales_val
-            filtros_para_bq['penalizar_puertas_bajas'] = penalizar_puertas_flag
-            filtros_para_bq['aplicar_logica_distintivo_ambiental'] = flag_aplicar_distintivo_val
-            filtros_para_bq['es_municipio_zbe'] = flag_es_zbe_val
-            filtros_para_bq['desfavorecer_carroceria_no_aventura'] = flag_desfav_car_no_aventura_val
-            filtros_para_bq['aplicar_logica_objetos_especiales'] = flag_aplicar_logica_objetos_especiales
-
+            filtros_para_bq = _filtros_para_busqueda(state)
             logging.debug(f"DEBUG (Buscar BQ) ► Filtros para BQ: {filtros_para_bq}") 
             logging.debug(f"DEBUG (Buscar BQ) ► Pesos para BQ: {pesos_finales}") 
-            
 
-            resultados_tupla = buscar_coches_bq(
-                filtros=filtros_para_bq, 
-                pesos=pesos_finales, 
-                k=k_coches
-            )
-            logging.debug(f"DEBUG (Buscar BQ) ► Llamando a buscar_coches_bq con k={k_coches}")
-            # Desempaquetamos el resultado de la búsqueda
-            coches_encontrados_raw, sql_ejecutada, params_ejecutados = resultados_tupla
-            
-            # Sanitizamos los datos para evitar errores de JSON
-            if coches_encontrados_raw:
-                for coche_raw in coches_encontrados_raw:
-                    coches_encontrados.append(sanitize_dict_for_json(coche_raw))
-                logging.info(f"INFO (Buscar BQ) ► {len(coches_encontrados)} coches sanitizados y listos.")
+            # Se pide el ranking completo (mismo coste de scoring) y se enseña la primera página;
+            # el resto queda en cache_rankings para "ver más coches".
+            ranking, sql_ejecutada, params_ejecutados = _buscar_ranking_coches(filtros_para_bq, pesos_finales, thread_id)
+            cache_rankings.guardar(thread_id, ranking)
+            coches_encontrados = ranking[:k_coches]
 
         except Exception as e_bq:
             logging.error(f"ERROR (Buscar BQ) ► Falló la ejecución de buscar_coches_bq: {e_bq}", exc_info=True)
@@ -1727,48 +1887,41 @@ def buscar_coches_finales_node(state: EstadoAnalisisPerfil, config: RunnableConf
     else:
         logging.error("ERROR (Buscar BQ) ► Faltan filtros o pesos finales en el estado para la búsqueda.")
         final_ai_msg = AIMessage(content="Lo siento, falta información interna para realizar la búsqueda final.")
-    
+    return {
+        "thread_id": thread_id,
+        "coches_encontrados": coches_encontrados,
+        "final_ai_msg": final_ai_msg,
+        "sql_ejecutada": sql_ejecutada,
+        "params_ejecutados": params_ejecutados,
+        "filtros_para_bq": filtros_para_bq,
+    }
+
+
+def _cerrar_busqueda_coches_finales(state: EstadoAnalisisPerfil, busqueda: dict, analisis_coches: list) -> dict:
+    """
+    Segunda mitad de buscar_coches_finales_node: mensaje final (con las explicaciones ya
+    generadas), encolado del log en BigQuery y delta del estado.
+    """
+    thread_id = busqueda["thread_id"]
+    coches_encontrados = busqueda["coches_encontrados"]
+    final_ai_msg = busqueda["final_ai_msg"]
+    sql_ejecutada = busqueda["sql_ejecutada"]
+    params_ejecutados = busqueda["params_ejecutados"]
+    filtros_para_bq = busqueda["filtros_para_bq"]
+    tabla_resumen_criterios_md = state.get("tabla_resumen_criterios", "No se pudo generar el resumen de criterios.")
+    filtros_finales_obj = state.get("filtros_inferidos") 
+    pesos_finales = state.get("pesos")
+    economia_obj = state.get("economia")
+
     # --- 3. CONSTRUCCIÓN DEL MENSAJE FINAL (LÓGICA CORREGIDA) ---
     if final_ai_msg is None: # Si no hubo un error previo en la búsqueda
         if coches_encontrados:
             # --- CASO A: Se encontraron coches ---
             try:
-                structured_response = {
-                    "type": "car_recommendation",
-                    "introText": f"¡Listo! Basado en todo lo que hablamos, aquí tienes {len(coches_encontrados)} coche(s) que podrían interesarte:",
-                    "cars": []
-                }
-                
-                for i, coche in enumerate(coches_encontrados):
-                    # Preparamos los datos de cada coche
-                    nombre = coche.get('nombre', 'Coche Desconocido')
-                    precio_str = "N/A"
-                    if coche.get('precio_compra_contado') is not None:
-                        try:
-                            precio_str = f"{coche.get('precio_compra_contado'):,.0f}€".replace(",", ".")
-                        except (ValueError, TypeError): pass
-
-                    score_str = "N/A"
-                    if coche.get('score_total') is not None:
-                        try:
-                            score_str = f"{coche.get('score_total'):.2f} pts"
-                        except (ValueError, TypeError): pass
-
-                    specs = [spec for spec in [coche.get('tipo_mecanica', ''), str(coche.get('ano_unidad', '')), coche.get('traccion', '')] if spec]
-
-                    car_object = {
-                        "name": f"{i+1}. {nombre}",
-                        "specs": specs,
-                        "imageUrl": coche.get('foto'),
-                        "price": precio_str,
-                        "score": score_str,
-                        "analysis": "Análisis detallado de la recomendación pendiente de desarrollo."
-                    }
-                    structured_response["cars"].append(car_object)
-
-                final_ai_msg = AIMessage(
-                    content=structured_response["introText"],
-                    additional_kwargs={"payload": structured_response}
+                final_ai_msg = _mensaje_recomendacion_coches(
+                    coches_encontrados,
+                    f"¡Listo! Basado en todo lo que hablamos, aquí tienes {len(coches_encontrados)} coche(s) que podrían interesarte:",
+                    analisis_coches,
                 )
             except Exception as e:
                 logging.error(f"ERROR (Buscar BQ) ► Fallo al construir la respuesta estructurada: {e}", exc_info=True)
@@ -1811,13 +1964,8 @@ def buscar_coches_finales_node(state: EstadoAnalisisPerfil, config: RunnableConf
             mensaje_final_texto = _sugerencia_generada or "He aplicado todos tus filtros, pero no encontré coches que coincidan exactamente. ¿Quizás quieras redefinir algún criterio general?"
             final_ai_msg = AIMessage(content=mensaje_final_texto)    
                 
-    # --- 4. ACTUALIZACIÓN DEL HISTORIAL Y RETORNO ---
-    historial_final = list(historial)
-    if final_ai_msg:
-        historial_final.append(final_ai_msg)     
-        
-    # --- 5. LOGGING A BIGQUERY (sin cambios) ---       
-    # Logueo a BigQuery (como lo tenías)
+    # --- 4. LOGGING A BIGQUERY ---
+    # Solo encola la fila: la inserción la hace el hilo de fondo de utils/bq_logger.py
     if filtros_finales_obj and pesos_finales: 
         try:
             log_busqueda_a_bigquery(
@@ -1838,63 +1986,136 @@ def buscar_coches_finales_node(state: EstadoAnalisisPerfil, config: RunnableConf
 #     # --- FIN LLAMADA AL LOGGER ---
         pass # Placeholder
 
-    # Devolver estado final
-    return {
-        "messages": historial_final,
+    # --- 5. RETORNO ---
+    # Solo lo que produce este nodo: add_messages añade el mensaje al historial y el resto
+    # de claves (filtros, pesos, flags...) ya están en el estado y no se reescriben.
+    delta = {
+        "messages": [final_ai_msg] if final_ai_msg else [],
         "coches_recomendados": coches_encontrados, 
-        "tabla_resumen_criterios": tabla_resumen_criterios_md, # Propagar la tabla (útil para logging)
-        # Propagar otros campos del estado que no se modifican aquí pero son necesarios
-        "preferencias_usuario": state.get("preferencias_usuario"),
-        "info_pasajeros": state.get("info_pasajeros"),
-        "filtros_inferidos": filtros_finales_obj, 
-        "economia": economia_obj, 
-        "pesos": pesos_finales, 
-        "penalizar_puertas_bajas": penalizar_puertas_flag, 
-       # "priorizar_ancho": state.get("priorizar_ancho"), 
-        "flag_penalizar_low_cost_comodidad": flag_penalizar_lc_comod,
-        "flag_penalizar_deportividad_comodidad": flag_penalizar_dep_comod, 
-        "flag_penalizar_antiguo_por_tecnologia": flag_penalizar_antiguo_tec_val,
-        "aplicar_logica_distintivo_ambiental": flag_aplicar_distintivo_val,
-        "es_municipio_zbe": flag_es_zbe_val, 
-        "penalizar_bev_reev_aventura_ocasional": flag_pen_bev_reev_avent_ocas,
-        "penalizar_phev_aventura_ocasional": flag_pen_phev_avent_ocas,
-        "penalizar_electrificados_aventura_extrema": flag_pen_electrif_avent_extr,
-        "codigo_postal_usuario": state.get("codigo_postal_usuario"),
-        "info_clima_usuario": state.get("info_clima_usuario"),
-        "favorecer_carroceria_montana": flag_fav_car_montana_val,
-        "favorecer_carroceria_comercial": flag_fav_car_comercial_val,
-        "favorecer_carroceria_pasajeros_pro": flag_fav_car_pasajeros_pro_val,
-        "desfavorecer_carroceria_no_aventura": flag_desfav_car_no_aventura_val,
-        "favorecer_suv_aventura_ocasional" : flag_fav_suv_aventura_ocasional,
-        'favorecer_pickup_todoterreno_aventura_extrema' : flag_fav_pickup_todoterreno_aventura_extrema,
-        'aplicar_logica_objetos_especiales' : flag_aplicar_logica_objetos_especiales,
-        'favorecer_carroceria_confort' : flag_fav_carroceria_confort,
-        'flag_logica_uso_ocasional' : flag_logica_uso_ocasional,
-        'flag_favorecer_bev_uso_definido' : flag_favorecer_bev_uso_definido,
-        'flag_penalizar_phev_uso_intensivo': flag_penalizar_phev_uso_intensivo,
-        'flag_favorecer_electrificados_por_punto_carga': flag_favorecer_electrificados_por_punto_carga,
-        'flag_logica_diesel_ciudad': flag_logica_diesel_ciudad ,
-        'penalizar_awd_ninguna_aventura' : penalizar_awd_ninguna_val,
-        'favorecer_awd_aventura_ocasional' : favorecer_awd_ocasional_val,
-        'favorecer_awd_aventura_extrema' : favorecer_awd_extrema_val,
-        'flag_logica_reductoras_aventura' :flag_reductoras_aventura_val,
-        'flag_bonus_awd_clima_adverso' : flag_bonus_awd_clima_adverso,
-        'flag_bonus_seguridad_critico': flag_bonus_seguridad_critico,
-        'flag_bonus_seguridad_fuerte' : flag_bonus_seguridad_fuerte ,
-        'flag_bonus_fiab_dur_critico' : flag_bonus_fiab_dur_critico,
-        'flag_bonus_fiab_dur_fuerte' : flag_bonus_fiab_dur_fuerte ,
-        'flag_bonus_costes_critico' : flag_bonus_costes_critico,
-        "flag_penalizar_tamano_no_compacto": flag_penalizar_tamano_no_compacto,
-        "flag_bonus_singularidad_lifestyle" : flag_bonus_singularidad_lifestyle,
-        "flag_deportividad_lifestyle": flag_deportividad_lifestyle,
-        "flag_coche_ciudad_perfil" : flag_coche_ciudad_perfil,
-        "flag_coche_ciudad_2_perfil" : flag_coche_ciudad_2_perfil,
-        "flag_es_conductor_urbano": flag_es_conductor_urbano,
-        "flag_ajuste_maletero_personal": flag_ajuste_maletero_personal,
-        "flag_bonus_nieve_val": flag_bonus_nieve_val,
-        "flag_bonus_montana_val": flag_bonus_montana_val,
-        "pregunta_pendiente": None # Este nodo es final para el turno
-        
+        "offset_busqueda": len(coches_encontrados), # Siguiente posición del ranking para "ver más coches"
     }
+    if state.get("pregunta_pendiente") is not None:
+        delta["pregunta_pendiente"] = None # Este nodo es final para el turno
+    return delta
+
+ 
+
+
+def buscar_coches_finales_node(state: EstadoAnalisisPerfil, config: RunnableConfig) -> dict:
+    """
+    Usa los filtros y pesos finales, busca en BQ, y presenta un mensaje combinado
+    con el resumen de criterios y los resultados de los coches.
+    """
+    busqueda = _buscar_coches_finales(state, config)
+    analisis = _analisis_coches(state, busqueda["coches_encontrados"]) if busqueda["final_ai_msg"] is None else []
+    return _cerrar_busqueda_coches_finales(state, busqueda, analisis)
+
+
+async def buscar_coches_finales_node_async(state: EstadoAnalisisPerfil, config: RunnableConfig) -> dict:
+    """
+    Variante async: la búsqueda en BigQuery/NumPy va en un hilo para no bloquear el event loop;
+    las explicaciones por coche se esperan directamente en el loop de la petición.
+    """
+    busqueda = await asyncio.to_thread(_buscar_coches_finales, state, config)
+    analisis = await _analisis_coches_async(state, busqueda["coches_encontrados"]) if busqueda["final_ai_msg"] is None else []
+    return _cerrar_busqueda_coches_finales(state, busqueda, analisis)
+
+
+def _pagina_mas_coches(state: EstadoAnalisisPerfil, config: RunnableConfig):
+    """
+    Siguiente página del ranking guardado por buscar_coches_finales_node; si ya no está en
+    memoria, repite solo la búsqueda. Devuelve (offset, página) o un delta final si no hay página.
+    """
+    logging.info("--- Ejecutando Nodo: mostrar_mas_coches_node ---")
+    k_coches = PAGINACION_COCHES_POR_PAGINA
+    thread_id = config.get("configurable", {}).get("thread_id", "unknown_thread_in_node")
+    offset = state.get("offset_busqueda") or len(state.get("coches_recomendados") or [])
+
+    ranking = cache_rankings.obtener(thread_id)
+    if ranking is None:
+        logging.info(f"INFO (Más coches) ► Ranking de {thread_id} no está en caché. Repitiendo solo la búsqueda.")
+        try:
+            ranking, _, _ = _buscar_ranking_coches(_filtros_para_busqueda(state), state.get("pesos"), thread_id)
+            cache_rankings.guardar(thread_id, ranking)
+        except Exception as e:
+            logging.error(f"ERROR (Más coches) ► Falló la búsqueda para paginar: {e}", exc_info=True)
+            return {"messages": [AIMessage(content="Lo siento, no he podido recuperar más coches en este momento.")]}
+
+    pagina = ranking[offset:offset + k_coches]
+    logging.info(f"INFO (Más coches) ► Posiciones {offset + 1}-{offset + len(pagina)} de {len(ranking)} para {thread_id}.")
+    if not pagina:
+        return {"messages": [AIMessage(content=(
+            "Ya te he mostrado todos los coches que encajan con tus criterios. "
+            "Si quieres, podemos ajustar algún criterio para ampliar la búsqueda."
+        ))]}
+    return offset, pagina
+
+
+def _mensaje_pagina_mas_coches(offset: int, pagina: list, analisis_coches: list) -> dict:
+    try:
+        mensaje = _mensaje_recomendacion_coches(
+            pagina,
+            f"Aquí tienes {len(pagina)} opción(es) más que también encajan contigo:",
+            analisis_coches,
+            primera_posicion=offset + 1,
+        )
+    except Exception as e:
+        logging.error(f"ERROR (Más coches) ► Fallo al construir la respuesta estructurada: {e}", exc_info=True)
+        mensaje = AIMessage(content="Lo siento, tuve un problema al formatear los resultados.")
+    return {"messages": [mensaje], "offset_busqueda": offset + len(pagina)}
+
+
+def mostrar_mas_coches_node(state: EstadoAnalisisPerfil, config: RunnableConfig) -> dict:
+    """
+    Siguiente página de recomendaciones. Sirve el slice [offset, offset + k) del ranking
+    guardado por buscar_coches_finales_node; si ya no está en memoria, repite solo la
+    búsqueda con los filtros, flags y pesos del estado (sin recalcular nada más ni llamar a los extractores).
+    """
+    resultado = _pagina_mas_coches(state, config)
+    if isinstance(resultado, dict):
+        return resultado
+    offset, pagina = resultado
+    return _mensaje_pagina_mas_coches(offset, pagina, _analisis_coches(state, pagina))
+
+
+async def mostrar_mas_coches_node_async(state: EstadoAnalisisPerfil, config: RunnableConfig) -> dict:
+    """Variante async: el fallback de búsqueda va en un hilo; las explicaciones, en el loop de la petición."""
+    resultado = await asyncio.to_thread(_pagina_mas_coches, state, config)
+    if isinstance(resultado, dict):
+        return resultado
+    offset, pagina = resultado
+    return _mensaje_pagina_mas_coches(offset, pagina, await _analisis_coches_async(state, pagina))
+
+
+def refinar_busqueda_node(state: EstadoAnalisisPerfil) -> dict:
+    """
+    Refinamiento tras enseñar los coches ("más baratos", "más caros"). Ajusta el presupuesto
+    que usa _filtros_para_busqueda (el del usuario o el calculado en Modo 1) y vacía
+    coches_recomendados para que buscar_coches_finales repita la búsqueda; con el re-ranking
+    incremental activo, un presupuesto más estricto se reordena sobre los candidatos en caché.
+    """
+    logging.info("--- Ejecutando Nodo: refinar_busqueda_node ---")
+    messages = state.get("messages") or []
+    direccion = detectar_refinamiento_presupuesto(messages[-1].content) if messages else None
+    factor = REFINAMIENTO_FACTOR_MAS_BARATO if direccion == "mas_barato" else REFINAMIENTO_FACTOR_MAS_CARO
+    delta = {"coches_recomendados": None, "offset_busqueda": 0}
+
+    economia_obj = state.get("economia")
+    filtros_obj = state.get("filtros_inferidos")
+    if economia_obj and economia_obj.presupuesto_definido is True:
+        campo = "pago_contado" if economia_obj.pago_contado is not None else "cuota_max"
+        valor = getattr(economia_obj, campo)
+        if valor is not None:
+            delta["economia"] = economia_obj.model_copy(update={campo: round(valor * factor, 2)})
+    elif filtros_obj:
+        campo = "precio_max_contado_recomendado" if filtros_obj.modo_adquisicion_recomendado == "Contado" else "cuota_max_calculada"
+        valor = getattr(filtros_obj, campo)
+        if valor is not None:
+            delta["filtros_inferidos"] = filtros_obj.model_copy(update={campo: round(valor * factor, 2)})
+
+    if "economia" in delta or "filtros_inferidos" in delta:
+        logging.info(f"INFO (Refinar) ► {direccion}: {campo} {valor} -> {round(valor * factor, 2)}.")
+    else:
+        logging.warning("WARN (Refinar) ► No hay presupuesto en el estado que ajustar. Se repite la búsqueda tal cual.")
+    return delta
 
- 
\ No newline at end of file
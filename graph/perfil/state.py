@@ -263,7 +263,7 @@ class EstadoAnalisisPerfil(TypedDict):
     flag_coche_ciudad_2_perfil: Optional[bool]
     km_anuales_estimados: Optional[int]
     tabla_resumen_criterios: Optional[str]
-    # offset_busqueda: int # Para la paginación de resultados
+    offset_busqueda: Optional[int] # Siguiente posición del ranking a mostrar (paginación)
     # ultima_busqueda_realizada: Optional[Dict[str, Any]]
 
 
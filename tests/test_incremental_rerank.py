@@ -0,0 +1,71 @@
+# tests/test_incremental_rerank.py
+# Un refinamiento que estrecha el presupuesto se reordena sobre los candidatos guardados
+# (sin búsqueda completa) y da el mismo ranking que buscar_coches_numpy.
+import numpy as np
+import pandas as pd
+import pytest
+
+import utils.incremental_rerank as incremental_rerank
+import utils.numpy_scoring as numpy_scoring
+from utils.conversion import detectar_refinamiento_presupuesto
+from utils.incremental_rerank import RerankingIncremental
+from utils.numpy_scoring import CatalogoNumpy, buscar_coches_numpy
+
+PESOS = {"estetica": 0.3, "premium": 0.2, "rating_seguridad": 0.5}
+
+
+@pytest.fixture
+def catalogo(monkeypatch):
+    rng = np.random.default_rng(7)
+    n = 60
+    df = pd.DataFrame({
+        "nombre": [f"Coche {i}" for i in range(n)],
+        "marca": [f"Marca {i % 12}" for i in range(n)],
+        "modelo": [f"Modelo {i}" for i in range(n)],
+        "tipo_mecanica": ["GASOLINA"] * n,
+        "cambio_automatico": [bool(i % 2) for i in range(n)],
+        "plazas": [5] * n,
+        "precio_compra_contado": rng.uniform(10000, 40000, n).round(0),
+        "estetica": rng.uniform(1, 10, n),
+        "premium": rng.uniform(1, 10, n),
+        "seguridad": rng.uniform(1, 10, n),
+    })
+    cat = CatalogoNumpy(df)
+    monkeypatch.setattr(incremental_rerank, "obtener_catalogo", lambda: cat)
+    monkeypatch.setattr(numpy_scoring, "obtener_catalogo", lambda: cat)
+    return cat
+
+
+def test_refinamiento_mas_barato_reutiliza_candidatos(catalogo):
+    rerank = RerankingIncremental(max_sesiones=10, ttl_seg=60)
+    rerank.registrar("hilo", {"pago_contado": 30000}, PESOS)
+    candidatos = rerank._sesiones["hilo"].idx
+
+    filtros_refinados = {"pago_contado": 30000 * 0.85}
+    resultado = rerank.reordenar("hilo", filtros_refinados, PESOS, k=10)
+
+    assert resultado is not None
+    assert rerank.sin_sesion == 0 and rerank.ampliaciones == 0
+    assert rerank._sesiones["hilo"].idx is candidatos
+    esperado = buscar_coches_numpy(filtros_refinados, PESOS, k=10)[0]
+    assert [c["nombre"] for c in resultado[0]] == [c["nombre"] for c in esperado]
+    assert [c["score_total"] for c in resultado[0]] == pytest.approx([c["score_total"] for c in esperado])
+
+
+def test_presupuesto_fuera_de_la_banda_repite_busqueda(catalogo):
+    rerank = RerankingIncremental(max_sesiones=10, ttl_seg=60)
+    rerank.registrar("hilo", {"pago_contado": 15000}, PESOS)
+
+    assert rerank.reordenar("hilo", {"pago_contado": 40000}, PESOS, k=10) is None
+    assert rerank.ampliaciones == 1
+
+
+@pytest.mark.parametrize("texto, esperado", [
+    ("quiero otros coches más baratos", "mas_barato"),
+    ("¿algo más económico?", "mas_barato"),
+    ("puedo subir el presupuesto", "mas_caro"),
+    ("no quiero más baratos", None),
+    ("ver más coches", None),
+])
+def test_detectar_refinamiento_presupuesto(texto, esperado):
+    assert detectar_refinamiento_presupuesto(texto) == esperado
@@ -0,0 +1,82 @@
+# tests/test_state_delta.py
+# Los nodos refactorizados a deltas, envueltos con la guarda del builder (GUARDA_DELTA_ESTADO),
+# no devuelven claves que no cambian el estado ni mensajes que ya estaban en el historial.
+import pytest
+
+pytest.importorskip("langgraph")
+pytest.importorskip("langchain")
+
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.runnables import RunnableLambda
+
+import graph.perfil.nodes as nodes
+from graph.perfil.builder import _con_guarda_delta
+from graph.perfil.condition import route_based_on_state_node
+from graph.perfil.state import FiltrosInferidos
+from utils.state_delta import claves_sin_cambios, metricas_delta_estado
+
+CONFIG = {"configurable": {"thread_id": "test-delta"}}
+
+
+def _ejecutar_con_guarda(nombre, nodo, state):
+    delta = _con_guarda_delta(nombre, RunnableLambda(nodo)).invoke(state, CONFIG)
+    assert claves_sin_cambios(state, delta) == []
+    assert metricas_delta_estado.estadisticas()[nombre]["claves_sin_cambios"] == 0
+    return delta
+
+
+def _historial():
+    return [AIMessage(content="Hola, ¿qué coche buscas?"), HumanMessage(content="Uno familiar")]
+
+
+@pytest.mark.parametrize("nombre, nodo", [
+    ("router", route_based_on_state_node),
+    ("preguntar_cp", nodes.preguntar_cp_node),
+    ("preguntar_info_pasajeros", nodes.preguntar_info_pasajeros_node),
+    ("preguntar_economia", nodes.preguntar_economia_node),
+    ("generar_mensaje_transicion", nodes.generar_mensaje_transicion_perfil),
+    ("generar_mensaje_transicion_pasajeros", nodes.generar_mensaje_transicion_pasajeros),
+    ("construir_filtros", nodes.construir_filtros_node),
+    ("formatear_tabla_resumen", nodes.formatear_tabla_resumen_node),
+])
+def test_nodos_devuelven_solo_deltas(nombre, nodo):
+    state = {"messages": _historial(), "pregunta_pendiente": None, "filtros_inferidos": FiltrosInferidos()}
+    _ejecutar_con_guarda(nombre, nodo, state)
+
+
+def test_calcular_flags_no_reescribe_penalizar_puertas_bajas():
+    state = {"messages": _historial(), "penalizar_puertas_bajas": True}
+    delta = _ejecutar_con_guarda("calcular_flags_dinamicos", nodes.calcular_flags_dinamicos_node, state)
+    assert "penalizar_puertas_bajas" not in delta
+
+
+def test_buscar_coches_finales_devuelve_solo_mensaje_coches_y_offset(monkeypatch):
+    coches = [{"nombre": "Coche 1", "precio_compra_contado": 20000, "score_total": 80.0}]
+    monkeypatch.setattr(nodes, "_buscar_ranking_coches", lambda filtros, pesos, thread_id=None: (coches, "SELECT", []))
+    monkeypatch.setattr(nodes, "log_busqueda_a_bigquery", lambda **kwargs: None)
+    state = {
+        "messages": _historial(),
+        "filtros_inferidos": FiltrosInferidos(),
+        "pesos": {"estetica": 1.0},
+        "pregunta_pendiente": None,
+        "coches_recomendados": None,
+    }
+    delta = _ejecutar_con_guarda("buscar_coches_finales", nodes.buscar_coches_finales_node, state)
+    assert set(delta) == {"messages", "coches_recomendados", "offset_busqueda"}
+
+
+def test_builder_envuelve_todos_los_nodos_con_la_guarda():
+    from langgraph.graph import StateGraph
+    from graph.perfil.builder import aplicar_guarda_delta
+    from graph.perfil.state import EstadoAnalisisPerfil
+
+    workflow = StateGraph(EstadoAnalisisPerfil)
+    workflow.add_node("router", route_based_on_state_node)
+    workflow.add_node("preguntar_cp", nodes.preguntar_cp_node)
+    aplicar_guarda_delta(workflow)
+
+    state = {"messages": _historial()}
+    for nombre, spec in workflow.nodes.items():
+        delta = spec.runnable.invoke(state, CONFIG)
+        assert claves_sin_cambios(state, delta) == []
+        assert metricas_delta_estado.estadisticas()[nombre]["claves_sin_cambios"] == 0
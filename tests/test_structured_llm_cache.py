@@ -0,0 +1,56 @@
+# tests/test_structured_llm_cache.py
+# La caché de LLMs estructurados no debe servir a una conversación el resultado extraído
+# con el contexto de otra (mismo último turno, turnos anteriores distintos).
+from typing import Optional
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from pydantic import BaseModel
+
+from utils.structured_llm_cache import LLMEstructuradoConCache
+
+
+class InfoPrueba(BaseModel):
+    num_ninos_silla: Optional[int] = None
+    num_otros_pasajeros: Optional[int] = None
+
+
+class LLMFalso:
+    """Devuelve los niños en silla solo si algún mensaje del contexto los menciona."""
+
+    def __init__(self):
+        self.llamadas = 0
+
+    def invoke(self, mensajes, config=None, **kwargs):
+        self.llamadas += 1
+        menciona_silla = any("silla" in str(m.content) for m in mensajes[:-1])
+        return InfoPrueba(num_ninos_silla=1 if menciona_silla else None, num_otros_pasajeros=int(mensajes[-1].content))
+
+
+SISTEMA = SystemMessage(content="Extrae la información de pasajeros.")
+PREGUNTA = AIMessage(content="¿Cuántas personas suelen viajar contigo?")
+
+
+def test_contexto_distinto_con_mismo_ultimo_turno_no_comparte_entrada():
+    llm = LLMFalso()
+    cache = LLMEstructuradoConCache(llm, "pasajeros", max_entradas=10)
+
+    conversacion_a = [SISTEMA, AIMessage(content="¿Viajas con niños?"), HumanMessage(content="Sí, uno en silla"), PREGUNTA, HumanMessage(content="2")]
+    conversacion_b = [SISTEMA, AIMessage(content="¿Viajas con niños?"), HumanMessage(content="No"), PREGUNTA, HumanMessage(content="2")]
+
+    resultado_a = cache.invoke(conversacion_a)
+    resultado_b = cache.invoke(conversacion_b)
+
+    assert llm.llamadas == 2
+    assert resultado_a.num_ninos_silla == 1
+    assert resultado_b.num_ninos_silla is None
+
+
+def test_mismo_contexto_normalizado_acierta():
+    llm = LLMFalso()
+    cache = LLMEstructuradoConCache(llm, "pasajeros", max_entradas=10)
+
+    cache.invoke([SISTEMA, PREGUNTA, HumanMessage(content="2")])
+    resultado = cache.invoke([SISTEMA, PREGUNTA, HumanMessage(content=" 2. ")])
+
+    assert llm.llamadas == 1
+    assert resultado.num_otros_pasajeros == 2
@@ -0,0 +1,300 @@
+# utils/batch_scoring.py
+# Scoring por lotes: rankea el catálogo completo para N perfiles (filtros, pesos) de una vez.
+#
+# Para el análisis offline y el ajuste A/B de los bonus de config/settings.py había que
+# relanzar conversaciones enteras y ver cómo cambiaba el ranking. Aquí cada perfil es un
+# par (filtros, pesos) —sacado de los logs de historial_busquedas_agente o de un fichero
+# sintético— y el catálogo en memoria del motor NumPy (utils/numpy_scoring.py) se puntúa
+# para todos a la vez:
+#   - Términos ponderados (puntuacion_base y bonus de ratings/costes): una multiplicación
+#     matricial (N x F) @ (F x coches) con la matriz de pesos del índice canónico
+#     (utils/weights_index.py) y las columnas escaladas del catálogo.
+#   - Ajustes de experto: no dependen de los pesos, solo de los flags, así que se calculan
+#     una vez por combinación distinta de flags y se suman como vector.
+#   - Filtros WHERE: una máscara por combinación distinta de filtros.
+#   - Dedup por (modelo, tipo_mecanica), máximo 2 por marca y top k: igual que la búsqueda.
+# Los perfiles se procesan en bloques de BATCH_SCORING_BLOQUE_PERFILES para acotar la memoria.
+#
+# Uso:
+#   python -m utils.batch_scoring --historial 1000 --k 7 --salida rankings.jsonl
+#   python -m utils.batch_scoring --perfiles perfiles.jsonl      (una línea {"filtros": {...}, "pesos": {...}})
+import argparse
+import json
+import logging
+import time
+import traceback
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from google.cloud import bigquery
+
+from config.settings import FACTOR_ESCALA_BASE, BATCH_SCORING_BLOQUE_PERFILES
+from utils.bigquery_tools import FiltrosDict, PesosDict, _resolver_presupuesto_maximo
+from utils.bq_client import obtener_cliente_bq
+from utils.bq_logger import PROJECT_ID, TABLE_FULL_ID
+from utils.numpy_scoring import (
+    FLAGS_BUSQUEDA, TERMINOS_BONUS_PONDERADOS, TERMINOS_PUNTUACION_BASE, CatalogoNumpy,
+    _calcular_componentes, _factores_bonus, _leer_flags, _mascara_filtros, obtener_catalogo
+)
+from utils.weights_index import CLAVES_SCORING, PARAMETROS_PESOS_SQL, matriz_pesos, posiciones_scoring
+
+logger = logging.getLogger(__name__)
+
+PerfilBusqueda = Tuple[FiltrosDict, PesosDict]
+
+# Columnas del catálogo que acompañan a cada coche del ranking (las que existan).
+COLUMNAS_SALIDA_LOTE = ("marca", "modelo", "tipo_mecanica", "tipo_carroceria", "precio_compra_contado")
+
+_NUM_TERMINOS_BASE = len(TERMINOS_PUNTUACION_BASE)
+_POSICIONES_PESOS = posiciones_scoring(
+    [clave for _, _, clave in TERMINOS_PUNTUACION_BASE] + [clave for _, _, clave, _ in TERMINOS_BONUS_PONDERADOS]
+)
+_NOMBRES_FACTORES = [nombre for _, _, _, nombre in TERMINOS_BONUS_PONDERADOS]
+# Candidatos por coche pedido que se ordenan antes de deduplicar (el resto del catálogo no se ordena).
+CANDIDATOS_POR_K = 20
+
+
+class MatrizCatalogo:
+    """Columnas escaladas de los términos ponderados como matriz (coches x F), una por catálogo cargado."""
+
+    def __init__(self, cat: CatalogoNumpy):
+        self.cat = cat
+        columnas = [col for _, col, _ in TERMINOS_PUNTUACION_BASE] + [col for _, col, _, _ in TERMINOS_BONUS_PONDERADOS]
+        self.caracteristicas = np.column_stack([cat.scaled[col] for col in columnas])
+        self.todos = np.arange(cat.n)
+
+
+_matriz: Optional[MatrizCatalogo] = None
+
+
+def _obtener_matriz(cat: CatalogoNumpy) -> MatrizCatalogo:
+    global _matriz
+    if _matriz is None or _matriz.cat is not cat:
+        _matriz = MatrizCatalogo(cat)
+    return _matriz
+
+
+def _ajustes_sin_pesos(cat: CatalogoNumpy, todos: np.ndarray, flags: Dict[str, Any]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Parte de puntuacion_base y de ajustes_experto que no depende de los pesos
+    (penalizaciones/bonus por flags). Con los pesos a 0 los términos ponderados se anulan.
+    """
+    pesos_cero = {nombre: 0.0 for nombre, _ in CLAVES_SCORING}
+    base, ajustes = _calcular_componentes(cat, todos, pesos_cero, flags)
+    return np.sum(list(base.values()), axis=0), np.sum(list(ajustes.values()), axis=0)
+
+
+def _clave_filtros(filtros: FiltrosDict) -> Tuple:
+    """Firma de las cláusulas WHERE: perfiles con la misma firma comparten máscara."""
+    tipos = filtros.get("tipo_mecanica")
+    return (
+        filtros.get("transmision_preferida"),
+        filtros.get("plazas_min"),
+        tuple(getattr(m, "value", m) for m in tipos) if isinstance(tipos, list) else None,
+        _resolver_presupuesto_maximo(filtros),
+    )
+
+
+def _diversificar(cat: CatalogoNumpy, idx: np.ndarray, score_total: np.ndarray, k: int) -> np.ndarray:
+    """Misma regla que _seleccionar_top_k (dedup por modelo/mecánica, 2 por marca) en un solo recorrido."""
+    precio = cat.num["precio_compra_contado"][idx]
+    orden = np.lexsort((np.where(np.isnan(precio), -np.inf, precio), -score_total[idx]))
+    modelos, mecanicas, marcas = cat.txt["modelo"][idx], cat.txt["tipo_mecanica"][idx], cat.txt["marca"][idx]
+    vistos, por_marca, seleccion = set(), {}, []
+    for pos in orden:
+        clave = (modelos[pos], mecanicas[pos])
+        if clave in vistos:
+            continue
+        vistos.add(clave)
+        if por_marca.get(marcas[pos], 0) < 2:
+            por_marca[marcas[pos]] = por_marca.get(marcas[pos], 0) + 1
+            seleccion.append(idx[pos])
+            if len(seleccion) == k:
+                break
+    return np.array(seleccion, dtype=np.intp)
+
+
+def _top_k(cat: CatalogoNumpy, idx: np.ndarray, score_total: np.ndarray, k: int) -> np.ndarray:
+    """
+    Top k (filas del catálogo) mirando solo los CANDIDATOS_POR_K * k mejores y los empates
+    en el corte. Dedup y límite por marca solo dependen de coches con más score, que están
+    todos entre los candidatos: si salen k coches, el resultado es el mismo que con todas
+    las filas. Si no salen, se repite sobre todas.
+    """
+    limite = CANDIDATOS_POR_K * k
+    if idx.size > limite:
+        scores = score_total[idx]
+        corte = np.partition(scores, idx.size - limite)[idx.size - limite]
+        seleccion = _diversificar(cat, idx[scores >= corte], score_total, k)
+        if len(seleccion) == k:
+            return seleccion
+    return _diversificar(cat, idx, score_total, k)
+
+
+def puntuar_perfiles_lote(
+    perfiles: Sequence[PerfilBusqueda],
+    k: int = 7,
+    columnas_salida: Sequence[str] = COLUMNAS_SALIDA_LOTE,
+    tamano_bloque: int = BATCH_SCORING_BLOQUE_PERFILES,
+) -> List[List[Dict[str, Any]]]:
+    """
+    Devuelve, para cada perfil (filtros, pesos), su top k con el mismo orden y las mismas
+    reglas de diversificación que buscar_coches_numpy / buscar_coches_bq. Cada coche lleva
+    score_total, puntuacion_base, ajustes_experto y las `columnas_salida` del catálogo.
+    """
+    cat = obtener_catalogo()
+    if cat is None:
+        raise RuntimeError("Catálogo no disponible para el scoring por lotes.")
+    matriz = _obtener_matriz(cat)
+    columnas = [c for c in columnas_salida if c in cat.df.columns]
+    valores_salida = {c: cat.df[c].to_numpy(dtype=object) for c in columnas}
+
+    inicio = time.perf_counter()
+    ajustes_por_flags: Dict[Tuple, Tuple[np.ndarray, np.ndarray]] = {}
+    mascaras: Dict[Tuple, np.ndarray] = {}
+    resultados: List[List[Dict[str, Any]]] = []
+
+    for desde in range(0, len(perfiles), tamano_bloque):
+        bloque = perfiles[desde:desde + tamano_bloque]
+        flags_bloque = [_leer_flags(filtros or {}) for filtros, _ in bloque]
+
+        # --- Pesos (N x F): pesos_completos de cada término, con el factor de flags en los bonus ---
+        pesos = matriz_pesos([p for _, p in bloque])[:, _POSICIONES_PESOS]
+        for i, flags in enumerate(flags_bloque):
+            factores = _factores_bonus(flags)
+            pesos[i, _NUM_TERMINOS_BASE:] *= [factores[nombre] for nombre in _NOMBRES_FACTORES]
+
+        # --- Términos ponderados: una multiplicación por bloque ---
+        x = matriz.caracteristicas
+        puntuacion_base = (pesos[:, :_NUM_TERMINOS_BASE] @ x[:, :_NUM_TERMINOS_BASE].T) * FACTOR_ESCALA_BASE
+        ajustes_experto = (pesos[:, _NUM_TERMINOS_BASE:] @ x[:, _NUM_TERMINOS_BASE:].T) * FACTOR_ESCALA_BASE
+
+        for i, ((filtros, _), flags) in enumerate(zip(bloque, flags_bloque)):
+            filtros = filtros or {}
+            clave_flags = tuple(flags.items())
+            if clave_flags not in ajustes_por_flags:
+                ajustes_por_flags[clave_flags] = _ajustes_sin_pesos(cat, matriz.todos, flags)
+            base_fija, ajustes_fijos = ajustes_por_flags[clave_flags]
+            puntuacion_base[i] += base_fija
+            ajustes_experto[i] += ajustes_fijos
+
+            clave_filtros = _clave_filtros(filtros)
+            if clave_filtros not in mascaras:
+                mascaras[clave_filtros] = _mascara_filtros(cat, filtros)[0]
+            idx = np.flatnonzero(mascaras[clave_filtros])
+
+            score_total = puntuacion_base[i] + ajustes_experto[i]
+            ranking = []
+            if idx.size:
+                for fila in _top_k(cat, idx, score_total, k):
+                    coche = {
+                        "score_total": float(score_total[fila]),
+                        "puntuacion_base": float(puntuacion_base[i, fila]),
+                        "ajustes_experto": float(ajustes_experto[i, fila]),
+                    }
+                    coche.update({c: valores_salida[c][fila] for c in columnas})
+                    ranking.append(coche)
+            resultados.append(ranking)
+
+    logging.info(
+        f"✅ (Batch Scoring) {len(perfiles)} perfiles sobre {cat.n} coches en {time.perf_counter() - inicio:.2f}s "
+        f"({len(ajustes_por_flags)} combinaciones de flags, {len(mascaras)} de filtros)."
+    )
+    return resultados
+
+
+# --- Reconstrucción de perfiles desde los logs de búsqueda ---
+# sql_params_json guarda los parámetros con los nombres de la query (buscar_coches_bq) o
+# con los del motor NumPy (peso_<clave de pesos_completos> y nombres internos de flags).
+_CLAVE_PESO_POR_PARAMETRO = {
+    **{f"peso_{nombre}": clave for nombre, clave in CLAVES_SCORING},
+    **{param: dict(CLAVES_SCORING)[nombre] for param, nombre in PARAMETROS_PESOS_SQL},
+}
+_CLAVE_FILTRO_POR_PARAMETRO: Dict[str, str] = {}
+for _nombre_flag, _clave_flag, _param_flag in FLAGS_BUSQUEDA:
+    _CLAVE_FILTRO_POR_PARAMETRO.setdefault(_param_flag, _clave_flag)
+    _CLAVE_FILTRO_POR_PARAMETRO.setdefault(_nombre_flag, _clave_flag)
+_CLAVE_FILTRO_POR_PARAMETRO.update({
+    "plazas_min": "plazas_min",
+    "tipos_mecanica": "tipo_mecanica",
+    # El presupuesto se reproduce en modo directo: precio_maximo/cuota_maxima ya resueltos
+    "precio_maximo": "pago_contado",
+    "cuota_maxima": "cuota_max",
+})
+
+
+def perfil_desde_params_log(params: Iterable[Dict[str, Any]]) -> PerfilBusqueda:
+    """Reconstruye (filtros, pesos) a partir de la lista de parámetros de una búsqueda logueada."""
+    filtros: FiltrosDict = {}
+    pesos: PesosDict = {}
+    for p in params:
+        nombre, valor = p.get("name"), p.get("value")
+        if nombre in _CLAVE_PESO_POR_PARAMETRO:
+            pesos[_CLAVE_PESO_POR_PARAMETRO[nombre]] = float(valor or 0.0)
+        elif nombre == "param_transmision_auto":
+            filtros["transmision_preferida"] = "automático" if valor else "manual"
+        elif nombre in _CLAVE_FILTRO_POR_PARAMETRO:
+            filtros.setdefault(_CLAVE_FILTRO_POR_PARAMETRO[nombre], valor)
+    return filtros, pesos
+
+
+def cargar_perfiles_historial(limite: int = 1000) -> List[Tuple[str, PerfilBusqueda]]:
+    """Últimas `limite` búsquedas de historial_busquedas_agente como (id_conversacion, perfil)."""
+    client = obtener_cliente_bq(PROJECT_ID)
+    query = f"""
+        SELECT id_conversacion, sql_params_json
+        FROM `{TABLE_FULL_ID}`
+        WHERE sql_params_json IS NOT NULL
+        ORDER BY timestamp_busqueda DESC
+        LIMIT @limite
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=[bigquery.ScalarQueryParameter("limite", "INT64", limite)])
+    perfiles = []
+    for fila in client.query(query, job_config=job_config).result():
+        try:
+            perfiles.append((fila["id_conversacion"], perfil_desde_params_log(json.loads(fila["sql_params_json"]))))
+        except Exception as e:
+            logging.warning(f"WARN (Batch Scoring) ► Log de '{fila['id_conversacion']}' ignorado: {e}")
+    logging.info(f"✅ (Batch Scoring) {len(perfiles)} perfiles cargados desde {TABLE_FULL_ID}.")
+    return perfiles
+
+
+def cargar_perfiles_fichero(ruta: str) -> List[Tuple[str, PerfilBusqueda]]:
+    """Perfiles sintéticos: JSONL con {"id": ..., "filtros": {...}, "pesos": {...}} por línea."""
+    perfiles = []
+    with open(ruta, "r", encoding="utf-8") as f:
+        for n, linea in enumerate(f, start=1):
+            if linea.strip():
+                datos = json.loads(linea)
+                perfiles.append((str(datos.get("id", n)), (datos.get("filtros") or {}, datos.get("pesos") or {})))
+    return perfiles
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Rankea el catálogo para muchos perfiles (filtros, pesos) de una vez.")
+    origen = parser.add_mutually_exclusive_group(required=True)
+    origen.add_argument("--historial", type=int, metavar="N", help="Usar las últimas N búsquedas de historial_busquedas_agente")
+    origen.add_argument("--perfiles", metavar="RUTA", help="Fichero JSONL de perfiles sintéticos")
+    parser.add_argument("--k", type=int, default=7, help="Coches por perfil")
+    parser.add_argument("--salida", default=None, help="Fichero JSONL de salida (por defecto, stdout)")
+    args = parser.parse_args()
+
+    try:
+        ids_perfiles = cargar_perfiles_historial(args.historial) if args.historial else cargar_perfiles_fichero(args.perfiles)
+        rankings = puntuar_perfiles_lote([perfil for _, perfil in ids_perfiles], k=args.k)
+    except Exception as e:
+        logging.error(f"❌ (Batch Scoring) Error en el scoring por lotes: {e}")
+        traceback.print_exc()
+        raise SystemExit(1)
+
+    salida = open(args.salida, "w", encoding="utf-8") if args.salida else None
+    try:
+        for (id_perfil, _), ranking in zip(ids_perfiles, rankings):
+            print(json.dumps({"id": id_perfil, "ranking": ranking}, ensure_ascii=False, default=str), file=salida)
+    finally:
+        if salida:
+            salida.close()
@@ -1,14 +1,21 @@
 # En utils/bigquery_search.py
+import argparse
+import itertools
 import logging
+import threading
 import traceback
 from typing import Optional, List, Dict, Any , Tuple
 from google.cloud import bigquery
 from config.settings import ( 
-    MIN_MAX_RANGES,PENALTY_PUERTAS_BAJAS,PENALTY_LOW_COST_POR_COMODIDAD, PENALTY_DEPORTIVIDAD_POR_COMODIDAD, PENALTY_ANTIGUEDAD_7_A_10_ANOS, PENALTY_ANTIGUEDAD_10_A_15_ANOS, PENALTY_ANTIGUEDAD_MAS_15_ANOS, PENALTY_ANTIGUEDAD_5_A_7_ANOS, BONUS_DISTINTIVO_ECO_CERO_C, PENALTY_DISTINTIVO_NA_B, BONUS_OCASION_POR_IMPACTO_AMBIENTAL,  PENALTY_BEV_REEV_AVENTURA_OCASIONAL,PENALTY_PHEV_AVENTURA_OCASIONAL, PENALTY_ELECTRIFICADOS_AVENTURA_EXTREMA,BONUS_CARROCERIA_MONTANA, BONUS_CARROCERIA_COMERCIAL,BONUS_CARROCERIA_PASAJEROS_PRO, PENALTY_CARROCERIA_NO_AVENTURA , BONUS_SUV_AVENTURA_OCASIONAL, BONUS_TODOTERRENO_AVENTURA_EXTREMA, BONUS_PICKUP_AVENTURA_EXTREMA, BONUS_CARROCERIA_OBJETOS_ESPECIALES, PENALTY_CARROCERIA_OBJETOS_ESPECIALES,  BONUS_CARROCERIA_CONFORT, FACTOR_CONVERSION_PRECIO_CUOTA,
+    PENALTY_PUERTAS_BAJAS,PENALTY_LOW_COST_POR_COMODIDAD, PENALTY_DEPORTIVIDAD_POR_COMODIDAD, PENALTY_ANTIGUEDAD_7_A_10_ANOS, PENALTY_ANTIGUEDAD_10_A_15_ANOS, PENALTY_ANTIGUEDAD_MAS_15_ANOS, PENALTY_ANTIGUEDAD_5_A_7_ANOS, BONUS_DISTINTIVO_ECO_CERO_C, PENALTY_DISTINTIVO_NA_B, BONUS_OCASION_POR_IMPACTO_AMBIENTAL,  PENALTY_BEV_REEV_AVENTURA_OCASIONAL,PENALTY_PHEV_AVENTURA_OCASIONAL, PENALTY_ELECTRIFICADOS_AVENTURA_EXTREMA,BONUS_CARROCERIA_MONTANA, BONUS_CARROCERIA_COMERCIAL,BONUS_CARROCERIA_PASAJEROS_PRO, PENALTY_CARROCERIA_NO_AVENTURA , BONUS_SUV_AVENTURA_OCASIONAL, BONUS_TODOTERRENO_AVENTURA_EXTREMA, BONUS_PICKUP_AVENTURA_EXTREMA, BONUS_CARROCERIA_OBJETOS_ESPECIALES, PENALTY_CARROCERIA_OBJETOS_ESPECIALES,  BONUS_CARROCERIA_CONFORT, FACTOR_CONVERSION_PRECIO_CUOTA,
     BONUS_OCASION_POR_USO_OCASIONAL, PENALTY_ELECTRIFICADOS_POR_USO_OCASIONAL, BONUS_BEV_REEV_USO_DEFINIDO,PENALTY_PHEV_USO_INTENSIVO_LARGO, BONUS_MOTOR_POCO_KM, PENALTY_OCASION_POCO_KM, PENALTY_OCASION_MEDIO_KM, BONUS_MOTOR_MUCHO_KM, PENALTY_OCASION_MUCHO_KM, PENALTY_OCASION_MUY_ALTO_KM_V2 ,BONUS_BEV_MUY_ALTO_KM , BONUS_REEV_MUY_ALTO_KM , BONUS_DIESEL_HEVD_MUY_ALTO_KM, BONUS_PHEVD_GLP_GNV_MUY_ALTO_KM, BONUS_PUNTO_CARGA_PROPIO, PENALTY_AWD_NINGUNA_AVENTURA,  BONUS_AWD_AVENTURA_OCASIONAL, BONUS_AWD_AVENTURA_EXTREMA, BONUS_AWD_ZONA_NIEVE, BONUS_AWD_ZONA_MONTA, BONUS_REDUCTORAS_AVENTURA_EXTREMA , PENALTY_ZBE_DISTINTIVO_DESFAVORABLE_NA, PENALTY_ZBE_DISTINTIVO_DESFAVORABLE_B , BONUS_ZBE_DISTINTIVO_FAVORABLE_C , BONUS_ZBE_DISTINTIVO_FAVORABLE_ECO_CERO, 
     BONUS_AWD_NINGUNA_AVENTURA_CLIMA_ADVERSO, PENALTY_DIESEL_CIUDAD , BONUS_DIESEL_CIUDAD_OCASIONAL, FACTOR_ESCALA_BASE, PENALTY_OCASION_KILOMETRAJE_EXTREMO, FACTOR_BONUS_RATING_CRITICO,FACTOR_BONUS_RATING_FUERTE, FACTOR_BONUS_FIABILIDAD_POR_IMPACTO, FACTOR_BONUS_DURABILIDAD_POR_IMPACTO, BONUS_REDUCTORAS_AVENTURA_OCASIONAL, FACTOR_BONUS_FIAB_DUR_CRITICO , FACTOR_BONUS_FIAB_DUR_FUERTE,FACTOR_BONUS_COSTES_CRITICO, PENALTY_ANO_PRE_1990 ,PENALTY_ANO_1991_1995, PENALTY_ANO_1996_2000 ,PENALTY_DIESEL_2001_2006, PENALTY_TAMANO_CARRETERA, PENALTY_TAMANO_CIUDAD, BONUS_CARROCERIA_COUPE_SINGULAR, BONUS_CARROCERIA_DESCAPOTABLE_SINGULAR, BONUS_CARROCERIA_COUPE_DEPORTIVO, BONUS_CARROCERIA_DESCAPOTABLE_DEPORTIVO, PENALTY_CARROCERIA_COMERCIAL_DEPORTIVO, PENALTY_CARROCERIA_FURGONETA_DEPORTIVO, 
-    PENALTY_MALETERO_INSUFICIENTE , PENALTY_COMERCIAL_USO_PERSONAL, BONUS_COCHE_MUY_CORTO_CIUDAD, BONUS_COCHE_LIGERO_CIUDAD , BONUS_COCHE_CORTO_CIUDAD_2 , BONUS_COCHE_LIGERO_CIUDAD_2,  UMBRAL_LARGO_CIUDAD_MM , UMBRAL_LARGO_CARRETERA_MM, PENALTY_CARROCERIA_SUV_DEPORTIVO, PENALTY_BEV_NO_DEPORTIVO_LIFESTYLE, FACTOR_PRECIO_MINIMO
+    PENALTY_MALETERO_INSUFICIENTE , PENALTY_COMERCIAL_USO_PERSONAL, BONUS_COCHE_MUY_CORTO_CIUDAD, BONUS_COCHE_LIGERO_CIUDAD , BONUS_COCHE_CORTO_CIUDAD_2 , BONUS_COCHE_LIGERO_CIUDAD_2,  UMBRAL_LARGO_CIUDAD_MM , UMBRAL_LARGO_CARRETERA_MM, PENALTY_CARROCERIA_SUV_DEPORTIVO, PENALTY_BEV_NO_DEPORTIVO_LIFESTYLE, FACTOR_PRECIO_MINIMO, TABLA_COCHES_BQ, CACHE_BUSQUEDAS_ACTIVA
     )
+from utils.scaled_features import ORIGENES_SCALED_DATA, obtener_version_catalogo, origen_scaled_data, sql_scaled_data
+from utils.bq_client import obtener_cliente_bq
+from utils.search_cache import cache_busquedas, calcular_huella_busqueda
+from utils.weights_index import dict_a_vector, parametros_pesos_sql, pesos_completos_desde_vector
 # --- Configuración de Logging ---
 logger = logging.getLogger(__name__) 
 
@@ -95,66 +102,39 @@ PesosDict = Dict[str, float]
 
 #------------------------------------------------------------------------------------------------
 
-def buscar_coches_bq(
-    filtros: Optional[FiltrosDict],
-    pesos: Optional[PesosDict], 
-    k: int
-) -> Tuple[List[Dict[str, Any]], str, List[Dict[str, Any]]]:
-    
-    if not filtros: filtros = {}
-    if not pesos: pesos = {}
+def _preparar_pesos_completos(pesos: PesosDict) -> Dict[str, float]:
+    """
+    Traduce los pesos normalizados del estado a las claves que usa el scoring
+    (parámetros @peso_... de la query o columnas del motor NumPy).
+    """
+    return pesos_completos_desde_vector(dict_a_vector(pesos))
 
-    try:
-        client = bigquery.Client()
-    except Exception as e_auth:
-        logging.error(f"Error al inicializar cliente BigQuery: {e_auth}")
-        return [], f"Error BQ Auth: {e_auth}", []
 
+def _resolver_presupuesto_maximo(filtros: FiltrosDict) -> Tuple[Optional[float], Optional[float]]:
+    """
+    Devuelve (precio_maximo, cuota_maxima) según el modo de adquisición.
+    Solo uno de los dos vendrá informado (o ninguno si no hay presupuesto).
+    """
+    modo_adq_rec = filtros.get("modo_adquisicion_recomendado")
+    precio_maximo = None
+    cuota_maxima = None
+    if modo_adq_rec == "Contado":
+        precio_maximo = filtros.get("precio_max_contado_recomendado")
+    elif modo_adq_rec == "Financiado":
+        cuota_maxima = filtros.get("cuota_max_calculada")
+    else:
+        # MODO 2 (DIRECTO) - El usuario proporciona su propio presupuesto
+        precio_maximo = filtros.get("pago_contado")
+        if precio_maximo is None:
+            cuota_maxima = filtros.get("cuota_max")
+    return precio_maximo, cuota_maxima
+
+
+def _parametros_busqueda(filtros: FiltrosDict, pesos: PesosDict, k: int) -> List[bigquery.ScalarQueryParameter]:
+    """Parámetros de la query que no dependen de la forma del WHERE: pesos, flags y k."""
     # PASO 1: PREPARACIÓN DE DATOS (Pesos, Flags, Min/Max)
-    # (Esta parte se mantiene igual)
-    pesos_completos = {
-        "estetica": pesos.get("estetica", 0.0), 
-        "premium": pesos.get("premium", 0.0),
-        "singular": pesos.get("singular", 0.0), 
-        "altura_libre_suelo": pesos.get("altura_libre_suelo", 0.0),
-        "batalla": pesos.get("batalla", 0.0), 
-        "indice_altura_interior": pesos.get("indice_altura_interior", 0.0), 
-        "ancho_general_score": pesos.get("ancho", 0.0),
-        "rating_durabilidad": pesos.get("rating_durabilidad", 0.0),
-        "rating_fiabilidad": pesos.get("rating_fiabilidad", 0.0),
-        "rating_seguridad": pesos.get("rating_seguridad", 0.0),
-        "rating_comodidad": pesos.get("rating_comodidad", 0.0),
-        "rating_impacto_ambiental": pesos.get("rating_impacto_ambiental", 0.0), 
-        "rating_costes_uso": pesos.get("rating_costes_uso", 0.0),
-        "rating_tecnologia_conectividad": pesos.get("rating_tecnologia_conectividad", 0.0),
-        "devaluacion": pesos.get("devaluacion", 0.0), 
-        "maletero_minimo_score": pesos.get("maletero_minimo_score", 0.0),
-        "maletero_maximo_score": pesos.get("maletero_maximo_score", 0.0),
-        "largo_vehiculo_score": pesos.get("largo_vehiculo_score", 0.0),
-        "autonomia_uso_maxima": pesos.get("autonomia_uso_maxima", 0.0),
-        "fav_bajo_peso": pesos.get("fav_bajo_peso", 0.0),
-        "fav_bajo_consumo": pesos.get("fav_bajo_consumo", 0.0),
-        "fav_bajo_coste_uso_directo": pesos.get("fav_bajo_coste_uso_directo", 0.0),
-        "fav_bajo_coste_mantenimiento_directo": pesos.get("fav_bajo_coste_mantenimiento_directo", 0.0),             
-        "par_motor_remolque_score": pesos.get("par_motor_remolque_score", 0.0),
-        "cap_remolque_cf_score": pesos.get("cap_remolque_cf_score", 0.0),
-        "cap_remolque_sf_score": pesos.get("cap_remolque_sf_score", 0.0),
-        "fav_menor_superficie_planta": pesos.get("fav_menor_superficie_planta", 0.0),
-        "fav_menor_diametro_giro": pesos.get("fav_menor_diametro_giro", 0.0),
-        "fav_menor_largo_garage": pesos.get("fav_menor_largo_garage", 0.0),
-        "fav_menor_ancho_garage": pesos.get("fav_menor_ancho_garage", 0.0),
-        "fav_menor_alto_garage": pesos.get("fav_menor_alto_garage", 0.0),
-        "deportividad_style_score": pesos.get("deportividad_style_score", 0.0),
-        "fav_menor_rel_peso_potencia_score": pesos.get("fav_menor_rel_peso_potencia_score", 0.0),
-        "potencia_maxima_style_score": pesos.get("potencia_maxima_style_score", 0.0),
-        "par_motor_style_score": pesos.get("par_motor_style_score", 0.0),
-        "fav_menor_aceleracion_score": pesos.get("fav_menor_aceleracion_score", 0.0),
-        "peso_autonomia_uso_principal": pesos.get("autonomia_uso_principal", 0.0),
-        "peso_autonomia_uso_2nd_drive":  pesos.get("autonomia_uso_2nd_drive", 0.0),
-        "peso_menor_tiempo_carga_min": pesos.get("menor_tiempo_carga_min", 0.0),
-        "peso_potencia_maxima_carga_AC":  pesos.get("potencia_maxima_carga_AC", 0.0),
-        "peso_potencia_maxima_carga_DC":  pesos.get("potencia_maxima_carga_DC", 0.0),     
-    }
+    # Los pesos pasan a vector del índice canónico una sola vez; los @peso_... salen de él.
+    vector_pesos = dict_a_vector(pesos)
 
     # ... el resto de la preparación de flags y min/max se mantiene igual ...
     penalizar_puertas_val = bool(filtros.get("penalizar_puertas_bajas", False))
@@ -201,66 +181,10 @@ def buscar_coches_bq(
     flag_es_conductor_urbano =  bool(filtros.get("flag_es_conductor_urbano", False))
     
     
-    m = MIN_MAX_RANGES
-    min_est, max_est = m["estetica"]; min_prem, max_prem = m["premium"]; min_sing, max_sing = m["singular"]
-    min_alt_ls, max_alt_ls = m["altura_libre_suelo"]; min_bat, max_bat = m["batalla"]; min_ind_alt, max_ind_alt = m["indice_altura_interior"]
-    min_anc, max_anc = m["ancho"]; min_fiab, max_fiab = m["fiabilidad"]; 
-    min_durab, max_durab = m["durabilidad"]; 
-    min_seg, max_seg = m["seguridad"]; min_comod, max_comod = m["comodidad"]; min_tec, max_tec = m["tecnologia"]
-    min_deval, max_deval = m["devaluacion"]; min_mal_min, max_mal_min = m["maletero_minimo"]; min_mal_max, max_mal_max = m["maletero_maximo"]
-    min_largo, max_largo = m["largo"]; min_acc_lc, max_acc_lc = m["acceso_low_cost"]; min_depor_bq, max_depor_bq = m["deportividad"]
-    min_auton, max_auton = m["autonomia_uso_maxima"]; min_peso_kg, max_peso_kg = m["peso"]; min_consumo, max_consumo = m["indice_consumo_energia"]
-    min_coste_uso, max_coste_uso = m["costes_de_uso"]; min_coste_mante, max_coste_mante = m["costes_mantenimiento"]
-    min_par, max_par = m["par"]; min_cap_cf, max_cap_cf = m["capacidad_remolque_con_freno"]; min_cap_sf, max_cap_sf = m["capacidad_remolque_sin_freno"]
-    min_sup_planta, max_sup_planta = m["superficie_planta"]; min_diam_giro, max_diam_giro = m["diametro_giro"]
-    min_alto_veh, max_alto_veh = m["alto_vehiculo"]; min_rel_pp, max_rel_pp = m["relacion_peso_potencia"]; min_pot_max, max_pot_max = m["potencia_maxima"]; min_acel, max_acel = m["aceleracion_0_100"] 
-    min_auto_p, max_auto_p = m["autonomia_uso_principal"]; min_auto_2, max_auto_2 = m["autonomia_uso_2nd_drive"]
-    min_t_carga, max_t_carga = m["tiempo_carga_min"]; min_pot_ac, max_pot_ac = m["potencia_maxima_carga_AC"]
-    min_pot_dc, max_pot_dc = m["potencia_maxima_carga_DC"]
-
-    # PASO 2: CONSTRUCCIÓN DE PARÁMETROS Y FILTROS
-    # (Esta parte se mantiene igual)
-    params = [
-        bigquery.ScalarQueryParameter("peso_estetica", "FLOAT64", pesos_completos["estetica"]),
-        bigquery.ScalarQueryParameter("peso_premium", "FLOAT64", pesos_completos["premium"]),
-        bigquery.ScalarQueryParameter("peso_singular", "FLOAT64", pesos_completos["singular"]),
-        bigquery.ScalarQueryParameter("peso_altura", "FLOAT64", pesos_completos["altura_libre_suelo"]),
-        bigquery.ScalarQueryParameter("peso_batalla", "FLOAT64", pesos_completos["batalla"]),
-        bigquery.ScalarQueryParameter("peso_indice_altura", "FLOAT64", pesos_completos["indice_altura_interior"]),
-        bigquery.ScalarQueryParameter("peso_ancho_general_score", "FLOAT64", pesos_completos["ancho_general_score"]),
+    # PASO 2: CONSTRUCCIÓN DE PARÁMETROS
+    params = [bigquery.ScalarQueryParameter(nombre, "FLOAT64", valor) for nombre, valor in parametros_pesos_sql(vector_pesos)]
+    params += [
         bigquery.ScalarQueryParameter("penalizar_puertas", "BOOL", penalizar_puertas_val),
-        bigquery.ScalarQueryParameter("peso_rating_durabilidad", "FLOAT64", pesos_completos["rating_durabilidad"]),
-        bigquery.ScalarQueryParameter("peso_rating_fiabilidad", "FLOAT64", pesos_completos["rating_fiabilidad"]),
-        bigquery.ScalarQueryParameter("peso_rating_seguridad", "FLOAT64", pesos_completos["rating_seguridad"]),
-        bigquery.ScalarQueryParameter("peso_rating_impacto_ambiental", "FLOAT64", pesos_completos["rating_impacto_ambiental"]),
-        bigquery.ScalarQueryParameter("peso_fav_bajo_coste_uso_directo", "FLOAT64", pesos_completos["fav_bajo_coste_uso_directo"]),
-        bigquery.ScalarQueryParameter("peso_fav_bajo_coste_mantenimiento_directo", "FLOAT64", pesos_completos["fav_bajo_coste_mantenimiento_directo"]),
-        bigquery.ScalarQueryParameter("peso_rating_tecnologia_conectividad", "FLOAT64", pesos_completos["rating_tecnologia_conectividad"]),
-        bigquery.ScalarQueryParameter("peso_devaluacion", "FLOAT64", pesos_completos["devaluacion"]),
-        bigquery.ScalarQueryParameter("peso_maletero_minimo_score", "FLOAT64", pesos_completos["maletero_minimo_score"]),
-        bigquery.ScalarQueryParameter("peso_maletero_maximo_score", "FLOAT64", pesos_completos["maletero_maximo_score"]),
-        bigquery.ScalarQueryParameter("peso_largo_vehiculo_score", "FLOAT64", pesos_completos["largo_vehiculo_score"]),
-        bigquery.ScalarQueryParameter("peso_autonomia_vehiculo", "FLOAT64", pesos_completos["autonomia_uso_maxima"]),
-        bigquery.ScalarQueryParameter("peso_fav_bajo_peso", "FLOAT64", pesos_completos["fav_bajo_peso"]),
-        bigquery.ScalarQueryParameter("peso_fav_bajo_consumo", "FLOAT64", pesos_completos["fav_bajo_consumo"]),
-        bigquery.ScalarQueryParameter("peso_par_motor_remolque_score", "FLOAT64", pesos_completos["par_motor_remolque_score"]),
-        bigquery.ScalarQueryParameter("peso_cap_remolque_cf_score", "FLOAT64", pesos_completos["cap_remolque_cf_score"]),
-        bigquery.ScalarQueryParameter("peso_cap_remolque_sf_score", "FLOAT64", pesos_completos["cap_remolque_sf_score"]),
-        bigquery.ScalarQueryParameter("peso_fav_menor_superficie_planta", "FLOAT64", pesos_completos["fav_menor_superficie_planta"]),
-        bigquery.ScalarQueryParameter("peso_fav_menor_diametro_giro", "FLOAT64", pesos_completos["fav_menor_diametro_giro"]),
-        bigquery.ScalarQueryParameter("peso_fav_menor_largo_garage", "FLOAT64", pesos_completos["fav_menor_largo_garage"]),
-        bigquery.ScalarQueryParameter("peso_fav_menor_ancho_garage", "FLOAT64", pesos_completos["fav_menor_ancho_garage"]),
-        bigquery.ScalarQueryParameter("peso_fav_menor_alto_garage", "FLOAT64", pesos_completos["fav_menor_alto_garage"]),
-        bigquery.ScalarQueryParameter("peso_deportividad_style_score", "FLOAT64", pesos_completos["deportividad_style_score"]),
-        bigquery.ScalarQueryParameter("peso_fav_menor_rel_peso_potencia_score", "FLOAT64", pesos_completos["fav_menor_rel_peso_potencia_score"]),
-        bigquery.ScalarQueryParameter("peso_potencia_maxima_style_score", "FLOAT64", pesos_completos["potencia_maxima_style_score"]),
-        bigquery.ScalarQueryParameter("peso_par_motor_style_score", "FLOAT64", pesos_completos["par_motor_style_score"]),
-        bigquery.ScalarQueryParameter("peso_autonomia_uso_principal", "FLOAT64", pesos_completos["peso_autonomia_uso_principal"]),
-        bigquery.ScalarQueryParameter("peso_autonomia_uso_2nd_drive", "FLOAT64", pesos_completos["peso_autonomia_uso_2nd_drive"]),
-        bigquery.ScalarQueryParameter("peso_menor_tiempo_carga_min", "FLOAT64", pesos_completos["peso_menor_tiempo_carga_min"]),
-        bigquery.ScalarQueryParameter("peso_potencia_maxima_carga_AC", "FLOAT64", pesos_completos["peso_potencia_maxima_carga_AC"]),
-        bigquery.ScalarQueryParameter("peso_potencia_maxima_carga_DC", "FLOAT64", pesos_completos["peso_potencia_maxima_carga_DC"]),
-        bigquery.ScalarQueryParameter("peso_fav_menor_aceleracion_score", "FLOAT64", pesos_completos["fav_menor_aceleracion_score"]),
         bigquery.ScalarQueryParameter("flag_penalizar_low_cost_comodidad", "BOOL", flag_penalizar_low_cost_comod),
         bigquery.ScalarQueryParameter("flag_penalizar_deportividad_comodidad", "BOOL", flag_penalizar_deportividad_comod),
         bigquery.ScalarQueryParameter("flag_penalizar_antiguo_tec", "BOOL", flag_penalizar_antiguo_tec_val),
@@ -304,127 +228,97 @@ def buscar_coches_bq(
         bigquery.ScalarQueryParameter("flag_es_conductor_urbano", "BOOL", flag_es_conductor_urbano),
         bigquery.ScalarQueryParameter("k", "INT64", k)
     ]
-    
-    sql_where_clauses = []
+    return params
+
+
+# --- PLANTILLAS SQL PRECOMPILADAS ---
+# La query solo cambia con el origen de ScaledData y con qué cláusulas WHERE lleva; los valores
+# (pesos, flags, límites) van siempre como parámetros y las constantes de config/settings.py se
+# interpolan una vez aquí. Así se genera una plantilla por combinación al importar el módulo, cada
+# búsqueda solo elige la suya, y el texto es idéntico entre búsquedas (la caché de resultados de
+# BigQuery compara el texto exacto de la query más los parámetros).
+# Forma del WHERE: (transmisión, plazas, mecánica, presupuesto None | "precio" | "cuota")
+FormaWhere = Tuple[bool, bool, bool, Optional[str]]
+
+FORMAS_WHERE: Tuple[FormaWhere, ...] = tuple(
+    itertools.product((False, True), (False, True), (False, True), (None, "precio", "cuota"))
+)
+
+_CLAUSULAS_PRESUPUESTO = {
+    "precio": [
+        "COALESCE(sd.precio_compra_contado, 999999999) <= @precio_maximo",
+        "sd.precio_compra_contado >= @precio_minimo",
+    ],
+    "cuota": [
+        f"(COALESCE(sd.precio_compra_contado, 0) * {FACTOR_CONVERSION_PRECIO_CUOTA}) <= @cuota_maxima",
+        f"(COALESCE(sd.precio_compra_contado, 0) * {FACTOR_CONVERSION_PRECIO_CUOTA}) >= @cuota_minima",
+    ],
+}
+
+
+def _clausulas_where(forma: FormaWhere) -> List[str]:
+    transmision, plazas, mecanica, presupuesto = forma
+    clausulas = []
+    if transmision:
+        clausulas.append("sd.cambio_automatico = @param_transmision_auto")
+    if plazas:
+        clausulas.append("sd.plazas >= @plazas_min")
+    if mecanica:
+        clausulas.append("sd.tipo_mecanica IN UNNEST(@tipos_mecanica)")
+    if presupuesto:
+        clausulas.extend(_CLAUSULAS_PRESUPUESTO[presupuesto])
+    return clausulas
+
+
+def _construir_where(filtros: FiltrosDict) -> Tuple[FormaWhere, List[bigquery.ScalarQueryParameter]]:
+    """Forma del WHERE que piden los filtros y los parámetros de sus cláusulas."""
+    params = []
+    con_transmision = False
     transmision_val = filtros.get("transmision_preferida")
     if isinstance(transmision_val, str) and transmision_val != "ambos":
-        param_name_trans = "param_transmision_auto"
-        if transmision_val.lower() == 'automático': 
-            sql_where_clauses.append(f"sd.cambio_automatico = @{param_name_trans}")
-            params.append(bigquery.ScalarQueryParameter(param_name_trans, "BOOL", True))
-        elif transmision_val.lower() == 'manual': 
-            sql_where_clauses.append(f"sd.cambio_automatico = @{param_name_trans}")
-            params.append(bigquery.ScalarQueryParameter(param_name_trans, "BOOL", False))
-    
+        valor_auto = {"automático": True, "manual": False}.get(transmision_val.lower())
+        if valor_auto is not None:
+            con_transmision = True
+            params.append(bigquery.ScalarQueryParameter("param_transmision_auto", "BOOL", valor_auto))
+
+    con_plazas = False
     plazas_min_val = filtros.get("plazas_min")
     if plazas_min_val is not None and isinstance(plazas_min_val, int) and plazas_min_val > 0:
-        sql_where_clauses.append(f"sd.plazas >= @plazas_min") 
+        con_plazas = True
         params.append(bigquery.ScalarQueryParameter("plazas_min", "INT64", plazas_min_val))
 
+    con_mecanica = False
     tipos_mecanica_list = filtros.get("tipo_mecanica")
     if isinstance(tipos_mecanica_list, list) and tipos_mecanica_list:
+        con_mecanica = True
         tipos_mecanica_str_list = [m.value if hasattr(m, 'value') else str(m) for m in tipos_mecanica_list]
-        sql_where_clauses.append(f"sd.tipo_mecanica IN UNNEST(@tipos_mecanica)")
         params.append(bigquery.ArrayQueryParameter("tipos_mecanica", "STRING", tipos_mecanica_str_list))
 
-    # --- LÓGICA DE FILTRADO ECONÓMICO (CORREGIDA Y REFACTORIZADA) ---
-
-# --- LÓGICA DE FILTRADO ECONÓMICO (CORREGIDA Y REFACTORIZADA) ---
-
-    modo_adq_rec = filtros.get("modo_adquisicion_recomendado")
-    precio_maximo = None
-    cuota_maxima = None
-
-    # 1. Determinamos el presupuesto MÁXIMO a usar con una lógica explícita
-    if modo_adq_rec == "Contado":
-        precio_maximo = filtros.get("precio_max_contado_recomendado")
-    elif modo_adq_rec == "Financiado":
-        cuota_maxima = filtros.get("cuota_max_calculada")
-    else:
-        # MODO 2 (DIRECTO) - El usuario proporciona su propio presupuesto
-        precio_maximo = filtros.get("pago_contado")
-        if precio_maximo is None:
-            cuota_maxima = filtros.get("cuota_max")
-
-    # 2. Construimos las cláusulas SQL basándonos en el presupuesto que se haya determinado
+    # --- FILTRO ECONÓMICO: rango [máximo * FACTOR_PRECIO_MINIMO, máximo] en precio o en cuota ---
+    presupuesto = None
+    precio_maximo, cuota_maxima = _resolver_presupuesto_maximo(filtros)
     if precio_maximo is not None:
+        presupuesto = "precio"
         precio_minimo = precio_maximo * FACTOR_PRECIO_MINIMO
         logging.info(f"Filtro Económico: Rango de precio Contado -> {precio_minimo:,.0f}€ a {precio_maximo:,.0f}€")
-        
-        # Filtro de Límite Superior
-        sql_where_clauses.append(f"COALESCE(sd.precio_compra_contado, 999999999) <= @precio_maximo")
         params.append(bigquery.ScalarQueryParameter("precio_maximo", "FLOAT64", float(precio_maximo)))
-        
-        # ✅ NUEVO FILTRO DE LÍMITE INFERIOR
-        sql_where_clauses.append(f"sd.precio_compra_contado >= @precio_minimo")
         params.append(bigquery.ScalarQueryParameter("precio_minimo", "FLOAT64", float(precio_minimo)))
-    
     elif cuota_maxima is not None:
+        presupuesto = "cuota"
         cuota_minima = cuota_maxima * FACTOR_PRECIO_MINIMO
         logging.info(f"Filtro Económico: Rango de Cuota -> {cuota_minima:,.0f}€/mes a {cuota_maxima:,.0f}€/mes")
-
-        # Filtro de Límite Superior
-        sql_where_clauses.append(f"(COALESCE(sd.precio_compra_contado, 0) * {FACTOR_CONVERSION_PRECIO_CUOTA}) <= @cuota_maxima")
         params.append(bigquery.ScalarQueryParameter("cuota_maxima", "FLOAT64", float(cuota_maxima)))
-        
-        # ✅ NUEVO FILTRO DE LÍMITE INFERIOR
-        sql_where_clauses.append(f"(COALESCE(sd.precio_compra_contado, 0) * {FACTOR_CONVERSION_PRECIO_CUOTA}) >= @cuota_minima")
         params.append(bigquery.ScalarQueryParameter("cuota_minima", "FLOAT64", float(cuota_minima)))
-        
-    # PASO 3: CONVERTIR CLÁUSULAS A STRING
-    sql_where_clauses_str = ""
-    if sql_where_clauses:
-        sql_where_clauses_str = " AND " + " AND ".join(sql_where_clauses)
 
-    # PASO 4: DEFINIR LA PLANTILLA SQL
-    sql = f"""
+    return (con_transmision, con_plazas, con_mecanica, presupuesto), params
+
+
+def _generar_sql_busqueda(cuerpo_scaled_data: str, sql_where_clauses_str: str) -> str:
+    """Texto completo de la query de búsqueda para un cuerpo de ScaledData y unas cláusulas WHERE."""
+    return f"""
     WITH ScaledData AS (
-        SELECT
-            *,
-            COALESCE(SAFE_DIVIDE(COALESCE(estetica, {min_est}) - {min_est}, NULLIF({max_est} - {min_est}, 0)), 0) AS estetica_scaled,
-            COALESCE(SAFE_DIVIDE(COALESCE(premium, {min_prem}) - {min_prem}, NULLIF({max_prem} - {min_prem}, 0)), 0) AS premium_scaled,
-            COALESCE(SAFE_DIVIDE(COALESCE(singular, {min_sing}) - {min_sing}, NULLIF({max_sing} - {min_sing}, 0)), 0) AS singular_scaled,
-            COALESCE(SAFE_DIVIDE(COALESCE(altura_libre_suelo, {min_alt_ls}) - {min_alt_ls}, NULLIF({max_alt_ls} - {min_alt_ls}, 0)), 0) AS altura_scaled,
-            COALESCE(SAFE_DIVIDE(COALESCE(batalla, {min_bat}) - {min_bat}, NULLIF({max_bat} - {min_bat}, 0)), 0) AS batalla_scaled,
-            COALESCE(SAFE_DIVIDE(COALESCE(indice_altura_interior, {min_ind_alt}) - {min_ind_alt}, NULLIF({max_ind_alt} - {min_ind_alt}, 0)), 0) AS indice_altura_scaled,
-            COALESCE(SAFE_DIVIDE(COALESCE(ancho, {min_anc}) - {min_anc}, NULLIF({max_anc} - {min_anc}, 0)), 0) AS ancho_scaled,
-            COALESCE(SAFE_DIVIDE(COALESCE(fiabilidad, {min_fiab}) - {min_fiab}, NULLIF({max_fiab} - {min_fiab}, 0)), 0) AS fiabilidad_scaled,
-            COALESCE(SAFE_DIVIDE(COALESCE(durabilidad, {min_durab}) - {min_durab}, NULLIF({max_durab} - {min_durab}, 0)), 0) AS durabilidad_scaled,
-            COALESCE(SAFE_DIVIDE(COALESCE(seguridad, {min_seg}) - {min_seg}, NULLIF({max_seg} - {min_seg}, 0)), 0) AS seguridad_scaled,
-            COALESCE(SAFE_DIVIDE(COALESCE(comodidad, {min_comod}) - {min_comod}, NULLIF({max_comod} - {min_comod}, 0)), 0) AS comodidad_scaled,
-            COALESCE(SAFE_DIVIDE({max_coste_uso} - COALESCE(costes_de_uso, {max_coste_uso}), NULLIF({max_coste_uso} - {min_coste_uso}, 0)), 0) AS costes_de_uso_bajo_scaled,
-            COALESCE(SAFE_DIVIDE({max_coste_mante} - COALESCE(costes_mantenimiento, {max_coste_mante}), NULLIF({max_coste_mante} - {min_coste_mante}, 0)), 0) AS costes_mantenimiento_bajo_scaled,
-            COALESCE(SAFE_DIVIDE(COALESCE(tecnologia, {min_tec}) - {min_tec}, NULLIF({max_tec} - {min_tec}, 0)), 0) AS tecnologia_scaled,
-            COALESCE(SAFE_DIVIDE(COALESCE(acceso_low_cost, {min_acc_lc}) - {min_acc_lc}, NULLIF({max_acc_lc} - {min_acc_lc}, 0)), 0) AS acceso_low_cost_scaled,
-            COALESCE(SAFE_DIVIDE(COALESCE(deportividad, {min_depor_bq}) - {min_depor_bq}, NULLIF({max_depor_bq} - {min_depor_bq}, 0)), 0) AS deportividad_bq_scaled,
-            COALESCE(SAFE_DIVIDE(COALESCE(devaluacion, {min_deval}) - {min_deval}, NULLIF({max_deval} - {min_deval}, 0)), 0) AS devaluacion_scaled,
-            COALESCE(SAFE_DIVIDE(COALESCE(maletero_minimo, {min_mal_min}) - {min_mal_min}, NULLIF({max_mal_min} - {min_mal_min}, 0)), 0) AS maletero_minimo_scaled,
-            COALESCE(SAFE_DIVIDE(COALESCE(maletero_maximo, {min_mal_max}) - {min_mal_max}, NULLIF({max_mal_max} - {min_mal_max}, 0)), 0) AS maletero_maximo_scaled,
-            COALESCE(SAFE_DIVIDE(COALESCE(largo, {min_largo}) - {min_largo}, NULLIF({max_largo} - {min_largo}, 0)), 0) AS largo_scaled,
-            COALESCE(SAFE_DIVIDE(COALESCE(autonomia_uso_maxima, {min_auton}) - {min_auton}, NULLIF({max_auton} - {min_auton}, 0)), 0) AS autonomia_uso_maxima_scaled,
-            COALESCE(SAFE_DIVIDE({max_peso_kg} - COALESCE(peso, {max_peso_kg}), NULLIF({max_peso_kg} - {min_peso_kg}, 0)), 0) AS bajo_peso_scaled,
-            COALESCE(SAFE_DIVIDE({max_consumo} - COALESCE(indice_consumo_energia, {max_consumo}), NULLIF({max_consumo} - {min_consumo}, 0)), 0) AS bajo_consumo_scaled,
-            COALESCE(SAFE_DIVIDE(COALESCE(par, {min_par}) - {min_par}, NULLIF({max_par} - {min_par}, 0)), 0) AS par_scaled,
-            COALESCE(SAFE_DIVIDE(COALESCE(capacidad_remolque_con_freno, {min_cap_cf}) - {min_cap_cf}, NULLIF({max_cap_cf} - {min_cap_cf}, 0)), 0) AS cap_remolque_cf_scaled,
-            COALESCE(SAFE_DIVIDE(COALESCE(capacidad_remolque_sin_freno, {min_cap_sf}) - {min_cap_sf}, NULLIF({max_cap_sf} - {min_cap_sf}, 0)), 0) AS cap_remolque_sf_scaled,
-            COALESCE(SAFE_DIVIDE({max_sup_planta} - COALESCE(superficie_planta, {max_sup_planta}), NULLIF({max_sup_planta} - {min_sup_planta}, 0)), 0) AS menor_superficie_planta_scaled,
-            COALESCE(SAFE_DIVIDE({max_diam_giro} - COALESCE(diametro_giro, {max_diam_giro}), NULLIF({max_diam_giro} - {min_diam_giro}, 0)), 0) AS menor_diametro_giro_scaled,
-            COALESCE(SAFE_DIVIDE({max_largo} - COALESCE(largo, {max_largo}), NULLIF({max_largo} - {min_largo}, 0)), 0) AS menor_largo_garage_scaled,
-            COALESCE(SAFE_DIVIDE({max_anc} - COALESCE(ancho, {max_anc}), NULLIF({max_anc} - {min_anc}, 0)), 0) AS menor_ancho_garage_scaled,
-            COALESCE(SAFE_DIVIDE({max_alto_veh} - COALESCE(alto, {max_alto_veh}), NULLIF({max_alto_veh} - {min_alto_veh}, 0)), 0) AS menor_alto_garage_scaled,
-            COALESCE(SAFE_DIVIDE(COALESCE(deportividad, {min_depor_bq}) - {min_depor_bq}, NULLIF({max_depor_bq} - {min_depor_bq}, 0)), 0) AS deportividad_style_scaled,
-            COALESCE(SAFE_DIVIDE({max_rel_pp} - COALESCE(relacion_peso_potencia, {max_rel_pp}), NULLIF({max_rel_pp} - {min_rel_pp}, 0)), 0) AS menor_rel_peso_potencia_scaled,
-            COALESCE(SAFE_DIVIDE(COALESCE(potencia_maxima, {min_pot_max}) - {min_pot_max}, NULLIF({max_pot_max} - {min_pot_max}, 0)), 0) AS potencia_maxima_style_scaled,
-            COALESCE(SAFE_DIVIDE({max_acel} - COALESCE(aceleracion_0_100, {max_acel}), NULLIF({max_acel} - {min_acel}, 0)), 0) AS menor_aceleracion_scaled,
-            COALESCE(SAFE_DIVIDE(COALESCE(autonomia_uso_principal, {min_auto_p}) - {min_auto_p}, NULLIF({max_auto_p} - {min_auto_p}, 0)), 0) AS autonomia_uso_principal_scaled,
-            COALESCE(SAFE_DIVIDE(COALESCE(autonomia_uso_2nd_drive, {min_auto_2}) - {min_auto_2}, NULLIF({max_auto_2} - {min_auto_2}, 0)), 0) AS autonomia_uso_2nd_drive_scaled, 
-            (CASE WHEN COALESCE(tiempo_carga_min, 0) = 0 THEN 0.0 ELSE COALESCE(SAFE_DIVIDE({max_t_carga} - tiempo_carga_min, NULLIF({max_t_carga} - {min_t_carga}, 0)), 0) END) AS menor_tiempo_carga_min_scaled,
-            (CASE WHEN COALESCE(potencia_maxima_carga_AC, 0) = 0 THEN 0.0 ELSE COALESCE(SAFE_DIVIDE(potencia_maxima_carga_AC - {min_pot_ac}, NULLIF({max_pot_ac} - {min_pot_ac}, 0)), 0) END) AS potencia_maxima_carga_AC_scaled,
-            (CASE WHEN COALESCE(potencia_maxima_carga_DC, 0) = 0 THEN 0.0 ELSE COALESCE(SAFE_DIVIDE(potencia_maxima_carga_DC - {min_pot_dc}, NULLIF({max_pot_dc} - {min_pot_dc}, 0)), 0) END) AS potencia_maxima_carga_DC_scaled,
-            
-        FROM
-            `thecarmentor-mvp2.web_cars.coches_prueba_2`
-            --`thecarmentor-mvp2.web_cars.match_coches_pruebas`
+        -- Tabla materializada con los *_scaled (utils/scaled_features.py) o escalado al vuelo si no está vigente
+        {cuerpo_scaled_data}
     ),      
     -- ESTE ES EL CTE CLAVE CON TODOS LOS DESGLOSES
     DebugScores AS (
@@ -669,8 +563,135 @@ def buscar_coches_bq(
         score_total DESC
     LIMIT @k 
     """
+
+
+def _precompilar_plantillas() -> Dict[Tuple[str, FormaWhere], str]:
+    plantillas = {}
+    for origen in ORIGENES_SCALED_DATA:
+        cuerpo_scaled_data = sql_scaled_data(origen)
+        for forma in FORMAS_WHERE:
+            clausulas = _clausulas_where(forma)
+            plantillas[(origen, forma)] = _generar_sql_busqueda(
+                cuerpo_scaled_data, " AND " + " AND ".join(clausulas) if clausulas else ""
+            )
+    return plantillas
+
+
+# (origen de ScaledData, forma del WHERE) -> texto de la query
+PLANTILLAS_SQL_BUSQUEDA: Dict[Tuple[str, FormaWhere], str] = _precompilar_plantillas()
+
+
+def _nombre_plantilla(clave: Tuple[str, FormaWhere]) -> str:
+    """Nombre legible de una plantilla, p. ej. "tabla|transmision+precio"."""
+    origen, (transmision, plazas, mecanica, presupuesto) = clave
+    partes = [nombre for nombre, activa in (("transmision", transmision), ("plazas", plazas), ("mecanica", mecanica)) if activa]
+    if presupuesto:
+        partes.append(presupuesto)
+    return f"{origen}|{'+'.join(partes) or 'sin_filtros'}"
+
+
+class EstadisticasPlantillas:
+    """Usos, aciertos de la caché de BigQuery y bytes procesados/facturados por plantilla."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._por_plantilla: Dict[str, Dict[str, int]] = {}
+
+    def registrar(self, clave: Tuple[str, FormaWhere], query_job) -> None:
+        nombre = _nombre_plantilla(clave)
+        with self._lock:
+            datos = self._por_plantilla.setdefault(
+                nombre, {"usos": 0, "aciertos_cache_bq": 0, "bytes_procesados": 0, "bytes_facturados": 0}
+            )
+            datos["usos"] += 1
+            datos["aciertos_cache_bq"] += int(bool(getattr(query_job, "cache_hit", False)))
+            datos["bytes_procesados"] += getattr(query_job, "total_bytes_processed", None) or 0
+            datos["bytes_facturados"] += getattr(query_job, "total_bytes_billed", None) or 0
+
+    def estadisticas(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "plantillas_precompiladas": len(PLANTILLAS_SQL_BUSQUEDA),
+                "plantillas_usadas": len(self._por_plantilla),
+                "por_plantilla": {nombre: dict(datos) for nombre, datos in sorted(self._por_plantilla.items())},
+            }
+
+
+# Instancia única por proceso
+estadisticas_plantillas = EstadisticasPlantillas()
+
+
+def obtener_estadisticas_plantillas_sql() -> Dict[str, Any]:
+    return estadisticas_plantillas.estadisticas()
+
+
+def estimar_bytes_plantillas(
+    client: Optional[bigquery.Client] = None,
+    origenes: Optional[List[str]] = None
+) -> List[Dict[str, Any]]:
+    """
+    Dry run de cada plantilla precompilada: bytes que procesaría en BigQuery (no se
+    ejecuta ni se factura nada). Los parámetros son de ejemplo; el coste solo depende
+    de las columnas y tablas que lee la query.
+    """
+    client = client or obtener_cliente_bq()
+    filtros_ejemplo_por_forma = {
+        0: {"transmision_preferida": "automático"},
+        1: {"plazas_min": 5},
+        2: {"tipo_mecanica": ["GASOLINA"]},
+    }
+    informe = []
+    for (origen, forma), sql in PLANTILLAS_SQL_BUSQUEDA.items():
+        if origenes and origen not in origenes:
+            continue
+        filtros = {}
+        for posicion, filtro in filtros_ejemplo_por_forma.items():
+            if forma[posicion]:
+                filtros.update(filtro)
+        if forma[3] == "precio":
+            filtros["pago_contado"] = 30000.0
+        elif forma[3] == "cuota":
+            filtros["cuota_max"] = 400.0
+        _, params_where = _construir_where(filtros)
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=_parametros_busqueda(filtros, {}, 7) + params_where,
+            dry_run=True,
+            use_query_cache=False,
+        )
+        fila = {"plantilla": _nombre_plantilla((origen, forma)), "bytes_procesados": None, "error": None}
+        try:
+            fila["bytes_procesados"] = client.query(sql, job_config=job_config).total_bytes_processed
+        except Exception as e:
+            fila["error"] = str(e)
+        informe.append(fila)
+    return informe
+
+
+def buscar_coches_bq(
+    filtros: Optional[FiltrosDict],
+    pesos: Optional[PesosDict], 
+    k: int
+) -> Tuple[List[Dict[str, Any]], str, List[Dict[str, Any]]]:
+    
+    if not filtros: filtros = {}
+    if not pesos: pesos = {}
+
+    try:
+        client = obtener_cliente_bq()
+    except Exception as e_auth:
+        logging.error(f"Error al inicializar cliente BigQuery: {e_auth}")
+        return [], f"Error BQ Auth: {e_auth}", []
+
+    # PASO 1 y 2: PARÁMETROS (pesos, flags, k) Y CLÁUSULAS WHERE
+    params = _parametros_busqueda(filtros, pesos, k)
+    forma_where, params_where = _construir_where(filtros)
+    params += params_where
+
+    # PASO 3 y 4: PLANTILLA SQL PRECOMPILADA para (origen de ScaledData, forma del WHERE)
+    clave_plantilla = (origen_scaled_data(client), forma_where)
+    sql = PLANTILLAS_SQL_BUSQUEDA[clave_plantilla]
+
     # PASO 5: LOGGING Y EJECUCIÓN
-    # (Esta parte se mantiene igual)
     log_params_for_logging = [] 
     if params:
         for p in params:
@@ -682,21 +703,32 @@ def buscar_coches_bq(
             except Exception as e_log_param:
                 logging.error(f"Error procesando param para log: {p}, error: {e_log_param}")
     
-  # --- ESTOS SON LOS PRINTS CLAVE PARA EL DEBUG ---
-    print("--- 🧠 SQL Query Template Enviada a BigQuery ---")
-    print(sql) # Este print ya contiene el valor de FACTOR_ESCALA_BASE
-    print("-------------------------------------------------")
-    print(f"\n--- 📦 Parameters Enviados a BigQuery ---\n{log_params_for_logging}")
-    print("-------------------------------------------------")
-
+    # --- CACHÉ DE RESULTADOS: mismos parámetros + mismo catálogo + misma plantilla = mismo resultado ---
+    huella_busqueda = None
+    version_catalogo = None
+    if CACHE_BUSQUEDAS_ACTIVA:
+        version_catalogo = obtener_version_catalogo(client)
+        huella_busqueda = calcular_huella_busqueda(log_params_for_logging, version_catalogo, sql, "bigquery")
+        resultado_cacheado = cache_busquedas.obtener(huella_busqueda, version_catalogo)
+        if resultado_cacheado is not None:
+            logging.info(f"✅ Búsqueda servida desde caché (huella {huella_busqueda[:12]}), {len(resultado_cacheado[0])} resultados.")
+            return resultado_cacheado
+
+    logging.debug(
+        f"DEBUG (Buscar BQ) ► Plantilla {_nombre_plantilla(clave_plantilla)} ({len(sql)} caracteres), "
+        f"parámetros: {log_params_for_logging}"
+    )
 
     try:
-        # No necesitas el bloque de .format() aquí
         job_config = bigquery.QueryJobConfig(query_parameters=params)
         query_job = client.query(sql, job_config=job_config)
         df = query_job.result().to_dataframe() 
-        logging.info(f"✅ BigQuery query ejecutada, {len(df)} resultados obtenidos.")
-        return df.to_dict(orient="records"), sql, log_params_for_logging
+        estadisticas_plantillas.registrar(clave_plantilla, query_job)
+        logging.info(f"✅ BigQuery query ejecutada ({_nombre_plantilla(clave_plantilla)}), {len(df)} resultados obtenidos.")
+        resultado = (df.to_dict(orient="records"), sql, log_params_for_logging)
+        if huella_busqueda is not None:
+            cache_busquedas.guardar(huella_busqueda, version_catalogo, resultado)
+        return resultado
     except Exception as e:
         logging.error(f"❌ Error al ejecutar la query en BigQuery: {e}")
         traceback.print_exc()
@@ -916,4 +948,27 @@ def buscar_coches_bq(
 
 # La columna de depuración dbg_bonus_seguridad te muestra correctamente los 1.67 puntos adicionales que se han sumado al score final gracias a esta regla.
 
-# ¡Tu lógica de scoring está funcionando exactamente como la diseñamos!
\ No newline at end of file
+# ¡Tu lógica de scoring está funcionando exactamente como la diseñamos!
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Plantillas SQL precompiladas de buscar_coches_bq.")
+    parser.add_argument("--dry-run", action="store_true", help="Estimar en BigQuery los bytes procesados por cada plantilla")
+    parser.add_argument("--origen", choices=ORIGENES_SCALED_DATA, default=None, help="Solo las plantillas de este origen de ScaledData")
+    args = parser.parse_args()
+
+    if not args.dry_run:
+        for clave, texto in PLANTILLAS_SQL_BUSQUEDA.items():
+            print(f"{_nombre_plantilla(clave):45} {len(texto):>8} caracteres")
+        raise SystemExit(0)
+
+    informe = estimar_bytes_plantillas(origenes=[args.origen] if args.origen else None)
+    for fila in informe:
+        if fila["error"]:
+            print(f"{fila['plantilla']:45} ERROR: {fila['error']}")
+        else:
+            print(f"{fila['plantilla']:45} {fila['bytes_procesados'] / 1024 ** 2:>10.2f} MB")
@@ -0,0 +1,139 @@
+# utils/bq_client.py
+# Registro de clientes BigQuery compartidos por todo el proceso.
+#
+# Antes cada llamada (buscar_coches_bq, obtener_datos_climaticos_por_cp,
+# log_busqueda_a_bigquery) creaba su propio bigquery.Client(): descubrimiento de
+# credenciales, nueva sesión HTTP y handshake TLS en cada conversación.
+# Ahora hay UN cliente por proyecto, creado en el startup de FastAPI, que reutiliza
+# una sesión HTTP con keep-alive y un pool de conexiones de tamaño configurable.
+# (bigquery.Client es thread-safe, así que se puede compartir entre peticiones.)
+import logging
+import threading
+import time
+import traceback
+from typing import Optional, Dict, Any
+
+import google.auth
+from google.auth.transport.requests import AuthorizedSession
+from google.cloud import bigquery
+from requests.adapters import HTTPAdapter
+
+from config.settings import BQ_POOL_CONEXIONES, BQ_TIMEOUT_HEALTHCHECK_SEG
+
+logger = logging.getLogger(__name__)
+
+SCOPES_BIGQUERY = ["https://www.googleapis.com/auth/cloud-platform"]
+_CLAVE_PROYECTO_POR_DEFECTO = "__default__"
+
+
+class RegistroClientesBigQuery:
+    """Clientes BigQuery por proyecto + métricas de adquisición."""
+
+    def __init__(self, tamano_pool: int):
+        self._tamano_pool = tamano_pool
+        self._clientes: Dict[str, bigquery.Client] = {}
+        self._proyecto_por_defecto: Optional[str] = None
+        self._lock = threading.Lock()
+        self.adquisiciones = 0
+        self.creaciones = 0
+        self.tiempo_total_adquisicion_ms = 0.0
+        self.tiempo_max_adquisicion_ms = 0.0
+        self.ultimo_healthcheck: Dict[str, Any] = {}
+
+    def _crear_cliente(self, project: Optional[str]) -> bigquery.Client:
+        credenciales, proyecto_por_defecto = google.auth.default(scopes=SCOPES_BIGQUERY)
+        sesion = AuthorizedSession(credenciales)
+        adaptador = HTTPAdapter(pool_connections=self._tamano_pool, pool_maxsize=self._tamano_pool)
+        sesion.mount("https://", adaptador)
+        cliente = bigquery.Client(project=project or proyecto_por_defecto, credentials=credenciales, _http=sesion)
+        self.creaciones += 1
+        logging.info(f"✅ (BQ Client) Cliente BigQuery creado para proyecto '{cliente.project}' (pool={self._tamano_pool}).")
+        return cliente
+
+    def obtener(self, project: Optional[str] = None) -> bigquery.Client:
+        """Devuelve el cliente compartido del proyecto, creándolo la primera vez."""
+        # project=None y el proyecto por defecto de las credenciales comparten cliente
+        clave = project or self._proyecto_por_defecto or _CLAVE_PROYECTO_POR_DEFECTO
+        inicio = time.perf_counter()
+        cliente = self._clientes.get(clave)
+        if cliente is None:
+            with self._lock:
+                cliente = self._clientes.get(clave)
+                if cliente is None:
+                    cliente = self._crear_cliente(project)
+                    if project is None:
+                        self._proyecto_por_defecto = cliente.project
+                    self._clientes[cliente.project] = cliente
+        duracion_ms = (time.perf_counter() - inicio) * 1000
+        with self._lock:
+            self.adquisiciones += 1
+            self.tiempo_total_adquisicion_ms += duracion_ms
+            self.tiempo_max_adquisicion_ms = max(self.tiempo_max_adquisicion_ms, duracion_ms)
+        if duracion_ms > 100:
+            logging.info(f"INFO (BQ Client) ► Adquisición de cliente '{clave}' tardó {duracion_ms:.1f} ms.")
+        return cliente
+
+    def verificar_salud(self) -> Dict[str, Any]:
+        """Lanza un SELECT 1 (0 bytes facturados) con cada cliente registrado."""
+        resultado: Dict[str, Any] = {}
+        for clave, cliente in list(self._clientes.items()):
+            inicio = time.perf_counter()
+            try:
+                cliente.query("SELECT 1").result(timeout=BQ_TIMEOUT_HEALTHCHECK_SEG)
+                resultado[clave] = {"ok": True, "latencia_ms": round((time.perf_counter() - inicio) * 1000, 1)}
+            except Exception as e:
+                logging.error(f"❌ (BQ Client) Healthcheck fallido para '{clave}': {e}")
+                resultado[clave] = {"ok": False, "error": str(e)}
+                # Se descarta el cliente para que la siguiente adquisición lo recree
+                with self._lock:
+                    self._clientes.pop(clave, None)
+        self.ultimo_healthcheck = resultado
+        return resultado
+
+    def cerrar(self) -> None:
+        with self._lock:
+            for clave, cliente in self._clientes.items():
+                try:
+                    cliente.close()
+                except Exception as e:
+                    logging.warning(f"WARN (BQ Client) ► Error cerrando cliente '{clave}': {e}")
+            self._clientes.clear()
+        logging.info("(BQ Client) Clientes BigQuery cerrados.")
+
+    def estadisticas(self) -> Dict[str, Any]:
+        with self._lock:
+            media_ms = self.tiempo_total_adquisicion_ms / self.adquisiciones if self.adquisiciones else 0.0
+            return {
+                "clientes_activos": list(self._clientes.keys()),
+                "tamano_pool_http": self._tamano_pool,
+                "creaciones": self.creaciones,
+                "adquisiciones": self.adquisiciones,
+                "adquisicion_media_ms": round(media_ms, 3),
+                "adquisicion_max_ms": round(self.tiempo_max_adquisicion_ms, 3),
+                "ultimo_healthcheck": self.ultimo_healthcheck,
+            }
+
+
+registro_clientes_bq = RegistroClientesBigQuery(tamano_pool=BQ_POOL_CONEXIONES)
+
+
+def obtener_cliente_bq(project: Optional[str] = None) -> bigquery.Client:
+    return registro_clientes_bq.obtener(project)
+
+
+def inicializar_clientes_bq(*projects: Optional[str]) -> None:
+    """Crea por adelantado los clientes (startup de FastAPI) para sacar la creación del camino crítico."""
+    for project in projects or (None,):
+        try:
+            registro_clientes_bq.obtener(project)
+        except Exception as e:
+            logging.error(f"❌ (BQ Client) No se pudo inicializar el cliente para '{project}': {e}")
+            traceback.print_exc()
+
+
+def cerrar_clientes_bq() -> None:
+    registro_clientes_bq.cerrar()
+
+
+def obtener_estadisticas_clientes_bq() -> Dict[str, Any]:
+    return registro_clientes_bq.estadisticas()
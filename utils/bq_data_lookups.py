@@ -4,6 +4,9 @@ import logging
 import traceback
 from typing import Optional, Dict, Any
 from google.cloud import bigquery
+from utils.bq_client import obtener_cliente_bq
+from utils.cp_climate_index import obtener_indice_cp
+from config.settings import CP_CLIMA_FALLBACK_BQ
 
 # Ajusta la ruta de importación según tu estructura
 from graph.perfil.state import InfoClimaUsuario # Necesitamos el modelo Pydantic
@@ -28,7 +31,10 @@ COLUMNAS_ZONA = [
 
 def obtener_datos_climaticos_por_cp(codigo_postal_str: str) -> Optional[InfoClimaUsuario]:
     """
-    Consulta la tabla de zonas climáticas en BigQuery para un código postal dado.
+    Consulta las zonas climáticas de un código postal. Primero mira el índice local
+    (utils/cp_climate_index.py, acceso O(1) sin red): si está vigente, un CP que no
+    aparece en él no pertenece a ninguna zona. Solo si no hay índice, o está caducado
+    y CP_CLIMA_FALLBACK_BQ está activo, consulta la tabla en BigQuery.
 
     Args:
         codigo_postal_str: El código postal del usuario (como string).
@@ -43,8 +49,17 @@ def obtener_datos_climaticos_por_cp(codigo_postal_str: str) -> Optional[InfoClim
         logging.warning(f"CP inválido proporcionado para búsqueda climática: {codigo_postal_str}")
         return None
 
+    indice = obtener_indice_cp()
+    if indice is not None:
+        if indice.esta_vigente() or not CP_CLIMA_FALLBACK_BQ:
+            # Un CP que no aparece en ninguna columna da el mismo resultado que la query: todo False
+            flags_zona = indice.consultar(int(codigo_postal_str)) or {col: False for col in COLUMNAS_ZONA}
+            logging.info(f"Datos climáticos (índice local) para CP {codigo_postal_str}: {flags_zona}")
+            return InfoClimaUsuario(**flags_zona, cp_valido_encontrado=True, codigo_postal_consultado=codigo_postal_str)
+        logging.warning(f"WARN (Índice CP) ► Índice local caducado (generado {indice.meta.get('generado_en')}). Consultando BigQuery...")
+
     try:
-        client = bigquery.Client(project=PROJECT_ID)
+        client = obtener_cliente_bq(PROJECT_ID)
         
         # Intentar convertir el CP a INTEGER para la query, ya que tus columnas BQ son INTEGER
         try:
@@ -1,10 +1,29 @@
 # utils/bq_logger.py
+# Registro de búsquedas en BigQuery con escritura diferida (write-behind).
+#
+# log_busqueda_a_bigquery ya no habla con BigQuery: serializa la fila (JSON compacto) y la
+# deja en una cola acotada en memoria. Un hilo de fondo agrupa las filas en lotes (por
+# número de filas o por tiempo) y las inserta con reintentos y backoff exponencial.
+# Si BigQuery no está disponible, o la cola está llena, las filas van a un spool local
+# (JSONL) que se reenvía cuando BigQuery vuelve a responder. Las filas que BigQuery rechaza
+# por inválidas (error de esquema) no se reintentan: van a un fichero de descartadas aparte.
+# En el shutdown de FastAPI se vacía la cola (detener_registrador_bq) para no perder filas.
 import json
 import logging
+import os
+import queue
+import threading
+import time
 import traceback
+import uuid
 from datetime import datetime, timezone
 from typing import Dict, List, Any, Optional
 from google.cloud import bigquery
+from utils.bq_client import obtener_cliente_bq
+from config.settings import (
+    LOG_BQ_MAX_COLA, LOG_BQ_TAMANO_LOTE, LOG_BQ_INTERVALO_FLUSH_SEG,
+    LOG_BQ_MAX_REINTENTOS, LOG_BQ_BACKOFF_BASE_SEG, LOG_BQ_SPOOL_PATH, LOG_BQ_DESCARTADAS_PATH
+)
 
 # Configura tu dataset y tabla de BigQuery
 PROJECT_ID = "thecarmentor-mvp2" # proyecto de GCP
@@ -13,6 +32,291 @@ TABLE_ID = "historial_busquedas_agente" # El nombre de tabla
 
 TABLE_FULL_ID = f"{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}"
 
+_FIN_COLA = object()  # Centinela para detener el hilo
+
+# Motivos de error por fila de insert_rows_json que no se arreglan reintentando (campo
+# inexistente, tipo incorrecto...). "stopped" marca filas válidas que BigQuery no insertó
+# porque otra fila de la misma petición era inválida: se reintentan sin esperar.
+_MOTIVOS_ERROR_PERMANENTE = frozenset({"invalid"})
+_MOTIVO_FILA_DETENIDA = "stopped"
+
+
+def _motivos(errores_fila: List[Dict[str, Any]]) -> set:
+    return {err.get("reason") for err in errores_fila}
+
+
+def _json_compacto(valor: Any) -> str:
+    return json.dumps(valor, separators=(",", ":"), ensure_ascii=False, default=str)
+
+
+def _modelo_a_json(obj: Optional[Any]) -> Optional[str]:
+    return obj.model_dump_json() if hasattr(obj, "model_dump_json") else None
+
+
+class RegistradorBusquedasBQ:
+    """Cola acotada + hilo de fondo que inserta las filas en BigQuery por lotes."""
+
+    def __init__(self, tabla: str, max_cola: int, tamano_lote: int, intervalo_flush_seg: float,
+                 max_reintentos: int, backoff_base_seg: float, ruta_spool: str,
+                 ruta_descartadas: str):
+        self.tabla = tabla
+        self.tamano_lote = tamano_lote
+        self.intervalo_flush_seg = intervalo_flush_seg
+        self.max_reintentos = max_reintentos
+        self.backoff_base_seg = backoff_base_seg
+        self.ruta_spool = ruta_spool
+        self.ruta_descartadas = ruta_descartadas
+        self._cola: queue.Queue = queue.Queue(maxsize=max_cola)
+        self._hilo: Optional[threading.Thread] = None
+        self._lock_hilo = threading.Lock()
+        self._lock_spool = threading.Lock()
+        self._lock_stats = threading.Lock()
+        self.encoladas = 0
+        self.insertadas = 0
+        self.lotes = 0
+        self.reintentos = 0
+        self.enviadas_a_spool = 0
+        self.reenviadas_desde_spool = 0
+        self.descartadas = 0
+
+    # --- Lado productor (camino crítico de la petición) ---
+
+    def encolar(self, fila: Dict[str, Any]) -> None:
+        """No bloquea nunca: si la cola está llena, la fila va directamente al spool."""
+        self._asegurar_hilo()
+        # insertId para que BigQuery deduplique si un reintento repite una fila ya insertada
+        entrada = {"insert_id": uuid.uuid4().hex, "fila": fila}
+        try:
+            self._cola.put_nowait(entrada)
+            with self._lock_stats:
+                self.encoladas += 1
+        except queue.Full:
+            logging.warning("WARN (BQ Logger) ► Cola de logs llena. La fila se guarda en el spool local.")
+            self._escribir_spool([entrada])
+
+    def _asegurar_hilo(self) -> None:
+        if self._hilo is not None and self._hilo.is_alive():
+            return
+        with self._lock_hilo:
+            if self._hilo is None or not self._hilo.is_alive():
+                self._hilo = threading.Thread(target=self._bucle, name="bq-logger", daemon=True)
+                self._hilo.start()
+
+    # --- Hilo de fondo ---
+
+    def _bucle(self) -> None:
+        self._reenviar_spool()
+        lote: List[Dict[str, Any]] = []
+        limite = None
+        while True:
+            espera = None if limite is None else max(0.0, limite - time.monotonic())
+            try:
+                entrada = self._cola.get(timeout=espera)
+            except queue.Empty:
+                entrada = None
+            if entrada is _FIN_COLA:
+                if self._volcar(lote):
+                    self._reenviar_spool()
+                return
+            if entrada is not None:
+                lote.append(entrada)
+                if limite is None:
+                    limite = time.monotonic() + self.intervalo_flush_seg
+            if lote and (len(lote) >= self.tamano_lote or time.monotonic() >= limite):
+                if self._volcar(lote):
+                    self._reenviar_spool()
+                lote = []
+                limite = None
+
+    def _volcar(self, lote: List[Dict[str, Any]]) -> bool:
+        """
+        Inserta el lote con reintentos. Las filas inválidas van a descartadas y lo que sigue
+        fallando tras los reintentos, al spool. True si no ha quedado nada en el spool.
+        """
+        if not lote:
+            return True
+        pendientes = lote
+        esperar = False
+        for intento in range(self.max_reintentos + 1):
+            if intento:
+                with self._lock_stats:
+                    self.reintentos += 1
+                if esperar:
+                    time.sleep(self.backoff_base_seg * (2 ** (intento - 1)))
+            try:
+                client = obtener_cliente_bq(PROJECT_ID)
+                errores = client.insert_rows_json(
+                    self.tabla,
+                    [e["fila"] for e in pendientes],
+                    row_ids=[e["insert_id"] for e in pendientes],
+                )
+            except Exception as e:
+                logging.warning(f"WARN (BQ Logger) ► Fallo insertando {len(pendientes)} filas (intento {intento + 1}): {e}")
+                esperar = True
+                continue
+            errores_por_indice = {err.get("index"): err.get("errors", []) for err in errores}
+            with self._lock_stats:
+                self.insertadas += len(pendientes) - len(errores_por_indice)
+                self.lotes += 1
+            if not errores_por_indice:
+                logging.info(f"INFO (BQ Logger) ► {len(pendientes)} logs de búsqueda insertados en BQ.")
+                return True
+            logging.error(f"Errores al insertar logs en BigQuery: {errores}")
+            invalidas, reintentables = [], []
+            for i, entrada in enumerate(pendientes):
+                if i not in errores_por_indice:
+                    continue
+                if _motivos(errores_por_indice[i]) & _MOTIVOS_ERROR_PERMANENTE:
+                    invalidas.append({**entrada, "errores": errores_por_indice[i]})
+                else:
+                    reintentables.append((entrada, errores_por_indice[i]))
+            if invalidas:
+                self._escribir_descartadas(invalidas)
+            if not reintentables:
+                return True
+            # Si las filas pendientes solo se detuvieron por culpa de las inválidas, no hay backoff
+            esperar = any(_motivos(errs) != {_MOTIVO_FILA_DETENIDA} for _, errs in reintentables)
+            pendientes = [entrada for entrada, _ in reintentables]
+        self._escribir_spool(pendientes)
+        return False
+
+    # --- Spool local ---
+
+    def _escribir_spool(self, entradas: List[Dict[str, Any]]) -> None:
+        try:
+            with self._lock_spool:
+                directorio = os.path.dirname(self.ruta_spool)
+                if directorio:
+                    os.makedirs(directorio, exist_ok=True)
+                with open(self.ruta_spool, "a", encoding="utf-8") as f:
+                    for entrada in entradas:
+                        f.write(_json_compacto(entrada) + "\n")
+            with self._lock_stats:
+                self.enviadas_a_spool += len(entradas)
+            logging.warning(f"WARN (BQ Logger) ► {len(entradas)} filas guardadas en spool '{self.ruta_spool}'.")
+        except Exception as e:
+            logging.error(f"❌ (BQ Logger) No se pudo escribir el spool ({len(entradas)} filas perdidas): {e}")
+            traceback.print_exc()
+
+    def _escribir_descartadas(self, entradas: List[Dict[str, Any]]) -> None:
+        """Guarda aparte, con sus errores, las filas que BigQuery rechaza por inválidas."""
+        try:
+            with self._lock_spool:
+                directorio = os.path.dirname(self.ruta_descartadas)
+                if directorio:
+                    os.makedirs(directorio, exist_ok=True)
+                with open(self.ruta_descartadas, "a", encoding="utf-8") as f:
+                    for entrada in entradas:
+                        f.write(_json_compacto(entrada) + "\n")
+            logging.error(f"❌ (BQ Logger) {len(entradas)} filas inválidas descartadas en '{self.ruta_descartadas}'.")
+        except Exception as e:
+            logging.error(f"❌ (BQ Logger) No se pudieron guardar {len(entradas)} filas inválidas: {e}")
+            traceback.print_exc()
+        with self._lock_stats:
+            self.descartadas += len(entradas)
+
+    def _reenviar_spool(self) -> None:
+        """Reinserta las filas del spool. Se llama desde el hilo de fondo tras un volcado OK."""
+        if not os.path.exists(self.ruta_spool):
+            return
+        ruta_procesando = self.ruta_spool + ".procesando"
+        try:
+            with self._lock_spool:
+                os.replace(self.ruta_spool, ruta_procesando)
+            with open(ruta_procesando, "r", encoding="utf-8") as f:
+                entradas = [json.loads(linea) for linea in f if linea.strip()]
+            os.remove(ruta_procesando)
+        except Exception as e:
+            logging.error(f"❌ (BQ Logger) Error leyendo el spool: {e}")
+            traceback.print_exc()
+            return
+        logging.info(f"INFO (BQ Logger) ► Reenviando {len(entradas)} filas del spool.")
+        for i in range(0, len(entradas), self.tamano_lote):
+            trozo = entradas[i:i + self.tamano_lote]
+            if self._volcar(trozo):
+                # Incluye trozos con filas inválidas: ya están en descartadas y se sigue con el resto
+                with self._lock_stats:
+                    self.reenviadas_desde_spool += len(trozo)
+            else:
+                # BigQuery sigue caído: lo que queda vuelve al spool sin reintentos extra
+                self._escribir_spool(entradas[i + self.tamano_lote:])
+                break
+
+    # --- Ciclo de vida ---
+
+    def detener(self, timeout: float = 30.0) -> None:
+        """Vacía la cola (inserta lo pendiente o lo manda al spool) y para el hilo."""
+        if self._hilo is None or not self._hilo.is_alive():
+            return
+        inicio = time.monotonic()
+        try:
+            # La cola es acotada: un put() bloqueante sobre una cola llena colgaría el shutdown
+            self._cola.put(_FIN_COLA, timeout=timeout)
+        except queue.Full:
+            logging.error("❌ (BQ Logger) Cola de logs llena en el shutdown. Pasando lo pendiente al spool.")
+            self._pasar_cola_a_spool()
+            try:
+                self._cola.put_nowait(_FIN_COLA)
+            except queue.Full:
+                pass
+        self._hilo.join(timeout=max(0.0, timeout - (time.monotonic() - inicio)))
+        if self._hilo.is_alive():
+            logging.error("❌ (BQ Logger) El hilo de logs no terminó a tiempo. Pasando lo pendiente al spool.")
+            self._pasar_cola_a_spool()
+        else:
+            logging.info("(BQ Logger) Cola de logs vaciada y hilo detenido.")
+
+    def _pasar_cola_a_spool(self) -> None:
+        restantes = []
+        while True:
+            try:
+                entrada = self._cola.get_nowait()
+            except queue.Empty:
+                break
+            if entrada is not _FIN_COLA:
+                restantes.append(entrada)
+        if restantes:
+            self._escribir_spool(restantes)
+
+    def estadisticas(self) -> Dict[str, Any]:
+        with self._lock_stats:
+            return {
+                "en_cola": self._cola.qsize(),
+                "max_cola": self._cola.maxsize,
+                "tamano_lote": self.tamano_lote,
+                "intervalo_flush_seg": self.intervalo_flush_seg,
+                "hilo_activo": self._hilo is not None and self._hilo.is_alive(),
+                "encoladas": self.encoladas,
+                "insertadas": self.insertadas,
+                "lotes": self.lotes,
+                "reintentos": self.reintentos,
+                "enviadas_a_spool": self.enviadas_a_spool,
+                "reenviadas_desde_spool": self.reenviadas_desde_spool,
+                "descartadas": self.descartadas,
+                "spool_pendiente": os.path.exists(self.ruta_spool),
+            }
+
+
+registrador_busquedas_bq = RegistradorBusquedasBQ(
+    tabla=TABLE_FULL_ID,
+    max_cola=LOG_BQ_MAX_COLA,
+    tamano_lote=LOG_BQ_TAMANO_LOTE,
+    intervalo_flush_seg=LOG_BQ_INTERVALO_FLUSH_SEG,
+    max_reintentos=LOG_BQ_MAX_REINTENTOS,
+    backoff_base_seg=LOG_BQ_BACKOFF_BASE_SEG,
+    ruta_spool=LOG_BQ_SPOOL_PATH,
+    ruta_descartadas=LOG_BQ_DESCARTADAS_PATH,
+)
+
+
+def detener_registrador_bq(timeout: float = 30.0) -> None:
+    registrador_busquedas_bq.detener(timeout)
+
+
+def obtener_estadisticas_registrador_bq() -> Dict[str, Any]:
+    return registrador_busquedas_bq.estadisticas()
+
+
 def log_busqueda_a_bigquery(
     id_conversacion: str,
     preferencias_usuario_obj: Optional[Any], # PerfilUsuario
@@ -25,49 +329,30 @@ def log_busqueda_a_bigquery(
     sql_query_ejecutada: Optional[str],
     sql_params_list: Optional[List[Dict[str, Any]]] # Lista de {"name":..., "value":..., "type":...}
 ):
-    """Guarda la información de una búsqueda finalizada en BigQuery."""
+    """Serializa la búsqueda finalizada y la encola para insertarla en BigQuery en segundo plano."""
     try:
-        client = bigquery.Client(project=PROJECT_ID)
-        
-        # Convertir objetos Pydantic y dicts a JSON strings
-        # Usar model_dump_json para Pydantic, json.dumps para dicts/lists
-        prefs_json = preferencias_usuario_obj.model_dump_json(indent=2) if hasattr(preferencias_usuario_obj, "model_dump_json") else None
-        filtros_json = filtros_aplicados_obj.model_dump_json(indent=2) if hasattr(filtros_aplicados_obj, "model_dump_json") else None
-        econ_json = economia_usuario_obj.model_dump_json(indent=2) if hasattr(economia_usuario_obj, "model_dump_json") else None
-        pesos_json = json.dumps(pesos_aplicados_dict, indent=2) if pesos_aplicados_dict else None
-        if coches_recomendados_list is not None: # Chequear si la lista es None
-            coches_json = json.dumps(coches_recomendados_list, indent=2) # json.dumps([]) produce "[]"
-        else:
-            coches_json = None # Si la lista original era None, el JSON es None
-        params_json = json.dumps(sql_params_list, indent=2) if sql_params_list else None
-
+        # JSON compacto (sin indent): las filas ocupan menos y se serializan más rápido.
+        # La serialización se hace aquí, y no en el hilo, porque los objetos del estado pueden mutar después.
         row_to_insert = {
             "id_conversacion": id_conversacion,
             "timestamp_busqueda": datetime.now(timezone.utc).isoformat(),
-            "preferencias_usuario_json": prefs_json,
-            "filtros_aplicados_json": filtros_json,
-            "economia_usuario_json": econ_json,
-            "pesos_aplicados_json": pesos_json,
+            "preferencias_usuario_json": _modelo_a_json(preferencias_usuario_obj),
+            "filtros_aplicados_json": _modelo_a_json(filtros_aplicados_obj),
+            "economia_usuario_json": _modelo_a_json(economia_usuario_obj),
+            "pesos_aplicados_json": _json_compacto(pesos_aplicados_dict) if pesos_aplicados_dict else None,
             "tabla_resumen_criterios_md": tabla_resumen_criterios_md,
-            "coches_recomendados_json": coches_json,
+            # json.dumps([]) produce "[]"; si la lista original era None, el JSON es None
+            "coches_recomendados_json": _json_compacto(coches_recomendados_list) if coches_recomendados_list is not None else None,
             "num_coches_devueltos": num_coches_devueltos,
             "sql_query_ejecutada": sql_query_ejecutada,
-            "sql_params_json": params_json,
+            "sql_params_json": _json_compacto(sql_params_list) if sql_params_list else None,
         }
-        
+
         # Quitar claves con valor None para no intentar insertar NULLs en campos no nullable (si aplica)
-        # O asegurarse que la tabla BQ permita NULLs para estos campos STRING JSON
         row_to_insert_cleaned = {k: v for k, v in row_to_insert.items() if v is not None}
-
-        errors = client.insert_rows_json(TABLE_FULL_ID, [row_to_insert_cleaned])
-        if not errors:
-            logging.info(f"Log de búsqueda para conversación '{id_conversacion}' insertado en BigQuery.")
-            print(f"INFO (BQ Logger) ► Log para '{id_conversacion}' guardado en BQ.")
-        else:
-            logging.error(f"Errores al insertar log en BigQuery para '{id_conversacion}': {errors}")
-            print(f"ERROR (BQ Logger) ► Errores al guardar log en BQ: {errors}")
+        registrador_busquedas_bq.encolar(row_to_insert_cleaned)
 
     except Exception as e:
         logging.error(f"Error en la función log_busqueda_a_bigquery para '{id_conversacion}': {e}")
         print(f"ERROR (BQ Logger) ► Fallo general en log_busqueda_a_bigquery: {e}")
-        traceback.print_exc()
\ No newline at end of file
+        traceback.print_exc()
@@ -0,0 +1,278 @@
+# utils/checkpoint_maintenance.py
+# Mantenimiento de las tablas del checkpointer de Postgres (AsyncPostgresSaver).
+#
+# LangGraph guarda un checkpoint por superstep y nunca borra ninguno: cada turno de cada
+# conversación añade ~5 filas a `checkpoints` (con el estado completo) más sus
+# `checkpoint_blobs` (mensajes, perfil, filtros...) y `checkpoint_writes`. Para retomar una
+# conversación solo hace falta el último checkpoint, así que este módulo:
+#   1. Compacta: deja los últimos CHECKPOINTS_MANTENER_POR_HILO checkpoints de cada hilo y
+#      borra sus writes y los blobs que ya no referencia ningún checkpoint superviviente.
+#   2. Expira: borra por completo los hilos sin actividad en CHECKPOINTS_TTL_HILO_DIAS días.
+# Trabaja por lotes de hilos (una transacción por lote, paginando por thread_id) y solo toca
+# hilos sin actividad en los últimos CHECKPOINTS_MARGEN_INACTIVIDAD_MIN minutos, para no
+# competir con un turno en curso (aput escribe los blobs antes que el checkpoint).
+# Al terminar ejecuta VACUUM (ANALYZE) e informa del tamaño y filas de cada tabla antes y después.
+#
+# Uso (Cloud Run Job / cron, con las mismas variables DB_* que la API):
+#   python -m utils.checkpoint_maintenance --mantener 5 --ttl-dias 30
+#   python -m utils.checkpoint_maintenance --dry-run
+# O dentro de la API con CHECKPOINTS_MANTENIMIENTO_INTERVALO_SEG > 0.
+import argparse
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+from config.settings import (
+    CHECKPOINTS_MANTENER_POR_HILO, CHECKPOINTS_TTL_HILO_DIAS, CHECKPOINTS_LOTE_HILOS,
+    CHECKPOINTS_MARGEN_INACTIVIDAD_MIN, CHECKPOINTS_PAUSA_ENTRE_LOTES_SEG
+)
+
+logger = logging.getLogger(__name__)
+
+TABLAS_CHECKPOINTER = ("checkpoints", "checkpoint_blobs", "checkpoint_writes")
+
+_SQL_LOTE_HILOS = """
+    SELECT thread_id, max((checkpoint->>'ts')::timestamptz) AS ultima_actividad, count(*) AS num_checkpoints
+    FROM checkpoints
+    WHERE thread_id > %s
+    GROUP BY thread_id
+    ORDER BY thread_id
+    LIMIT %s
+"""
+
+# Checkpoints que sobran: todos menos los `mantener` más recientes de cada (hilo, namespace).
+# checkpoint_id es un UUIDv6, ordenado por tiempo.
+_SQL_CHECKPOINTS_SOBRANTES = """
+    SELECT thread_id, checkpoint_ns, checkpoint_id FROM (
+        SELECT thread_id, checkpoint_ns, checkpoint_id,
+               row_number() OVER (PARTITION BY thread_id, checkpoint_ns ORDER BY checkpoint_id DESC) AS posicion
+        FROM checkpoints
+        WHERE thread_id = ANY(%(hilos)s)
+    ) ranking
+    WHERE posicion > %(mantener)s
+"""
+
+_SQL_BORRAR_WRITES_SOBRANTES = f"""
+    DELETE FROM checkpoint_writes w
+    USING ({_SQL_CHECKPOINTS_SOBRANTES}) s
+    WHERE w.thread_id = s.thread_id AND w.checkpoint_ns = s.checkpoint_ns AND w.checkpoint_id = s.checkpoint_id
+"""
+
+_SQL_BORRAR_CHECKPOINTS_SOBRANTES = f"""
+    DELETE FROM checkpoints c
+    USING ({_SQL_CHECKPOINTS_SOBRANTES}) s
+    WHERE c.thread_id = s.thread_id AND c.checkpoint_ns = s.checkpoint_ns AND c.checkpoint_id = s.checkpoint_id
+"""
+
+# Un blob (canal, versión) sigue vivo si algún checkpoint restante lo referencia en channel_versions
+_SQL_BORRAR_BLOBS_HUERFANOS = """
+    DELETE FROM checkpoint_blobs b
+    WHERE b.thread_id = ANY(%(hilos)s)
+      AND NOT EXISTS (
+          SELECT 1 FROM checkpoints c
+          WHERE c.thread_id = b.thread_id
+            AND c.checkpoint_ns = b.checkpoint_ns
+            AND c.checkpoint->'channel_versions'->>b.channel = b.version
+      )
+"""
+
+
+def construir_conn_string_postgres() -> str:
+    """Cadena de conexión a partir de DB_USER/DB_PASSWORD/DB_HOST/DB_PORT/DB_NAME (TCP o socket de Cloud SQL)."""
+    db_user = os.environ.get("DB_USER")
+    db_password = os.environ.get("DB_PASSWORD")
+    db_host = os.environ.get("DB_HOST")
+    db_port = os.environ.get("DB_PORT", "5432")
+    db_name = os.environ.get("DB_NAME")
+
+    if not all([db_user, db_password, db_host, db_name]):
+        raise RuntimeError("Configuración de base de datos incompleta.")
+
+    if db_host.startswith("/cloudsql/"):
+        return f"dbname='{db_name}' user='{db_user}' password='{db_password}' host='{db_host}'"
+    return f"postgresql://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}"
+
+
+async def medir_tablas(conn) -> Dict[str, Dict[str, int]]:
+    """Tamaño total (tabla + índices + TOAST) y número de filas de cada tabla del checkpointer."""
+    resultado = {}
+    async with conn.cursor() as cur:
+        for tabla in TABLAS_CHECKPOINTER:
+            await cur.execute(f"SELECT pg_total_relation_size(%s), (SELECT count(*) FROM {tabla})", (tabla,))
+            bytes_tabla, filas = await cur.fetchone()
+            resultado[tabla] = {"bytes": int(bytes_tabla), "filas": int(filas)}
+    return resultado
+
+
+async def _procesar_lote(conn, lote: List[tuple], mantener: int, limite_ttl: datetime, limite_actividad: datetime, dry_run: bool) -> Dict[str, int]:
+    expirados = [hilo for hilo, ultima, _ in lote if ultima is not None and ultima < limite_ttl]
+    compactables = [
+        hilo for hilo, ultima, num in lote
+        if hilo not in expirados and num > mantener and (ultima is None or ultima < limite_actividad)
+    ]
+    borrados = {"hilos_expirados": len(expirados), "hilos_compactados": len(compactables),
+                "checkpoints": 0, "checkpoint_writes": 0, "checkpoint_blobs": 0}
+    if not expirados and not compactables:
+        return borrados
+
+    # En dry-run se ejecutan los mismos DELETE y se deshace la transacción: los conteos son exactos
+    async with conn.transaction(force_rollback=dry_run):
+        async with conn.cursor() as cur:
+            if expirados:
+                for tabla in ("checkpoint_writes", "checkpoint_blobs", "checkpoints"):
+                    await cur.execute(f"DELETE FROM {tabla} WHERE thread_id = ANY(%s)", (expirados,))
+                    borrados[tabla] += cur.rowcount
+            if compactables:
+                parametros = {"hilos": compactables, "mantener": mantener}
+                await cur.execute(_SQL_BORRAR_WRITES_SOBRANTES, parametros)
+                borrados["checkpoint_writes"] += cur.rowcount
+                await cur.execute(_SQL_BORRAR_CHECKPOINTS_SOBRANTES, parametros)
+                borrados["checkpoints"] += cur.rowcount
+                await cur.execute(_SQL_BORRAR_BLOBS_HUERFANOS, {"hilos": compactables})
+                borrados["checkpoint_blobs"] += cur.rowcount
+    return borrados
+
+
+async def mantener_checkpoints(
+    conn_string: Optional[str] = None,
+    mantener: int = CHECKPOINTS_MANTENER_POR_HILO,
+    ttl_dias: int = CHECKPOINTS_TTL_HILO_DIAS,
+    lote_hilos: int = CHECKPOINTS_LOTE_HILOS,
+    margen_inactividad_min: int = CHECKPOINTS_MARGEN_INACTIVIDAD_MIN,
+    pausa_entre_lotes_seg: float = CHECKPOINTS_PAUSA_ENTRE_LOTES_SEG,
+    vacuum: bool = True,
+    dry_run: bool = False,
+) -> Dict[str, Any]:
+    """
+    Compacta y expira los hilos del checkpointer por lotes. Devuelve un informe con lo borrado
+    y con el tamaño/filas de cada tabla antes y después.
+    """
+    from psycopg import AsyncConnection  # Solo lo necesita quien ejecuta el mantenimiento
+
+    if mantener < 1:
+        raise ValueError("Hay que conservar al menos el último checkpoint de cada hilo (mantener >= 1).")
+    inicio = time.perf_counter()
+    ahora = datetime.now(timezone.utc)
+    limite_ttl = ahora - timedelta(days=ttl_dias)
+    limite_actividad = ahora - timedelta(minutes=margen_inactividad_min)
+    totales = {"lotes": 0, "hilos_revisados": 0, "hilos_expirados": 0, "hilos_compactados": 0,
+               "checkpoints": 0, "checkpoint_writes": 0, "checkpoint_blobs": 0}
+
+    async with await AsyncConnection.connect(conn_string or construir_conn_string_postgres(), autocommit=True) as conn:
+        antes = await medir_tablas(conn)
+        ultimo_hilo = ""
+        while True:
+            async with conn.cursor() as cur:
+                await cur.execute(_SQL_LOTE_HILOS, (ultimo_hilo, lote_hilos))
+                lote = await cur.fetchall()
+            if not lote:
+                break
+            borrados = await _procesar_lote(conn, lote, mantener, limite_ttl, limite_actividad, dry_run)
+            totales["lotes"] += 1
+            totales["hilos_revisados"] += len(lote)
+            for clave, valor in borrados.items():
+                totales[clave] += valor
+            logging.info(
+                f"INFO (Mantenimiento Checkpoints) ► Lote {totales['lotes']}: {len(lote)} hilos, "
+                f"{borrados['hilos_expirados']} expirados, {borrados['hilos_compactados']} compactados, "
+                f"{borrados['checkpoints']} checkpoints borrados."
+            )
+            ultimo_hilo = lote[-1][0]
+            if len(lote) < lote_hilos:
+                break
+            if pausa_entre_lotes_seg:
+                await asyncio.sleep(pausa_entre_lotes_seg)
+
+        # VACUUM no puede ir dentro de una transacción (la conexión está en autocommit)
+        if vacuum and not dry_run:
+            for tabla in TABLAS_CHECKPOINTER:
+                await conn.execute(f"VACUUM (ANALYZE) {tabla}")
+        despues = await medir_tablas(conn)
+
+    informe = {
+        "fecha": ahora.isoformat(),
+        "dry_run": dry_run,
+        "mantener_por_hilo": mantener,
+        "ttl_dias": ttl_dias,
+        "borrados": totales,
+        "antes": antes,
+        "despues": despues,
+        "duracion_seg": round(time.perf_counter() - inicio, 2),
+    }
+    _registrar_informe(informe)
+    logging.info(
+        f"✅ (Mantenimiento Checkpoints) ► {totales['hilos_revisados']} hilos revisados, "
+        f"{totales['hilos_expirados']} expirados, {totales['checkpoints']} checkpoints borrados en {informe['duracion_seg']} s"
+        f"{' (dry-run)' if dry_run else ''}."
+    )
+    return informe
+
+
+# --- Ejecución periódica dentro de la API y último informe para /metrics ---
+_ultimo_informe: Optional[Dict[str, Any]] = None
+
+
+def _registrar_informe(informe: Dict[str, Any]) -> None:
+    global _ultimo_informe
+    _ultimo_informe = informe
+
+
+async def bucle_mantenimiento_checkpoints(conn_string: str, intervalo_seg: int) -> None:
+    """Tarea de fondo para la API: ejecuta el mantenimiento cada `intervalo_seg` segundos."""
+    while True:
+        await asyncio.sleep(intervalo_seg)
+        try:
+            await mantener_checkpoints(conn_string)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"❌ (Mantenimiento Checkpoints) ► Falló el mantenimiento programado: {e}", exc_info=True)
+
+
+def obtener_estadisticas_mantenimiento_checkpoints() -> Dict[str, Any]:
+    return {"ultimo_informe": _ultimo_informe}
+
+
+def _formatear_bytes(num_bytes: int) -> str:
+    for unidad in ("B", "KB", "MB", "GB"):
+        if num_bytes < 1024:
+            return f"{num_bytes:.1f} {unidad}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} TB"
+
+
+def _imprimir_informe(informe: Dict[str, Any]) -> None:
+    print(f"\n--- Mantenimiento de checkpoints{' (dry-run)' if informe['dry_run'] else ''} ---")
+    print(f"Últimos {informe['mantener_por_hilo']} checkpoints por hilo, TTL {informe['ttl_dias']} días")
+    for clave, valor in informe["borrados"].items():
+        print(f"  {clave:<20} {valor}")
+    print(f"{'Tabla':<20} {'Filas antes':>12} {'Filas después':>14} {'Tamaño antes':>14} {'Tamaño después':>15}")
+    for tabla in TABLAS_CHECKPOINTER:
+        a, d = informe["antes"][tabla], informe["despues"][tabla]
+        print(f"{tabla:<20} {a['filas']:>12} {d['filas']:>14} {_formatear_bytes(a['bytes']):>14} {_formatear_bytes(d['bytes']):>15}")
+    print(f"Duración: {informe['duracion_seg']} s")
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Compacta y expira los hilos del checkpointer de Postgres.")
+    parser.add_argument("--mantener", type=int, default=CHECKPOINTS_MANTENER_POR_HILO, help="Checkpoints que se conservan por hilo")
+    parser.add_argument("--ttl-dias", type=int, default=CHECKPOINTS_TTL_HILO_DIAS, help="Días sin actividad tras los que se borra un hilo")
+    parser.add_argument("--lote", type=int, default=CHECKPOINTS_LOTE_HILOS, help="Hilos por lote/transacción")
+    parser.add_argument("--sin-vacuum", action="store_true", help="No ejecutar VACUUM (ANALYZE) al final")
+    parser.add_argument("--dry-run", action="store_true", help="Calcula lo que se borraría sin borrar nada")
+    args = parser.parse_args()
+
+    _imprimir_informe(asyncio.run(mantener_checkpoints(
+        mantener=args.mantener,
+        ttl_dias=args.ttl_dias,
+        lote_hilos=args.lote,
+        vacuum=not args.sin_vacuum,
+        dry_run=args.dry_run,
+    )))
@@ -0,0 +1,158 @@
+# utils/context_window.py
+# Selección del contexto que se envía a los LLMs extractores.
+#
+# El historial crece con cada turno (una conversación completa ronda los 40 mensajes) y
+# varios nodos le pasaban al LLM el historial entero, así que el tamaño del prompt crecía
+# turno a turno. Cada extractor tiene ahora una política con tres recortes, en este orden:
+#   1. ventana de etapa: solo los mensajes desde que empezaron las preguntas de su etapa
+#      (las preguntas de cada etapa llevan response_metadata["etapa"], ver marcar_etapa);
+#   2. últimos N mensajes;
+#   3. presupuesto de tokens (tiktoken): se descartan los más antiguos hasta caber,
+#      conservando siempre el último mensaje del usuario.
+# Así el prompt por turno tiene un tamaño acotado sea cual sea la longitud de la conversación.
+import logging
+import threading
+from typing import Any, Dict, List, Optional
+
+from langchain_core.messages import AIMessage, BaseMessage, SystemMessage
+
+from config.settings import (
+    CONTEXTO_LLM_MAX_TOKENS, CONTEXTO_LLM_ULTIMOS_N, CONTEXTO_LLM_ENCODING
+)
+
+logger = logging.getLogger(__name__)
+
+CLAVE_ETAPA = "etapa"
+# Sobrecoste aproximado por mensaje en el formato de chat de OpenAI (rol + separadores)
+_TOKENS_POR_MENSAJE = 4
+
+# Política por extractor: etapa (None = sin ventana de etapa), últimos N mensajes y presupuesto
+POLITICAS_CONTEXTO: Dict[str, Dict[str, Any]] = {
+    "cp": {"etapa": "cp", "ultimos_n": 4, "max_tokens": CONTEXTO_LLM_MAX_TOKENS},
+    # El perfil y la economía solo necesitan la última pregunta y la respuesta
+    "perfil": {"etapa": None, "ultimos_n": 2, "max_tokens": CONTEXTO_LLM_MAX_TOKENS},
+    "pasajeros": {"etapa": "pasajeros", "ultimos_n": CONTEXTO_LLM_ULTIMOS_N, "max_tokens": CONTEXTO_LLM_MAX_TOKENS},
+    "economia": {"etapa": None, "ultimos_n": 2, "max_tokens": CONTEXTO_LLM_MAX_TOKENS},
+}
+
+_encoding = None
+_encoding_cargado = False
+_encoding_lock = threading.Lock()
+
+
+def _obtener_encoding():
+    """Carga perezosa del encoding de tiktoken. None si no está disponible (se estima)."""
+    global _encoding, _encoding_cargado
+    if _encoding_cargado:
+        return _encoding
+    with _encoding_lock:
+        if not _encoding_cargado:
+            try:
+                import tiktoken
+                _encoding = tiktoken.get_encoding(CONTEXTO_LLM_ENCODING)
+            except Exception as e:
+                logging.warning(f"WARN (Contexto) ► tiktoken no disponible ({e}). Se estimarán los tokens (~4 caracteres/token).")
+                _encoding = None
+            _encoding_cargado = True
+    return _encoding
+
+
+def contar_tokens(texto: Any) -> int:
+    texto = str(texto or "")
+    encoding = _obtener_encoding()
+    if encoding is None:
+        return len(texto) // 4 + 1
+    return len(encoding.encode(texto))
+
+
+def contar_tokens_mensajes(mensajes: List[BaseMessage]) -> int:
+    return sum(contar_tokens(m.content) + _TOKENS_POR_MENSAJE for m in mensajes)
+
+
+def marcar_etapa(mensaje: AIMessage, etapa: str) -> AIMessage:
+    """Marca una pregunta del agente como perteneciente a `etapa` (no se envía al LLM ni al frontend)."""
+    mensaje.response_metadata[CLAVE_ETAPA] = etapa
+    return mensaje
+
+
+def ventana_etapa(historial: List[BaseMessage], etapa: str) -> List[BaseMessage]:
+    """
+    Sufijo del historial que pertenece a la etapa: se retrocede desde el final mientras los
+    mensajes del agente estén marcados con `etapa`. Si no hay ninguno marcado (checkpoints
+    anteriores a las marcas) se devuelve el historial completo y mandan los otros recortes.
+    """
+    inicio = len(historial)
+    hay_marcados = False
+    for i in range(len(historial) - 1, -1, -1):
+        mensaje = historial[i]
+        if isinstance(mensaje, AIMessage):
+            if mensaje.response_metadata.get(CLAVE_ETAPA) != etapa:
+                break
+            hay_marcados = True
+        inicio = i
+    return historial[inicio:] if hay_marcados else list(historial)
+
+
+class MetricasContexto:
+    """Tokens de prompt por extractor, para comprobar que no crecen con la conversación."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._por_nodo: Dict[str, Dict[str, int]] = {}
+
+    def registrar(self, nodo: str, tokens: int, mensajes_descartados: int) -> None:
+        with self._lock:
+            m = self._por_nodo.setdefault(nodo, {"llamadas": 0, "tokens_total": 0, "tokens_max": 0, "mensajes_descartados": 0})
+            m["llamadas"] += 1
+            m["tokens_total"] += tokens
+            m["tokens_max"] = max(m["tokens_max"], tokens)
+            m["mensajes_descartados"] += mensajes_descartados
+
+    def estadisticas(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                nodo: {**m, "tokens_medios": round(m["tokens_total"] / m["llamadas"], 1) if m["llamadas"] else 0.0}
+                for nodo, m in self._por_nodo.items()
+            }
+
+
+metricas_contexto = MetricasContexto()
+
+
+def seleccionar_contexto(historial: List[BaseMessage], nodo: str, system_prompt: str) -> List[BaseMessage]:
+    """
+    Devuelve [SystemMessage, *mensajes seleccionados] según la política de `nodo`
+    y registra los tokens del prompt resultante.
+    """
+    politica = POLITICAS_CONTEXTO[nodo]
+    seleccion = list(historial)
+    if politica["etapa"]:
+        seleccion = ventana_etapa(seleccion, politica["etapa"])
+    if politica["ultimos_n"]:
+        seleccion = seleccion[-politica["ultimos_n"]:]
+
+    system = SystemMessage(content=system_prompt)
+    tokens_system = contar_tokens_mensajes([system])
+    tokens_por_mensaje = [contar_tokens_mensajes([m]) for m in seleccion]
+    tokens = tokens_system + sum(tokens_por_mensaje)
+    # El system prompt y el último mensaje nunca se descartan
+    while len(seleccion) > 1 and tokens > politica["max_tokens"]:
+        seleccion.pop(0)
+        tokens -= tokens_por_mensaje.pop(0)
+
+    descartados = len(historial) - len(seleccion)
+    metricas_contexto.registrar(nodo, tokens, descartados)
+    logging.info(
+        f"INFO (Contexto) ► {nodo}: {len(seleccion)}/{len(historial)} mensajes, "
+        f"{tokens} tokens de prompt (system: {tokens_system})."
+    )
+    return [system, *seleccion]
+
+
+def obtener_estadisticas_contexto() -> Dict[str, Any]:
+    return {
+        "max_tokens": CONTEXTO_LLM_MAX_TOKENS,
+        "tiktoken": _obtener_encoding() is not None,
+        "politicas": POLITICAS_CONTEXTO,
+        "por_nodo": metricas_contexto.estadisticas(),
+    }
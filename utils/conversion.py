@@ -1,5 +1,6 @@
 import unicodedata
 import re
+from typing import Literal, Optional
 
 # Función es transformar datos (de Enums a strings).
 # Otras funciones de transformación como normalize_text_sql().
@@ -26,3 +27,45 @@ def normalize_text_sql(text: str) -> str:
 def is_yes(v):
     return isinstance(v, str) and v.strip().lower() in ("sí","si")
 
+
+
+# "ver más coches", "muéstrame más opciones", "siguientes", "otros coches por favor"...
+# Anclado al mensaje completo: "otros coches más baratos", "otras opciones con cambio automático"
+# o "no quiero más coches" no son paginación (son refinamientos o negativas y van por su ruta).
+_RE_PETICION_MAS_COCHES = re.compile(
+    r"^\s*(?:(?:vale|ok|venga|y|por favor)[\s,]+)?"
+    r"(?:(?:puedes\s+|podrias\s+|me\s+)?(?:ver|quiero ver|quiero|dame|ensename|ensenas|muestrame|muestras|hay|tienes)\s+)?"
+    r"(?:(?:mas|otros|otras|(?:los\s+|las\s+)?siguientes?)(?:\s+(?:coches|opciones|resultados|modelos|recomendaciones))?"
+    r"|siguiente pagina|otra pagina)"
+    r"(?:[\s,]+por favor)?\s*[.!?]*\s*$"
+)
+
+
+def es_peticion_mas_coches(texto: str) -> bool:
+    """True si el usuario pide la siguiente página de recomendaciones."""
+    return isinstance(texto, str) and bool(_RE_PETICION_MAS_COCHES.search(normalizar_texto(texto)))
+
+
+# Refinamientos de presupuesto tras enseñar los coches: "otros coches más baratos", "algo más económico",
+# "puedo subir el presupuesto"... Un mensaje que empieza por "no" no se toma como refinamiento.
+_RE_REFINAMIENTO_MAS_BARATO = re.compile(
+    r"\bmas (barat|economic)[oa]s?\b|\bmenos car[oa]s?\b|\b(bajar|reducir) (el |mi )?presupuesto\b"
+)
+_RE_REFINAMIENTO_MAS_CARO = re.compile(
+    r"\bmas car[oa]s?\b|\b(subir|ampliar|aumentar) (el |mi )?presupuesto\b|\bmas presupuesto\b"
+)
+_RE_NEGACION_INICIAL = re.compile(r"^\W*no\b")
+
+
+def detectar_refinamiento_presupuesto(texto: str) -> Optional[Literal["mas_barato", "mas_caro"]]:
+    """Dirección del refinamiento de presupuesto que pide el mensaje, o None si no pide ninguno."""
+    if not isinstance(texto, str):
+        return None
+    texto_norm = normalizar_texto(texto)
+    if _RE_NEGACION_INICIAL.search(texto_norm):
+        return None
+    if _RE_REFINAMIENTO_MAS_BARATO.search(texto_norm):
+        return "mas_barato"
+    if _RE_REFINAMIENTO_MAS_CARO.search(texto_norm):
+        return "mas_caro"
+    return None
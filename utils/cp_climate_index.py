@@ -0,0 +1,160 @@
+# utils/cp_climate_index.py
+# Índice local de zonas climáticas por código postal.
+#
+# La tabla zonas_climas solo sirve para responder "¿este CP pertenece a la zona X?" y en
+# España hay ~11k CPs, así que toda la tabla cabe en un fichero de 100.000 bytes:
+# un byte por CP (posición = CP entero, 00000-99999) con un bit por zona de COLUMNAS_ZONA
+# y un bit extra que indica que el CP aparece en la tabla. El fichero se abre con
+# np.memmap, de modo que cada consulta es un acceso O(1) sin lanzar un job de BigQuery.
+#
+# Regenerar el índice (p. ej. tras actualizar zonas_climas):
+#   python -m utils.cp_climate_index
+import json
+import logging
+import os
+import threading
+import traceback
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Dict, Any
+
+import numpy as np
+from google.cloud import bigquery
+
+from config.settings import CP_CLIMA_INDEX_PATH, CP_CLIMA_INDEX_MAX_DIAS
+from utils.bq_client import obtener_cliente_bq
+
+logger = logging.getLogger(__name__)
+
+NUM_CODIGOS_POSTALES = 100000
+BIT_CP_PRESENTE = 7  # Bit alto: el CP aparece en al menos una columna de la tabla
+
+
+def _ruta_meta(ruta: str) -> str:
+    return ruta + ".meta.json"
+
+
+def construir_indice_cp(
+    client: Optional[bigquery.Client] = None,
+    ruta: str = CP_CLIMA_INDEX_PATH
+) -> bool:
+    """Descarga zonas_climas y escribe el índice binario + su metadata."""
+    # Import local para evitar el ciclo bq_data_lookups <-> cp_climate_index
+    from utils.bq_data_lookups import COLUMNAS_ZONA, TABLE_FULL_ID_ZONAS, PROJECT_ID
+    try:
+        client = client or obtener_cliente_bq(PROJECT_ID)
+        sql = "\nUNION ALL\n".join(
+            f"SELECT {i} AS zona, {col} AS cp FROM `{TABLE_FULL_ID_ZONAS}` WHERE {col} IS NOT NULL"
+            for i, col in enumerate(COLUMNAS_ZONA)
+        )
+        indice = np.zeros(NUM_CODIGOS_POSTALES, dtype=np.uint8)
+        filas = 0
+        for fila in client.query(sql).result():
+            cp = int(fila.cp)
+            if 0 <= cp < NUM_CODIGOS_POSTALES:
+                indice[cp] |= np.uint8((1 << fila.zona) | (1 << BIT_CP_PRESENTE))
+                filas += 1
+
+        directorio = os.path.dirname(ruta)
+        if directorio:
+            os.makedirs(directorio, exist_ok=True)
+        # Escritura atómica (índice y meta) para no dejar ficheros a medias si hay lectores
+        ruta_tmp = ruta + ".tmp"
+        indice.tofile(ruta_tmp)
+        os.replace(ruta_tmp, ruta)
+        ruta_meta_tmp = _ruta_meta(ruta) + ".tmp"
+        with open(ruta_meta_tmp, "w", encoding="utf-8") as f:
+            json.dump({
+                "columnas_zona": COLUMNAS_ZONA,
+                "tabla_origen": TABLE_FULL_ID_ZONAS,
+                "num_cps": int(np.count_nonzero(indice)),
+                "filas_origen": filas,
+                "generado_en": datetime.now(timezone.utc).isoformat(),
+            }, f, indent=2)
+        os.replace(ruta_meta_tmp, _ruta_meta(ruta))
+        logging.info(f"✅ (Índice CP) Índice escrito en {ruta}: {np.count_nonzero(indice)} CPs con zona.")
+        recargar_indice_cp()
+        return True
+    except Exception as e:
+        logging.error(f"❌ (Índice CP) Error construyendo el índice de CPs: {e}")
+        traceback.print_exc()
+        return False
+
+
+class IndiceClimaCP:
+    """Vista memory-mapped del índice de zonas por CP."""
+
+    def __init__(self, ruta: str):
+        from utils.bq_data_lookups import COLUMNAS_ZONA
+        with open(_ruta_meta(ruta), "r", encoding="utf-8") as f:
+            self.meta: Dict[str, Any] = json.load(f)
+        if self.meta.get("columnas_zona") != COLUMNAS_ZONA:
+            raise ValueError(
+                f"El índice {ruta} se generó con columnas {self.meta.get('columnas_zona')}, "
+                f"se esperaban {COLUMNAS_ZONA}. Regenera con `python -m utils.cp_climate_index`."
+            )
+        self.columnas = COLUMNAS_ZONA
+        self.datos = np.memmap(ruta, dtype=np.uint8, mode="r", shape=(NUM_CODIGOS_POSTALES,))
+
+    def esta_vigente(self) -> bool:
+        """True si el índice se generó hace menos de CP_CLIMA_INDEX_MAX_DIAS."""
+        try:
+            generado_en = datetime.fromisoformat(self.meta["generado_en"])
+        except (KeyError, TypeError, ValueError):
+            return False
+        return datetime.now(timezone.utc) - generado_en < timedelta(days=CP_CLIMA_INDEX_MAX_DIAS)
+
+    def contiene(self, cp_int: int) -> bool:
+        """True si el CP aparece en zonas_climas (CP real conocido)."""
+        return 0 <= cp_int < NUM_CODIGOS_POSTALES and bool(int(self.datos[cp_int]) & (1 << BIT_CP_PRESENTE))
+
+    def consultar(self, cp_int: int) -> Optional[Dict[str, bool]]:
+        """Flags de zona del CP, o None si el CP no aparece en el índice."""
+        if not 0 <= cp_int < NUM_CODIGOS_POSTALES:
+            return None
+        valor = int(self.datos[cp_int])
+        if not valor & (1 << BIT_CP_PRESENTE):
+            return None
+        return {col: bool(valor & (1 << i)) for i, col in enumerate(self.columnas)}
+
+
+_indice: Optional[IndiceClimaCP] = None
+_indice_cargado = False
+_indice_lock = threading.Lock()
+
+
+def obtener_indice_cp() -> Optional[IndiceClimaCP]:
+    """Carga perezosa (una vez por proceso) del índice. None si no existe o no es válido."""
+    global _indice, _indice_cargado
+    if _indice_cargado:
+        return _indice
+    with _indice_lock:
+        if _indice_cargado:
+            return _indice
+        if os.path.exists(CP_CLIMA_INDEX_PATH) and os.path.exists(_ruta_meta(CP_CLIMA_INDEX_PATH)):
+            try:
+                _indice = IndiceClimaCP(CP_CLIMA_INDEX_PATH)
+                logging.info(f"✅ (Índice CP) Índice local cargado desde {CP_CLIMA_INDEX_PATH} ({_indice.meta.get('num_cps')} CPs).")
+            except Exception as e:
+                logging.error(f"❌ (Índice CP) No se pudo cargar {CP_CLIMA_INDEX_PATH}: {e}")
+                _indice = None
+        else:
+            logging.warning(f"WARN (Índice CP) ► No existe {CP_CLIMA_INDEX_PATH}. Se consultará BigQuery.")
+        _indice_cargado = True
+    return _indice
+
+
+def recargar_indice_cp() -> None:
+    global _indice, _indice_cargado
+    with _indice_lock:
+        _indice = None
+        _indice_cargado = False
+    obtener_indice_cp()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    print(f"Construyendo índice de zonas climáticas por CP en '{CP_CLIMA_INDEX_PATH}'...")
+    if construir_indice_cp():
+        print("Índice construido correctamente.")
+    else:
+        print("Error durante la construcción del índice.")
@@ -0,0 +1,104 @@
+# utils/cp_extractor.py
+# Extracción determinista del código postal antes de llamar a llm_cp_extractor.
+#
+# La mayoría de usuarios responde con el número tal cual ("28001", "es el 46009"), y las
+# reglas del prompt system_prompt_cp son puramente mecánicas (una secuencia de exactamente
+# 5 dígitos). Aquí se aplican esas mismas reglas con una regex y solo se escala al LLM
+# cuando el texto es ambiguo: varios números, CP escrito con letras, prefijo de provincia
+# inexistente, etc. El índice local de zonas (utils/cp_climate_index.py) sirve como
+# conjunto de CPs conocidos para desempatar cuando hay varios candidatos.
+import logging
+import re
+import threading
+from typing import Optional, Dict, Any, Tuple
+
+from utils.cp_climate_index import obtener_indice_cp
+
+logger = logging.getLogger(__name__)
+
+_RE_SECUENCIA_DIGITOS = re.compile(r"\d+")
+# Los dos primeros dígitos de un CP español son la provincia: 01-52
+_PROVINCIA_MIN, _PROVINCIA_MAX = 1, 52
+
+# (resuelto, codigo_postal): resuelto=False => hay que preguntar al LLM;
+# con resuelto=True, codigo_postal=None significa "el mensaje no contiene un CP válido".
+ResultadoExtraccionCP = Tuple[bool, Optional[str]]
+_ESCALAR_A_LLM: ResultadoExtraccionCP = (False, None)
+
+
+def _prefijo_provincia_valido(cp: str) -> bool:
+    return _PROVINCIA_MIN <= int(cp[:2]) <= _PROVINCIA_MAX
+
+
+def _es_cp_conocido(cp: str) -> bool:
+    indice = obtener_indice_cp()
+    return indice is not None and indice.contiene(int(cp))
+
+
+def extraer_cp_determinista(texto: Optional[str]) -> ResultadoExtraccionCP:
+    """Aplica las reglas del prompt de CP sin LLM. Devuelve _ESCALAR_A_LLM si no hay certeza."""
+    if not texto:
+        return _ESCALAR_A_LLM
+    secuencias = _RE_SECUENCIA_DIGITOS.findall(texto)
+
+    # Sin dígitos: puede ser una negativa o un CP escrito con letras -> lo decide el LLM
+    if not secuencias:
+        return _ESCALAR_A_LLM
+
+    if len(secuencias) == 1:
+        secuencia = secuencias[0]
+        if len(secuencia) != 5:
+            # Regla 4 del prompt: un número de longitud distinta de 5 es un CP inválido
+            return (True, None)
+        if _prefijo_provincia_valido(secuencia):
+            return (True, secuencia)
+        return _ESCALAR_A_LLM
+
+    # Varios números ("vivo en el 3, CP 28001"): solo se resuelve si hay un único candidato conocido
+    candidatos = [s for s in secuencias if len(s) == 5 and _prefijo_provincia_valido(s)]
+    conocidos = [c for c in candidatos if _es_cp_conocido(c)]
+    if len(set(conocidos)) == 1:
+        return (True, conocidos[0])
+    return _ESCALAR_A_LLM
+
+
+class MetricasExtractorCP:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.resueltos_con_cp = 0
+        self.resueltos_sin_cp = 0
+        self.escalados_llm = 0
+
+    def registrar(self, resultado: ResultadoExtraccionCP) -> None:
+        resuelto, codigo_postal = resultado
+        with self._lock:
+            if not resuelto:
+                self.escalados_llm += 1
+            elif codigo_postal:
+                self.resueltos_con_cp += 1
+            else:
+                self.resueltos_sin_cp += 1
+
+    def estadisticas(self) -> Dict[str, Any]:
+        with self._lock:
+            resueltos = self.resueltos_con_cp + self.resueltos_sin_cp
+            total = resueltos + self.escalados_llm
+            return {
+                "resueltos_con_cp": self.resueltos_con_cp,
+                "resueltos_sin_cp": self.resueltos_sin_cp,
+                "escalados_llm": self.escalados_llm,
+                "ratio_sin_llm": round(resueltos / total, 4) if total else 0.0,
+            }
+
+
+metricas_extractor_cp = MetricasExtractorCP()
+
+
+def extraer_cp_con_metricas(texto: Optional[str]) -> ResultadoExtraccionCP:
+    resultado = extraer_cp_determinista(texto)
+    metricas_extractor_cp.registrar(resultado)
+    return resultado
+
+
+def obtener_estadisticas_extractor_cp() -> Dict[str, Any]:
+    return metricas_extractor_cp.estadisticas()
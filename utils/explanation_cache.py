@@ -0,0 +1,139 @@
+# utils/explanation_cache.py
+# Caché de explicaciones de coches generadas por el LLM.
+#
+# El texto solo depende del contexto que se le pasa al LLM (coche, top-2 prioridades,
+# puntos fuertes y consideraciones por flags), así que la clave es un hash de
+# contexto_para_llm + el system prompt. Coches populares con perfiles parecidos producen
+# el mismo contexto y reutilizan la explicación sin llamar a gpt-3.5-turbo.
+#
+# Cada entrada guarda su instante de expiración (TLRUCache), de modo que al persistir en
+# disco y recargar tras un reinicio se respeta el TTL original de cada explicación.
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import traceback
+from typing import Optional, Dict, Any, Tuple
+
+from cachetools import TLRUCache
+
+from config.settings import (
+    CACHE_EXPLICACIONES_ACTIVA, CACHE_EXPLICACIONES_MAX_ENTRADAS, CACHE_EXPLICACIONES_TTL_SEG,
+    CACHE_EXPLICACIONES_PATH
+)
+
+logger = logging.getLogger(__name__)
+
+# Cada cuántas inserciones nuevas se vuelca la caché a disco (además de en el shutdown)
+_ESCRITURAS_POR_VOLCADO = 25
+
+
+def calcular_clave_explicacion(contexto_para_llm: str, system_prompt: str) -> str:
+    contenido = f"{system_prompt}\x00{contexto_para_llm.strip()}"
+    return hashlib.sha256(contenido.encode("utf-8")).hexdigest()
+
+
+class CacheExplicaciones:
+    """Caché TTL + LRU de explicaciones con persistencia opcional en un fichero JSON."""
+
+    def __init__(self, max_entradas: int, ttl_seg: int, ruta_disco: Optional[str] = None):
+        self._ttl_seg = ttl_seg
+        # El valor es (texto, expira_en); ttu devuelve el instante de expiración de cada entrada
+        self._cache: TLRUCache = TLRUCache(
+            maxsize=max_entradas, ttu=lambda _clave, valor, _ahora: valor[1], timer=time.time
+        )
+        self._ruta_disco = ruta_disco
+        self._lock = threading.Lock()
+        self._escrituras_pendientes = 0
+        self.aciertos = 0
+        self.fallos = 0
+        if ruta_disco:
+            self._cargar_de_disco()
+
+    def obtener(self, clave: str) -> Optional[str]:
+        with self._lock:
+            valor: Optional[Tuple[str, float]] = self._cache.get(clave)
+            if valor is not None:
+                self.aciertos += 1
+                return valor[0]
+            self.fallos += 1
+            return None
+
+    def guardar(self, clave: str, texto: str) -> None:
+        volcar = False
+        with self._lock:
+            self._cache[clave] = (texto, time.time() + self._ttl_seg)
+            self._escrituras_pendientes += 1
+            if self._ruta_disco and self._escrituras_pendientes >= _ESCRITURAS_POR_VOLCADO:
+                volcar = True
+        if volcar:
+            self.guardar_en_disco()
+
+    def _cargar_de_disco(self) -> None:
+        if not os.path.exists(self._ruta_disco):
+            return
+        try:
+            with open(self._ruta_disco, "r", encoding="utf-8") as f:
+                entradas = json.load(f)
+            ahora = time.time()
+            vigentes = 0
+            for clave, (texto, expira_en) in entradas.items():
+                if expira_en > ahora:
+                    self._cache[clave] = (texto, expira_en)
+                    vigentes += 1
+            logging.info(f"✅ (Cache Explicaciones) {vigentes} explicaciones cargadas desde {self._ruta_disco}.")
+        except Exception as e:
+            logging.error(f"❌ (Cache Explicaciones) No se pudo cargar {self._ruta_disco}: {e}")
+            traceback.print_exc()
+
+    def guardar_en_disco(self) -> None:
+        if not self._ruta_disco:
+            return
+        try:
+            with self._lock:
+                self._cache.expire()
+                entradas = {clave: list(valor) for clave, valor in self._cache.items()}
+                self._escrituras_pendientes = 0
+            directorio = os.path.dirname(self._ruta_disco)
+            if directorio:
+                os.makedirs(directorio, exist_ok=True)
+            ruta_tmp = self._ruta_disco + ".tmp"
+            with open(ruta_tmp, "w", encoding="utf-8") as f:
+                json.dump(entradas, f, ensure_ascii=False, separators=(",", ":"))
+            os.replace(ruta_tmp, self._ruta_disco)
+            logging.info(f"(Cache Explicaciones) {len(entradas)} explicaciones guardadas en {self._ruta_disco}.")
+        except Exception as e:
+            logging.error(f"❌ (Cache Explicaciones) No se pudo guardar {self._ruta_disco}: {e}")
+            traceback.print_exc()
+
+    def estadisticas(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.aciertos + self.fallos
+            return {
+                "activa": CACHE_EXPLICACIONES_ACTIVA,
+                "entradas": len(self._cache),
+                "max_entradas": self._cache.maxsize,
+                "ttl_seg": self._ttl_seg,
+                "persistencia": self._ruta_disco,
+                "aciertos": self.aciertos,
+                "fallos": self.fallos,
+                "ratio_aciertos": round(self.aciertos / total, 4) if total else 0.0,
+            }
+
+
+# Instancia única por proceso
+cache_explicaciones = CacheExplicaciones(
+    max_entradas=CACHE_EXPLICACIONES_MAX_ENTRADAS,
+    ttl_seg=CACHE_EXPLICACIONES_TTL_SEG,
+    ruta_disco=CACHE_EXPLICACIONES_PATH or None,
+)
+
+
+def guardar_cache_explicaciones() -> None:
+    cache_explicaciones.guardar_en_disco()
+
+
+def obtener_estadisticas_cache_explicaciones() -> Dict[str, Any]:
+    return cache_explicaciones.estadisticas()
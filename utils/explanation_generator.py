@@ -1,13 +1,18 @@
 #usada en el Nodo final para explicar el coche recomendado
 import pandas as pd
 import traceback
-from typing import Dict, List, Optional, Any
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Any, Tuple
 import logging # Asegúrate de tener logging
 from langchain_core.messages import AIMessage
 from graph.perfil.state import EstadoAnalisisPerfil, PerfilUsuario 
 from utils.conversion import is_yes
 # Modelos LLM y prompts
 from config.llm import llm_explicacion_coche 
+from config.settings import EXPLICACIONES_MAX_CONCURRENCIA, EXPLICACIONES_TIMEOUT_SEG, CACHE_EXPLICACIONES_ACTIVA
+from utils.explanation_cache import cache_explicaciones, calcular_clave_explicacion
 from prompts.loader import system_prompt_explicacion_coche_mejorado
 from langchain_core.messages import SystemMessage, HumanMessage
 from pydantic import BaseModel, Field
@@ -419,7 +424,7 @@ def _extraer_prioridades_clave(perfil: PerfilUsuario, limite: int = 2) -> List[s
 UMBRAL_LOW_COST_PENALIZABLE_SCALED = 0.6
 UMBRAL_DEPORTIVIDAD_PENALIZABLE_SCALED = 0.6
 
-def generar_explicacion_coche_mejorada(
+def _construir_contexto_explicacion(
     coche_dict_completo: Dict[str, Any],
     preferencias_usuario: PerfilUsuario,
     pesos_normalizados: Dict[str, float],
@@ -429,9 +434,10 @@ def generar_explicacion_coche_mejorada(
     flag_es_zbe: bool,
     flag_aplicar_dist_gen: bool,
     flag_penalizar_puertas: bool,
-) -> str:
+) -> Tuple[str, List[Dict[str, Any]]]:
     """
-    Función orquestadora final que usa los componentes refactorizados.
+    Construye el contexto que se pasa al LLM para un coche.
+    Devuelve (contexto_para_llm, puntos_fuertes) — los puntos fuertes se reutilizan en el texto de fallback.
     """
     nombre_coche = coche_dict_completo.get("nombre", "Este vehículo")
 
@@ -506,19 +512,136 @@ def generar_explicacion_coche_mejorada(
     ## Otras Consideraciones
     - {consideraciones_str}
     """
+    return contexto_para_llm, puntos_fuertes_list
+
+
+def _explicacion_fallback(coche_dict_completo: Dict[str, Any], puntos_fuertes_list: List[Dict[str, Any]]) -> str:
+    """Texto determinista (sin LLM) para cuando la llamada falla o tarda demasiado."""
+    nombre_coche = coche_dict_completo.get("nombre", "Este coche")
+    if not puntos_fuertes_list:
+        return f"El {nombre_coche} es una excelente opción que se ajusta a tus necesidades."
+    razones = " y ".join(
+        f"su {p['caracteristica_coche']} es ideal {p['razon_usuario']}" for p in puntos_fuertes_list
+    )
+    return f"El {nombre_coche} encaja contigo: {razones}."
+
+
+def _mensajes_explicacion(contexto_para_llm: str) -> list:
+    return [SystemMessage(content=system_prompt_explicacion_coche_mejorado), HumanMessage(content=contexto_para_llm)]
+
+
+def generar_explicacion_coche_mejorada(
+    coche_dict_completo: Dict[str, Any],
+    preferencias_usuario: PerfilUsuario,
+    pesos_normalizados: Dict[str, float],
+    flag_penalizar_lc_comod: bool,
+    flag_penalizar_dep_comod: bool,
+    flag_penalizar_ant_tec: bool,
+    flag_es_zbe: bool,
+    flag_aplicar_dist_gen: bool,
+    flag_penalizar_puertas: bool,
+) -> str:
+    """
+    Función orquestadora final que usa los componentes refactorizados.
+    """
+    contexto_para_llm, _ = _construir_contexto_explicacion(
+        coche_dict_completo, preferencias_usuario, pesos_normalizados,
+        flag_penalizar_lc_comod, flag_penalizar_dep_comod, flag_penalizar_ant_tec,
+        flag_es_zbe, flag_aplicar_dist_gen, flag_penalizar_puertas,
+    )
     
     print("--- CONTEXTO GENERADO PARA EL LLM ---")
     print(contexto_para_llm)
     print("------------------------------------")
     
+    # Mismo contexto => misma explicación: se evita la llamada al LLM
+    clave_cache = calcular_clave_explicacion(contexto_para_llm, system_prompt_explicacion_coche_mejorado)
+    if CACHE_EXPLICACIONES_ACTIVA:
+        texto_cacheado = cache_explicaciones.obtener(clave_cache)
+        if texto_cacheado is not None:
+            return texto_cacheado
+
     #6. Llamada al LLM (usa tu system prompt de "copywriter experto")
     try:
-        messages = [SystemMessage(content=system_prompt_explicacion_coche_mejorado), HumanMessage(content=contexto_para_llm)]
-        response = llm_explicacion_coche.invoke(messages)
+        response = llm_explicacion_coche.invoke(_mensajes_explicacion(contexto_para_llm))
+        if CACHE_EXPLICACIONES_ACTIVA:
+            cache_explicaciones.guardar(clave_cache, response.content)
         return response.content
     except Exception as e:
         logging.error(f"Error en LLM: {e}")
         return "Este coche es una excelente opción que se ajusta a tus necesidades."
 
-    # Devolvemos el contexto para la depuración
-    return contexto_para_llm
+
+# =================================================================================
+# 4. EXPLICACIONES EN LOTE (CONCURRENTES)
+# =================================================================================
+
+async def generar_explicaciones_coches_async(
+    coches: List[Dict[str, Any]],
+    preferencias_usuario: PerfilUsuario,
+    pesos_normalizados: Dict[str, float],
+    flag_penalizar_lc_comod: bool,
+    flag_penalizar_dep_comod: bool,
+    flag_penalizar_ant_tec: bool,
+    flag_es_zbe: bool,
+    flag_aplicar_dist_gen: bool,
+    flag_penalizar_puertas: bool,
+    max_concurrencia: int = EXPLICACIONES_MAX_CONCURRENCIA,
+    timeout_seg: float = EXPLICACIONES_TIMEOUT_SEG,
+) -> List[str]:
+    """
+    Genera la explicación de todos los coches a la vez (como mucho `max_concurrencia`
+    llamadas simultáneas), así el tiempo total ≈ la llamada más lenta y no la suma.
+    Cada llamada tiene su timeout; si falla o se pasa, ese coche recibe el texto de
+    fallback determinista. Devuelve una explicación por coche, en el mismo orden.
+    """
+    semaforo = asyncio.Semaphore(max(1, max_concurrencia))
+
+    async def _explicar(coche: Dict[str, Any]) -> str:
+        contexto_para_llm, puntos_fuertes = _construir_contexto_explicacion(
+            coche, preferencias_usuario, pesos_normalizados,
+            flag_penalizar_lc_comod, flag_penalizar_dep_comod, flag_penalizar_ant_tec,
+            flag_es_zbe, flag_aplicar_dist_gen, flag_penalizar_puertas,
+        )
+        clave_cache = calcular_clave_explicacion(contexto_para_llm, system_prompt_explicacion_coche_mejorado)
+        if CACHE_EXPLICACIONES_ACTIVA:
+            texto_cacheado = cache_explicaciones.obtener(clave_cache)
+            if texto_cacheado is not None:
+                return texto_cacheado
+        if llm_explicacion_coche is None:
+            return _explicacion_fallback(coche, puntos_fuertes)
+        async with semaforo:
+            try:
+                response = await asyncio.wait_for(
+                    llm_explicacion_coche.ainvoke(_mensajes_explicacion(contexto_para_llm)),
+                    timeout=timeout_seg,
+                )
+                # Los textos de fallback no se cachean: la próxima vez se reintenta con el LLM
+                if CACHE_EXPLICACIONES_ACTIVA:
+                    cache_explicaciones.guardar(clave_cache, response.content)
+                return response.content
+            except asyncio.TimeoutError:
+                logging.warning(f"WARN (Explicaciones) ► Timeout ({timeout_seg}s) para '{coche.get('nombre')}'. Se usa texto de fallback.")
+            except Exception as e:
+                logging.error(f"Error en LLM (explicación de '{coche.get('nombre')}'): {e}")
+        return _explicacion_fallback(coche, puntos_fuertes)
+
+    inicio = time.perf_counter()
+    explicaciones = await asyncio.gather(*(_explicar(coche) for coche in coches))
+    logging.info(f"INFO (Explicaciones) ► {len(coches)} explicaciones generadas en {time.perf_counter() - inicio:.2f}s (concurrencia={max_concurrencia}).")
+    return list(explicaciones)
+
+
+def generar_explicaciones_coches(coches: List[Dict[str, Any]], *args, **kwargs) -> List[str]:
+    """
+    Versión síncrona para el grafo síncrono (invoke, scripts): crea un event loop por llamada.
+    Los nodos async de la API deben esperar generar_explicaciones_coches_async directamente,
+    para que los clientes async del LLM no queden ligados a un loop ya cerrado.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(generar_explicaciones_coches_async(coches, *args, **kwargs))
+    # Llamada desde dentro de un event loop: se lanza en un hilo aparte para no bloquearlo con run()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, generar_explicaciones_coches_async(coches, *args, **kwargs)).result()
@@ -0,0 +1,289 @@
+# utils/incremental_rerank.py
+# Re-ranking incremental de la última búsqueda de cada conversación.
+#
+# Tras enseñar los coches, un refinamiento ("más barato", "no necesito 4x4") cambia un peso,
+# un flag o el presupuesto y antes volvía a lanzar la búsqueda completa. Ahora cada hilo
+# guarda en memoria una SesionRanking con:
+#   - los candidatos: filas del catálogo en memoria (utils/numpy_scoring.py) que cumplen los
+#     filtros estructurales (transmisión, plazas, mecánica) y una banda de presupuesto
+#     ampliada RERANK_INCREMENTAL_MARGEN_PRESUPUESTO por cada lado;
+#   - el desglose dbg_* de cada candidato (el CTE DebugScores) con los pesos y flags usados.
+# En la siguiente búsqueda del hilo solo se recalcula lo que cambió:
+#   - pesos: los términos ponderados (dbg_score_*, dbg_bonus_* de ratings/costes) de esas claves;
+#   - flags: el desglose completo, pero solo sobre los candidatos;
+#   - filtros más estrictos o presupuesto dentro de la banda: solo la máscara.
+# Después se reaplica el dedup por (modelo, tipo_mecanica), el máximo de 2 por marca y el top k.
+# Si los filtros se amplían más allá de los candidatos guardados (quitar una mecánica, bajar
+# plazas, salir de la banda de presupuesto) o el catálogo se recargó, devuelve None y el
+# llamador repite la búsqueda completa y registra una sesión nueva.
+#
+# El resultado coincide con buscar_coches_numpy, que replica la SQL de buscar_coches_bq. Solo se
+# usa con MOTOR_BUSQUEDA_COCHES = "numpy" (el catálogo ya está en memoria). Los refinamientos le
+# llegan por la ruta refinar_busqueda del router, que repite buscar_coches_finales.
+import logging
+import threading
+import time
+import traceback
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
+
+import numpy as np
+from cachetools import TTLCache
+
+from config.settings import (
+    FACTOR_CONVERSION_PRECIO_CUOTA, FACTOR_ESCALA_BASE, FACTOR_PRECIO_MINIMO, RERANK_INCREMENTAL_MARGEN_PRESUPUESTO,
+    RERANK_INCREMENTAL_MAX_SESIONES, RERANK_INCREMENTAL_TTL_SEG
+)
+from utils.batch_scoring import _top_k
+from utils.bigquery_tools import FiltrosDict, PesosDict, _preparar_pesos_completos, _resolver_presupuesto_maximo
+from utils.numpy_scoring import (
+    TERMINOS_BONUS_PONDERADOS, TERMINOS_PUNTUACION_BASE, CatalogoNumpy, _calcular_componentes, _filas_resultado,
+    _factores_bonus, _leer_flags, _mascara_filtros, _params_log, obtener_catalogo
+)
+
+logger = logging.getLogger(__name__)
+
+# Claves de filtros de las que sale el presupuesto (_resolver_presupuesto_maximo).
+CLAVES_PRESUPUESTO = ("modo_adquisicion_recomendado", "precio_max_contado_recomendado", "cuota_max_calculada", "pago_contado", "cuota_max")
+
+# clave en pesos_completos -> términos que la usan: (columna dbg, columna escalada, factor de bonus o None)
+_TERMINOS_POR_PESO: Dict[str, List[Tuple[str, str, Optional[str]]]] = {}
+for _dbg, _col, _clave in TERMINOS_PUNTUACION_BASE:
+    _TERMINOS_POR_PESO.setdefault(_clave, []).append((_dbg, _col, None))
+for _dbg, _col, _clave, _factor in TERMINOS_BONUS_PONDERADOS:
+    _TERMINOS_POR_PESO.setdefault(_clave, []).append((_dbg, _col, _factor))
+
+# (cambio_automatico requerido, plazas mínimas, mecánicas permitidas)
+Restricciones = Tuple[Optional[bool], int, Optional[FrozenSet[str]]]
+# (modo "precio" | "cuota", mínimo, máximo)
+Banda = Tuple[str, float, float]
+
+
+def _restricciones(filtros: FiltrosDict) -> Restricciones:
+    """Filtros estructurales con la misma interpretación que _mascara_filtros."""
+    transmision = filtros.get("transmision_preferida")
+    valor_auto = None
+    if isinstance(transmision, str) and transmision != "ambos":
+        valor_auto = {"automático": True, "manual": False}.get(transmision.lower())
+    plazas = filtros.get("plazas_min")
+    plazas = plazas if isinstance(plazas, int) and plazas > 0 else 0
+    tipos = filtros.get("tipo_mecanica")
+    mecanicas = frozenset(m.value if hasattr(m, "value") else str(m) for m in tipos) if isinstance(tipos, list) and tipos else None
+    return valor_auto, plazas, mecanicas
+
+
+def _banda_presupuesto(filtros: FiltrosDict) -> Optional[Banda]:
+    precio_maximo, cuota_maxima = _resolver_presupuesto_maximo(filtros)
+    if precio_maximo is not None:
+        return "precio", float(precio_maximo) * FACTOR_PRECIO_MINIMO, float(precio_maximo)
+    if cuota_maxima is not None:
+        return "cuota", float(cuota_maxima) * FACTOR_PRECIO_MINIMO, float(cuota_maxima)
+    return None
+
+
+def _contenidas(pool: Restricciones, nuevas: Restricciones) -> bool:
+    """True si todo coche que cumple `nuevas` cumple también `pool`."""
+    auto_pool, plazas_pool, mecanicas_pool = pool
+    auto_nuevo, plazas_nuevas, mecanicas_nuevas = nuevas
+    if auto_pool is not None and auto_nuevo != auto_pool:
+        return False
+    if plazas_nuevas < plazas_pool:
+        return False
+    if mecanicas_pool is not None and (mecanicas_nuevas is None or not mecanicas_nuevas <= mecanicas_pool):
+        return False
+    return True
+
+
+def _banda_contenida(pool: Optional[Banda], nueva: Optional[Banda]) -> bool:
+    if pool is None:
+        return True
+    if nueva is None or nueva[0] != pool[0]:
+        return False
+    return nueva[1] >= pool[1] and nueva[2] <= pool[2]
+
+
+def _mascara_banda(cat: CatalogoNumpy, banda: Banda) -> np.ndarray:
+    """Coches dentro de la banda ampliada (superconjunto de las cláusulas de presupuesto de la SQL)."""
+    modo, minimo, maximo = banda
+    precio = cat.num["precio_compra_contado"]
+    if modo == "precio":
+        return (precio >= minimo) & (precio <= maximo)
+    cuota_estimada = np.where(np.isnan(precio), 0.0, precio) * FACTOR_CONVERSION_PRECIO_CUOTA
+    return (cuota_estimada >= minimo) & (cuota_estimada <= maximo)
+
+
+class SesionRanking:
+    """Candidatos de un hilo con su desglose dbg_* para los últimos pesos y flags. Inmutable."""
+
+    __slots__ = (
+        "cat", "idx", "restricciones", "banda", "pesos_completos", "flags",
+        "base", "ajustes", "puntuacion_base", "ajustes_experto"
+    )
+
+    def __init__(self, cat, idx, restricciones, banda, pesos_completos, flags, base, ajustes):
+        self.cat: CatalogoNumpy = cat
+        self.idx: np.ndarray = idx
+        self.restricciones: Restricciones = restricciones
+        self.banda: Optional[Banda] = banda
+        self.pesos_completos: Dict[str, float] = pesos_completos
+        self.flags: Dict[str, Any] = flags
+        self.base: Dict[str, np.ndarray] = base
+        self.ajustes: Dict[str, np.ndarray] = ajustes
+        # Misma suma (y mismo orden) que buscar_coches_numpy -> mismos scores al bit
+        self.puntuacion_base = np.sum(list(base.values()), axis=0) if idx.size else np.zeros(0)
+        self.ajustes_experto = np.sum(list(ajustes.values()), axis=0) if idx.size else np.zeros(0)
+
+
+class RerankingIncremental:
+    """Sesiones de ranking por thread_id (TTL + LRU) y re-ranking por deltas."""
+
+    def __init__(self, max_sesiones: int, ttl_seg: int):
+        self._sesiones: TTLCache = TTLCache(maxsize=max_sesiones, ttl=ttl_seg)
+        self._lock = threading.Lock()
+        self.sesiones_registradas = 0
+        self.sin_sesion = 0
+        self.ampliaciones = 0
+        self.catalogo_recargado = 0
+        self.errores = 0
+        self.reordenaciones = {"sin_cambios": 0, "pesos": 0, "flags": 0}
+        self.terminos_recalculados = 0
+        self._tiempo_total_ms = 0.0
+
+    def registrar(self, thread_id: str, filtros: Optional[FiltrosDict], pesos: Optional[PesosDict]) -> None:
+        """Calcula los candidatos y su desglose tras una búsqueda completa y los guarda para el hilo."""
+        filtros = filtros or {}
+        cat = obtener_catalogo()
+        if cat is None:
+            logging.warning("WARN (Re-ranking) ► Catálogo en memoria no disponible. No se guarda la sesión.")
+            return
+        try:
+            restricciones = _restricciones(filtros)
+            filtros_estructurales = {c: v for c, v in filtros.items() if c not in CLAVES_PRESUPUESTO}
+            mascara = _mascara_filtros(cat, filtros_estructurales)[0]
+            banda = _banda_presupuesto(filtros)
+            if banda is not None:
+                modo, minimo, maximo = banda
+                banda = (modo, minimo * (1 - RERANK_INCREMENTAL_MARGEN_PRESUPUESTO), maximo * (1 + RERANK_INCREMENTAL_MARGEN_PRESUPUESTO))
+                mascara &= _mascara_banda(cat, banda)
+            idx = np.flatnonzero(mascara)
+            pesos_completos = _preparar_pesos_completos(pesos or {})
+            flags = _leer_flags(filtros)
+            base, ajustes = _calcular_componentes(cat, idx, pesos_completos, flags)
+            sesion = SesionRanking(cat, idx, restricciones, banda, pesos_completos, flags, base, ajustes)
+        except Exception as e:
+            self.errores += 1
+            logging.error(f"❌ (Re-ranking) Error registrando la sesión de {thread_id}: {e}")
+            traceback.print_exc()
+            return
+        with self._lock:
+            self._sesiones[thread_id] = sesion
+            self.sesiones_registradas += 1
+        logging.info(f"✅ (Re-ranking) Sesión de {thread_id} guardada con {idx.size} candidatos.")
+
+    def reordenar(
+        self,
+        thread_id: str,
+        filtros: Optional[FiltrosDict],
+        pesos: Optional[PesosDict],
+        k: int
+    ) -> Optional[Tuple[List[Dict[str, Any]], str, List[Dict[str, Any]]]]:
+        """
+        Ranking de la búsqueda (filtros, pesos) a partir de la sesión del hilo, con la misma
+        salida que buscar_coches_numpy. None si no hay sesión o los filtros la desbordan.
+        """
+        filtros = filtros or {}
+        with self._lock:
+            sesion = self._sesiones.get(thread_id)
+        if sesion is None:
+            self.sin_sesion += 1
+            return None
+        if sesion.cat is not obtener_catalogo():
+            self.catalogo_recargado += 1
+            return None
+        if not (_contenidas(sesion.restricciones, _restricciones(filtros)) and _banda_contenida(sesion.banda, _banda_presupuesto(filtros))):
+            self.ampliaciones += 1
+            logging.info(f"INFO (Re-ranking) ► Los filtros de {thread_id} se amplían fuera de los candidatos en caché. Búsqueda completa.")
+            return None
+
+        try:
+            inicio = time.perf_counter()
+            cat, idx = sesion.cat, sesion.idx
+            pesos_completos = _preparar_pesos_completos(pesos or {})
+            flags = _leer_flags(filtros)
+
+            if flags != sesion.flags:
+                tipo = "flags"
+                base, ajustes = _calcular_componentes(cat, idx, pesos_completos, flags)
+                recalculados = len(base) + len(ajustes)
+            else:
+                cambiadas = [clave for clave, valor in pesos_completos.items() if sesion.pesos_completos.get(clave) != valor]
+                tipo = "pesos" if cambiadas else "sin_cambios"
+                base, ajustes = dict(sesion.base), dict(sesion.ajustes)
+                factores = _factores_bonus(flags)
+                recalculados = 0
+                for clave in cambiadas:
+                    for dbg, col_scaled, nombre_factor in _TERMINOS_POR_PESO.get(clave, ()):
+                        if nombre_factor is None:
+                            base[dbg] = cat.scaled[col_scaled][idx] * pesos_completos[clave] * FACTOR_ESCALA_BASE
+                        else:
+                            ajustes[dbg] = cat.scaled[col_scaled][idx] * pesos_completos[clave] * factores[nombre_factor] * FACTOR_ESCALA_BASE
+                        recalculados += 1
+            nueva = SesionRanking(cat, idx, sesion.restricciones, sesion.banda, pesos_completos, flags, base, ajustes)
+
+            mascara, clausulas, params_filtros = _mascara_filtros(cat, filtros)
+            score_total = nueva.puntuacion_base + nueva.ajustes_experto
+            score_catalogo = np.full(cat.n, -np.inf)
+            score_catalogo[idx] = score_total
+            filas = _top_k(cat, idx[mascara[idx]], score_catalogo, k) if idx.size else np.zeros(0, dtype=np.intp)
+            posiciones = np.searchsorted(idx, filas)
+            resultados = _filas_resultado(cat, idx, posiciones, score_total, nueva.puntuacion_base, nueva.ajustes_experto, base, ajustes)
+        except Exception as e:
+            self.errores += 1
+            logging.error(f"❌ (Re-ranking) Error reordenando la sesión de {thread_id}: {e}")
+            traceback.print_exc()
+            return None
+
+        ms = (time.perf_counter() - inicio) * 1000
+        with self._lock:
+            self._sesiones[thread_id] = nueva
+            self.reordenaciones[tipo] += 1
+            self.terminos_recalculados += recalculados
+            self._tiempo_total_ms += ms
+        logging.info(
+            f"✅ (Re-ranking) {len(resultados)} resultados de {idx.size} candidatos en caché "
+            f"(cambio: {tipo}, {recalculados} términos recalculados) en {ms:.1f} ms."
+        )
+        descripcion_consulta = (
+            f"-- Re-ranking incremental sobre {idx.size} candidatos en caché (cambio: {tipo})\n"
+            f"WHERE 1=1{' AND ' + ' AND '.join(clausulas) if clausulas else ''}"
+        )
+        return resultados, descripcion_consulta, _params_log(pesos_completos, flags, params_filtros, k)
+
+    def estadisticas(self) -> Dict[str, Any]:
+        with self._lock:
+            total = sum(self.reordenaciones.values())
+            return {
+                "sesiones": len(self._sesiones),
+                "max_sesiones": self._sesiones.maxsize,
+                "ttl_seg": self._sesiones.ttl,
+                "sesiones_registradas": self.sesiones_registradas,
+                "reordenaciones": dict(self.reordenaciones),
+                "busquedas_completas": {
+                    "sin_sesion": self.sin_sesion,
+                    "filtros_ampliados": self.ampliaciones,
+                    "catalogo_recargado": self.catalogo_recargado,
+                },
+                "terminos_recalculados": self.terminos_recalculados,
+                "tiempo_medio_ms": round(self._tiempo_total_ms / total, 2) if total else 0.0,
+                "errores": self.errores,
+            }
+
+
+# Instancia única por proceso
+reranking_incremental = RerankingIncremental(
+    max_sesiones=RERANK_INCREMENTAL_MAX_SESIONES,
+    ttl_seg=RERANK_INCREMENTAL_TTL_SEG,
+)
+
+
+def obtener_estadisticas_reranking_incremental() -> Dict[str, Any]:
+    return reranking_incremental.estadisticas()
@@ -0,0 +1,654 @@
+# utils/numpy_scoring.py
+# Motor de scoring en memoria: réplica vectorizada (NumPy) de la query de buscar_coches_bq.
+#
+# El catálogo de coches es pequeño, así que se carga UNA sola vez desde BigQuery en
+# arrays columnares y cada búsqueda se resuelve en milisegundos sin lanzar una query
+# facturada por usuario. La lógica replica los CTEs de utils/bigquery_tools.py:
+#   ScaledData          -> columnas *_scaled del snapshot/tabla materializada (utils/scaled_features.py)
+#                          o _escalar_catalogo si no hay versión vigente
+#   DebugScores         -> _calcular_componentes (dbg_score_*, dbg_bonus_*, dbg_pen_*, dbg_ajuste_*)
+#   IntermediateScores  -> puntuacion_base / ajustes_experto
+#   DeduplicatedData    -> mejor coche por (modelo, tipo_mecanica)
+#   BrandRankedData     -> máximo 2 coches por marca, top k por score_total
+# ⚠️ Cualquier cambio en la query SQL debe reflejarse aquí (y viceversa).
+import logging
+import threading
+import time
+import traceback
+from typing import Optional, List, Dict, Any, Tuple
+
+import numpy as np
+import pandas as pd
+
+from config.settings import (
+    MIN_MAX_RANGES, PENALTY_PUERTAS_BAJAS, PENALTY_LOW_COST_POR_COMODIDAD, PENALTY_DEPORTIVIDAD_POR_COMODIDAD, PENALTY_ANTIGUEDAD_7_A_10_ANOS, PENALTY_ANTIGUEDAD_10_A_15_ANOS, PENALTY_ANTIGUEDAD_MAS_15_ANOS, PENALTY_ANTIGUEDAD_5_A_7_ANOS, BONUS_DISTINTIVO_ECO_CERO_C, PENALTY_DISTINTIVO_NA_B, BONUS_OCASION_POR_IMPACTO_AMBIENTAL, PENALTY_BEV_REEV_AVENTURA_OCASIONAL, PENALTY_PHEV_AVENTURA_OCASIONAL, PENALTY_ELECTRIFICADOS_AVENTURA_EXTREMA, BONUS_CARROCERIA_MONTANA, BONUS_CARROCERIA_COMERCIAL, BONUS_CARROCERIA_PASAJEROS_PRO, PENALTY_CARROCERIA_NO_AVENTURA, BONUS_SUV_AVENTURA_OCASIONAL, BONUS_TODOTERRENO_AVENTURA_EXTREMA, BONUS_PICKUP_AVENTURA_EXTREMA, BONUS_CARROCERIA_OBJETOS_ESPECIALES, PENALTY_CARROCERIA_OBJETOS_ESPECIALES, BONUS_CARROCERIA_CONFORT, FACTOR_CONVERSION_PRECIO_CUOTA,
+    BONUS_OCASION_POR_USO_OCASIONAL, PENALTY_ELECTRIFICADOS_POR_USO_OCASIONAL, BONUS_BEV_REEV_USO_DEFINIDO, PENALTY_PHEV_USO_INTENSIVO_LARGO, BONUS_MOTOR_POCO_KM, PENALTY_OCASION_POCO_KM, PENALTY_OCASION_MEDIO_KM, BONUS_MOTOR_MUCHO_KM, PENALTY_OCASION_MUCHO_KM, PENALTY_OCASION_MUY_ALTO_KM_V2, BONUS_BEV_MUY_ALTO_KM, BONUS_REEV_MUY_ALTO_KM, BONUS_DIESEL_HEVD_MUY_ALTO_KM, BONUS_PHEVD_GLP_GNV_MUY_ALTO_KM, BONUS_PUNTO_CARGA_PROPIO, PENALTY_AWD_NINGUNA_AVENTURA, BONUS_AWD_AVENTURA_OCASIONAL, BONUS_AWD_AVENTURA_EXTREMA, BONUS_AWD_ZONA_NIEVE, BONUS_AWD_ZONA_MONTA, BONUS_REDUCTORAS_AVENTURA_EXTREMA, PENALTY_ZBE_DISTINTIVO_DESFAVORABLE_NA, PENALTY_ZBE_DISTINTIVO_DESFAVORABLE_B, BONUS_ZBE_DISTINTIVO_FAVORABLE_C, BONUS_ZBE_DISTINTIVO_FAVORABLE_ECO_CERO,
+    BONUS_AWD_NINGUNA_AVENTURA_CLIMA_ADVERSO, PENALTY_DIESEL_CIUDAD, BONUS_DIESEL_CIUDAD_OCASIONAL, FACTOR_ESCALA_BASE, PENALTY_OCASION_KILOMETRAJE_EXTREMO, FACTOR_BONUS_RATING_CRITICO, FACTOR_BONUS_RATING_FUERTE, FACTOR_BONUS_FIABILIDAD_POR_IMPACTO, FACTOR_BONUS_DURABILIDAD_POR_IMPACTO, BONUS_REDUCTORAS_AVENTURA_OCASIONAL, FACTOR_BONUS_FIAB_DUR_CRITICO, FACTOR_BONUS_FIAB_DUR_FUERTE, FACTOR_BONUS_COSTES_CRITICO, PENALTY_ANO_PRE_1990, PENALTY_ANO_1991_1995, PENALTY_ANO_1996_2000, PENALTY_DIESEL_2001_2006, PENALTY_TAMANO_CARRETERA, PENALTY_TAMANO_CIUDAD, BONUS_CARROCERIA_COUPE_SINGULAR, BONUS_CARROCERIA_DESCAPOTABLE_SINGULAR, BONUS_CARROCERIA_COUPE_DEPORTIVO, BONUS_CARROCERIA_DESCAPOTABLE_DEPORTIVO, PENALTY_CARROCERIA_COMERCIAL_DEPORTIVO, PENALTY_CARROCERIA_FURGONETA_DEPORTIVO,
+    PENALTY_MALETERO_INSUFICIENTE, PENALTY_COMERCIAL_USO_PERSONAL, BONUS_COCHE_MUY_CORTO_CIUDAD, BONUS_COCHE_LIGERO_CIUDAD, BONUS_COCHE_CORTO_CIUDAD_2, BONUS_COCHE_LIGERO_CIUDAD_2, UMBRAL_LARGO_CIUDAD_MM, UMBRAL_LARGO_CARRETERA_MM, PENALTY_CARROCERIA_SUV_DEPORTIVO, PENALTY_BEV_NO_DEPORTIVO_LIFESTYLE, FACTOR_PRECIO_MINIMO, TABLA_COCHES_BQ
+)
+from utils.bq_client import obtener_cliente_bq
+from utils.bigquery_tools import FiltrosDict, PesosDict, _preparar_pesos_completos, _resolver_presupuesto_maximo
+from utils.scaled_features import (
+    COLUMNAS_ESCALADAS, NOMBRES_COLUMNAS_ESCALADAS, TABLA_COCHES_ESCALADOS_BQ, USAR_TABLA_ESCALADA,
+    cargar_snapshot_local, tabla_escalada_vigente
+)
+
+logger = logging.getLogger(__name__)
+
+# --- Términos de puntuacion_base: (columna dbg, columna escalada, clave en pesos_completos) ---
+# dbg_score_autonomia_principal está comentado en la SQL, por eso no aparece aquí.
+TERMINOS_PUNTUACION_BASE = [
+    ("dbg_score_estetica", "estetica_scaled", "estetica"),
+    ("dbg_score_premium", "premium_scaled", "premium"),
+    ("dbg_score_singular", "singular_scaled", "singular"),
+    ("dbg_score_altura_libre", "altura_scaled", "altura_libre_suelo"),
+    ("dbg_score_batalla", "batalla_scaled", "batalla"),
+    ("dbg_score_altura_interior", "indice_altura_scaled", "indice_altura_interior"),
+    ("dbg_score_ancho", "ancho_scaled", "ancho_general_score"),
+    ("dbg_score_devaluacion", "devaluacion_scaled", "devaluacion"),
+    ("dbg_score_maletero_min", "maletero_minimo_scaled", "maletero_minimo_score"),
+    ("dbg_score_maletero_max", "maletero_maximo_scaled", "maletero_maximo_score"),
+    ("dbg_score_largo", "largo_scaled", "largo_vehiculo_score"),
+    ("dbg_score_autonomia_max", "autonomia_uso_maxima_scaled", "autonomia_uso_maxima"),
+    ("dbg_score_bajo_peso", "bajo_peso_scaled", "fav_bajo_peso"),
+    ("dbg_score_par_remolque", "par_scaled", "par_motor_remolque_score"),
+    ("dbg_score_remolque_cf", "cap_remolque_cf_scaled", "cap_remolque_cf_score"),
+    ("dbg_score_remolque_sf", "cap_remolque_sf_scaled", "cap_remolque_sf_score"),
+    ("dbg_score_menor_superficie", "menor_superficie_planta_scaled", "fav_menor_superficie_planta"),
+    ("dbg_score_menor_giro", "menor_diametro_giro_scaled", "fav_menor_diametro_giro"),
+    ("dbg_score_menor_largo", "menor_largo_garage_scaled", "fav_menor_largo_garage"),
+    ("dbg_score_menor_ancho", "menor_ancho_garage_scaled", "fav_menor_ancho_garage"),
+    ("dbg_score_menor_alto", "menor_alto_garage_scaled", "fav_menor_alto_garage"),
+    ("dbg_score_deportividad", "deportividad_style_scaled", "deportividad_style_score"),
+    ("dbg_score_menor_rel_peso_pot", "menor_rel_peso_potencia_scaled", "fav_menor_rel_peso_potencia_score"),
+    ("dbg_score_potencia", "potencia_maxima_style_scaled", "potencia_maxima_style_score"),
+    ("dbg_score_par_deportivo", "par_scaled", "par_motor_style_score"),
+    ("dbg_score_autonomia_2nd", "autonomia_uso_2nd_drive_scaled", "peso_autonomia_uso_2nd_drive"),
+    ("dbg_score_menor_t_carga", "menor_tiempo_carga_min_scaled", "peso_menor_tiempo_carga_min"),
+    ("dbg_score_pot_carga_ac", "potencia_maxima_carga_AC_scaled", "peso_potencia_maxima_carga_AC"),
+    ("dbg_score_pot_carga_dc", "potencia_maxima_carga_DC_scaled", "peso_potencia_maxima_carga_DC"),
+    ("dbg_score_menor_aceleracion", "menor_aceleracion_scaled", "fav_menor_aceleracion_score"),
+]
+
+# --- Términos ponderados de ajustes_experto: (columna dbg, columna escalada, clave en pesos_completos, factor) ---
+# El factor depende de los flags (_factores_bonus); el resto de ajustes no depende de los pesos.
+TERMINOS_BONUS_PONDERADOS = [
+    ("dbg_bonus_seguridad", "seguridad_scaled", "rating_seguridad", "seguridad"),
+    ("dbg_bonus_fiabilidad", "fiabilidad_scaled", "rating_fiabilidad", "fiabilidad"),
+    ("dbg_bonus_durabilidad", "durabilidad_scaled", "rating_durabilidad", "durabilidad"),
+    ("dbg_bonus_bajo_consumo", "bajo_consumo_scaled", "fav_bajo_consumo", "costes"),
+    ("dbg_bonus_coste_uso", "costes_de_uso_bajo_scaled", "fav_bajo_coste_uso_directo", "costes"),
+    ("dbg_bonus_coste_mantenimiento", "costes_mantenimiento_bajo_scaled", "fav_bajo_coste_mantenimiento_directo", "costes"),
+]
+
+# Columnas numéricas (además de las de COLUMNAS_ESCALADAS) que usan los filtros y los ajustes.
+COLUMNAS_NUMERICAS_EXTRA = ["km_ocasion", "puertas", "anos_vehiculo", "ano_unidad", "plazas", "precio_compra_contado"]
+COLUMNAS_BOOLEANAS = ["ocasion", "reductoras", "cambio_automatico"]
+COLUMNAS_TEXTO = ["tipo_mecanica", "tipo_carroceria", "traccion", "distintivo_ambiental", "modelo", "marca"]
+
+
+class CatalogoNumpy:
+    """
+    Catálogo de coches en formato columnar: arrays float (NaN = NULL) para columnas
+    numéricas/booleanas, arrays object (None = NULL) para texto, y las columnas
+    escaladas ya calculadas.
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        self.df = df.reset_index(drop=True)
+        self.n = len(self.df)
+        self.num: Dict[str, np.ndarray] = {}
+        self.txt: Dict[str, np.ndarray] = {}
+
+        columnas_num = {col for _, col, _, _ in COLUMNAS_ESCALADAS} | set(COLUMNAS_NUMERICAS_EXTRA)
+        for col in columnas_num:
+            self.num[col] = _columna_float(self.df, col)
+        for col in COLUMNAS_BOOLEANAS:
+            # True -> 1.0, False -> 0.0, NULL -> NaN (así "= TRUE" y COALESCE se replican igual que en SQL)
+            self.num[col] = _columna_bool_float(self.df, col)
+        for col in COLUMNAS_TEXTO:
+            self.txt[col] = _columna_texto(self.df, col)
+        self.txt["distintivo_upper"] = np.array(
+            [v.upper() if isinstance(v, str) else None for v in self.txt["distintivo_ambiental"]], dtype=object
+        )
+
+        self._mascaras_texto: Dict[Tuple[str, Tuple[str, ...]], np.ndarray] = {}
+
+        if all(col in self.df.columns for col in NOMBRES_COLUMNAS_ESCALADAS):
+            # Catálogo ya materializado con la versión vigente: no hay que escalar nada
+            self.scaled = {col: _columna_float(self.df, col) for col in NOMBRES_COLUMNAS_ESCALADAS}
+        else:
+            self.scaled = _escalar_catalogo(self.num)
+
+    def mascara_texto(self, col: str, valores: Tuple[str, ...]) -> np.ndarray:
+        """
+        `col IN (valores)` sobre todo el catálogo (NULL -> False). Las condiciones de texto de
+        los ajustes son siempre las mismas, así que se calculan una vez y se reutilizan.
+        """
+        clave = (col, valores)
+        mascara = self._mascaras_texto.get(clave)
+        if mascara is None:
+            mascara = np.isin(self.txt[col], list(valores))
+            mascara.flags.writeable = False
+            self._mascaras_texto[clave] = mascara
+        return mascara
+
+
+def _columna_float(df: pd.DataFrame, col: str) -> np.ndarray:
+    if col not in df.columns:
+        logging.warning(f"WARN (NumPy Scoring) ► Columna '{col}' no encontrada en el catálogo. Se trata como NULL.")
+        return np.full(len(df), np.nan)
+    return pd.to_numeric(df[col], errors="coerce").to_numpy(dtype=float, na_value=np.nan)
+
+
+def _columna_bool_float(df: pd.DataFrame, col: str) -> np.ndarray:
+    if col not in df.columns:
+        logging.warning(f"WARN (NumPy Scoring) ► Columna '{col}' no encontrada en el catálogo. Se trata como NULL.")
+        return np.full(len(df), np.nan)
+    return df[col].astype("boolean").astype("Float64").to_numpy(dtype=float, na_value=np.nan)
+
+
+def _columna_texto(df: pd.DataFrame, col: str) -> np.ndarray:
+    if col not in df.columns:
+        logging.warning(f"WARN (NumPy Scoring) ► Columna '{col}' no encontrada en el catálogo. Se trata como NULL.")
+        return np.full(len(df), None, dtype=object)
+    serie = df[col].astype(object)
+    return serie.where(serie.notna(), None).to_numpy(dtype=object)
+
+
+def _escalar_catalogo(num: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    """Replica el CTE ScaledData. Mantiene la semántica SAFE_DIVIDE (rango 0 -> 0) y no recorta a [0, 1]."""
+    scaled = {}
+    for nombre_scaled, col, clave_rango, modo in COLUMNAS_ESCALADAS:
+        minimo, maximo = MIN_MAX_RANGES[clave_rango]
+        x = num[col]
+        rango = maximo - minimo
+        if rango == 0:
+            scaled[nombre_scaled] = np.zeros_like(x)
+            continue
+        if modo == "directo":
+            valores = (np.where(np.isnan(x), minimo, x) - minimo) / rango
+        elif modo == "inverso":
+            valores = (maximo - np.where(np.isnan(x), maximo, x)) / rango
+        else:
+            activo = ~np.isnan(x) & (x != 0)
+            x_seguro = np.where(activo, x, 0.0)
+            valores_activos = (maximo - x_seguro) / rango if modo == "carga_inverso" else (x_seguro - minimo) / rango
+            valores = np.where(activo, valores_activos, 0.0)
+        scaled[nombre_scaled] = valores
+    return scaled
+
+
+# --- Carga única del catálogo (thread-safe) ---
+_catalogo: Optional[CatalogoNumpy] = None
+_catalogo_lock = threading.Lock()
+
+
+def obtener_catalogo(forzar_recarga: bool = False) -> Optional[CatalogoNumpy]:
+    """
+    Devuelve el catálogo en memoria, cargándolo desde BigQuery la primera vez
+    (o cuando se fuerza la recarga). Devuelve None si la carga falla.
+    """
+    global _catalogo
+    if _catalogo is not None and not forzar_recarga:
+        return _catalogo
+    with _catalogo_lock:
+        if _catalogo is not None and not forzar_recarga:
+            return _catalogo
+        try:
+            inicio = time.perf_counter()
+            client = obtener_cliente_bq()
+            # 1º snapshot local vigente, 2º tabla escalada vigente en BQ, 3º catálogo crudo (se escala aquí)
+            df = cargar_snapshot_local(client)
+            origen = "snapshot local"
+            if df is None:
+                origen = TABLA_COCHES_ESCALADOS_BQ if (USAR_TABLA_ESCALADA and tabla_escalada_vigente(client)) else TABLA_COCHES_BQ
+                df = client.query(f"SELECT * FROM `{origen}`").result().to_dataframe()
+            _catalogo = CatalogoNumpy(df)
+            logging.info(
+                f"✅ (NumPy Scoring) Catálogo cargado en memoria: {_catalogo.n} coches "
+                f"en {time.perf_counter() - inicio:.2f}s desde {origen}."
+            )
+        except Exception as e:
+            logging.error(f"❌ (NumPy Scoring) Error cargando el catálogo desde BigQuery: {e}")
+            traceback.print_exc()
+            return None
+    return _catalogo
+
+
+def _si(condicion: np.ndarray, valor: float) -> np.ndarray:
+    """Equivalente a CASE WHEN condicion THEN valor ELSE 0.0 END (NaN en la condición cuenta como False)."""
+    return np.where(condicion, float(valor), 0.0)
+
+
+def _mascara_filtros(cat: CatalogoNumpy, filtros: FiltrosDict) -> Tuple[np.ndarray, List[str], List[Dict[str, Any]]]:
+    """
+    Replica las cláusulas WHERE de buscar_coches_bq. Devuelve la máscara, la
+    descripción textual de cada cláusula y los parámetros para el log.
+    """
+    num, txt = cat.num, cat.txt
+    mascara = np.ones(cat.n, dtype=bool)
+    clausulas: List[str] = []
+    params_log: List[Dict[str, Any]] = []
+
+    transmision_val = filtros.get("transmision_preferida")
+    if isinstance(transmision_val, str) and transmision_val != "ambos":
+        valor_auto = None
+        if transmision_val.lower() == 'automático':
+            valor_auto = True
+        elif transmision_val.lower() == 'manual':
+            valor_auto = False
+        if valor_auto is not None:
+            mascara &= num["cambio_automatico"] == (1.0 if valor_auto else 0.0)
+            clausulas.append("cambio_automatico = @param_transmision_auto")
+            params_log.append({"name": "param_transmision_auto", "value": valor_auto, "type": "BOOL"})
+
+    plazas_min_val = filtros.get("plazas_min")
+    if plazas_min_val is not None and isinstance(plazas_min_val, int) and plazas_min_val > 0:
+        mascara &= num["plazas"] >= plazas_min_val
+        clausulas.append("plazas >= @plazas_min")
+        params_log.append({"name": "plazas_min", "value": plazas_min_val, "type": "INT64"})
+
+    tipos_mecanica_list = filtros.get("tipo_mecanica")
+    if isinstance(tipos_mecanica_list, list) and tipos_mecanica_list:
+        tipos_mecanica_str_list = [m.value if hasattr(m, 'value') else str(m) for m in tipos_mecanica_list]
+        mascara &= np.isin(txt["tipo_mecanica"], tipos_mecanica_str_list)
+        clausulas.append("tipo_mecanica IN UNNEST(@tipos_mecanica)")
+        params_log.append({"name": "tipos_mecanica", "value": tipos_mecanica_str_list, "type": "ARRAY<STRING>"})
+
+    precio = num["precio_compra_contado"]
+    precio_maximo, cuota_maxima = _resolver_presupuesto_maximo(filtros)
+    if precio_maximo is not None:
+        precio_minimo = precio_maximo * FACTOR_PRECIO_MINIMO
+        logging.info(f"Filtro Económico: Rango de precio Contado -> {precio_minimo:,.0f}€ a {precio_maximo:,.0f}€")
+        mascara &= np.where(np.isnan(precio), 999999999, precio) <= float(precio_maximo)
+        mascara &= precio >= float(precio_minimo)
+        clausulas.append("COALESCE(precio_compra_contado, 999999999) <= @precio_maximo")
+        clausulas.append("precio_compra_contado >= @precio_minimo")
+        params_log.append({"name": "precio_maximo", "value": float(precio_maximo), "type": "FLOAT64"})
+        params_log.append({"name": "precio_minimo", "value": float(precio_minimo), "type": "FLOAT64"})
+    elif cuota_maxima is not None:
+        cuota_minima = cuota_maxima * FACTOR_PRECIO_MINIMO
+        logging.info(f"Filtro Económico: Rango de Cuota -> {cuota_minima:,.0f}€/mes a {cuota_maxima:,.0f}€/mes")
+        cuota_estimada = np.where(np.isnan(precio), 0.0, precio) * FACTOR_CONVERSION_PRECIO_CUOTA
+        mascara &= cuota_estimada <= float(cuota_maxima)
+        mascara &= cuota_estimada >= float(cuota_minima)
+        clausulas.append(f"(COALESCE(precio_compra_contado, 0) * {FACTOR_CONVERSION_PRECIO_CUOTA}) <= @cuota_maxima")
+        clausulas.append(f"(COALESCE(precio_compra_contado, 0) * {FACTOR_CONVERSION_PRECIO_CUOTA}) >= @cuota_minima")
+        params_log.append({"name": "cuota_maxima", "value": float(cuota_maxima), "type": "FLOAT64"})
+        params_log.append({"name": "cuota_minima", "value": float(cuota_minima), "type": "FLOAT64"})
+
+    return mascara, clausulas, params_log
+
+
+# --- Flags de ajuste: (nombre interno, clave en filtros, parámetro @... de la query) ---
+# Mismas claves (y defaults) que buscar_coches_bq. Los no booleanos se leen tal cual.
+FLAGS_BUSQUEDA = (
+    ("penalizar_puertas", "penalizar_puertas_bajas", "penalizar_puertas"),
+    ("penalizar_low_cost_comodidad", "flag_penalizar_low_cost_comodidad", "flag_penalizar_low_cost_comodidad"),
+    ("penalizar_deportividad_comodidad", "flag_penalizar_deportividad_comodidad", "flag_penalizar_deportividad_comodidad"),
+    ("penalizar_antiguo_tec", "flag_penalizar_antiguo_por_tecnologia", "flag_penalizar_antiguo_tec"),
+    ("aplicar_logica_distintivo", "aplicar_logica_distintivo_ambiental", "flag_aplicar_logica_distintivo"),
+    ("es_municipio_zbe", "es_municipio_zbe", "flag_es_municipio_zbe"),
+    ("pen_bev_reev_avent_ocas", "penalizar_bev_reev_aventura_ocasional", "flag_pen_bev_reev_avent_ocas"),
+    ("pen_phev_avent_ocas", "penalizar_phev_aventura_ocasional", "flag_pen_phev_avent_ocas"),
+    ("pen_electrif_avent_extr", "penalizar_electrificados_aventura_extrema", "flag_pen_electrif_avent_extr"),
+    ("fav_car_montana", "favorecer_carroceria_montana", "flag_fav_car_montana"),
+    ("fav_car_comercial", "favorecer_carroceria_comercial", "flag_fav_car_comercial"),
+    ("fav_car_pasajeros_pro", "favorecer_carroceria_pasajeros_pro", "flag_fav_car_pasajeros_pro"),
+    ("desfav_car_no_aventura", "desfavorecer_carroceria_no_aventura", "flag_desfav_car_no_aventura"),
+    ("fav_suv_aventura_ocasional", "favorecer_suv_aventura_ocasional", "flag_fav_suv_aventura_ocasional"),
+    ("fav_pickup_todoterreno_aventura_extrema", "favorecer_pickup_todoterreno_aventura_extrema", "flag_fav_pickup_todoterreno_aventura_extrema"),
+    ("aplicar_logica_objetos_especiales", "aplicar_logica_objetos_especiales", "flag_aplicar_logica_objetos_especiales"),
+    ("fav_carroceria_confort", "favorecer_carroceria_confort", "flag_fav_carroceria_confort"),
+    ("logica_uso_ocasional", "flag_logica_uso_ocasional", "flag_logica_uso_ocasional"),
+    ("favorecer_bev_uso_definido", "flag_favorecer_bev_uso_definido", "flag_favorecer_bev_uso_definido"),
+    ("penalizar_phev_uso_intensivo", "flag_penalizar_phev_uso_intensivo", "flag_penalizar_phev_uso_intensivo"),
+    ("favorecer_electrificados_por_punto_carga", "flag_favorecer_electrificados_por_punto_carga", "flag_favorecer_electrificados_por_punto_carga"),
+    ("km_anuales_estimados", "km_anuales_estimados", "km_anuales_estimados"),
+    ("penalizar_awd_ninguna_aventura", "penalizar_awd_ninguna_aventura", "penalizar_awd_ninguna_aventura"),
+    ("favorecer_awd_aventura_ocasional", "favorecer_awd_aventura_ocasional", "favorecer_awd_aventura_ocasional"),
+    ("favorecer_awd_aventura_extrema", "favorecer_awd_aventura_extrema", "favorecer_awd_aventura_extrema"),
+    ("bonus_awd_nieve", "flag_bonus_awd_nieve", "flag_bonus_awd_nieve"),
+    ("bonus_awd_montana", "flag_bonus_awd_montana", "flag_bonus_awd_montana"),
+    ("logica_reductoras_aventura", "flag_logica_reductoras_aventura", "flag_logica_reductoras_aventura"),
+    ("bonus_awd_clima_adverso", "flag_bonus_awd_clima_adverso", "flag_bonus_awd_clima_adverso"),
+    ("logica_diesel_ciudad", "flag_logica_diesel_ciudad", "flag_logica_diesel_ciudad"),
+    ("bonus_seguridad_critico", "flag_bonus_seguridad_critico", "flag_bonus_seguridad_critico"),
+    ("bonus_seguridad_fuerte", "flag_bonus_seguridad_fuerte", "flag_bonus_seguridad_fuerte"),
+    ("bonus_fiab_dur_critico", "flag_bonus_fiab_dur_critico", "flag_bonus_fiab_dur_critico"),
+    ("bonus_fiab_dur_fuerte", "flag_bonus_fiab_dur_fuerte", "flag_bonus_fiab_dur_fuerte"),
+    ("bonus_costes_critico", "flag_bonus_costes_critico", "flag_bonus_costes_critico"),
+    ("penalizar_tamano_no_compacto", "flag_penalizar_tamano_no_compacto", "flag_penalizar_tamano_no_compacto"),
+    # Igual que en buscar_coches_bq: este flag se alimenta de flag_penalizar_tamano_no_compacto.
+    ("bonus_singularidad_lifestyle", "flag_penalizar_tamano_no_compacto", "flag_bonus_singularidad_lifestyle"),
+    ("deportividad_lifestyle", "flag_deportividad_lifestyle", "flag_deportividad_lifestyle"),
+    ("ajuste_maletero_personal", "flag_ajuste_maletero_personal", "flag_ajuste_maletero_personal"),
+    ("coche_ciudad_perfil", "flag_coche_ciudad_perfil", "flag_coche_ciudad_perfil"),
+    ("coche_ciudad_2_perfil", "flag_coche_ciudad_2_perfil", "flag_coche_ciudad_2_perfil"),
+    ("es_conductor_urbano", "flag_es_conductor_urbano", "flag_es_conductor_urbano"),
+)
+FLAGS_NO_BOOLEANOS = {"km_anuales_estimados", "logica_reductoras_aventura", "logica_diesel_ciudad"}
+
+
+def _leer_flags(filtros: FiltrosDict) -> Dict[str, Any]:
+    """Lee los flags de filtros con las mismas claves (y defaults) que buscar_coches_bq."""
+    flags = {}
+    for nombre, clave_filtros, _ in FLAGS_BUSQUEDA:
+        if nombre not in FLAGS_NO_BOOLEANOS:
+            flags[nombre] = bool(filtros.get(clave_filtros, False))
+        elif nombre == "km_anuales_estimados":
+            flags[nombre] = filtros.get(clave_filtros) or 0
+        else:
+            flags[nombre] = filtros.get(clave_filtros)
+    return flags
+
+
+def _factores_bonus(f: Dict[str, Any]) -> Dict[str, float]:
+    """Multiplicadores de los TERMINOS_BONUS_PONDERADOS según los flags de rating críticos/fuertes."""
+    factor_fiab_dur = FACTOR_BONUS_FIAB_DUR_CRITICO if f["bonus_fiab_dur_critico"] else (FACTOR_BONUS_FIAB_DUR_FUERTE if f["bonus_fiab_dur_fuerte"] else 1.0)
+    factor_fiab_impacto = FACTOR_BONUS_FIABILIDAD_POR_IMPACTO if f["aplicar_logica_distintivo"] else 1.0
+    factor_dur_impacto = FACTOR_BONUS_DURABILIDAD_POR_IMPACTO if f["aplicar_logica_distintivo"] else 1.0
+    return {
+        "seguridad": FACTOR_BONUS_RATING_CRITICO if f["bonus_seguridad_critico"] else (FACTOR_BONUS_RATING_FUERTE if f["bonus_seguridad_fuerte"] else 1.0),
+        "fiabilidad": factor_fiab_impacto * factor_fiab_dur,
+        "durabilidad": factor_dur_impacto * factor_fiab_dur,
+        "costes": FACTOR_BONUS_COSTES_CRITICO if f["bonus_costes_critico"] else 1.0,
+    }
+
+
+def _calcular_componentes(
+    cat: CatalogoNumpy,
+    idx: np.ndarray,
+    pc: Dict[str, float],
+    f: Dict[str, Any]
+) -> Tuple[Dict[str, np.ndarray], Dict[str, np.ndarray]]:
+    """
+    Replica el CTE DebugScores sobre las filas `idx`.
+    Devuelve (componentes de puntuacion_base, componentes de ajustes_experto).
+    """
+    sc = {nombre: valores[idx] for nombre, valores in cat.scaled.items()}
+    n = len(idx)
+    ceros = np.zeros(n)
+    tc = cat.txt["tipo_carroceria"][idx]
+    en_tm = lambda *valores: cat.mascara_texto("tipo_mecanica", valores)[idx]
+    en_tc = lambda *valores: cat.mascara_texto("tipo_carroceria", valores)[idx]
+    en_dist = lambda *valores: cat.mascara_texto("distintivo_upper", valores)[idx]
+    es_awd = cat.mascara_texto("traccion", ('ALL',))[idx]
+    km_ocasion = np.nan_to_num(cat.num["km_ocasion"][idx], nan=0.0)
+    es_ocasion = cat.num["ocasion"][idx] == 1.0
+    tiene_reductoras = cat.num["reductoras"][idx] == 1.0
+    puertas = cat.num["puertas"][idx]
+    anos = cat.num["anos_vehiculo"][idx]
+    ano_unidad = cat.num["ano_unidad"][idx]
+    largo = cat.num["largo"][idx]
+    peso = cat.num["peso"][idx]
+    plazas = cat.num["plazas"][idx]
+    maletero_minimo = cat.num["maletero_minimo"][idx]
+
+    # --- Desglose de puntuacion_base ---
+    base = {
+        dbg: sc[col_scaled] * pc[clave_peso] * FACTOR_ESCALA_BASE
+        for dbg, col_scaled, clave_peso in TERMINOS_PUNTUACION_BASE
+    }
+    base["dbg_pen_bev_lifestyle"] = _si(
+        f["deportividad_lifestyle"] & en_tm('BEV') & (tc != None) & ~en_tc('COUPE', 'DESCAPOTABLE'),  # noqa: E711
+        PENALTY_BEV_NO_DEPORTIVO_LIFESTYLE
+    )
+
+    # --- Desglose de ajustes_experto ---
+    aj: Dict[str, np.ndarray] = {}
+    factores = _factores_bonus(f)
+    for dbg, col_scaled, clave_peso, nombre_factor in TERMINOS_BONUS_PONDERADOS:
+        aj[dbg] = sc[col_scaled] * pc[clave_peso] * factores[nombre_factor] * FACTOR_ESCALA_BASE
+
+    aj["dbg_pen_km_extremo"] = _si(km_ocasion >= 250000, PENALTY_OCASION_KILOMETRAJE_EXTREMO)
+    aj["dbg_pen_puertas"] = _si(f["penalizar_puertas"] & (puertas <= 3), PENALTY_PUERTAS_BAJAS)
+    aj["dbg_pen_low_cost_comodidad"] = sc["acceso_low_cost_scaled"] * PENALTY_LOW_COST_POR_COMODIDAD if f["penalizar_low_cost_comodidad"] else ceros
+    aj["dbg_pen_deportividad_comodidad"] = sc["deportividad_bq_scaled"] * PENALTY_DEPORTIVIDAD_POR_COMODIDAD if f["penalizar_deportividad_comodidad"] else ceros
+    aj["dbg_pen_antiguedad"] = np.select(
+        [anos > 15, anos > 10, anos > 7, anos > 5],
+        [PENALTY_ANTIGUEDAD_MAS_15_ANOS, PENALTY_ANTIGUEDAD_10_A_15_ANOS, PENALTY_ANTIGUEDAD_7_A_10_ANOS, PENALTY_ANTIGUEDAD_5_A_7_ANOS],
+        0.0
+    ) if f["penalizar_antiguo_tec"] else ceros
+    aj["dbg_pen_antiguedad_general"] = np.select(
+        [
+            ano_unidad < 1990,
+            (ano_unidad >= 1991) & (ano_unidad <= 1995),
+            (ano_unidad >= 1996) & (ano_unidad <= 2000),
+            (ano_unidad >= 2001) & (ano_unidad <= 2006) & en_tm('DIESEL'),
+        ],
+        [PENALTY_ANO_PRE_1990, PENALTY_ANO_1991_1995, PENALTY_ANO_1996_2000, PENALTY_DIESEL_2001_2006],
+        0.0
+    )
+    aj["dbg_ajuste_distintivo"] = np.select(
+        [en_dist('CERO', '0', 'ECO', 'C'), en_dist('B', 'NA')],
+        [BONUS_DISTINTIVO_ECO_CERO_C, PENALTY_DISTINTIVO_NA_B],
+        0.0
+    ) if f["aplicar_logica_distintivo"] else ceros
+    aj["dbg_bonus_ocasion_ambiental"] = _si(f["aplicar_logica_distintivo"] & es_ocasion, BONUS_OCASION_POR_IMPACTO_AMBIENTAL)
+    aj["dbg_ajuste_zbe"] = np.select(
+        [en_dist('CERO', '0', 'ECO'), en_dist('C'), en_dist('NA'), en_dist('B')],
+        [BONUS_ZBE_DISTINTIVO_FAVORABLE_ECO_CERO, BONUS_ZBE_DISTINTIVO_FAVORABLE_C, PENALTY_ZBE_DISTINTIVO_DESFAVORABLE_NA, PENALTY_ZBE_DISTINTIVO_DESFAVORABLE_B],
+        0.0
+    ) if f["es_municipio_zbe"] else ceros
+    aj["dbg_pen_bev_reev_avent_ocas"] = _si(f["pen_bev_reev_avent_ocas"] & en_tm('BEV', 'REEV'), PENALTY_BEV_REEV_AVENTURA_OCASIONAL)
+    aj["dbg_pen_phev_avent_ocas"] = _si(f["pen_phev_avent_ocas"] & en_tm('PHEVD', 'PHEVG'), PENALTY_PHEV_AVENTURA_OCASIONAL)
+    aj["dbg_pen_electrif_avent_extr"] = _si(f["pen_electrif_avent_extr"] & en_tm('BEV', 'REEV', 'PHEVD', 'PHEVG'), PENALTY_ELECTRIFICADOS_AVENTURA_EXTREMA)
+    aj["dbg_bonus_car_montana"] = _si(f["fav_car_montana"] & en_tc('SUV', 'TODOTERRENO'), BONUS_CARROCERIA_MONTANA)
+    aj["dbg_bonus_car_comercial"] = _si(f["fav_car_comercial"] & en_tc('COMERCIAL'), BONUS_CARROCERIA_COMERCIAL)
+    aj["dbg_bonus_car_pasajeros"] = _si(f["fav_car_pasajeros_pro"] & en_tc('3VOL', 'MONOVOLUMEN'), BONUS_CARROCERIA_PASAJEROS_PRO)
+    aj["dbg_pen_car_no_aventura"] = _si(f["desfav_car_no_aventura"] & en_tc('PICKUP', 'TODOTERRENO'), PENALTY_CARROCERIA_NO_AVENTURA)
+    aj["dbg_bonus_suv_avent_ocas"] = _si(f["fav_suv_aventura_ocasional"] & en_tc('SUV'), BONUS_SUV_AVENTURA_OCASIONAL)
+    aj["dbg_bonus_tt_avent_extr"] = _si(f["fav_pickup_todoterreno_aventura_extrema"] & en_tc('TODOTERRENO'), BONUS_TODOTERRENO_AVENTURA_EXTREMA)
+    aj["dbg_bonus_pickup_avent_extr"] = _si(f["fav_pickup_todoterreno_aventura_extrema"] & en_tc('PICKUP'), BONUS_PICKUP_AVENTURA_EXTREMA)
+    aj["dbg_ajuste_objetos_especiales"] = np.select(
+        [en_tc('MONOVOLUMEN', 'FURGONETA', 'FAMILIAR', 'SUV'), en_tc('3VOL', 'COUPE', 'DESCAPOTABLE')],
+        [BONUS_CARROCERIA_OBJETOS_ESPECIALES, PENALTY_CARROCERIA_OBJETOS_ESPECIALES],
+        0.0
+    ) if f["aplicar_logica_objetos_especiales"] else ceros
+    aj["dbg_bonus_car_confort"] = _si(f["fav_carroceria_confort"] & en_tc('3VOL', '2VOL', 'SUV', 'FAMILIAR', 'MONOVOLUMEN'), BONUS_CARROCERIA_CONFORT)
+    aj["dbg_bonus_ocasion_uso_ocas"] = _si(f["logica_uso_ocasional"] & es_ocasion, BONUS_OCASION_POR_USO_OCASIONAL)
+    aj["dbg_pen_electrif_uso_ocas"] = _si(f["logica_uso_ocasional"] & en_tm('PHEVD', 'PHEVG', 'BEV', 'REEV'), PENALTY_ELECTRIFICADOS_POR_USO_OCASIONAL)
+    aj["dbg_bonus_bev_uso_definido"] = _si(f["favorecer_bev_uso_definido"] & en_tm('BEV', 'REEV'), BONUS_BEV_REEV_USO_DEFINIDO)
+    aj["dbg_pen_phev_uso_intensivo"] = _si(f["penalizar_phev_uso_intensivo"] & en_tm('PHEVD', 'PHEVG'), PENALTY_PHEV_USO_INTENSIVO_LARGO)
+    aj["dbg_bonus_punto_carga"] = _si(f["favorecer_electrificados_por_punto_carga"] & en_tm('BEV', 'PHEVD', 'PHEVG', 'REEV'), BONUS_PUNTO_CARGA_PROPIO)
+
+    # CASE encadenado de AWD: gana el primer flag activo (todas las ramas exigen traccion = 'ALL')
+    if f["bonus_awd_clima_adverso"]:
+        valor_awd = BONUS_AWD_NINGUNA_AVENTURA_CLIMA_ADVERSO
+    elif f["penalizar_awd_ninguna_aventura"]:
+        valor_awd = PENALTY_AWD_NINGUNA_AVENTURA
+    elif f["favorecer_awd_aventura_ocasional"]:
+        valor_awd = BONUS_AWD_AVENTURA_OCASIONAL
+    elif f["favorecer_awd_aventura_extrema"]:
+        valor_awd = BONUS_AWD_AVENTURA_EXTREMA
+    else:
+        valor_awd = 0.0
+    aj["dbg_ajuste_awd_aventura"] = _si(es_awd, valor_awd)
+    aj["dbg_bonus_awd_nieve"] = _si(f["bonus_awd_nieve"] & es_awd, BONUS_AWD_ZONA_NIEVE)
+    aj["dbg_bonus_awd_montana"] = _si(f["bonus_awd_montana"] & es_awd, BONUS_AWD_ZONA_MONTA)
+
+    valor_reductoras = {
+        'FAVORECER_OCASIONAL': BONUS_REDUCTORAS_AVENTURA_OCASIONAL,
+        'FAVORECER_EXTREMA': BONUS_REDUCTORAS_AVENTURA_EXTREMA,
+    }.get(f["logica_reductoras_aventura"], 0.0)
+    aj["dbg_bonus_reductoras"] = _si(tiene_reductoras, valor_reductoras)
+
+    valor_diesel_ciudad = {
+        'PENALIZAR': PENALTY_DIESEL_CIUDAD,
+        'BONIFICAR': BONUS_DIESEL_CIUDAD_OCASIONAL,
+    }.get(f["logica_diesel_ciudad"], 0.0)
+    aj["dbg_ajuste_diesel_ciudad"] = _si(en_tm('DIESEL', 'HEVD', 'MHEVD'), valor_diesel_ciudad)
+
+    if f["penalizar_tamano_no_compacto"]:
+        if f["es_conductor_urbano"]:
+            aj["dbg_pen_tamano_contextual"] = _si(largo >= UMBRAL_LARGO_CIUDAD_MM, PENALTY_TAMANO_CIUDAD)
+        else:
+            aj["dbg_pen_tamano_contextual"] = _si(largo >= UMBRAL_LARGO_CARRETERA_MM, PENALTY_TAMANO_CARRETERA)
+    else:
+        aj["dbg_pen_tamano_contextual"] = ceros
+
+    aj["dbg_bonus_lifestyle"] = np.select(
+        [en_tc('COUPE'), en_tc('DESCAPOTABLE')],
+        [BONUS_CARROCERIA_COUPE_SINGULAR, BONUS_CARROCERIA_DESCAPOTABLE_SINGULAR],
+        0.0
+    ) if f["bonus_singularidad_lifestyle"] else ceros
+    aj["dbg_ajuste_deportividad_lifestyle"] = np.select(
+        [en_tc('COUPE'), en_tc('DESCAPOTABLE'), en_tc('COMERCIAL'), en_tc('FURGONETA'), en_tc('SUV')],
+        [BONUS_CARROCERIA_COUPE_DEPORTIVO, BONUS_CARROCERIA_DESCAPOTABLE_DEPORTIVO, PENALTY_CARROCERIA_COMERCIAL_DEPORTIVO, PENALTY_CARROCERIA_FURGONETA_DEPORTIVO, PENALTY_CARROCERIA_SUV_DEPORTIVO],
+        0.0
+    ) if f["deportividad_lifestyle"] else ceros
+    aj["dbg_ajuste_maletero_personal"] = (
+        np.select(
+            [(plazas <= 3) & (maletero_minimo < 450), (plazas > 3) & (maletero_minimo < 550)],
+            [PENALTY_MALETERO_INSUFICIENTE, PENALTY_MALETERO_INSUFICIENTE],
+            0.0
+        ) + _si(en_tc('COMERCIAL'), PENALTY_COMERCIAL_USO_PERSONAL)
+    ) if f["ajuste_maletero_personal"] else ceros
+    aj["dbg_bonus_coche_ciudad"] = (
+        _si(largo < 3300, BONUS_COCHE_MUY_CORTO_CIUDAD) + _si(peso < 950, BONUS_COCHE_LIGERO_CIUDAD)
+    ) if f["coche_ciudad_perfil"] else ceros
+    aj["dbg_bonus_coche_ciudad_2"] = (
+        _si(largo < 3900, BONUS_COCHE_CORTO_CIUDAD_2) + _si(peso < 1000, BONUS_COCHE_LIGERO_CIUDAD_2)
+    ) if f["coche_ciudad_2_perfil"] else ceros
+
+    km = f["km_anuales_estimados"]
+    if 0 < km < 10000:
+        ajuste_km = _si(en_tm('GASOLINA', 'MHEVG', 'HEVG'), BONUS_MOTOR_POCO_KM) + _si(km_ocasion > 250000, PENALTY_OCASION_POCO_KM)
+    elif 10000 <= km < 30000:
+        ajuste_km = _si(km_ocasion > 120000, PENALTY_OCASION_MEDIO_KM)
+    elif 30000 <= km < 60000:
+        ajuste_km = _si(en_tm('DIESEL', 'MHEVD', 'HEVD', 'GLP', 'GNV'), BONUS_MOTOR_MUCHO_KM) + _si(km_ocasion > 80000, PENALTY_OCASION_MUCHO_KM)
+    elif km >= 60000:
+        ajuste_km = np.select(
+            [en_tm('BEV'), en_tm('REEV'), en_tm('HEVD', 'DIESEL', 'MHEVD'), en_tm('PHEVD', 'GLP', 'GNV')],
+            [BONUS_BEV_MUY_ALTO_KM, BONUS_REEV_MUY_ALTO_KM, BONUS_DIESEL_HEVD_MUY_ALTO_KM, BONUS_PHEVD_GLP_GNV_MUY_ALTO_KM],
+            0.0
+        ) + _si(km_ocasion > 20000, PENALTY_OCASION_MUY_ALTO_KM_V2)
+    else:
+        ajuste_km = ceros
+    aj["dbg_ajuste_km_anuales"] = ajuste_km
+
+    return base, aj
+
+
+def _seleccionar_top_k(
+    cat: CatalogoNumpy,
+    idx: np.ndarray,
+    score_total: np.ndarray,
+    k: int
+) -> np.ndarray:
+    """
+    Replica DeduplicatedData + BrandRankedData: mejor coche por (modelo, tipo_mecanica),
+    máximo 2 por marca y top k por score_total. Devuelve posiciones relativas a `idx`.
+    """
+    precio = cat.num["precio_compra_contado"][idx]
+    # ORDER BY score DESC, precio ASC (en BigQuery los NULL van primero en ASC)
+    orden = np.lexsort((np.where(np.isnan(precio), -np.inf, precio), -score_total))
+    claves = pd.DataFrame({
+        "modelo": cat.txt["modelo"][idx][orden],
+        "tipo_mecanica": cat.txt["tipo_mecanica"][idx][orden],
+    })
+    orden = orden[~claves.duplicated(keep="first").to_numpy()]
+    # Tras deduplicar, el orden sigue siendo por score DESC -> cumcount = brand_rank - 1
+    marcas = pd.Series(cat.txt["marca"][idx][orden])
+    brand_rank = marcas.groupby(marcas, dropna=False).cumcount().to_numpy()
+    return orden[brand_rank < 2][:k]
+
+
+def _params_log(
+    pesos_completos: Dict[str, float],
+    flags: Dict[str, Any],
+    params_filtros: List[Dict[str, Any]],
+    k: int
+) -> List[Dict[str, Any]]:
+    """Parámetros de la búsqueda en el mismo formato que el log de buscar_coches_bq."""
+    params = [{"name": f"peso_{clave}", "value": valor, "type": "FLOAT64"} for clave, valor in pesos_completos.items()]
+    params += [{"name": nombre, "value": valor, "type": type(valor).__name__} for nombre, valor in flags.items()]
+    params += params_filtros
+    params.append({"name": "k", "value": k, "type": "INT64"})
+    return params
+
+
+def _filas_resultado(
+    cat: CatalogoNumpy,
+    idx: np.ndarray,
+    posiciones: np.ndarray,
+    score_total: np.ndarray,
+    puntuacion_base: np.ndarray,
+    ajustes_experto: np.ndarray,
+    base: Dict[str, np.ndarray],
+    ajustes: Dict[str, np.ndarray]
+) -> List[Dict[str, Any]]:
+    """Filas de salida (mismas columnas que la SELECT final de la SQL) de los candidatos `posiciones` de `idx`."""
+    filas = idx[posiciones]
+    # Un solo iloc para todas las filas (iloc fila a fila era la mayor parte del tiempo de la búsqueda)
+    registros = cat.df.iloc[filas].to_dict(orient="records")
+    resultados = []
+    for pos, fila, registro in zip(posiciones, filas, registros):
+        coche = {
+            "score_total": float(score_total[pos]),
+            "puntuacion_base": float(puntuacion_base[pos]),
+            "ajustes_experto": float(ajustes_experto[pos]),
+        }
+        coche.update(registro)
+        coche.update({nombre: float(valores[fila]) for nombre, valores in cat.scaled.items()})
+        coche.update({nombre: float(valores[pos]) for nombre, valores in base.items()})
+        coche.update({nombre: float(valores[pos]) for nombre, valores in ajustes.items()})
+        resultados.append(coche)
+    return resultados
+
+
+def buscar_coches_numpy(
+    filtros: Optional[FiltrosDict],
+    pesos: Optional[PesosDict],
+    k: int
+) -> Tuple[List[Dict[str, Any]], str, List[Dict[str, Any]]]:
+    """
+    Alternativa en memoria a buscar_coches_bq con la misma firma y el mismo formato de
+    salida: (lista de coches, descripción de la consulta, parámetros para el log).
+    """
+    if not filtros: filtros = {}
+    if not pesos: pesos = {}
+
+    cat = obtener_catalogo()
+    if cat is None:
+        return [], "Error NumPy Scoring: catálogo no disponible", []
+
+    inicio = time.perf_counter()
+    pesos_completos = _preparar_pesos_completos(pesos)
+    flags = _leer_flags(filtros)
+    mascara, clausulas, params_filtros = _mascara_filtros(cat, filtros)
+
+    log_params_for_logging = _params_log(pesos_completos, flags, params_filtros, k)
+
+    descripcion_consulta = (
+        f"-- Motor NumPy en memoria sobre {TABLA_COCHES_BQ} ({cat.n} coches)\n"
+        f"WHERE 1=1{' AND ' + ' AND '.join(clausulas) if clausulas else ''}"
+    )
+
+    try:
+        idx = np.flatnonzero(mascara)
+        if idx.size == 0:
+            logging.info("✅ (NumPy Scoring) Ningún coche cumple los filtros.")
+            return [], descripcion_consulta, log_params_for_logging
+
+        base, ajustes = _calcular_componentes(cat, idx, pesos_completos, flags)
+        puntuacion_base = np.sum(list(base.values()), axis=0)
+        ajustes_experto = np.sum(list(ajustes.values()), axis=0)
+        score_total = puntuacion_base + ajustes_experto
+
+        seleccion = _seleccionar_top_k(cat, idx, score_total, k)
+
+        resultados = _filas_resultado(cat, idx, seleccion, score_total, puntuacion_base, ajustes_experto, base, ajustes)
+
+        logging.info(
+            f"✅ (NumPy Scoring) {len(resultados)} resultados de {idx.size} candidatos "
+            f"en {(time.perf_counter() - inicio) * 1000:.1f} ms."
+        )
+        return resultados, descripcion_consulta, log_params_for_logging
+    except Exception as e:
+        logging.error(f"❌ (NumPy Scoring) Error calculando el ranking en memoria: {e}")
+        traceback.print_exc()
+        return [], descripcion_consulta, log_params_for_logging
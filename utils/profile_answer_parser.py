@@ -0,0 +1,200 @@
+# utils/profile_answer_parser.py
+# Intérprete determinista de respuestas a las preguntas cerradas del perfil.
+#
+# Cada pregunta de QUESTION_BANK corresponde a un único campo de PerfilUsuario y la
+# mayoría admite respuestas cerradas: sí/no, una opción de un enum o una nota 0-10.
+# Si la respuesta del usuario es inequívoca ("sí", "8", "ocasionalmente", "2") se rellena
+# el campo directamente; si no, interpretar_respuesta_perfil devuelve None y el nodo
+# recurre a llm_solo_perfil como hasta ahora.
+import logging
+import re
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from utils.enums import (
+    DimensionProblematica, DistanciaTrayecto, EstiloConduccion, FrecuenciaUso,
+    FrecuenciaViajesLargos, NivelAventura, TipoUsoProfesional, Transmision
+)
+from utils.structured_llm_cache import normalizar_texto
+
+logger = logging.getLogger(__name__)
+
+CAMPOS_SI_NO = {
+    "apasionado_motor", "valora_estetica", "coche_principal_hogar", "realiza_viajes_largos",
+    "circula_principalmente_ciudad", "uso_profesional", "prefiere_diseno_exclusivo",
+    "altura_mayor_190", "transporta_carga_voluminosa", "necesita_espacio_objetos_especiales",
+    "arrastra_remolque", "tiene_garage", "espacio_sobra_garage", "problemas_aparcar_calle",
+    "tiene_punto_carga_propio", "solo_electricos", "prioriza_baja_depreciacion",
+}
+# Campos con variantes de pregunta que no son de sí/no ("¿te gusta diferenciarte o prefieres
+# la discreción?"): solo se interpreta "sí"/"no" si la pregunta mostraba esas opciones.
+CAMPOS_SI_NO_SOLO_CON_OPCIONES = {"prefiere_diseno_exclusivo"}
+
+RESPUESTAS_SI = {"si", "s", "claro", "claro que si", "por supuesto", "afirmativo", "exacto", "correcto", "si claro", "yes"}
+RESPUESTAS_NO = {"no", "n", "para nada", "en absoluto", "negativo", "nop", "claro que no", "no no"}
+
+# Opciones de cada campo enum: (valor, sinónimos). El orden coincide con el de las opciones
+# listadas en QUESTION_BANK, así "1"/"2"/"3" se traducen a la opción correspondiente.
+OPCIONES_ENUM: Dict[str, List[Tuple[Any, Tuple[str, ...]]]] = {
+    "frecuencia_uso": [
+        (FrecuenciaUso.DIARIO, ("diario", "a diario", "diariamente", "todos los dias", "cada dia")),
+        (FrecuenciaUso.FRECUENTEMENTE, ("frecuentemente", "frecuente", "varias veces por semana")),
+        (FrecuenciaUso.OCASIONALMENTE, ("ocasionalmente", "ocasional", "pocas veces al mes", "de vez en cuando")),
+    ],
+    "distancia_trayecto": [
+        (DistanciaTrayecto.MENOS_10_KM, ("hasta 10 km", "hasta 10", "menos de 10 km", "menos de 10")),
+        (DistanciaTrayecto.ENTRE_10_Y_50_KM, ("10-50 km", "10-50", "entre 10 y 50 km", "entre 10 y 50")),
+        (DistanciaTrayecto.ENTRE_51_Y_150_KM, ("51-150 km", "51-150", "entre 51 y 150 km", "entre 50 y 150 km", "entre 51 y 150", "entre 50 y 150")),
+        (DistanciaTrayecto.MAS_150_KM, ("mas de 150 km", "mas de 150")),
+    ],
+    "frecuencia_viajes_largos": [
+        (FrecuenciaViajesLargos.FRECUENTEMENTE, ("frecuentemente", "frecuente", "varias veces al mes")),
+        (FrecuenciaViajesLargos.OCASIONALMENTE, ("ocasionalmente", "ocasional", "algunas veces al mes")),
+        (FrecuenciaViajesLargos.ESPORADICAMENTE, ("esporadicamente", "esporadico", "pocas veces al ano")),
+    ],
+    "aventura": [
+        (NivelAventura.ninguna, ("solo asfalto", "asfalto", "ninguna")),
+        (NivelAventura.ocasional, ("pistas", "ocasional", "ocasionalmente", "tambien por pistas sin asfaltar, de forma ocasional")),
+        (NivelAventura.extrema, ("extrema", "extremo", "terrenos complicados", "frecuentemente por terrenos complicados o en condiciones extremas")),
+    ],
+    "estilo_conduccion": [
+        (EstiloConduccion.TRANQUILO, ("tranquilo", "tranquila", "relajado", "relajada")),
+        (EstiloConduccion.DEPORTIVO, ("deportivo", "deportiva")),
+        (EstiloConduccion.MIXTO, ("mixto", "mixta", "depende", "depende del dia", "depende del dia, mixto")),
+    ],
+    "transmision_preferida": [
+        (Transmision.AUTOMATICO, ("automatico", "automatica", "automaticos")),
+        (Transmision.MANUAL, ("manual", "manuales")),
+        (Transmision.AMBOS, ("ambos", "ambas", "me da igual", "cualquiera", "indiferente")),
+    ],
+    "tipo_uso_profesional": [
+        (TipoUsoProfesional.PASAJEROS, ("pasajeros", "personas", "clientes")),
+        (TipoUsoProfesional.CARGA, ("carga", "mercancias", "mercancia", "productos")),
+        (TipoUsoProfesional.MIXTO, ("mixto", "ambos", "ambas", "los dos", "las dos", "de todo")),
+    ],
+}
+# Preguntas abiertas (sin lista numerada): un "1" no significa nada
+CAMPOS_ENUM_SIN_NUMERACION = {"tipo_uso_profesional"}
+
+PALABRAS_NEGACION = {"no", "nunca", "ni", "tampoco"}
+MAX_PALABRAS_RESPUESTA_CORTA = 4
+
+NUMEROS_EN_LETRA = {
+    "cero": 0, "uno": 1, "un": 1, "dos": 2, "tres": 3, "cuatro": 4, "cinco": 5,
+    "seis": 6, "siete": 7, "ocho": 8, "nueve": 9, "diez": 10,
+}
+_RE_RATING = re.compile(r"^(?:un |una |el |la |le doy un |le daria un |)(\w+)(?:\s*(?:/|de|sobre)\s*10)?$")
+_RE_OPCION_NUMERICA = re.compile(r"^(?:la |opcion |la opcion |)(\d)$")
+_RE_PALABRAS = re.compile(r"[a-z0-9ñ\-]+")
+
+
+def _limpiar(texto: str) -> str:
+    # Quita emojis/viñetas de los extremos además de normalizar ("✅ Sí" -> "si")
+    return re.sub(r"^[^\w]+|[^\w]+$", "", normalizar_texto(texto))
+
+
+def _interpretar_si_no(respuesta: str, pregunta: str, campo: str) -> Optional[str]:
+    if campo in CAMPOS_SI_NO_SOLO_CON_OPCIONES and "✅ si" not in normalizar_texto(pregunta):
+        return None
+    if respuesta in RESPUESTAS_SI:
+        return "sí"
+    if respuesta in RESPUESTAS_NO:
+        return "no"
+    return None
+
+
+def _interpretar_enum(respuesta: str, campo: str) -> Any:
+    opciones = OPCIONES_ENUM[campo]
+    if campo not in CAMPOS_ENUM_SIN_NUMERACION:
+        m = _RE_OPCION_NUMERICA.match(respuesta)
+        if m:
+            indice = int(m.group(1)) - 1
+            return opciones[indice][0] if 0 <= indice < len(opciones) else None
+    for valor, sinonimos in opciones:
+        if respuesta in sinonimos:
+            return valor
+    # Respuesta corta con sinónimos de UNA sola opción y sin negaciones ("lo uso a diario")
+    palabras = _RE_PALABRAS.findall(respuesta)
+    if len(palabras) > MAX_PALABRAS_RESPUESTA_CORTA or PALABRAS_NEGACION & set(palabras):
+        return None
+    texto_palabras = f" {' '.join(palabras)} "
+    coincidencias = {
+        valor for valor, sinonimos in opciones
+        if any(f" {s} " in texto_palabras for s in sinonimos)
+    }
+    return coincidencias.pop() if len(coincidencias) == 1 else None
+
+
+def _interpretar_rating(respuesta: str) -> Optional[int]:
+    m = _RE_RATING.match(respuesta)
+    if not m:
+        return None
+    token = m.group(1)
+    valor = int(token) if token.isdigit() else NUMEROS_EN_LETRA.get(token)
+    return valor if valor is not None and 0 <= valor <= 10 else None
+
+
+def _interpretar_dimensiones(respuesta: str) -> Optional[List[DimensionProblematica]]:
+    palabras = _RE_PALABRAS.findall(respuesta)
+    dimensiones = [DimensionProblematica(p) for p in palabras if p in {"largo", "ancho", "alto"}]
+    resto = [p for p in palabras if p not in {"largo", "ancho", "alto", "y", "el", "la", "e"}]
+    if not dimensiones or resto:
+        return None
+    return list(dict.fromkeys(dimensiones))
+
+
+def interpretar_respuesta_perfil(campo: Optional[str], pregunta: str, respuesta: str) -> Any:
+    """
+    Devuelve el valor para `campo` si la respuesta es inequívoca, o None si hay que usar el LLM.
+    """
+    if not campo or not respuesta:
+        return None
+    respuesta_limpia = _limpiar(respuesta)
+    if not respuesta_limpia:
+        return None
+    if campo in CAMPOS_SI_NO:
+        return _interpretar_si_no(respuesta_limpia, pregunta, campo)
+    if campo in OPCIONES_ENUM:
+        return _interpretar_enum(respuesta_limpia, campo)
+    if campo.startswith("rating_"):
+        return _interpretar_rating(respuesta_limpia)
+    if campo == "problema_dimension_garage":
+        return _interpretar_dimensiones(respuesta_limpia)
+    return None
+
+
+class MetricasParserPerfil:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.resueltas_sin_llm: Dict[str, int] = {}
+        self.escaladas_llm: Dict[str, int] = {}
+
+    def registrar(self, campo: Optional[str], resuelta: bool) -> None:
+        destino = self.resueltas_sin_llm if resuelta else self.escaladas_llm
+        with self._lock:
+            destino[campo or "desconocido"] = destino.get(campo or "desconocido", 0) + 1
+
+    def estadisticas(self) -> Dict[str, Any]:
+        with self._lock:
+            resueltas = sum(self.resueltas_sin_llm.values())
+            total = resueltas + sum(self.escaladas_llm.values())
+            return {
+                "resueltas_sin_llm": resueltas,
+                "escaladas_llm": total - resueltas,
+                "ratio_sin_llm": round(resueltas / total, 4) if total else 0.0,
+                "por_campo_sin_llm": dict(self.resueltas_sin_llm),
+                "por_campo_llm": dict(self.escaladas_llm),
+            }
+
+
+metricas_parser_perfil = MetricasParserPerfil()
+
+
+def interpretar_respuesta_perfil_con_metricas(campo: Optional[str], pregunta: str, respuesta: str) -> Any:
+    valor = interpretar_respuesta_perfil(campo, pregunta, respuesta)
+    metricas_parser_perfil.registrar(campo, valor is not None)
+    return valor
+
+
+def obtener_estadisticas_parser_perfil() -> Dict[str, Any]:
+    return metricas_parser_perfil.estadisticas()
@@ -0,0 +1,64 @@
+# utils/ranking_cache.py
+# Ranking completo de la última búsqueda de cada conversación, para paginar.
+#
+# buscar_coches_finales_node pide al motor PAGINACION_MAX_COCHES coches (el coste de la
+# query/scoring es el mismo que con k=7) y enseña solo la primera página. El ranking
+# entero se guarda aquí, en memoria y no en el checkpoint (cada coche lleva ~150 columnas
+# dbg_*/scaled), de modo que "ver más coches" es un slice sin volver a puntuar ni a pasar
+# por la cadena de finalización. Si la entrada expiró o la petición llega a otra
+# instancia, el nodo de paginación repite solo la búsqueda con los pesos y flags del estado.
+import logging
+import threading
+from typing import Optional, List, Dict, Any
+
+from cachetools import TTLCache
+
+from config.settings import PAGINACION_CACHE_MAX_CONVERSACIONES, PAGINACION_CACHE_TTL_SEG
+
+logger = logging.getLogger(__name__)
+
+
+class CacheRankings:
+    """TTL + LRU de rankings por thread_id."""
+
+    def __init__(self, max_conversaciones: int, ttl_seg: int):
+        self._cache: TTLCache = TTLCache(maxsize=max_conversaciones, ttl=ttl_seg)
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+
+    def guardar(self, thread_id: str, coches: List[Dict[str, Any]]) -> None:
+        with self._lock:
+            self._cache[thread_id] = list(coches)
+
+    def obtener(self, thread_id: str) -> Optional[List[Dict[str, Any]]]:
+        with self._lock:
+            coches = self._cache.get(thread_id)
+            if coches is None:
+                self.fallos += 1
+                return None
+            self.aciertos += 1
+            return coches
+
+    def estadisticas(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.aciertos + self.fallos
+            return {
+                "conversaciones": len(self._cache),
+                "max_conversaciones": self._cache.maxsize,
+                "ttl_seg": self._cache.ttl,
+                "aciertos": self.aciertos,
+                "fallos": self.fallos,
+                "ratio_aciertos": round(self.aciertos / total, 4) if total else 0.0,
+            }
+
+
+# Instancia única por proceso
+cache_rankings = CacheRankings(
+    max_conversaciones=PAGINACION_CACHE_MAX_CONVERSACIONES,
+    ttl_seg=PAGINACION_CACHE_TTL_SEG,
+)
+
+
+def obtener_estadisticas_cache_rankings() -> Dict[str, Any]:
+    return cache_rankings.estadisticas()
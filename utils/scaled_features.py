@@ -0,0 +1,297 @@
+# utils/scaled_features.py
+# Materialización de las características escaladas (min-max) del catálogo de coches.
+#
+# El CTE ScaledData solo depende de la fila del coche y de MIN_MAX_RANGES, así que no
+# tiene sentido recalcular ~40 escalados en cada búsqueda. Este módulo:
+#   - Define en un único sitio las columnas escaladas (COLUMNAS_ESCALADAS), que usan
+#     tanto la query de BigQuery como el motor NumPy.
+#   - Calcula una versión (hash) de MIN_MAX_RANGES + definición de columnas.
+#   - Materializa la tabla escalada en BigQuery (TABLA_COCHES_ESCALADOS_BQ) y/o un
+#     snapshot local en parquet, ambos etiquetados con esa versión.
+#   - Decide si la búsqueda puede leer directamente de la tabla materializada o si
+#     debe escalar al vuelo (versión distinta o catálogo modificado después).
+#
+# Uso (regenerar tras cambiar MIN_MAX_RANGES o el catálogo):
+#   python -m utils.scaled_features          -> tabla BQ + snapshot local
+#   python -m utils.scaled_features bq       -> solo tabla BQ
+#   python -m utils.scaled_features local    -> solo snapshot local
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import traceback
+from datetime import datetime, timezone
+from typing import Optional, Dict, Any
+
+import pandas as pd
+from google.cloud import bigquery
+from utils.bq_client import obtener_cliente_bq
+
+from config.settings import (
+    MIN_MAX_RANGES, TABLA_COCHES_BQ, TABLA_COCHES_ESCALADOS_BQ, USAR_TABLA_ESCALADA,
+    SNAPSHOT_COCHES_ESCALADOS_PATH, TTL_VERIFICACION_TABLA_ESCALADA_SEG
+)
+
+logger = logging.getLogger(__name__)
+
+# --- Definición de las columnas escaladas (equivalente al antiguo CTE ScaledData) ---
+# (columna_escalada, columna_origen, clave en MIN_MAX_RANGES, modo)
+#   "directo":       (COALESCE(x, min) - min) / (max - min)
+#   "inverso":       (max - COALESCE(x, max)) / (max - min)   -> "menor es mejor"
+#   "carga_inverso": 0 si x es NULL o 0, si no (max - x) / (max - min)
+#   "carga_directo": 0 si x es NULL o 0, si no (x - min) / (max - min)
+COLUMNAS_ESCALADAS = [
+    ("estetica_scaled", "estetica", "estetica", "directo"),
+    ("premium_scaled", "premium", "premium", "directo"),
+    ("singular_scaled", "singular", "singular", "directo"),
+    ("altura_scaled", "altura_libre_suelo", "altura_libre_suelo", "directo"),
+    ("batalla_scaled", "batalla", "batalla", "directo"),
+    ("indice_altura_scaled", "indice_altura_interior", "indice_altura_interior", "directo"),
+    ("ancho_scaled", "ancho", "ancho", "directo"),
+    ("fiabilidad_scaled", "fiabilidad", "fiabilidad", "directo"),
+    ("durabilidad_scaled", "durabilidad", "durabilidad", "directo"),
+    ("seguridad_scaled", "seguridad", "seguridad", "directo"),
+    ("comodidad_scaled", "comodidad", "comodidad", "directo"),
+    ("costes_de_uso_bajo_scaled", "costes_de_uso", "costes_de_uso", "inverso"),
+    ("costes_mantenimiento_bajo_scaled", "costes_mantenimiento", "costes_mantenimiento", "inverso"),
+    ("tecnologia_scaled", "tecnologia", "tecnologia", "directo"),
+    ("acceso_low_cost_scaled", "acceso_low_cost", "acceso_low_cost", "directo"),
+    ("deportividad_bq_scaled", "deportividad", "deportividad", "directo"),
+    ("devaluacion_scaled", "devaluacion", "devaluacion", "directo"),
+    ("maletero_minimo_scaled", "maletero_minimo", "maletero_minimo", "directo"),
+    ("maletero_maximo_scaled", "maletero_maximo", "maletero_maximo", "directo"),
+    ("largo_scaled", "largo", "largo", "directo"),
+    ("autonomia_uso_maxima_scaled", "autonomia_uso_maxima", "autonomia_uso_maxima", "directo"),
+    ("bajo_peso_scaled", "peso", "peso", "inverso"),
+    ("bajo_consumo_scaled", "indice_consumo_energia", "indice_consumo_energia", "inverso"),
+    ("par_scaled", "par", "par", "directo"),
+    ("cap_remolque_cf_scaled", "capacidad_remolque_con_freno", "capacidad_remolque_con_freno", "directo"),
+    ("cap_remolque_sf_scaled", "capacidad_remolque_sin_freno", "capacidad_remolque_sin_freno", "directo"),
+    ("menor_superficie_planta_scaled", "superficie_planta", "superficie_planta", "inverso"),
+    ("menor_diametro_giro_scaled", "diametro_giro", "diametro_giro", "inverso"),
+    ("menor_largo_garage_scaled", "largo", "largo", "inverso"),
+    ("menor_ancho_garage_scaled", "ancho", "ancho", "inverso"),
+    ("menor_alto_garage_scaled", "alto", "alto_vehiculo", "inverso"),
+    ("deportividad_style_scaled", "deportividad", "deportividad", "directo"),
+    ("menor_rel_peso_potencia_scaled", "relacion_peso_potencia", "relacion_peso_potencia", "inverso"),
+    ("potencia_maxima_style_scaled", "potencia_maxima", "potencia_maxima", "directo"),
+    ("menor_aceleracion_scaled", "aceleracion_0_100", "aceleracion_0_100", "inverso"),
+    ("autonomia_uso_principal_scaled", "autonomia_uso_principal", "autonomia_uso_principal", "directo"),
+    ("autonomia_uso_2nd_drive_scaled", "autonomia_uso_2nd_drive", "autonomia_uso_2nd_drive", "directo"),
+    ("menor_tiempo_carga_min_scaled", "tiempo_carga_min", "tiempo_carga_min", "carga_inverso"),
+    ("potencia_maxima_carga_AC_scaled", "potencia_maxima_carga_AC", "potencia_maxima_carga_AC", "carga_directo"),
+    ("potencia_maxima_carga_DC_scaled", "potencia_maxima_carga_DC", "potencia_maxima_carga_DC", "carga_directo"),
+]
+
+NOMBRES_COLUMNAS_ESCALADAS = [nombre for nombre, _, _, _ in COLUMNAS_ESCALADAS]
+
+
+def calcular_version_escalado() -> str:
+    """
+    Versión del escalado: hash de MIN_MAX_RANGES + definición de columnas.
+    Cambia en cuanto se toca un rango o una columna, invalidando lo materializado.
+    """
+    contenido = json.dumps({"rangos": MIN_MAX_RANGES, "columnas": COLUMNAS_ESCALADAS}, sort_keys=True)
+    return "v" + hashlib.sha1(contenido.encode("utf-8")).hexdigest()[:12]
+
+
+VERSION_ESCALADO = calcular_version_escalado()
+
+
+def _expresion_sql(nombre_scaled: str, col: str, clave_rango: str, modo: str) -> str:
+    minimo, maximo = MIN_MAX_RANGES[clave_rango]
+    if modo == "directo":
+        return f"COALESCE(SAFE_DIVIDE(COALESCE({col}, {minimo}) - {minimo}, NULLIF({maximo} - {minimo}, 0)), 0) AS {nombre_scaled}"
+    if modo == "inverso":
+        return f"COALESCE(SAFE_DIVIDE({maximo} - COALESCE({col}, {maximo}), NULLIF({maximo} - {minimo}, 0)), 0) AS {nombre_scaled}"
+    if modo == "carga_inverso":
+        return f"(CASE WHEN COALESCE({col}, 0) = 0 THEN 0.0 ELSE COALESCE(SAFE_DIVIDE({maximo} - {col}, NULLIF({maximo} - {minimo}, 0)), 0) END) AS {nombre_scaled}"
+    return f"(CASE WHEN COALESCE({col}, 0) = 0 THEN 0.0 ELSE COALESCE(SAFE_DIVIDE({col} - {minimo}, NULLIF({maximo} - {minimo}, 0)), 0) END) AS {nombre_scaled}"
+
+
+def generar_sql_escalado() -> str:
+    """SELECT que añade las columnas escaladas a cada fila del catálogo."""
+    expresiones = ",\n            ".join(_expresion_sql(*spec) for spec in COLUMNAS_ESCALADAS)
+    return f"""SELECT
+            *,
+            {expresiones}
+        FROM
+            `{TABLA_COCHES_BQ}`"""
+
+
+# --- Vigencia de la tabla materializada (cacheada para no consultar metadatos en cada búsqueda) ---
+_vigencia_cache: Dict[str, Any] = {"valor": None, "comprobado_en": 0.0}
+_vigencia_lock = threading.Lock()
+
+
+def _timestamp_modificacion_catalogo(client: bigquery.Client) -> int:
+    return int(client.get_table(TABLA_COCHES_BQ).modified.timestamp())
+
+
+def tabla_escalada_vigente(client: bigquery.Client, forzar: bool = False) -> bool:
+    """
+    True si TABLA_COCHES_ESCALADOS_BQ está etiquetada con la versión actual y se
+    generó después de la última modificación del catálogo.
+    """
+    ahora = time.monotonic()
+    with _vigencia_lock:
+        if (not forzar and _vigencia_cache["valor"] is not None
+                and ahora - _vigencia_cache["comprobado_en"] < TTL_VERIFICACION_TABLA_ESCALADA_SEG):
+            return _vigencia_cache["valor"]
+    try:
+        etiquetas = client.get_table(TABLA_COCHES_ESCALADOS_BQ).labels or {}
+        vigente = (
+            etiquetas.get("version_escalado") == VERSION_ESCALADO
+            and int(etiquetas.get("catalogo_modificado", 0)) >= _timestamp_modificacion_catalogo(client)
+        )
+        if not vigente:
+            logging.warning(
+                f"WARN (Escalado) ► {TABLA_COCHES_ESCALADOS_BQ} desactualizada "
+                f"(versión {etiquetas.get('version_escalado')} vs {VERSION_ESCALADO}). Se escalará al vuelo."
+            )
+    except Exception as e:
+        logging.warning(f"WARN (Escalado) ► No se pudo verificar {TABLA_COCHES_ESCALADOS_BQ}: {e}. Se escalará al vuelo.")
+        vigente = False
+    with _vigencia_lock:
+        _vigencia_cache["valor"] = vigente
+        _vigencia_cache["comprobado_en"] = ahora
+    return vigente
+
+
+_version_catalogo_cache: Dict[str, Any] = {"valor": None, "comprobado_en": 0.0}
+
+
+def obtener_version_catalogo(client: bigquery.Client) -> str:
+    """
+    Identificador del estado del catálogo: versión de escalado + fecha de última
+    modificación de TABLA_COCHES_BQ. Se cachea TTL_VERIFICACION_TABLA_ESCALADA_SEG.
+    """
+    ahora = time.monotonic()
+    with _vigencia_lock:
+        if (_version_catalogo_cache["valor"] is not None
+                and ahora - _version_catalogo_cache["comprobado_en"] < TTL_VERIFICACION_TABLA_ESCALADA_SEG):
+            return _version_catalogo_cache["valor"]
+    try:
+        version = f"{VERSION_ESCALADO}-{_timestamp_modificacion_catalogo(client)}"
+    except Exception as e:
+        logging.warning(f"WARN (Escalado) ► No se pudo leer la fecha de modificación de {TABLA_COCHES_BQ}: {e}")
+        version = f"{VERSION_ESCALADO}-desconocida"
+    with _vigencia_lock:
+        _version_catalogo_cache["valor"] = version
+        _version_catalogo_cache["comprobado_en"] = ahora
+    return version
+
+
+# Orígenes posibles del CTE ScaledData (utils/bigquery_tools.py precompila una plantilla por origen).
+ORIGENES_SCALED_DATA = ("tabla", "al_vuelo")
+
+
+def origen_scaled_data(client: bigquery.Client) -> str:
+    """"tabla" si la tabla materializada está vigente; "al_vuelo" si hay que escalar en la query."""
+    return "tabla" if USAR_TABLA_ESCALADA and tabla_escalada_vigente(client) else "al_vuelo"
+
+
+def sql_scaled_data(origen: str) -> str:
+    """Cuerpo del CTE ScaledData para un origen de ORIGENES_SCALED_DATA."""
+    if origen == "tabla":
+        return f"SELECT * FROM `{TABLA_COCHES_ESCALADOS_BQ}`"
+    return generar_sql_escalado()
+
+
+def materializar_tabla_escalada(client: Optional[bigquery.Client] = None) -> bool:
+    """(Re)crea TABLA_COCHES_ESCALADOS_BQ con las columnas escaladas y la versión en las etiquetas."""
+    try:
+        client = client or obtener_cliente_bq()
+        catalogo_modificado = _timestamp_modificacion_catalogo(client)
+        sql = f"""
+        CREATE OR REPLACE TABLE `{TABLA_COCHES_ESCALADOS_BQ}`
+        OPTIONS (labels = [('version_escalado', '{VERSION_ESCALADO}'), ('catalogo_modificado', '{catalogo_modificado}')])
+        AS
+        {generar_sql_escalado()}
+        """
+        client.query(sql).result()
+        tabla_escalada_vigente(client, forzar=True)
+        logging.info(f"✅ (Escalado) Tabla {TABLA_COCHES_ESCALADOS_BQ} materializada con versión {VERSION_ESCALADO}.")
+        return True
+    except Exception as e:
+        logging.error(f"❌ (Escalado) Error materializando {TABLA_COCHES_ESCALADOS_BQ}: {e}")
+        traceback.print_exc()
+        return False
+
+
+# --- Snapshot local (lo usa el motor NumPy para arrancar sin tocar BigQuery) ---
+
+def _ruta_meta_snapshot(ruta: str) -> str:
+    return ruta + ".meta.json"
+
+
+def guardar_snapshot_local(client: Optional[bigquery.Client] = None, ruta: str = SNAPSHOT_COCHES_ESCALADOS_PATH) -> bool:
+    """Descarga el catálogo ya escalado y lo guarda en parquet junto a su versión."""
+    try:
+        client = client or obtener_cliente_bq()
+        catalogo_modificado = _timestamp_modificacion_catalogo(client)
+        df = client.query(generar_sql_escalado()).result().to_dataframe()
+        directorio = os.path.dirname(ruta)
+        if directorio:
+            os.makedirs(directorio, exist_ok=True)
+        df.to_parquet(ruta, index=False)
+        with open(_ruta_meta_snapshot(ruta), "w", encoding="utf-8") as f:
+            json.dump({
+                "version_escalado": VERSION_ESCALADO,
+                "catalogo_modificado": catalogo_modificado,
+                "generado_en": datetime.now(timezone.utc).isoformat(),
+                "num_coches": len(df),
+            }, f, indent=2)
+        logging.info(f"✅ (Escalado) Snapshot local guardado en {ruta} ({len(df)} coches, versión {VERSION_ESCALADO}).")
+        return True
+    except Exception as e:
+        logging.error(f"❌ (Escalado) Error guardando el snapshot local {ruta}: {e}")
+        traceback.print_exc()
+        return False
+
+
+def cargar_snapshot_local(
+    client: Optional[bigquery.Client] = None,
+    ruta: str = SNAPSHOT_COCHES_ESCALADOS_PATH
+) -> Optional[pd.DataFrame]:
+    """
+    Devuelve el catálogo escalado desde el snapshot local si existe y su versión es la
+    actual. Si hay cliente, comprueba además que el catálogo no haya cambiado desde entonces.
+    """
+    if not ruta or not os.path.exists(ruta) or not os.path.exists(_ruta_meta_snapshot(ruta)):
+        return None
+    try:
+        with open(_ruta_meta_snapshot(ruta), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version_escalado") != VERSION_ESCALADO:
+            logging.warning(f"WARN (Escalado) ► Snapshot {ruta} con versión {meta.get('version_escalado')}, se esperaba {VERSION_ESCALADO}. Se ignora.")
+            return None
+        if client is not None:
+            try:
+                if int(meta.get("catalogo_modificado", 0)) < _timestamp_modificacion_catalogo(client):
+                    logging.warning(f"WARN (Escalado) ► El catálogo ha cambiado desde el snapshot {ruta}. Se ignora.")
+                    return None
+            except Exception as e_meta:
+                logging.warning(f"WARN (Escalado) ► No se pudo comprobar la fecha del catálogo ({e_meta}). Se usa el snapshot.")
+        df = pd.read_parquet(ruta)
+        logging.info(f"✅ (Escalado) Snapshot local {ruta} cargado ({len(df)} coches, versión {VERSION_ESCALADO}).")
+        return df
+    except Exception as e:
+        logging.error(f"❌ (Escalado) Error leyendo el snapshot local {ruta}: {e}")
+        return None
+
+
+if __name__ == "__main__":
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    destino = sys.argv[1] if len(sys.argv) > 1 else "todo"
+    print(f"Versión de escalado actual: {VERSION_ESCALADO}")
+    cliente = obtener_cliente_bq()
+    if destino in ("bq", "todo"):
+        print(f"Materializando {TABLA_COCHES_ESCALADOS_BQ}...")
+        materializar_tabla_escalada(cliente)
+    if destino in ("local", "todo"):
+        print(f"Guardando snapshot local en {SNAPSHOT_COCHES_ESCALADOS_PATH}...")
+        guardar_snapshot_local(cliente)
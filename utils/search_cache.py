@@ -0,0 +1,173 @@
+# utils/search_cache.py
+# Caché de resultados de búsqueda de coches.
+#
+# Los pesos salen de respuestas discretas (compute_raw_weights) y los flags son booleanos,
+# así que muchos usuarios acaban lanzando EXACTAMENTE la misma búsqueda. La clave de la
+# caché es un hash canónico de la lista de parámetros que construye buscar_coches_bq
+# (nombre, tipo y valor de cada parámetro) más la versión del catálogo: si el catálogo
+# o MIN_MAX_RANGES cambian, la versión cambia y las entradas antiguas dejan de servirse.
+# La clave incluye también el motor de búsqueda y un hash del texto SQL ejecutado, donde van
+# interpoladas las constantes de bonus/penalización de config/settings.py: un despliegue que
+# cambie el scoring no reutiliza rankings antiguos (tampoco los que sigan vivos en Redis).
+#
+# Backends:
+#   - Local (por defecto): cachetools.TTLCache -> TTL + expulsión LRU por tamaño.
+#   - Compartido (opcional): Redis si se define CACHE_BUSQUEDAS_REDIS_URL, para que varias
+#     instancias de Cloud Run compartan aciertos. La caché local se sigue usando delante.
+import copy
+import hashlib
+import json
+import logging
+import threading
+from typing import Optional, List, Dict, Any, Tuple
+
+from cachetools import TTLCache
+
+from config.settings import (
+    CACHE_BUSQUEDAS_ACTIVA, CACHE_BUSQUEDAS_MAX_ENTRADAS, CACHE_BUSQUEDAS_TTL_SEG, CACHE_BUSQUEDAS_REDIS_URL
+)
+
+try:
+    import redis  # Dependencia opcional: solo hace falta si se usa el backend compartido
+except ImportError:
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+ResultadoBusqueda = Tuple[List[Dict[str, Any]], str, List[Dict[str, Any]]]
+
+# Los valores en Redis son JSON (nunca pickle: leerlos no debe poder ejecutar código).
+PREFIJO_CLAVE_REDIS = "carmentor:busqueda:json:"
+
+
+def calcular_huella_busqueda(
+    params_log: List[Dict[str, Any]], version_catalogo: str, texto_sql: str, motor: str
+) -> str:
+    """
+    Hash canónico de la búsqueda: parámetros ordenados por nombre (el orden de la lista
+    no importa) + versión del catálogo + motor + hash del SQL (constantes de scoring incluidas).
+    """
+    params_canonicos = sorted(
+        ({"name": p.get("name"), "type": str(p.get("type")), "value": p.get("value")} for p in params_log),
+        key=lambda p: p["name"]
+    )
+    contenido = json.dumps(
+        {
+            "catalogo": version_catalogo,
+            "motor": motor,
+            "sql": hashlib.sha256(texto_sql.encode("utf-8")).hexdigest(),
+            "params": params_canonicos,
+        },
+        sort_keys=True, default=str, separators=(",", ":")
+    )
+    return hashlib.sha256(contenido.encode("utf-8")).hexdigest()
+
+
+class CacheBusquedas:
+    """Caché TTL + LRU de resultados de búsqueda con contadores de aciertos/fallos."""
+
+    def __init__(self, max_entradas: int, ttl_seg: int, redis_url: Optional[str] = None):
+        self._local: TTLCache = TTLCache(maxsize=max_entradas, ttl=ttl_seg)
+        self._ttl_seg = ttl_seg
+        self._lock = threading.Lock()
+        self._version_catalogo: Optional[str] = None
+        self._redis = None
+        self.aciertos_local = 0
+        self.aciertos_compartido = 0
+        self.fallos = 0
+        self.errores_compartido = 0
+        self.invalidaciones = 0
+
+        if redis_url:
+            if redis is None:
+                logging.warning("WARN (Cache Búsquedas) ► CACHE_BUSQUEDAS_REDIS_URL definido pero 'redis' no está instalado. Solo caché local.")
+            else:
+                try:
+                    self._redis = redis.Redis.from_url(redis_url, socket_timeout=0.5, socket_connect_timeout=0.5)
+                    logging.info("✅ (Cache Búsquedas) Backend compartido Redis configurado.")
+                except Exception as e:
+                    logging.error(f"❌ (Cache Búsquedas) No se pudo configurar Redis: {e}. Solo caché local.")
+
+    def _comprobar_version(self, version_catalogo: str) -> None:
+        """Vacía la caché local si el catálogo ha cambiado desde la última búsqueda."""
+        if self._version_catalogo != version_catalogo:
+            if self._version_catalogo is not None:
+                logging.info(f"INFO (Cache Búsquedas) ► Versión de catálogo {self._version_catalogo} -> {version_catalogo}. Se invalida la caché.")
+                self.invalidaciones += 1
+            self._local.clear()
+            self._version_catalogo = version_catalogo
+
+    def obtener(self, huella: str, version_catalogo: str) -> Optional[ResultadoBusqueda]:
+        with self._lock:
+            self._comprobar_version(version_catalogo)
+            resultado = self._local.get(huella)
+            if resultado is not None:
+                self.aciertos_local += 1
+                return copy.deepcopy(resultado)
+
+        if self._redis is not None:
+            try:
+                crudo = self._redis.get(PREFIJO_CLAVE_REDIS + huella)
+                if crudo is not None:
+                    coches, sql, params = json.loads(crudo)
+                    resultado = (coches, sql, params)
+                    with self._lock:
+                        self._local[huella] = resultado
+                        self.aciertos_compartido += 1
+                    return copy.deepcopy(resultado)
+            except Exception as e:
+                with self._lock:
+                    self.errores_compartido += 1
+                logging.warning(f"WARN (Cache Búsquedas) ► Error leyendo de Redis: {e}")
+
+        with self._lock:
+            self.fallos += 1
+        return None
+
+    def guardar(self, huella: str, version_catalogo: str, resultado: ResultadoBusqueda) -> None:
+        copia = copy.deepcopy(resultado)
+        with self._lock:
+            self._comprobar_version(version_catalogo)
+            self._local[huella] = copia
+        if self._redis is not None:
+            try:
+                self._redis.set(PREFIJO_CLAVE_REDIS + huella, json.dumps(copia, default=str), ex=self._ttl_seg)
+            except Exception as e:
+                with self._lock:
+                    self.errores_compartido += 1
+                logging.warning(f"WARN (Cache Búsquedas) ► Error escribiendo en Redis: {e}")
+
+    def limpiar(self) -> None:
+        with self._lock:
+            self._local.clear()
+
+    def estadisticas(self) -> Dict[str, Any]:
+        with self._lock:
+            aciertos = self.aciertos_local + self.aciertos_compartido
+            total = aciertos + self.fallos
+            return {
+                "activa": CACHE_BUSQUEDAS_ACTIVA,
+                "backend_compartido": self._redis is not None,
+                "entradas_locales": len(self._local),
+                "max_entradas": self._local.maxsize,
+                "ttl_seg": self._ttl_seg,
+                "version_catalogo": self._version_catalogo,
+                "aciertos_local": self.aciertos_local,
+                "aciertos_compartido": self.aciertos_compartido,
+                "fallos": self.fallos,
+                "ratio_aciertos": round(aciertos / total, 4) if total else 0.0,
+                "errores_compartido": self.errores_compartido,
+                "invalidaciones": self.invalidaciones,
+            }
+
+
+# Instancia única por proceso
+cache_busquedas = CacheBusquedas(
+    max_entradas=CACHE_BUSQUEDAS_MAX_ENTRADAS,
+    ttl_seg=CACHE_BUSQUEDAS_TTL_SEG,
+    redis_url=CACHE_BUSQUEDAS_REDIS_URL,
+)
+
+
+def obtener_estadisticas_cache_busquedas() -> Dict[str, Any]:
+    return cache_busquedas.estadisticas()
@@ -0,0 +1,91 @@
+# utils/state_delta.py
+# Guarda de "deltas" para los nodos del grafo.
+#
+# Un nodo de LangGraph solo debe devolver las claves que cambia: cada clave devuelta se
+# escribe en su canal, cuenta como versión nueva y se serializa en el checkpoint. Antes
+# varios nodos devolvían {**state} o el historial completo más un mensaje, y cada turno
+# reescribía en Postgres el perfil, los filtros, los ~50 flags y todos los mensajes.
+#
+# Con GUARDA_DELTA_ESTADO=true el builder envuelve cada nodo y, tras ejecutarlo, compara
+# lo devuelto con el estado de entrada: avisa (WARN) de las claves cuyo valor no cambia y
+# de los mensajes que ya estaban en el historial. Pensado para desarrollo y para pasar
+# las conversaciones de prueba; en producción está desactivado.
+import logging
+import threading
+from typing import Any, Dict, List, Mapping
+
+logger = logging.getLogger(__name__)
+
+CLAVE_MENSAJES = "messages"
+
+
+def _mensajes_repetidos(historial: List[Any], nuevos: Any) -> int:
+    """Mensajes devueltos que ya estaban en el historial (mismo id o mismo objeto)."""
+    if not isinstance(nuevos, list):
+        nuevos = [nuevos]
+    ids = {getattr(m, "id", None) for m in historial} - {None}
+    objetos = {id(m) for m in historial}
+    return sum(1 for m in nuevos if id(m) in objetos or getattr(m, "id", None) in ids)
+
+
+def claves_sin_cambios(state: Mapping[str, Any], delta: Any) -> List[str]:
+    """
+    Claves de `delta` que no aportan nada respecto a `state`. Para "messages" se
+    informa como "messages[N repetidos]" si el nodo reenvía mensajes ya presentes.
+    """
+    if not isinstance(delta, Mapping):
+        return []
+    sin_cambios = []
+    for clave, valor in delta.items():
+        if clave == CLAVE_MENSAJES:
+            repetidos = _mensajes_repetidos(state.get(CLAVE_MENSAJES) or [], valor)
+            if repetidos:
+                sin_cambios.append(f"{CLAVE_MENSAJES}[{repetidos} repetidos]")
+            continue
+        if clave not in state:
+            continue
+        actual = state[clave]
+        try:
+            igual = actual is valor or actual == valor
+        except Exception:
+            igual = False
+        if igual:
+            sin_cambios.append(clave)
+    return sin_cambios
+
+
+class MetricasDeltaEstado:
+    """Claves redundantes devueltas por cada nodo (solo con la guarda activa)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._por_nodo: Dict[str, Dict[str, Any]] = {}
+
+    def registrar(self, nodo: str, claves_devueltas: int, sin_cambios: List[str]) -> None:
+        with self._lock:
+            m = self._por_nodo.setdefault(nodo, {"ejecuciones": 0, "claves_devueltas": 0, "claves_sin_cambios": 0, "ultimas_sin_cambios": []})
+            m["ejecuciones"] += 1
+            m["claves_devueltas"] += claves_devueltas
+            m["claves_sin_cambios"] += len(sin_cambios)
+            if sin_cambios:
+                m["ultimas_sin_cambios"] = sin_cambios
+
+    def estadisticas(self) -> Dict[str, Any]:
+        with self._lock:
+            return {nodo: {**m, "ultimas_sin_cambios": list(m["ultimas_sin_cambios"])} for nodo, m in self._por_nodo.items()}
+
+
+metricas_delta_estado = MetricasDeltaEstado()
+
+
+def verificar_delta(nodo: str, state: Mapping[str, Any], delta: Any) -> List[str]:
+    """Registra el delta de `nodo` y avisa si devuelve claves que no cambian el estado."""
+    sin_cambios = claves_sin_cambios(state, delta)
+    metricas_delta_estado.registrar(nodo, len(delta) if isinstance(delta, Mapping) else 0, sin_cambios)
+    if sin_cambios:
+        logging.warning(f"WARN (Delta Estado) ► '{nodo}' devuelve claves sin cambios: {', '.join(sin_cambios)}")
+    return sin_cambios
+
+
+def obtener_estadisticas_delta_estado() -> Dict[str, Any]:
+    return metricas_delta_estado.estadisticas()
@@ -0,0 +1,127 @@
+# utils/structured_llm_cache.py
+# Caché exacta delante de los LLMs con salida estructurada.
+#
+# recopilar_preferencias_node y recopilar_info_pasajeros_node preguntan siempre lo mismo
+# (las preguntas fijas de QUESTION_BANK) y las respuestas suelen ser cortas ("sí", "no",
+# "2"). La clave es (id del prompt, huella de TODOS los mensajes enviados —rol + contenido
+# normalizado—, respuesta del usuario): el extractor de pasajeros recibe la ventana completa
+# de la etapa y su salida puede depender de turnos anteriores, así que dos conversaciones
+# solo comparten entrada si le mandaron exactamente el mismo contexto. El valor es el objeto
+# Pydantic que devolvió el LLM. Se devuelve una copia
+# profunda, que conserva los campos "set" para que model_dump(exclude_unset=True) en los
+# nodos siga devolviendo solo el delta.
+import hashlib
+import logging
+import re
+import threading
+import unicodedata
+from typing import Any, Dict, List, Optional, Tuple
+
+from cachetools import LRUCache
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
+
+from config.settings import CACHE_LLM_ESTRUCTURADO_ACTIVA, CACHE_LLM_ESTRUCTURADO_MAX_ENTRADAS
+
+logger = logging.getLogger(__name__)
+
+_RE_ESPACIOS = re.compile(r"\s+")
+_PUNTUACION_FINAL = " .!¡?¿,;:"
+
+
+def normalizar_texto(texto: Any) -> str:
+    """Minúsculas, sin tildes, espacios colapsados y sin puntuación en los extremos."""
+    texto = str(texto or "")
+    sin_tildes = "".join(
+        c for c in unicodedata.normalize("NFKD", texto) if not unicodedata.combining(c)
+    )
+    return _RE_ESPACIOS.sub(" ", sin_tildes.lower()).strip(_PUNTUACION_FINAL)
+
+
+class LLMEstructuradoConCache:
+    """
+    Envuelve un runnable `llm.with_structured_output(...)` exponiendo invoke/ainvoke.
+    Solo cachea llamadas cuyo último mensaje es del usuario.
+    """
+
+    def __init__(self, llm_estructurado: Any, nombre: str, max_entradas: int):
+        self._llm = llm_estructurado
+        self.nombre = nombre
+        self._cache: LRUCache = LRUCache(maxsize=max_entradas)
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+
+    def _clave(self, mensajes: List[BaseMessage]) -> Optional[Tuple[str, str, str]]:
+        if not mensajes or not isinstance(mensajes[-1], HumanMessage):
+            return None
+        system = next((m.content for m in mensajes if isinstance(m, SystemMessage)), "")
+        # El id del prompt incluye su contenido: si se edita el .txt, las entradas viejas no se sirven
+        id_prompt = f"{self.nombre}:{hashlib.sha1(str(system).encode('utf-8')).hexdigest()[:12]}"
+        contexto = "\x1e".join(
+            f"{m.type}\x1f{normalizar_texto(m.content)}" for m in mensajes
+        )
+        huella_contexto = hashlib.sha1(contexto.encode("utf-8")).hexdigest()
+        return id_prompt, huella_contexto, normalizar_texto(mensajes[-1].content)
+
+    def _buscar(self, clave: Optional[Tuple[str, str, str]]) -> Any:
+        if clave is None or not CACHE_LLM_ESTRUCTURADO_ACTIVA:
+            return None
+        with self._lock:
+            resultado = self._cache.get(clave)
+            if resultado is None:
+                self.fallos += 1
+                return None
+            self.aciertos += 1
+        logging.debug(f"DEBUG (Cache LLM) ► Acierto en '{self.nombre}' para respuesta '{clave[2]}'.")
+        return resultado.model_copy(deep=True)
+
+    def _guardar(self, clave: Optional[Tuple[str, str, str]], resultado: Any) -> None:
+        if clave is None or resultado is None or not CACHE_LLM_ESTRUCTURADO_ACTIVA:
+            return
+        with self._lock:
+            self._cache[clave] = resultado.model_copy(deep=True)
+
+    def invoke(self, mensajes: List[BaseMessage], config: Optional[Dict[str, Any]] = None, **kwargs) -> Any:
+        clave = self._clave(mensajes)
+        resultado = self._buscar(clave)
+        if resultado is not None:
+            return resultado
+        resultado = self._llm.invoke(mensajes, config=config, **kwargs)
+        self._guardar(clave, resultado)
+        return resultado
+
+    async def ainvoke(self, mensajes: List[BaseMessage], config: Optional[Dict[str, Any]] = None, **kwargs) -> Any:
+        clave = self._clave(mensajes)
+        resultado = self._buscar(clave)
+        if resultado is not None:
+            return resultado
+        resultado = await self._llm.ainvoke(mensajes, config=config, **kwargs)
+        self._guardar(clave, resultado)
+        return resultado
+
+    def estadisticas(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.aciertos + self.fallos
+            return {
+                "entradas": len(self._cache),
+                "max_entradas": self._cache.maxsize,
+                "aciertos": self.aciertos,
+                "fallos": self.fallos,
+                "ratio_aciertos": round(self.aciertos / total, 4) if total else 0.0,
+            }
+
+
+_llms_con_cache: Dict[str, LLMEstructuradoConCache] = {}
+
+
+def envolver_con_cache(llm_estructurado: Any, nombre: str) -> Any:
+    """Devuelve el LLM envuelto (o None si el LLM base no se pudo crear)."""
+    if llm_estructurado is None:
+        return None
+    envuelto = LLMEstructuradoConCache(llm_estructurado, nombre, CACHE_LLM_ESTRUCTURADO_MAX_ENTRADAS)
+    _llms_con_cache[nombre] = envuelto
+    return envuelto
+
+
+def obtener_estadisticas_cache_llm() -> Dict[str, Any]:
+    return {"activa": CACHE_LLM_ESTRUCTURADO_ACTIVA, **{n: llm.estadisticas() for n, llm in _llms_con_cache.items()}}
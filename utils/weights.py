@@ -4,7 +4,10 @@ from .conversion import is_yes
 import yaml
 import math
 import logging
+import numpy as np
 from .enums import NivelAventura , FrecuenciaUso, DistanciaTrayecto,EstiloConduccion, DimensionProblematica
+from .weights_genome import obtener_genoma_pesos
+from .weights_index import NUM_PESOS, vector_multiplicadores, vector_a_dict
 from graph.perfil.state import PerfilUsuario # Importar para type hint
 # from config.settings import (altura_map, MIN_SINGLE_RAW_WEIGHT, MAX_SINGLE_RAW_WEIGHT, AJUSTE_CRUDO_SEGURIDAD_POR_NIEBLA , PESO_CRUDO_FAV_MENOR_SUPERFICIE, PESO_CRUDO_FAV_MENOR_DIAMETRO_GIRO, PESO_CRUDO_FAV_MENOR_DIMENSION_GARAJE, UMBRAL_RATING_IMPACTO_PARA_FAV_PESO_CONSUMO, UMBRAL_RATING_COSTES_USO_PARA_FAV_CONSUMO_COSTES, UMBRAL_RATING_COMODIDAD_PARA_FAVORECER, RAW_WEIGHT_BONUS_FIABILIDAD_POR_IMPACTO,
 #                             RAW_WEIGHT_ADICIONAL_FAV_BAJO_PESO_POR_IMPACTO, RAW_WEIGHT_ADICIONAL_FAV_BAJO_CONSUMO_POR_IMPACTO, RAW_WEIGHT_ADICIONAL_FAV_BAJO_CONSUMO_POR_COSTES, RAW_WEIGHT_FAV_BAJO_COSTE_USO_DIRECTO, RAW_WEIGHT_FAV_BAJO_COSTE_MANTENIMIENTO_DIRECTO,
@@ -210,183 +213,184 @@ logger = logging.getLogger(__name__)
     
 #     return final_weights
 
-def compute_raw_weights(
-    preferencias: Optional[Dict[str, Any]],
-    info_pasajeros_dict: Optional[Dict[str, Any]],
-    es_zona_nieblas: bool = False,
-    km_anuales_estimados: Optional[int] = None,
-) -> Dict[str, float]:
-    """
-    Calcula los pesos crudos (sin normalizar) para el perfil de un usuario.
-    La normalización final se realiza en un paso externo.
-    1. Suaviza los pesos base para reducir la disparidad inicial.
-    2. Ajusta los pesos según el arquetipo de conducción.
-    3. Aplica multiplicadores basados en preferencias explícitas.
-    """
-    # --- PASO 1: Carga del "Genoma" de Pesos Base ---
-    try:
-        with open('master_weights.yaml', 'r', encoding='utf-8') as f:
-            master_weights = yaml.safe_load(f)
-    except FileNotFoundError:
-        logging.error("ERROR CRÍTICO: No se encontró 'master_weights.yaml'. El cálculo de pesos no puede continuar.")
-        return {}
-    except Exception as e:
-        logging.error(f"Error al cargar o procesar 'master_weights.yaml': {e}")
-        return {}
-
-    # --- PASO 1.5: SUAVIZADO DE PESOS BASE CON RAÍZ CUADRADA ---
-    # Se aplica la transformación, pero ya NO se re-normaliza aquí.
-    master_weights = {k: math.sqrt(v) for k, v in master_weights.items()}
-    
-    preferencias = preferencias or {}
-    pasajeros_info = info_pasajeros_dict or {}
-
-    # --- PASO 2: Ajuste Dinámico de Pesos Base ---
-    dynamic_master_weights = master_weights.copy()
-    
-    estilo_input = preferencias.get("estilo_conduccion", "TRANQUILO")
-    try:
-        estilo = EstiloConduccion(estilo_input)
-    except (ValueError, NameError):
-        estilo = "TRANQUILO"
-
-    style_multipliers = {
-        "DEPORTIVO": {
-            'deportividad_style_score': 8.0,
-            'fav_menor_rel_peso_potencia_score': 2.0,
-            'potencia_maxima_style_score': 5.0,
-            'par_motor_style_score': 3.5,
-            'fav_menor_aceleracion_score': 3.5
-        },
-        "MIXTO": {
-            'deportividad_style_score':4.0,
-            'fav_menor_rel_peso_potencia_score': 1.0,
-            'potencia_maxima_style_score': 2.0,
-            'par_motor_style_score': 2.0,
-            'fav_menor_aceleracion_score': 1.5
-        }
-    }
-
-    current_style_name = estilo.name if hasattr(estilo, 'name') else estilo
-
-    if current_style_name in style_multipliers:
-        multipliers_to_apply = style_multipliers[current_style_name]
-        for key, boost_value in multipliers_to_apply.items():
-            if key in dynamic_master_weights:
-                dynamic_master_weights[key] *= boost_value
-        
-        # --- ELIMINADO ---
-        # El bloque de re-normalización que estaba aquí ha sido eliminado.
-        # total_boosted_weight = sum(dynamic_master_weights.values()) ...
-
-    # --- PASO 3: Inicialización de Multiplicadores ---
-    multiplicadores = {key: 1.0 for key in dynamic_master_weights.keys()}
-
-    # --- PASO 4: Aplicación de Reglas de Negocio (Multiplicadores) ---
-    # Esta sección se mantiene igual, aplicando los multiplicadores sobre los pesos ya "boosteados".
-    if is_yes(preferencias.get("valora_estetica")): multiplicadores['estetica'] *= 5.0
-    if is_yes(preferencias.get("apasionado_motor")):
-        multiplicadores['premium'] *= 4.0
-        multiplicadores['singular'] *= 2.0
-    if is_yes(preferencias.get("prefiere_diseno_exclusivo")): multiplicadores['singular'] *= 7.0
-    if is_yes(preferencias.get("prioriza_baja_depreciacion")): multiplicadores['devaluacion'] *= 10.0
-    if is_yes(preferencias.get("arrastra_remolque")):
-        multiplicadores['par_motor_remolque_score'] *= 10.0
-        multiplicadores['cap_remolque_cf_score'] *= 8.0
-        multiplicadores['cap_remolque_sf_score'] *=8.0
+# --- Multiplicadores como vectores del índice canónico (utils/weights_index.py) ---
+# Se construyen una vez al importar; por perfil solo se eligen los que aplican y se
+# multiplican elemento a elemento, en el mismo orden en que se aplicaban sobre el dict.
+MULTIPLICADORES_ESTILO = {
+    "DEPORTIVO": vector_multiplicadores({
+        'deportividad_style_score': 8.0,
+        'fav_menor_rel_peso_potencia_score': 2.0,
+        'potencia_maxima_style_score': 5.0,
+        'par_motor_style_score': 3.5,
+        'fav_menor_aceleracion_score': 3.5
+    }),
+    "MIXTO": vector_multiplicadores({
+        'deportividad_style_score':4.0,
+        'fav_menor_rel_peso_potencia_score': 1.0,
+        'potencia_maxima_style_score': 2.0,
+        'par_motor_style_score': 2.0,
+        'fav_menor_aceleracion_score': 1.5
+    })
+}
+
+MULT_VALORA_ESTETICA = vector_multiplicadores({'estetica': 5.0})
+MULT_APASIONADO_MOTOR = vector_multiplicadores({'premium': 4.0, 'singular': 2.0})
+MULT_DISENO_EXCLUSIVO = vector_multiplicadores({'singular': 7.0})
+MULT_BAJA_DEPRECIACION = vector_multiplicadores({'devaluacion': 10.0})
+MULT_REMOLQUE = vector_multiplicadores({'par_motor_remolque_score': 10.0, 'cap_remolque_cf_score': 8.0, 'cap_remolque_sf_score': 8.0})
+MULT_KM_MUY_ALTO = vector_multiplicadores({
+    'autonomia_uso_maxima': 5.0, 'autonomia_uso_2nd_drive': 5.0, 'menor_tiempo_carga_min': 5.0, 'potencia_maxima_carga_DC': 5.0
+})
+MULT_AVENTURA = {
+    "ocasional": vector_multiplicadores({'altura_libre_suelo': 2.5}),
+    "extrema": vector_multiplicadores({'altura_libre_suelo': 5.0}),
+}
+MULT_ALTURA_MAYOR_190 = vector_multiplicadores({'batalla': 5.0, 'indice_altura_interior': 10.0})
+MULT_PASAJEROS_FRECUENTE = vector_multiplicadores({'ancho': 3.0})
+MULT_PASAJEROS_OCASIONAL = vector_multiplicadores({'ancho': 2.0})
+MULT_CARGA_VOLUMINOSA = vector_multiplicadores({'maletero_minimo_score': 10.0, 'maletero_maximo_score': 7.0}) #15 / #10
+MULT_OBJETOS_ESPECIALES = vector_multiplicadores({'largo_vehiculo_score': 7.0, 'ancho': 3.5}) #10 / #5
+MULT_CIUDAD = vector_multiplicadores({'fav_menor_diametro_giro': 3.0})
+MULT_SIN_GARAJE_PROBLEMAS_APARCAR = vector_multiplicadores({'fav_menor_superficie_planta': 10.0})
+MULT_GARAJE_JUSTO = vector_multiplicadores({'fav_menor_diametro_giro': 2.5})
+MULT_GARAJE_DIMENSION = {
+    DimensionProblematica.LARGO: vector_multiplicadores({'fav_menor_largo_garage': 7.0}),
+    DimensionProblematica.ANCHO: vector_multiplicadores({'fav_menor_ancho_garage': 7.0}),
+    DimensionProblematica.ALTO: vector_multiplicadores({'fav_menor_alto_garage': 7.0}),
+}
+MULT_ZONA_NIEBLAS = vector_multiplicadores({'rating_seguridad': 2.5})
+
+# El clamping sigue siendo útil para evitar valores crudos absurdamente altos
+# antes de la normalización externa.
+MAX_SINGLE_RAW_WEIGHT = 100.0 # Se puede ajustar este límite si es necesario
+
+
+def _multiplicadores_preferencias(
+    preferencias: Dict[str, Any],
+    pasajeros_info: Dict[str, Any],
+    es_zona_nieblas: bool,
+    km_anuales_estimados: Optional[int],
+) -> list:
+    """Lista (en orden de aplicación) de los vectores de multiplicadores que aplican al perfil."""
+    activos = []
+    if is_yes(preferencias.get("valora_estetica")): activos.append(MULT_VALORA_ESTETICA)
+    if is_yes(preferencias.get("apasionado_motor")): activos.append(MULT_APASIONADO_MOTOR)
+    if is_yes(preferencias.get("prefiere_diseno_exclusivo")): activos.append(MULT_DISENO_EXCLUSIVO)
+    if is_yes(preferencias.get("prioriza_baja_depreciacion")): activos.append(MULT_BAJA_DEPRECIACION)
+    if is_yes(preferencias.get("arrastra_remolque")): activos.append(MULT_REMOLQUE)
 
     if km_anuales_estimados is not None and km_anuales_estimados > 60000:
-        multiplicadores['autonomia_uso_maxima'] *= 5.0
-        multiplicadores['autonomia_uso_2nd_drive'] *= 5.0
-        multiplicadores['menor_tiempo_carga_min'] *= 5.0
-        multiplicadores['potencia_maxima_carga_DC'] *= 5.0
+        activos.append(MULT_KM_MUY_ALTO)
 
     aventura_input = preferencias.get("aventura", "ninguna")
-    aventura_map = {"ocasional": 2.5, "extrema": 5.0}
-    multiplicadores['altura_libre_suelo'] *= aventura_map.get(aventura_input, 1.0)
+    if aventura_input in MULT_AVENTURA:
+        activos.append(MULT_AVENTURA[aventura_input])
+
+    if is_yes(preferencias.get("altura_mayor_190")): activos.append(MULT_ALTURA_MAYOR_190)
 
-    if is_yes(preferencias.get("altura_mayor_190")):
-        multiplicadores['batalla'] *= 5.0
-        multiplicadores['indice_altura_interior'] *= 10.0
-   
     frecuencia_pasajeros = pasajeros_info.get("frecuencia_viaje_con_acompanantes")
     num_ninos_silla = pasajeros_info.get("num_ninos_silla", 0)
     num_otros_pasajeros = pasajeros_info.get("num_otros_pasajeros", 0)
     if frecuencia_pasajeros == "frecuente" and num_otros_pasajeros >= 2:
-        multiplicadores['ancho'] *= 3.0
+        activos.append(MULT_PASAJEROS_FRECUENTE)
     elif frecuencia_pasajeros == "ocasional" and (num_ninos_silla + num_otros_pasajeros) >= 2:
-        multiplicadores['ancho'] *= 2.0
-        
+        activos.append(MULT_PASAJEROS_OCASIONAL)
+
     if is_yes(preferencias.get("transporta_carga_voluminosa")):
-        multiplicadores['maletero_minimo_score'] *= 10.0 #15
-        multiplicadores['maletero_maximo_score'] *= 7.0 #10
+        activos.append(MULT_CARGA_VOLUMINOSA)
         if is_yes(preferencias.get("necesita_espacio_objetos_especiales")):
-            multiplicadores['largo_vehiculo_score'] *= 7.0 #10
-            multiplicadores['ancho'] *= 3.5 #5
+            activos.append(MULT_OBJETOS_ESPECIALES)
+
+    if is_yes(preferencias.get("circula_principalmente_ciudad")): activos.append(MULT_CIUDAD)
 
-    if is_yes(preferencias.get("circula_principalmente_ciudad")):
-        multiplicadores['fav_menor_diametro_giro'] *= 3.0
-    
     if preferencias.get("tiene_garage") is not None:
         if not is_yes(preferencias.get("tiene_garage")): # No tiene garaje
             if is_yes(preferencias.get("problemas_aparcar_calle")):
-                multiplicadores['fav_menor_superficie_planta'] *= 10.0
-                
+                activos.append(MULT_SIN_GARAJE_PROBLEMAS_APARCAR)
         else: # Sí tiene garaje
             if not is_yes(preferencias.get("espacio_sobra_garage")):
                 print("DEBUG (Garaje) ► Detectado: 'espacio_sobra_garage' es NO.")
-                multiplicadores['fav_menor_diametro_giro'] *= 2.5
-                
-                # Obtenemos la lista de Enums
+                activos.append(MULT_GARAJE_JUSTO)
                 problema_dim = preferencias.get("problema_dimension_garage") or []
-                # --- Prints para depuración ---
                 print(f"DEBUG (Garaje) ► Valor de 'problema_dimension_garage': {problema_dim}")
-                if problema_dim:
-                    if DimensionProblematica.LARGO in problema_dim:
-                        print("DEBUG (Garaje) ► ¡CONDICIÓN LARGO CUMPLIDA! Aplicando multiplicador.")
-                        multiplicadores['fav_menor_largo_garage'] *= 7.0
-                    if DimensionProblematica.ANCHO in problema_dim:
-                        print("DEBUG (Garaje) ► ¡CONDICIÓN ANCHO CUMPLIDA! Aplicando multiplicador.")
-                        multiplicadores['fav_menor_ancho_garage'] *= 7.0
-                    if DimensionProblematica.ALTO in problema_dim:
-                        print("DEBUG (Garaje) ► ¡CONDICIÓN ALTO CUMPLIDA! Aplicando multiplicador.")
-                        multiplicadores['fav_menor_alto_garage'] *= 7.0
-    
-    if es_zona_nieblas:
-        multiplicadores['rating_seguridad'] *= 2.5
-
-    # --- PASO 5: Cálculo de Pesos Crudos Finales ---
-    # El nombre 'raw_weights' ahora es más preciso que nunca.
-    raw_weights = {
-        key: dynamic_master_weights.get(key, 0.0) * multiplicadores.get(key, 1.0)
-        for key in dynamic_master_weights
-    }
-    
-    # --- PASO 7: Clamping Final ---
-    # El clamping sigue siendo útil para evitar valores crudos absurdamente altos
-    # antes de la normalización externa.
-    MAX_SINGLE_RAW_WEIGHT = 100.0 # Se puede ajustar este límite si es necesario
-    final_raw_weights = {
-        key: max(0.0, min(value, MAX_SINGLE_RAW_WEIGHT))
-        for key, value in raw_weights.items()
-    }
-    
-    logging.debug(f"Pesos Crudos Finales (Sin Normalizar): {final_raw_weights}")
-    print(f"DEBUG (compute_raw_weights) ►► Pesos Crudos Finales (listos para normalizar): {final_raw_weights}")
-    
-    return final_raw_weights
+                for dimension, multiplicador in MULT_GARAJE_DIMENSION.items():
+                    if dimension in problema_dim:
+                        print(f"DEBUG (Garaje) ► ¡CONDICIÓN {dimension.name} CUMPLIDA! Aplicando multiplicador.")
+                        activos.append(multiplicador)
+
+    if es_zona_nieblas: activos.append(MULT_ZONA_NIEBLAS)
+    return activos
+
+
+def calcular_vector_pesos_crudos(
+    preferencias: Optional[Dict[str, Any]],
+    info_pasajeros_dict: Optional[Dict[str, Any]],
+    es_zona_nieblas: bool = False,
+    km_anuales_estimados: Optional[int] = None,
+) -> Optional[np.ndarray]:
+    """
+    Pesos crudos (sin normalizar) del perfil como vector alineado con CLAVES_PESOS.
+    Devuelve None si no hay genoma de pesos base.
+    1. Pesos base suavizados (genoma, ya con sqrt).
+    2. Multiplicadores del arquetipo de conducción.
+    3. Multiplicadores por preferencias explícitas y contexto.
+    4. Clamping a [0, MAX_SINGLE_RAW_WEIGHT].
+    """
+    # --- PASO 1: "Genoma" de Pesos Base (ya suavizado con raíz cuadrada, utils/weights_genome.py) ---
+    genoma = obtener_genoma_pesos()
+    if genoma is None:
+        return None
 
+    preferencias = preferencias or {}
+    pasajeros_info = info_pasajeros_dict or {}
 
+    # --- PASO 2: Ajuste por Arquetipo (sin re-normalizar) ---
+    estilo_input = preferencias.get("estilo_conduccion", "TRANQUILO")
+    try:
+        estilo = EstiloConduccion(estilo_input)
+    except (ValueError, NameError):
+        estilo = "TRANQUILO"
+    current_style_name = estilo.name if hasattr(estilo, 'name') else estilo
+    multiplicador_estilo = MULTIPLICADORES_ESTILO.get(current_style_name)
+    dynamic_master_weights = genoma.valores * multiplicador_estilo if multiplicador_estilo is not None else genoma.valores
+
+    # --- PASO 3 y 4: Multiplicadores de Reglas de Negocio ---
+    multiplicadores = np.ones(NUM_PESOS, dtype=np.float64)
+    for vector in _multiplicadores_preferencias(preferencias, pasajeros_info, es_zona_nieblas, km_anuales_estimados):
+        multiplicadores *= vector
+
+    # --- PASO 5 y 7: Pesos Crudos Finales y Clamping ---
+    return np.clip(dynamic_master_weights * multiplicadores, 0.0, MAX_SINGLE_RAW_WEIGHT)
+
+
+def normalizar_vector_pesos(raw_weights: np.ndarray) -> np.ndarray:
+    """Normaliza un vector de pesos crudos (o una matriz N x NUM_PESOS, por filas) para que sume 1.0."""
+    total = raw_weights.sum(axis=-1, keepdims=True)
+    return raw_weights / np.where(total == 0, 1.0, total)
+
+
+def compute_raw_weights(
+    preferencias: Optional[Dict[str, Any]],
+    info_pasajeros_dict: Optional[Dict[str, Any]],
+    es_zona_nieblas: bool = False,
+    km_anuales_estimados: Optional[int] = None,
+) -> Dict[str, float]:
+    """
+    Calcula los pesos crudos (sin normalizar) para el perfil de un usuario como dict.
+    Frontera de calcular_vector_pesos_crudos para quien necesite {clave: peso}.
+    """
+    raw_weights = calcular_vector_pesos_crudos(preferencias, info_pasajeros_dict, es_zona_nieblas, km_anuales_estimados)
+    if raw_weights is None:
+        return {}
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(f"Pesos Crudos Finales (Sin Normalizar): {vector_a_dict(raw_weights)}")
+    return vector_a_dict(raw_weights)
 
 
-# normalize_weights se mantiene igual (quizás con el DEBUG print que añadí antes)
 def normalize_weights(raw_weights: dict) -> dict:
     """Normaliza los pesos crudos para que sumen 1.0."""
-    valid_values = [v for v in raw_weights.values() if isinstance(v, (int, float))]
-    total = sum(valid_values) or 1.0 
-    logging.info(f"DEBUG (Weights) ► ► Suma Pesos Crudos: {total}")
-    normalized = {k: (v / total) if isinstance(v, (int, float)) else 0.0 for k, v in raw_weights.items()}
-    print(f"DEBUG (Normalize Weights) ► Pesos Normalizados: {normalized}")
+    valores = np.array([v if isinstance(v, (int, float)) else 0.0 for v in raw_weights.values()], dtype=np.float64)
+    logging.info(f"DEBUG (Weights) ► ► Suma Pesos Crudos: {valores.sum() or 1.0}")
+    normalized = dict(zip(raw_weights.keys(), normalizar_vector_pesos(valores).tolist()))
+    logging.debug(f"DEBUG (Normalize Weights) ► Pesos Normalizados: {normalized}")
     return normalized
-
-
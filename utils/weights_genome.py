@@ -0,0 +1,149 @@
+# utils/weights_genome.py
+# "Genoma" de pesos base (master_weights.yaml) cargado una vez por proceso.
+#
+# compute_raw_weights abría y parseaba el YAML (relativo al directorio de trabajo) en cada
+# llamada y volvía a aplicar math.sqrt a todas las claves. Ahora el fichero se parsea una
+# vez, con la raíz cuadrada ya aplicada, y se guarda en un GenomaPesos inmutable: un
+# vector NumPy de solo lectura más el índice clave -> posición. Cada
+# MASTER_WEIGHTS_INTERVALO_COMPROBACION_SEG se mira el mtime del fichero; si cambió, se
+# parsea la nueva versión y se sustituye la referencia de golpe (los cálculos en curso
+# siguen con el genoma que ya tenían). Si el YAML nuevo es inválido se conserva el anterior.
+#
+# La ruta relativa se resuelve contra la raíz del proyecto, no contra el CWD. El vector se
+# alinea con el índice canónico de utils/weights_index.py: las claves del índice que no
+# estén en el YAML valen 0 y las del YAML que no estén en el índice se ignoran (con WARN).
+import logging
+import math
+import os
+import threading
+import time
+from pathlib import Path
+from types import MappingProxyType
+from typing import Any, Dict, Mapping, Optional
+
+import numpy as np
+import yaml
+
+from config.settings import MASTER_WEIGHTS_PATH, MASTER_WEIGHTS_INTERVALO_COMPROBACION_SEG
+from utils.weights_index import CLAVES_PESOS, INDICE_PESOS, NUM_PESOS, vector_a_dict
+
+logger = logging.getLogger(__name__)
+
+RAIZ_PROYECTO = Path(__file__).resolve().parent.parent
+
+
+def ruta_master_weights() -> Path:
+    ruta = Path(MASTER_WEIGHTS_PATH)
+    return ruta if ruta.is_absolute() else RAIZ_PROYECTO / ruta
+
+
+class GenomaPesos:
+    """Pesos base suavizados (sqrt) como vector inmutable alineado con el índice canónico."""
+
+    __slots__ = ("claves", "valores", "indice", "mtime", "ruta")
+
+    def __init__(self, pesos_sqrt: Mapping[str, float], mtime: float, ruta: Path):
+        valores = np.zeros(NUM_PESOS, dtype=np.float64)
+        for clave, valor in pesos_sqrt.items():
+            valores[INDICE_PESOS[clave]] = valor
+        valores.flags.writeable = False
+        object.__setattr__(self, "claves", CLAVES_PESOS)
+        object.__setattr__(self, "valores", valores)
+        object.__setattr__(self, "indice", INDICE_PESOS)
+        object.__setattr__(self, "mtime", mtime)
+        object.__setattr__(self, "ruta", ruta)
+
+    def __setattr__(self, nombre, valor):
+        raise AttributeError("GenomaPesos es inmutable")
+
+    def __len__(self) -> int:
+        return len(self.claves)
+
+    def como_dict(self) -> Dict[str, float]:
+        """Copia mutable {clave: peso_sqrt} (solo para inspección; el cálculo usa `valores`)."""
+        return vector_a_dict(self.valores)
+
+
+def _parsear_genoma(ruta: Path) -> GenomaPesos:
+    mtime = ruta.stat().st_mtime
+    with open(ruta, "r", encoding="utf-8") as f:
+        master_weights = yaml.safe_load(f)
+    if not isinstance(master_weights, dict) or not master_weights:
+        raise ValueError(f"'{ruta.name}' no contiene un diccionario de pesos.")
+    pesos_sqrt = {}
+    for clave, valor in master_weights.items():
+        if not isinstance(valor, (int, float)) or valor < 0:
+            raise ValueError(f"Peso inválido para '{clave}': {valor!r}")
+        if clave not in INDICE_PESOS:
+            logging.warning(f"WARN (Genoma Pesos) ► '{clave}' no está en el índice de pesos (utils/weights_index.py). Se ignora.")
+            continue
+        # --- SUAVIZADO DE PESOS BASE CON RAÍZ CUADRADA (antes se hacía en cada compute_raw_weights) ---
+        pesos_sqrt[str(clave)] = math.sqrt(valor)
+    return GenomaPesos(pesos_sqrt, mtime, ruta)
+
+
+_genoma: Optional[GenomaPesos] = None
+_ultima_comprobacion = 0.0
+_recargas = 0
+_errores_recarga = 0
+_mtime_fallido: Optional[float] = None  # Para no reintentar (ni loguear) el mismo fichero roto en cada comprobación
+_lock = threading.Lock()
+
+
+def obtener_genoma_pesos() -> Optional[GenomaPesos]:
+    """
+    Devuelve el genoma vigente. Solo toca disco la primera vez y, como mucho, una vez
+    cada MASTER_WEIGHTS_INTERVALO_COMPROBACION_SEG para comprobar el mtime.
+    """
+    global _genoma, _ultima_comprobacion, _recargas, _errores_recarga, _mtime_fallido
+    genoma = _genoma
+    ahora = time.monotonic()
+    if genoma is not None and ahora - _ultima_comprobacion < MASTER_WEIGHTS_INTERVALO_COMPROBACION_SEG:
+        return genoma
+
+    with _lock:
+        if _genoma is not None and ahora - _ultima_comprobacion < MASTER_WEIGHTS_INTERVALO_COMPROBACION_SEG:
+            return _genoma
+        _ultima_comprobacion = ahora
+        ruta = ruta_master_weights()
+        mtime = None  # Sigue a None si falla el propio os.stat (p. ej. PermissionError)
+        try:
+            mtime = os.stat(ruta).st_mtime
+            if (_genoma is not None and _genoma.ruta == ruta and _genoma.mtime == mtime) or mtime == _mtime_fallido:
+                return _genoma
+            nuevo = _parsear_genoma(ruta)
+        except FileNotFoundError:
+            if _genoma is None:
+                logging.error(f"ERROR CRÍTICO: No se encontró '{ruta}'. El cálculo de pesos no puede continuar.")
+            else:
+                logging.warning(f"WARN (Genoma Pesos) ► '{ruta}' no existe. Se mantienen los pesos cargados.")
+            return _genoma
+        except Exception as e:
+            _errores_recarga += 1
+            if mtime is not None:
+                # El fichero existe pero no se pudo parsear: no reintentar hasta que cambie
+                _mtime_fallido = mtime
+            logging.error(f"Error al cargar o procesar '{ruta}': {e}. Se mantienen los pesos anteriores.")
+            return _genoma
+
+        recarga = _genoma is not None
+        _genoma = nuevo
+        if recarga:
+            _recargas += 1
+            logging.info(f"✅ (Genoma Pesos) ► '{ruta.name}' modificado: recargados {len(nuevo)} pesos base.")
+        else:
+            logging.info(f"✅ (Genoma Pesos) ► Cargados {len(nuevo)} pesos base desde '{ruta}'.")
+        return _genoma
+
+
+def obtener_estadisticas_genoma_pesos() -> Dict[str, Any]:
+    genoma = _genoma
+    return {
+        "ruta": str(ruta_master_weights()),
+        "cargado": genoma is not None,
+        "num_pesos": len(genoma) if genoma else 0,
+        "mtime": genoma.mtime if genoma else None,
+        "recargas": _recargas,
+        "errores_recarga": _errores_recarga,
+        "intervalo_comprobacion_seg": MASTER_WEIGHTS_INTERVALO_COMPROBACION_SEG,
+    }
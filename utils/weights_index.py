@@ -0,0 +1,223 @@
+# utils/weights_index.py
+# Índice canónico de pesos: un ordinal fijo por clave de peso.
+#
+# Los pesos de un perfil viajaban como dicts de ~40 claves que se multiplicaban, recortaban
+# y normalizaban con comprensiones, y buscar_coches_bq los volvía a mapear a mano a
+# pesos_completos y a ~40 ScalarQueryParameter. Ahora todo el cálculo (utils/weights.py)
+# trabaja sobre vectores float64 alineados con CLAVES_PESOS, y la conversión a dict (estado
+# del grafo) o a parámetros SQL / claves del motor NumPy se hace solo en las fronteras con
+# las tablas de este módulo. Con el mismo índice se pueden apilar N perfiles en una matriz
+# (N, NUM_PESOS) y puntuarlos de una vez.
+#
+# ⚠️ Una clave nueva en master_weights.yaml tiene que añadirse aquí (y en la query SQL).
+from types import MappingProxyType
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+import numpy as np
+
+# Orden del índice = orden de master_weights.yaml; las dos últimas no tienen peso base
+# (quedan a 0) pero la query sí las recibe como parámetro.
+CLAVES_PESOS: Tuple[str, ...] = (
+    "estetica",
+    "premium",
+    "singular",
+    "deportividad_style_score",
+    "fav_menor_rel_peso_potencia_score",
+    "potencia_maxima_style_score",
+    "par_motor_style_score",
+    "fav_menor_aceleracion_score",
+    "fav_bajo_consumo",
+    "fav_bajo_coste_uso_directo",
+    "fav_bajo_coste_mantenimiento_directo",
+    "devaluacion",
+    "fav_bajo_peso",
+    "par_motor_remolque_score",
+    "cap_remolque_cf_score",
+    "cap_remolque_sf_score",
+    "maletero_minimo_score",
+    "maletero_maximo_score",
+    "largo_vehiculo_score",
+    "fav_menor_largo_garage",
+    "fav_menor_ancho_garage",
+    "fav_menor_alto_garage",
+    "fav_menor_superficie_planta",
+    "altura_libre_suelo",
+    "fav_menor_diametro_giro",
+    "batalla",
+    "indice_altura_interior",
+    "ancho",
+    "indice_habitabilidad",
+    "autonomia_uso_maxima",
+    "autonomia_uso_2nd_drive",
+    "menor_tiempo_carga_min",
+    "potencia_maxima_carga_AC",
+    "potencia_maxima_carga_DC",
+    "rating_fiabilidad",
+    "rating_durabilidad",
+    "rating_comodidad",
+    "rating_tecnologia_conectividad",
+    "rating_seguridad",
+    "rating_impacto_ambiental",
+    "rating_costes_uso",
+)
+NUM_PESOS = len(CLAVES_PESOS)
+INDICE_PESOS: Mapping[str, int] = MappingProxyType({clave: i for i, clave in enumerate(CLAVES_PESOS)})
+
+# --- Frontera con el scoring: clave en pesos_completos -> clave de peso ---
+# Es la traducción que hacía _preparar_pesos_completos (p. ej. "ancho" -> "ancho_general_score").
+CLAVES_SCORING: Tuple[Tuple[str, str], ...] = (
+    ("estetica", "estetica"),
+    ("premium", "premium"),
+    ("singular", "singular"),
+    ("altura_libre_suelo", "altura_libre_suelo"),
+    ("batalla", "batalla"),
+    ("indice_altura_interior", "indice_altura_interior"),
+    ("ancho_general_score", "ancho"),
+    ("rating_durabilidad", "rating_durabilidad"),
+    ("rating_fiabilidad", "rating_fiabilidad"),
+    ("rating_seguridad", "rating_seguridad"),
+    ("rating_comodidad", "rating_comodidad"),
+    ("rating_impacto_ambiental", "rating_impacto_ambiental"),
+    ("rating_costes_uso", "rating_costes_uso"),
+    ("rating_tecnologia_conectividad", "rating_tecnologia_conectividad"),
+    ("devaluacion", "devaluacion"),
+    ("maletero_minimo_score", "maletero_minimo_score"),
+    ("maletero_maximo_score", "maletero_maximo_score"),
+    ("largo_vehiculo_score", "largo_vehiculo_score"),
+    ("autonomia_uso_maxima", "autonomia_uso_maxima"),
+    ("fav_bajo_peso", "fav_bajo_peso"),
+    ("fav_bajo_consumo", "fav_bajo_consumo"),
+    ("fav_bajo_coste_uso_directo", "fav_bajo_coste_uso_directo"),
+    ("fav_bajo_coste_mantenimiento_directo", "fav_bajo_coste_mantenimiento_directo"),
+    ("par_motor_remolque_score", "par_motor_remolque_score"),
+    ("cap_remolque_cf_score", "cap_remolque_cf_score"),
+    ("cap_remolque_sf_score", "cap_remolque_sf_score"),
+    ("fav_menor_superficie_planta", "fav_menor_superficie_planta"),
+    ("fav_menor_diametro_giro", "fav_menor_diametro_giro"),
+    ("fav_menor_largo_garage", "fav_menor_largo_garage"),
+    ("fav_menor_ancho_garage", "fav_menor_ancho_garage"),
+    ("fav_menor_alto_garage", "fav_menor_alto_garage"),
+    ("deportividad_style_score", "deportividad_style_score"),
+    ("fav_menor_rel_peso_potencia_score", "fav_menor_rel_peso_potencia_score"),
+    ("potencia_maxima_style_score", "potencia_maxima_style_score"),
+    ("par_motor_style_score", "par_motor_style_score"),
+    ("fav_menor_aceleracion_score", "fav_menor_aceleracion_score"),
+    ("peso_autonomia_uso_principal", "autonomia_uso_principal"),  # Sin peso base: siempre 0
+    ("peso_autonomia_uso_2nd_drive", "autonomia_uso_2nd_drive"),
+    ("peso_menor_tiempo_carga_min", "menor_tiempo_carga_min"),
+    ("peso_potencia_maxima_carga_AC", "potencia_maxima_carga_AC"),
+    ("peso_potencia_maxima_carga_DC", "potencia_maxima_carga_DC"),
+)
+
+# --- Frontera con la query: parámetro @peso_... -> clave en pesos_completos ---
+PARAMETROS_PESOS_SQL: Tuple[Tuple[str, str], ...] = (
+    ("peso_estetica", "estetica"),
+    ("peso_premium", "premium"),
+    ("peso_singular", "singular"),
+    ("peso_altura", "altura_libre_suelo"),
+    ("peso_batalla", "batalla"),
+    ("peso_indice_altura", "indice_altura_interior"),
+    ("peso_ancho_general_score", "ancho_general_score"),
+    ("peso_rating_durabilidad", "rating_durabilidad"),
+    ("peso_rating_fiabilidad", "rating_fiabilidad"),
+    ("peso_rating_seguridad", "rating_seguridad"),
+    ("peso_rating_impacto_ambiental", "rating_impacto_ambiental"),
+    ("peso_fav_bajo_coste_uso_directo", "fav_bajo_coste_uso_directo"),
+    ("peso_fav_bajo_coste_mantenimiento_directo", "fav_bajo_coste_mantenimiento_directo"),
+    ("peso_rating_tecnologia_conectividad", "rating_tecnologia_conectividad"),
+    ("peso_devaluacion", "devaluacion"),
+    ("peso_maletero_minimo_score", "maletero_minimo_score"),
+    ("peso_maletero_maximo_score", "maletero_maximo_score"),
+    ("peso_largo_vehiculo_score", "largo_vehiculo_score"),
+    ("peso_autonomia_vehiculo", "autonomia_uso_maxima"),
+    ("peso_fav_bajo_peso", "fav_bajo_peso"),
+    ("peso_fav_bajo_consumo", "fav_bajo_consumo"),
+    ("peso_par_motor_remolque_score", "par_motor_remolque_score"),
+    ("peso_cap_remolque_cf_score", "cap_remolque_cf_score"),
+    ("peso_cap_remolque_sf_score", "cap_remolque_sf_score"),
+    ("peso_fav_menor_superficie_planta", "fav_menor_superficie_planta"),
+    ("peso_fav_menor_diametro_giro", "fav_menor_diametro_giro"),
+    ("peso_fav_menor_largo_garage", "fav_menor_largo_garage"),
+    ("peso_fav_menor_ancho_garage", "fav_menor_ancho_garage"),
+    ("peso_fav_menor_alto_garage", "fav_menor_alto_garage"),
+    ("peso_deportividad_style_score", "deportividad_style_score"),
+    ("peso_fav_menor_rel_peso_potencia_score", "fav_menor_rel_peso_potencia_score"),
+    ("peso_potencia_maxima_style_score", "potencia_maxima_style_score"),
+    ("peso_par_motor_style_score", "par_motor_style_score"),
+    ("peso_autonomia_uso_principal", "peso_autonomia_uso_principal"),
+    ("peso_autonomia_uso_2nd_drive", "peso_autonomia_uso_2nd_drive"),
+    ("peso_menor_tiempo_carga_min", "peso_menor_tiempo_carga_min"),
+    ("peso_potencia_maxima_carga_AC", "peso_potencia_maxima_carga_AC"),
+    ("peso_potencia_maxima_carga_DC", "peso_potencia_maxima_carga_DC"),
+    ("peso_fav_menor_aceleracion_score", "fav_menor_aceleracion_score"),
+)
+
+
+def _indices_frontera(claves_peso) -> np.ndarray:
+    # Claves sin ordinal (autonomia_uso_principal) apuntan a la posición extra NUM_PESOS, que vale 0.
+    return np.array([INDICE_PESOS.get(clave, NUM_PESOS) for clave in claves_peso], dtype=np.intp)
+
+
+_NOMBRES_SCORING = tuple(nombre for nombre, _ in CLAVES_SCORING)
+_IDX_SCORING = _indices_frontera(clave for _, clave in CLAVES_SCORING)
+_POS_SCORING = {nombre: i for i, nombre in enumerate(_NOMBRES_SCORING)}
+_NOMBRES_PARAMETROS_SQL = tuple(nombre for nombre, _ in PARAMETROS_PESOS_SQL)
+_IDX_PARAMETROS_SQL = _IDX_SCORING[[_POS_SCORING[clave] for _, clave in PARAMETROS_PESOS_SQL]]
+
+
+def vector_multiplicadores(factores: Mapping[str, float]) -> np.ndarray:
+    """Vector de solo lectura con 1.0 en todo el índice salvo en las claves de `factores`."""
+    vector = np.ones(NUM_PESOS, dtype=np.float64)
+    for clave, factor in factores.items():
+        vector[INDICE_PESOS[clave]] = factor
+    vector.flags.writeable = False
+    return vector
+
+
+def dict_a_vector(pesos: Optional[Mapping[str, Any]]) -> np.ndarray:
+    """Pesos {clave: valor} -> vector del índice. Claves ausentes o no numéricas valen 0."""
+    vector = np.zeros(NUM_PESOS, dtype=np.float64)
+    for clave, valor in (pesos or {}).items():
+        i = INDICE_PESOS.get(clave)
+        if i is not None and isinstance(valor, (int, float)):
+            vector[i] = valor
+    return vector
+
+
+def vector_a_dict(vector: np.ndarray) -> Dict[str, float]:
+    """Vector del índice -> {clave: float} (lo que se guarda en state['pesos'])."""
+    return dict(zip(CLAVES_PESOS, vector.tolist()))
+
+
+def _valores_frontera(vector: np.ndarray, idx: np.ndarray) -> List[float]:
+    return np.append(vector, 0.0)[idx].tolist()
+
+
+def pesos_completos_desde_vector(vector: np.ndarray) -> Dict[str, float]:
+    """Vector del índice -> claves que usa el scoring (parámetros @peso_... o columnas del motor NumPy)."""
+    return dict(zip(_NOMBRES_SCORING, _valores_frontera(vector, _IDX_SCORING)))
+
+
+def parametros_pesos_sql(vector: np.ndarray) -> List[Tuple[str, float]]:
+    """Vector del índice -> [(nombre del parámetro @peso_..., valor)] en el orden de la query."""
+    return list(zip(_NOMBRES_PARAMETROS_SQL, _valores_frontera(vector, _IDX_PARAMETROS_SQL)))
+
+
+def posiciones_scoring(nombres_scoring) -> np.ndarray:
+    """
+    Posiciones en el vector del índice (ampliado con un 0 al final) de las claves de
+    pesos_completos indicadas. Con ellas, matriz_extendida[:, posiciones] da la matriz de
+    pesos en el orden de los términos del scoring.
+    """
+    return np.array([_IDX_SCORING[_POS_SCORING[nombre]] for nombre in nombres_scoring], dtype=np.intp)
+
+
+def matriz_pesos(lista_pesos: List[Optional[Mapping[str, Any]]]) -> np.ndarray:
+    """
+    Apila N perfiles de pesos en una matriz (N, NUM_PESOS + 1) alineada con el índice; la
+    última columna vale 0 (destino de las claves del scoring sin peso base).
+    """
+    matriz = np.zeros((len(lista_pesos), NUM_PESOS + 1), dtype=np.float64)
+    for i, pesos in enumerate(lista_pesos):
+        matriz[i, :NUM_PESOS] = dict_a_vector(pesos)
+    return matriz